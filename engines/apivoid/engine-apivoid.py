@@ -6,15 +6,14 @@ import os
 import sys
 import json
 import time
-import threading
-import requests
 import re
 from urllib.parse import urlparse
 from flask import Flask, request, jsonify
 
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineKeyPool import KeyPool
+from PatrowlEnginesUtils.PatrowlEngineCache import force_refresh
 
 app = Flask(__name__)
 APP_DEBUG = False
@@ -23,6 +22,7 @@ APP_PORT = 5022
 APP_MAXSCANS = int(os.environ.get('APP_MAXSCANS', 25))
 APP_ENGINE_NAME = "apivoid"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_API_URL = "https://endpoint.apivoid.com/iprep/v1/pay-as-you-go/"
 VERSIOn = "1.4.18"
 
 engine = PatrowlEngine(
@@ -34,7 +34,7 @@ engine = PatrowlEngine(
 )
 
 this = sys.modules[__name__]
-this.keys = []
+this.keypool = KeyPool([])
 
 
 @app.errorhandler(404)
@@ -105,6 +105,18 @@ def UpdateEngineStatus():
     return engine.getstatus()
 
 
+@app.route('/engines/apivoid/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/apivoid/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/apivoid/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -134,12 +146,20 @@ def _loadconfig():
     if os.path.exists(conf_file):
         json_data = open(conf_file)
         engine.scanner = json.load(json_data)
+        engine.scanner["api_url"] = os.environ.get(
+            'APIVOID_API_URL', engine.scanner.get("api_url", DEFAULT_API_URL))
 
         try:
-            this.keys = os.environ.get('APIVOID_APIKEY', engine.scanner['apikeys'][0])
+            apikey = os.environ.get('APIVOID_APIKEY', engine.scanner['apikeys'][0])
+            # Rate and quota of the apikey of the plan, if any (see PatrowlEngineKeyPool)
+            this.keypool = KeyPool(
+                [apikey], name=APP_ENGINE_NAME,
+                **engine.scanner.get("apikeys_rate", {}))
+            if "cache_ttl" in engine.scanner:
+                engine.cache.set_ttl(APP_ENGINE_NAME, engine.scanner["cache_ttl"])
             engine.scanner['status'] = "READY"
         except Exception:
-            this.keys = ""
+            this.keypool = KeyPool([])
             engine.scanner['status'] = "ERROR"
             app.logger.error("Error: No API KEY available")
             return {"status": "error", "reason": "No API KEY available"}
@@ -238,13 +258,12 @@ def start_scan():
         'scan_id': scan_id,
         'status': "STARTED",
         'started_at': int(time.time() * 1000),
-        'findings': {}
+        'findings': {},
+        'callback_url': engine.callback_url(data)
     }
 
     engine.scans.update({scan_id: scan})
-    th = threading.Thread(target=_scan_urls, args=(scan_id,))
-    th.start()
-    engine.scans[scan_id]['threads'].append(th)
+    engine.start_thread(scan_id, _scan_urls, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -262,15 +281,22 @@ def _scan_urls(scan_id):
     for asset in engine.scans[scan_id]['assets']:
         assets.append(asset)
 
+    refresh = force_refresh(engine.scans[scan_id])
     for asset in assets:
-        apikey = this.keys
         if asset not in engine.scans[scan_id]["findings"]:
             engine.scans[scan_id]["findings"][asset] = {}
-        try:
-            engine.scans[scan_id]["findings"][asset]['issues'] = get_report(scan_id, asset, apikey)
-        except Exception as ex:
-            app.logger.error("_scan_urls failed {}".format(re.sub(r'/' + apikey + '/', r'/***/', ex.__str__())))
-            return False
+        # Reports of the previous and concurrent scans, see PatrowlEngineCache
+        report = engine.cache.lookup(
+            APP_ENGINE_NAME, "iprep", asset, lambda: _fetch_report(scan_id, asset),
+            force_refresh=refresh,
+            cacheable=lambda report: report is not None and report["status_code"] == 200)
+        if report is None:
+            if engine.is_cancelled(scan_id):
+                return False
+        else:
+            with open(get_outputfile(scan_id), 'w') as output_file:
+                output_file.write(report["text"])
+        engine.scans[scan_id]["findings"][asset]['issues'] = []
 
     return True
 
@@ -284,32 +310,27 @@ def get_filename(scan_id, extension):
         extension)
 
 
-def get_findingsfile(scan_id):
-    return get_filename(scan_id, "json")
-
-
 def get_outputfile(scan_id):
     return get_filename(scan_id, "tmp")
 
 
-def get_report(scan_id, asset, apikey):
-    """Get APIvoid json report."""
-    scan_url = "https://endpoint.apivoid.com/iprep/v1/pay-as-you-go/?key={}&host={}".format(apikey, asset)
-
-    issues = []
+def _fetch_report(scan_id, asset):
+    """Get the report of an asset with the next available apikey, None if failed."""
+    apikey = this.keypool.acquire(cancel=lambda: engine.is_cancelled(scan_id))
+    if apikey is None:
+        return None
     try:
-        response = requests.get(scan_url)
-        open(get_outputfile(scan_id), 'wb').write(response.content)
+        return get_report(asset, apikey)
     except Exception as ex:
         app.logger.error("get_report failed {}".format(re.sub(r'/' + apikey + '/', r'/***/', ex.__str__())))
-        # return issues
+        return None
 
-    # tree = ElementTree.fromstring(xml.text)
-    # if tree.find("detections/engines") is not None:
-    #    for child in tree.find("detections/engines"):
-    #        issues.append(child.text)
 
-    return issues
+def get_report(asset, apikey):
+    """Get APIvoid json report."""
+    scan_url = "{}?key={}&host={}".format(engine.scanner["api_url"], apikey, asset)
+    response = engine.http.get(scan_url, api="apivoid")
+    return {"status_code": response.status_code, "text": response.text}
 
 
 def _parse_results(scan_id):
@@ -403,6 +424,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -425,20 +450,14 @@ def getfindings(scan_id):
     }
 
     scan.update(status)
-    # Store the findings in a file
-    with open(get_findingsfile(scan_id), 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues})
     res.update(status)
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
@@ -10,10 +10,12 @@ import time
 import subprocess
 import hashlib
 import optparse
-import psutil
 import logging
 from flask import Flask
-from flask import request, jsonify, redirect, url_for, send_from_directory
+from flask import request, jsonify, redirect, url_for
+from PatrowlEnginesUtils.PatrowlEngineCancel import start_process, terminate_process
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
 
 app = Flask(__name__)
 APP_DEBUG = False
@@ -26,6 +28,7 @@ this = sys.modules[__name__]
 this.proc = None
 this.scanner = {}   # Scanner info
 this.scans = {}     # Active scan list
+this.results = ResultsStore(BASE_DIR+"/results", "arachni")  # Findings reports
 requests.packages.urllib3.disable_warnings()
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -86,10 +89,9 @@ def _loadconfig():
         }
 
     # check if an instance is running, then kill and restart it
-    if hasattr(this.proc, 'pid') and psutil.pid_exists(this.proc.pid):
+    if hasattr(this.proc, 'pid') and this.proc.poll() is None:
         app.logger.info(" * Terminate PID {}".format(this.proc.pid))
-        psutil.Process(this.proc.pid).terminate()
-        time.sleep(5)
+        terminate_process(this.proc)
 
     cmd = this.scanner['path'] + "/bin/arachni_rest_server " \
         + "--address " + this.scanner['listening_host'] \
@@ -97,7 +99,8 @@ def _loadconfig():
         + " --authentication-username " + this.scanner['username'] \
         + " --authentication-password " + this.scanner['password'] \
         + " --reroute-to-logfile " + BASE_DIR + "/logs"
-    this.proc = subprocess.Popen(cmd, shell=True, stdout=open("/dev/null", "w"), stderr=open("/dev/null", "w"))
+    # Supervised (reaped when it exits) and terminated with its children on restart
+    this.proc = start_process(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     this.scanner['status'] = 'READY'
     app.logger.info(" * Arachni REST API server successfully started on http://{}:{}/"
           .format(this.scanner['listening_host'], this.scanner['listening_port']))
@@ -396,6 +399,10 @@ def stop():
 def getfindings(scan_id):
     res = {"page": "getfindings", "scan_id": scan_id}
 
+    # Next pages of a cleaned scan are served from the findings file
+    if scan_id not in this.scans.keys() and "cursor" in request.args and this.results.find(scan_id) is not None:
+        return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
+
     if not _is_scan_finished(scan_id):
         res.update({"status": "ERROR", "reason": "scan '{}' not finished".format(scan_id)})
         return jsonify(res)
@@ -433,19 +440,15 @@ def getfindings(scan_id):
     except Exception:
         this.scans[scan_id]["status"] = "ERROR"
 
-    # Store the findings in a file
-    with open(BASE_DIR+"/results/arachni_"+str(scan_id)+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    this.results.write_report(
+        scan_id, scan, issues, summary=summary, default=_json_serial,
+        assets=[app_url], delta_only=delta_only(scan))
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"issues": issues, "summary": summary, "status": "success"})
-    return jsonify(res)
+    return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
 
 def _json_serial(obj):
@@ -570,17 +573,11 @@ def _parse_report(results, asset_name, asset_host, asset_port, asset_protocol):
 
 @app.route('/engines/arachni/getreport/<scan_id>')
 def getreport(scan_id):
-    filepath = BASE_DIR+"/results/arachni_"+scan_id+".json"
-
-    if not os.path.exists(filepath):
+    if this.results.find(scan_id) is None:
         return jsonify({"status": "ERROR", "reason": "report file for scan_id '{}' not found".format(scan_id)})
 
-    #@todo
-    # return send_file(filepath,
-    #     mimetype='application/json',
-    #     attachment_filename='arachni_'+str(scan_id)+".json",
-    #     as_attachment=True)
-    return send_from_directory(BASE_DIR+"/results/", "arachni_"+scan_id+".json")
+    # Compressed reports are sent as is to the clients accepting them
+    return this.results.report_response(scan_id, request.accept_encodings)
 
 
 @app.route('/engines/arachni/test')
@@ -8,12 +8,12 @@ Licensed under the AGPLv3 License
 Written by Nicolas BEGUIER (nicolas.beguier@adevinta.com)
 """
 
-from json import dump, dumps, load, loads
+from copy import deepcopy
+from json import dumps, loads
 from logging import getLogger
 import os
 from os.path import dirname, exists, isfile, realpath
 from sys import argv, modules, path
-from threading import Thread
 from time import time, sleep
 from urllib.parse import urlparse
 
@@ -31,9 +31,9 @@ except ModuleNotFoundError:
     LOG.warning("[WARNING] You have to 'git clone https://github.com/AssuranceMaladieSec/CertStreamMonitor.git'")
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineConfig import ConfigLoader
 
 # Debug
 # from pdb import set_trace as st
@@ -61,6 +61,7 @@ engine = PatrowlEngine(
 
 this = modules[__name__]
 this.keys = []
+this.config = None
 
 def get_options(payload):
     """
@@ -93,15 +94,16 @@ def get_criticity(score):
 
 def in_whitelist(domain):
     """
-    Returns True if the domain is in the whitelist
+    Returns True if the domain (or one of its parent domains) is in the whitelist
     """
-    if not engine.scanner["options"]["Whitelist"]["present"]:
+    whitelist = this.config.derived["whitelist"]
+    if not whitelist:
         return False
-    whitelist = engine.scanner["options"]["Whitelist"]["list"]
     if domain in whitelist:
         return True
-    for white in whitelist:
-        if domain.endswith("."+white):
+    labels = domain.split(".")
+    for i in range(1, len(labels)):
+        if ".".join(labels[i:]) in whitelist:
             return True
     return False
 
@@ -170,25 +172,24 @@ def clean_scan(scan_id):
 @app.route("/engines/certstream/status")
 def status():
     """Get status on engine and all scans."""
-    CertStreamMonitorFile = engine.scanner["options"]["CertStreamMonitorFile"]["value"]
-    if not exists(CertStreamMonitorFile):
-        LOG.error("Error: CertStreamMonitorFile not found : {}".format(CertStreamMonitorFile))
-        return jsonify({"status": "error", "reason": "CertStreamMonitorFile not found : {}".format(CertStreamMonitorFile)})
+    # The CertStreamMonitor conf is parsed again only if it changed
+    res = _loadconfig()
+    if res is not None:
+        return jsonify(res)
 
-    try:
-        CONF = ConfParser(CertStreamMonitorFile)
-        engine.scanner["options"]["DBFile"] = "CertStreamMonitor/" + CONF.DBFile
-        engine.scanner["options"]["TABLEname"] = CONF.TABLEname
-        engine.scanner["options"]["SearchKeywords"] = CONF.SearchKeywords
-    except Exception:
-        LOG.error("Error: Cannot read CertStreamMonitorFile : {}".format(CertStreamMonitorFile))
-        return jsonify({"status": "error", "reason": "Cannot read CertStreamMonitorFile : {}".format(CertStreamMonitorFile)})
+    return engine.getstatus()
 
-    if not exists(engine.scanner["options"]["DBFile"]):
-        LOG.error("Error: sqlite file not found : {}".format(engine.scanner["options"]["DBFile"]))
-        return jsonify({"status": "error", "reason": "sqlite file not found : {}".format(engine.scanner["options"]["DBFile"])})
 
-    return engine.getstatus()
+@app.route("/engines/certstream/metrics")
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route("/engines/certstream/events")
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
 
 
 @app.route("/engines/certstream/status/<scan_id>")
@@ -233,48 +234,72 @@ def getreport(scan_id):
     return engine.getreport(scan_id)
 
 
-def _loadconfig():
+def _get_conf_file():
     conf_file = APP_BASE_DIR+"/certstream.json"
     if len(argv) > 1 and exists(APP_BASE_DIR+"/"+argv[1]):
         conf_file = APP_BASE_DIR + "/" + argv[1]
-    if exists(conf_file):
-        json_data = open(conf_file)
-        engine.scanner = load(json_data)
-        engine.scanner["status"] = "READY"
-    else:
-        LOG.error("Error: config file '{}' not found".format(conf_file))
-        return {"status": "error", "reason": "config file not found"}
+    return conf_file
 
-    if "options" not in engine.scanner:
-        LOG.error("Error: You have to specify options")
-        return {"status": "error", "reason": "You have to specify options"}
 
-    engine.scanner["options"]["Whitelist"]["present"] = "Whitelist" in engine.scanner["options"] and exists(engine.scanner["options"]["Whitelist"]["value"])
+def _config_files(config):
+    """Files the config depends on: a change reloads it."""
+    options = config.get("options", {})
+    return [
+        options.get("Whitelist", {}).get("value"),
+        options.get("CertStreamMonitorFile", {}).get("value"),
+    ]
 
-    with open(engine.scanner["options"]["Whitelist"]["value"], "r", encoding="UTF-8") as whitelist_file:
-        whitelist = whitelist_file.read()
-        engine.scanner["options"]["Whitelist"]["list"] = whitelist.split("\n")[:-1]
 
-    if "CertStreamMonitorFile" not in engine.scanner["options"]:
-        LOG.error("Error: You have to specify CertStreamMonitorFile in options")
-        return {"status": "error", "reason": "You have to specify CertStreamMonitorFile in options"}
+def _build_config(config):
+    """Complete the config and build the whitelist set."""
+    if "options" not in config:
+        raise ValueError("You have to specify options")
 
-    CertStreamMonitorFile = engine.scanner["options"]["CertStreamMonitorFile"]["value"]
+    whitelist = frozenset()
+    config["options"]["Whitelist"]["present"] = "Whitelist" in config["options"] and exists(config["options"]["Whitelist"]["value"])
+    with open(config["options"]["Whitelist"]["value"], "r", encoding="UTF-8") as whitelist_file:
+        config["options"]["Whitelist"]["list"] = whitelist_file.read().split("\n")[:-1]
+    if config["options"]["Whitelist"]["present"]:
+        whitelist = frozenset(config["options"]["Whitelist"]["list"])
+
+    if "CertStreamMonitorFile" not in config["options"]:
+        raise ValueError("You have to specify CertStreamMonitorFile in options")
+
+    CertStreamMonitorFile = config["options"]["CertStreamMonitorFile"]["value"]
     if not exists(CertStreamMonitorFile):
-        LOG.error("Error: CertStreamMonitorFile not found : {}".format(CertStreamMonitorFile))
-        return {"status": "error", "reason": "CertStreamMonitorFile not found : {}".format(CertStreamMonitorFile)}
+        raise ValueError("CertStreamMonitorFile not found : {}".format(CertStreamMonitorFile))
 
     LOG.info("[OK] CertStreamMonitorFile")
 
     try:
         CONF = ConfParser(CertStreamMonitorFile)
 
-        engine.scanner["options"]["DBFile"] = "CertStreamMonitor/" + CONF.DBFile
-        engine.scanner["options"]["TABLEname"] = CONF.TABLEname
-        engine.scanner["options"]["SearchKeywords"] = CONF.SearchKeywords
+        config["options"]["DBFile"] = "CertStreamMonitor/" + CONF.DBFile
+        config["options"]["TABLEname"] = CONF.TABLEname
+        config["options"]["SearchKeywords"] = CONF.SearchKeywords
     except Exception:
-        LOG.error("Error: Cannot read CertStreamMonitorFile : {}".format(CertStreamMonitorFile))
-        return {"status": "error", "reason": "Cannot read CertStreamMonitorFile : {}".format(CertStreamMonitorFile)}
+        raise ValueError("Cannot read CertStreamMonitorFile : {}".format(CertStreamMonitorFile))
+
+    return {"whitelist": whitelist}
+
+
+CONFIG = ConfigLoader(_get_conf_file(), build=_build_config, files=_config_files)
+
+
+def _loadconfig(force=False):
+    try:
+        config = CONFIG.get(force=force)
+    except PatrowlEngineExceptions:
+        LOG.error("Error: config file '{}' not found".format(CONFIG.filepath))
+        return {"status": "error", "reason": "config file not found"}
+    except Exception as e:
+        LOG.error("Error: {}".format(e))
+        return {"status": "error", "reason": str(e)}
+
+    if config is not this.config:
+        # The scans update engine.scanner["options"]: the snapshot is left as is
+        engine.scanner = dict(deepcopy(config.config), status="READY")
+        this.config = config
 
     if not exists(engine.scanner["options"]["DBFile"]):
         LOG.error("Error: sqlite file not found : {}".format(engine.scanner["options"]["DBFile"]))
@@ -283,7 +308,7 @@ def _loadconfig():
 @app.route("/engines/certstream/reloadconfig", methods=["GET"])
 def reloadconfig():
     res = {"page": "reloadconfig"}
-    _loadconfig()
+    _loadconfig(force=True)
     res.update({"config": engine.scanner})
     return jsonify(res)
 
@@ -365,7 +390,8 @@ def start_scan():
         "status":       "STARTED",
         "lock":         False,
         "started_at":   int(time() * 1000),
-        "findings":     {}
+        "findings":     {},
+        "callback_url": engine.callback_url(data)
     }
 
     options = get_options(data)
@@ -380,9 +406,7 @@ def start_scan():
     engine.scanner["options"]["since"] = options["since"]
 
     engine.scans.update({scan_id: scan})
-    thread = Thread(target=_scan_urls, args=(scan_id,))
-    thread.start()
-    engine.scans[scan_id]["threads"].append(thread)
+    engine.start_thread(scan_id, _scan_urls, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -546,6 +570,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -566,19 +594,13 @@ def getfindings(scan_id):
         "finished_at": engine.scans[scan_id]["finished_at"]
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/certstream_"+scan_id+".json", "w") as rf:
-        dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, rf, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
@@ -2,8 +2,14 @@
 # -*- coding: utf-8 -*-
 import os, sys, json, time, datetime, threading, hashlib, optparse
 from urllib.parse import urlparse
-from flask import Flask, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, request, jsonify, redirect, url_for
 from cortexapi import CortexApi, CortexException
+from PatrowlEnginesUtils.PatrowlEngineScheduler import ScanScheduler
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken
+from PatrowlEnginesUtils.PatrowlEngineCache import get_lookup_cache, force_refresh
+from PatrowlEnginesUtils.PatrowlEngineCheckpoint import get_checkpoint_store, resume_enabled
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
 
 app = Flask(__name__)
 APP_DEBUG = False
@@ -16,6 +22,10 @@ this = sys.modules[__name__]
 this.scanner = {}   # Scanner config
 this.scans = {}     # Scans list
 this.api = None     # Cortex API instance
+this.scheduler = ScanScheduler(name="cortex-worker")
+this.cache = get_lookup_cache(BASE_DIR, "cortex")  # Reports of the analyzers
+this.checkpoints = get_checkpoint_store(BASE_DIR+"/results", "cortex")  # Jobs of the scans
+this.results = ResultsStore(BASE_DIR+"/results", "cortex")  # Findings reports
 
 
 @app.route('/')
@@ -33,6 +43,7 @@ def _loadconfig():
     if os.path.exists(conf_file):
         json_data = open(conf_file)
         this.scanner = json.load(json_data)
+        this.scanner["api_url"] = os.environ.get('CORTEX_API_URL', this.scanner["api_url"])
 
         this.api = CortexApi(
             this.scanner["api_url"],
@@ -40,6 +51,9 @@ def _loadconfig():
             proxies=this.scanner["proxies"],
             cert=False)
 
+        if "cache_ttl" in this.scanner:
+            this.cache.set_ttl("cortex", this.scanner["cache_ttl"])
+
         this.scanner["status"] = "READY"
         _refresh_analyzers()
     else:
@@ -48,6 +62,15 @@ def _loadconfig():
         return {"status": "error", "reason": "config file not found"}
 
 
+def _nb_active_scans():
+    # Stopped scans no longer hold any resource
+    return len([s for s in this.scans.values() if s['status'] != "STOPPED"])
+
+
+def _is_cancelled(scan_id):
+    return scan_id not in this.scans.keys() or this.scans[scan_id]['cancel_token'].is_cancelled()
+
+
 def _refresh_analyzers():
     try:
         analyzers = this.api.get_analyzers()
@@ -77,7 +100,7 @@ def start_scan():
     res = {"page": "startscan"}
 
     # check the scanner is ready to start a new scan
-    if len(this.scans) == APP_MAXSCANS:
+    if _nb_active_scans() >= APP_MAXSCANS:
         res.update({
             "status": "error",
             "reason": "Scan refused: max concurrent active scans reached ({})".format(APP_MAXSCANS)
@@ -125,22 +148,13 @@ def start_scan():
         }})
         return jsonify(res)
 
-    scan = {
-        'assets':       data['assets'],
-        'threads':      [],
-        'jobs':         [],
-        'options':      data['options'],
-        'scan_id':      scan_id,
-        'status':       "STARTED",
-        'started_at':   int(time.time() * 1000),
-        'findings':     []
-    }
+    scan = _new_scan(scan_id, data['assets'], data['options'])
+    scan['checkpoint'] = this.checkpoints.create(
+        scan_id, {"assets": data['assets'], "options": data['options'], "scan_id": scan_id},
+        units=[_asset_unit(asset) for asset in data['assets']])
 
     this.scans.update({scan_id: scan})
-    for asset in data['assets']:
-        th = threading.Thread(target=_start_analyzes, args=(scan_id, asset["value"], asset["datatype"]))
-        th.start()
-        this.scans[scan_id]['threads'].append(th)
+    _submit_analyzes(scan_id)
 
     res.update({
         "status": "accepted",
@@ -151,6 +165,66 @@ def start_scan():
     return jsonify(res)
 
 
+def _new_scan(scan_id, assets, options):
+    return {
+        'assets':       assets,
+        'threads':      [],
+        'jobs':         [],
+        'job_lookups':  {},
+        'options':      options,
+        'scan_id':      scan_id,
+        'status':       "STARTED",
+        'started_at':   int(time.time() * 1000),
+        'findings':     [],
+        'cancel_token': CancelToken()
+    }
+
+
+def _asset_unit(asset):
+    return "{}:{}".format(asset["datatype"], asset["value"])
+
+
+def _submit_analyzes(scan_id):
+    # The assets whose analyzers were all submitted before a restart are skipped
+    checkpoint = this.scans[scan_id]['checkpoint']
+    pending = set(checkpoint.pending_units())
+    # Not finished before all its jobs are queued (see ScanScheduler.open_scan)
+    this.scheduler.open_scan(scan_id)
+    try:
+        for asset in this.scans[scan_id]['assets']:
+            if _asset_unit(asset) in pending:
+                this.scheduler.submit(scan_id, _start_analyzes, args=(scan_id, asset["value"], asset["datatype"]), criticity=asset.get("criticity"))
+    finally:
+        this.scheduler.close_scan(scan_id)
+
+
+def _resume_scans():
+    """
+        Resume the scans checkpointed by a previous process of the engine:
+        their Cortex jobs are polled again and the analyzers of their assets
+        not done are run.
+    """
+    for checkpoint in this.checkpoints.claim_orphans():
+        if not resume_enabled():
+            checkpoint.remove()
+            continue
+        scan_id = checkpoint.scan_id
+        scan = _new_scan(scan_id, checkpoint.params["assets"], checkpoint.params["options"])
+        scan['checkpoint'] = checkpoint
+        scan['findings'] = checkpoint.findings()
+        for name, lookup in checkpoint.jobs().items():
+            if name.startswith("job:"):
+                scan['jobs'].append(name[4:])
+                scan['job_lookups'][name[4:]] = tuple(lookup)
+        this.scans.update({scan_id: scan})
+        if checkpoint.finished:
+            scan['status'] = "FINISHED"
+            scan['finished_at'] = int(time.time() * 1000)
+        else:
+            scan['status'] = "SCANNING"
+            _submit_analyzes(scan_id)
+
+
 def _start_analyzes(scan_id, asset, datatype):
     analyzers = []
 
@@ -175,14 +249,35 @@ def _start_analyzes(scan_id, asset, datatype):
                 analyzers = analyzers + this.scanner["meta_analyzers"][ma]
 
     # Run all selected (unique) analyzers
+    refresh = force_refresh(this.scans[scan_id])
+    checkpoint = this.scans[scan_id]["checkpoint"]
     for analyzer in list(set(analyzers)):
+        if _is_cancelled(scan_id):
+            return False
+        lookup = ("{}/{}".format(analyzer, datatype), asset)
+        if lookup in this.scans[scan_id]["job_lookups"].values():
+            # Job submitted before a restart
+            continue
+        # Report of a previous scan, see PatrowlEngineCache
+        report = this.cache.get("cortex", lookup[0], asset, force_refresh=refresh)
+        if report is not None:
+            this.scans[scan_id]["findings"] = this.scans[scan_id]["findings"] + _parse_results(scan_id, report)
+            continue
         try:
             resp = this.api.run_analyzer(analyzer, datatype, 1, asset)
+            if _is_cancelled(scan_id):
+                # Stopped while the job was submitted
+                _clean_job(resp["id"])
+                return False
+            this.scans[scan_id]["job_lookups"][resp["id"]] = lookup
             this.scans[scan_id]["jobs"].append(resp["id"])
+            checkpoint.set_job("job:" + resp["id"], lookup)
         except CortexException as ex:
             print('[ERROR]: Failed to run analyzer: {}'.format(ex.message))
+            checkpoint.unit_failed(_asset_unit({"datatype": datatype, "value": asset}))
             return False
 
+    checkpoint.unit_done(_asset_unit({"datatype": datatype, "value": asset}), this.scans[scan_id]["findings"])
     return True
 
 
@@ -199,13 +294,14 @@ def stop_scan(scan_id):
         res.update({"status": "error", "reason": "scan '{}' is not running (status={})".format(scan_id, this.scans[scan_id]['status'])})
         return jsonify(res)
 
+    this.scans[scan_id]['cancel_token'].cancel()
+    this.scheduler.forget(scan_id)
     for job_id in this.scans[scan_id]['jobs']:
         _clean_job(job_id)
 
-    for t in this.scans[scan_id]['threads']:
-        t._Thread__stop()
     this.scans[scan_id]['status'] = "STOPPED"
     this.scans[scan_id]['finished_at'] = int(time.time() * 1000)
+    this.scans[scan_id]['checkpoint'].remove()
 
     res.update({"status": "success"})
     return jsonify(res)
@@ -227,6 +323,10 @@ def stop():
 @app.route('/engines/cortex/clean')
 def clean():
     res = {"page": "clean"}
+    for scan_id in this.scans.keys():
+        this.scans[scan_id]['cancel_token'].cancel()
+        this.scheduler.forget(scan_id)
+        this.scans[scan_id]['checkpoint'].remove()
     this.scans.clear()
     _loadconfig()
     res.update({"status": "SUCCESS"})
@@ -242,10 +342,12 @@ def clean_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
+    this.scans[scan_id]['cancel_token'].cancel()
+    this.scheduler.forget(scan_id)
     for job in this.scans[scan_id]["jobs"]:
         _clean_job(job)
 
-    this.scans.pop(scan_id)
+    this.scans.pop(scan_id)['checkpoint'].remove()
     res.update({"status": "removed"})
     return jsonify(res)
 
@@ -270,31 +372,41 @@ def scan_status(scan_id):
             r = this.api.get_job_report(job_id)
             if r["status"] in ["Success", "Failure"]:
                 this.scans[scan_id]["findings"] = this.scans[scan_id]["findings"] + _parse_results(scan_id, r)
+                lookup = this.scans[scan_id]["job_lookups"].pop(job_id, None)
+                if lookup is not None and r["status"] == "Success":
+                    this.cache.set("cortex", lookup[0], lookup[1], r)
                 this.scans[scan_id]["jobs"].remove(job_id)
+                this.scans[scan_id]["checkpoint"].save_findings(this.scans[scan_id]["findings"])
+                this.scans[scan_id]["checkpoint"].del_job("job:" + job_id)
         except CortexException as ex:
             print('[ERROR]: Failed to get job report'.format(ex.message))
 
-    all_threads_finished = False
-    for t in this.scans[scan_id]['threads']:
-        if t.isAlive():
-            this.scans[scan_id]['status'] = "SCANNING"
-            all_threads_finished = False
-            break
-        else:
+    progress = this.scheduler.progress(scan_id)
+    # No job queued: no asset, or all its assets were done before a restart
+    all_threads_finished = progress is None
+    if progress is not None:
+        this.scans[scan_id]['progress'] = progress
+        if this.scheduler.is_finished(scan_id):
             all_threads_finished = True
+        elif this.scans[scan_id]['status'] != "STOPPED":
+            this.scans[scan_id]['status'] = "SCANNING"
 
-    if all_threads_finished and len(this.scans[scan_id]['jobs']) == 0 and this.scans[scan_id]['status'] == "SCANNING":
+    if all_threads_finished and len(this.scans[scan_id]['jobs']) == 0 and this.scans[scan_id]['status'] in ["STARTED", "SCANNING"]:
         this.scans[scan_id]['status'] = "FINISHED"
         this.scans[scan_id]['finished_at'] = int(time.time() * 1000)
+        this.scans[scan_id]['checkpoint'].finish(this.scans[scan_id]['findings'])
 
-    return jsonify({"status": this.scans[scan_id]['status']})
+    res = {"status": this.scans[scan_id]['status']}
+    if progress is not None:
+        res.update({"progress": progress})
+    return jsonify(res)
 
 
 @app.route('/engines/cortex/status')
 def status():
     res = {"page": "status"}
 
-    if len(this.scans) == APP_MAXSCANS:
+    if _nb_active_scans() >= APP_MAXSCANS:
         this.scanner['status'] = "BUSY"
     else:
         this.scanner['status'] = "READY"
@@ -447,6 +559,9 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in this.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        if "cursor" in request.args and this.results.find(scan_id) is not None:
+            return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -459,21 +574,10 @@ def getfindings(scan_id):
     findings = this.scans[scan_id]["findings"]
 
     summary = {
-        "nb_issues": len(findings),
-        "nb_info": 0,
-        "nb_low": 0,
-        "nb_medium": 0,
-        "nb_high": 0,
-        "nb_critical": 0,
         "engine_name": "cortex",
         "engine_version": this.scanner["version"]
     }
 
-    # Update summary with severity counts
-    for finding in findings:
-        sev = finding["severity"]
-        summary.update({"nb_"+sev: summary["nb_"+sev] + 1})
-
     scan = {
         "scan_id": scan_id,
         "assets": this.scans[scan_id]['assets'],
@@ -483,19 +587,15 @@ def getfindings(scan_id):
         "finished_at": this.scans[scan_id]['finished_at']
     }
 
-    # store the findings in a file
-    with open(BASE_DIR+"/results/cortex_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": findings
-        }, report_file, default=_json_serial)
+    # store the findings in a file, one at a time (with the severity counters)
+    this.results.write_report(
+        scan_id, scan, findings, summary=summary, default=_json_serial,
+        assets=this.scans[scan_id]['assets'], delta_only=delta_only(this.scans[scan_id]))
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": findings, "status": "success"})
-    return jsonify(res)
+    return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
 
 def _json_serial(obj):
@@ -512,12 +612,11 @@ def _json_serial(obj):
 
 @app.route('/engines/cortex/getreport/<scan_id>')
 def getreport(scan_id):
-    filepath = BASE_DIR+"/results/cortex_"+scan_id+".json"
-
-    if not os.path.exists(filepath):
+    if this.results.find(scan_id) is None:
         return jsonify({"status": "error", "reason": "report file for scan_id '{}' not found".format(scan_id)})
 
-    return send_from_directory(BASE_DIR+"/results/", "cortex_"+scan_id+".json")
+    # Compressed reports are sent as is to the clients accepting them
+    return this.results.report_response(scan_id, request.accept_encodings)
 
 
 @app.route('/engines/cortex/test')
@@ -548,6 +647,7 @@ def main():
     if not os.path.exists(BASE_DIR+"/results"):
         os.makedirs(BASE_DIR+"/results")
     _loadconfig()
+    _resume_scans()
 
 
 if __name__ == '__main__':
@@ -17,12 +17,14 @@ try:
     from patrowlhears4py.api import PatrowlHearsApi
 except ModuleNotFoundError:
     pass
-import psutil
 
 # Own library imports
 from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken
+from PatrowlEnginesUtils.PatrowlEngineProcess import supervisor
 app = Flask(__name__)
 APP_DEBUG = False
 APP_HOST = "0.0.0.0"
@@ -48,6 +50,11 @@ engine = PatrowlEngine(
 )
 
 
+def _nb_active_scans():
+    # Stopped scans no longer hold any resource
+    return len([s for s in this.scans.values() if s["status"] != "STOPPED"])
+
+
 @app.errorhandler(PatrowlEngineExceptions)
 def handle_invalid_usage(error):
     """Invalid request usage."""
@@ -115,7 +122,7 @@ def clean_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    this.scans.pop(scan_id)
+    this.scans.pop(scan_id)["cancel_token"].cancel()
     res.update({"status": "removed"})
     return jsonify(res)
 
@@ -125,7 +132,7 @@ def status():
     """Get status on engine and all scans."""
     res = {"page": "status"}
 
-    if len(this.scans) == APP_MAXSCANS:
+    if _nb_active_scans() >= APP_MAXSCANS:
         this.scanner['status'] = "BUSY"
     else:
         this.scanner['status'] = "READY"
@@ -152,6 +159,7 @@ def status():
             "nb_findings": this.scans[scan]["nb_findings"],
         }})
     res.update({"scans": scans})
+    res.update({"processes": supervisor.stats()})
     return jsonify(res)
 
 
@@ -221,6 +229,12 @@ def test():
     return res
 
 
+@app.route('/engines/droopescan/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
 @app.route('/engines/droopescan/status/<scan_id>', methods=['GET'])
 def scan_status(scan_id):
     """Get status on scan identified by id."""
@@ -230,22 +244,29 @@ def scan_status(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
+    if this.scans[scan_id].get("findings_written") and engine.results.find(scan_id) is not None:
+        return engine.findings_response(scan_id, res)
+
     proc = this.scans[scan_id]["proc"]
 
     if this.scans[scan_id]["status"] == "ERROR":
         res.update({"status": "error", "reason": "todo"})
         return jsonify(res)
 
+    if this.scans[scan_id]["status"] == "STOPPED":
+        res.update({"status": "STOPPED"})
+        return jsonify(res)
+
     if not hasattr(proc, "pid"):
         res.update({"status": "ERROR", "reason": "No PID found"})
         return jsonify(res)
 
-    if not psutil.pid_exists(proc.pid):
+    # droopescan is reaped by the process supervisor as soon as it exits
+    if proc.poll() is not None:
         res.update({"status": "FINISHED"})
         this.scans[scan_id]["status"] = "FINISHED"
 
-    elif psutil.pid_exists(proc.pid) and \
-            psutil.Process(proc.pid).status() in ["sleeping", "running"]:
+    else:
         res.update({
             "status": "SCANNING",
             "info": {
@@ -253,11 +274,6 @@ def scan_status(scan_id):
                 "cmd": this.scans[scan_id]["proc_cmd"]}
         })
 
-    elif psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() == "zombie":
-        res.update({"status": "FINISHED"})
-        this.scans[scan_id]["status"] = "FINISHED"
-        psutil.Process(proc.pid).terminate()
-
     # return the scan parameters and the status
     #res.update({
     #    "scan": this.scans[scan_id],
@@ -331,10 +347,13 @@ def stop_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
+    # Terminate and reap the droopescan process group
+    if this.scans[scan_id]["status"] in ["STARTED", "SCANNING"]:
+        this.scans[scan_id]["status"] = "STOPPED"
+    this.scans[scan_id]["cancel_token"].cancel()
+
     proc = this.scans[scan_id]["proc"]
     if hasattr(proc, 'pid'):
-        if psutil.pid_exists(proc.pid):
-            psutil.Process(proc.pid).terminate()
         res.update({"status": "TERMINATED",
                     "details": {
                         "pid": proc.pid,
@@ -350,7 +369,7 @@ def start():
     res = {"page": "startscan"}
 
     # check the scanner is ready to start a new scan
-    if len(this.scans) == APP_MAXSCANS:
+    if _nb_active_scans() >= APP_MAXSCANS:
         res.update({
             "status": "error",
             "reason": "Scan refused: max concurrent active scans reached ({})".format(APP_MAXSCANS)
@@ -395,7 +414,8 @@ def start():
         'scan_id':      scan_id,
         'status':       "STARTED",
         'started_at':   int(time.time() * 1000),
-        'nb_findings':  0
+        'nb_findings':  0,
+        'cancel_token': CancelToken()
     }
 
     this.scans.update({scan_id: scan})
@@ -437,6 +457,8 @@ def _scan_thread(scan_id):
     app.logger.debug('Hosts set : %s', hosts)
 
     # Update status
+    if this.scans[scan_id]["status"] == "STOPPED":
+        return False
     this.scans[scan_id]["status"] = "SCANNING"
 
     # Deduplicate hosts
@@ -494,10 +516,10 @@ def _scan_thread(scan_id):
 
     this.scans[scan_id]["proc_cmd"] = "not set!!"
     with open(error_log_path, "w") as stderr:
-        this.scans[scan_id]["proc"] = subprocess.Popen(cmd_sec,
-                                                       shell=False,
-                                                       stdout=open(log_path, "w"),
-                                                       stderr=stderr)
+        # droopescan runs in its own process group, terminated if the scan is stopped
+        with open(log_path, "w") as stdout:
+            this.scans[scan_id]["proc"] = this.scans[scan_id]["cancel_token"].popen(
+                cmd_sec, shell=False, stdout=stdout, stderr=stderr)
     this.scans[scan_id]["proc_cmd"] = cmd
 
     return True
@@ -698,17 +720,22 @@ def getfindings(scan_id):
     """ Retrieve findings from scan results.  """
     res = {"page": "getfindings", "scan_id": scan_id}
     if scan_id not in this.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
+    if this.scans[scan_id].get("findings_written") and engine.results.find(scan_id) is not None:
+        return engine.findings_response(scan_id, res)
+
     proc = this.scans[scan_id]["proc"]
 
     # check if the scan is finished
     status()
 
-    if (hasattr(proc, 'pid') and
-            psutil.pid_exists(proc.pid) and
-            psutil.Process(proc.pid).status() in ["sleeping", "running"]):
+    if hasattr(proc, 'pid') and proc.poll() is None:
         res.update({"status": "error", "reason": "Scan in progress"})
         return jsonify(res)
 
@@ -723,34 +750,23 @@ def getfindings(scan_id):
         "scan_id": scan_id
     }
     summary = {
-        "nb_issues": len(issues),
-        "nb_info": len(issues),
-        "nb_low": 0,
-        "nb_medium": 0,
-        "nb_high": 0,
-        "nb_critical": 0,
         "engine_name": "droopescan",
         "engine_version": this.scanner['version']
     }
 
-    # Store the findings in a file
-    with open(BASE_DIR+"/results/droopescan_"+scan_id+".json", 'w') as report_file:
-        json.dump({"scan": scan, "summary": summary, "issues": issues},
-                  report_file, default=_json_serial)
+    # Store the findings in a file, one at a time (with the severity counters)
+    report_summary = engine.results.write_report(
+        scan_id, scan, issues, summary=summary, default=_json_serial,
+        assets=this.scans[scan_id]["assets"], delta_only=delta_only(this.scans[scan_id]))
+    this.scans[scan_id]["findings_written"] = True
+    engine.metrics.scan_findings(scan_id, report_summary["nb_issues"])
 
     # Delete the tmp hosts file (used with -iL argument upon launching Droopescan)
     hosts_filename = BASE_DIR+"/tmp/engine_droopescan_hosts_file_scan_id_{}.tmp".format(scan_id)
     if os.path.exists(hosts_filename):
         os.remove(hosts_filename)
 
-    res.update({
-        "scan": scan,
-        "summary": summary,
-        "issues": issues,
-        "status": "success"
-        })
-
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
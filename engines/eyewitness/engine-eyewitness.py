@@ -9,13 +9,12 @@ Written by Nicolas BEGUIER (nicolas.beguier@adevinta.com)
 """
 
 from datetime import datetime
-from json import dump, load, loads
+from json import load, loads
 from logging import getLogger
 import os
 from os.path import dirname, exists, realpath
 from re import search
 from subprocess import check_output, CalledProcessError, STDOUT
-from threading import Thread
 from time import time, sleep
 from urllib.parse import urlparse
 
@@ -23,7 +22,6 @@ from urllib.parse import urlparse
 from flask import Flask, request, jsonify
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
 
@@ -260,6 +258,18 @@ def status():
     return ENGINE.getstatus()
 
 
+@app.route("/engines/eyewitness/metrics")
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route("/engines/eyewitness/events")
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route("/engines/eyewitness/status/<scan_id>")
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -450,13 +460,12 @@ def start_scan():
         "status":       "STARTED",
         "lock":         False,
         "started_at":   int(time() * 1000),
-        "findings":     {}
+        "findings":     {},
+        "callback_url": ENGINE.callback_url(data)
     }
 
     ENGINE.scans.update({scan_id: scan})
-    thread = Thread(target=_scan_urls, args=(scan_id,))
-    thread.start()
-    ENGINE.scans[scan_id]["threads"].append(thread)
+    ENGINE.start_thread(scan_id, _scan_urls, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -623,6 +632,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in ENGINE.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = ENGINE.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         LOG.warning(res)
         return jsonify(res)
@@ -645,19 +658,13 @@ def getfindings(scan_id):
         "finished_at": ENGINE.scans[scan_id]["finished_at"]
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/eyewitness_"+scan_id+".json", "w") as report_file:
-        dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    ENGINE.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return ENGINE.findings_response(scan_id, res)
 
 
 @app.before_first_request
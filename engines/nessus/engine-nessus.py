@@ -4,7 +4,7 @@
 from nessrest import ness6rest, credentials
 from tinydb import TinyDB, Query, where
 from tinyrecord import transaction
-from flask import Flask, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, request, jsonify, redirect, url_for
 from werkzeug.utils import secure_filename
 from urllib.parse import urlparse
 import os
@@ -18,6 +18,10 @@ import logging
 
 # Import local report parser
 from parser import parse_report
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
+from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineCheckpoint import get_checkpoint_store, resume_enabled
 
 
 app = Flask(__name__)
@@ -34,6 +38,8 @@ table = TinyDB('db.json').table('table')
 this.nessscan = None
 this.scanner = {}
 this.scans = {}
+this.results = ResultsStore(BASE_DIR+"/results", "nessus")
+this.checkpoints = get_checkpoint_store(BASE_DIR+"/results", "nessus")
 
 
 if __name__ != '__main__':
@@ -126,6 +132,9 @@ def getfindings(scan_id):
     item = table.search(Query().scan_id == scan_id)
 
     if not item:
+        # Next pages of a cleaned scan are served from the findings file
+        if "cursor" in request.args and this.results.find(scan_id) is not None:
+            return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -161,23 +170,17 @@ def getfindings(scan_id):
     block_summary, block_issues = parse_report(report_filename, nessus_prefix, resolve_fqdn)
     ######
 
-    # Store the findings in a file
-    with open(BASE_DIR+"/results/nessus_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": item[0],
-            "summary": block_summary,
-            "issues": block_issues
-        }, report_file, default=_json_serial)
-
-    res.update({
-        "status": "success",
-        "summary": block_summary,
-        "issues": block_issues
-    })
+    # Store the findings in a file, one at a time
+    this.results.write_report(
+        scan_id, item[0], block_issues,
+        summary=block_summary,
+        default=_json_serial,
+        assets=item[0].get("assets"), delta_only=delta_only(item[0]))
+
     # Remove the scan from the active scan list
     clean_scan(scan_id)
 
-    return jsonify(res)
+    return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
 
 def _json_serial(obj):
@@ -194,15 +197,14 @@ def _json_serial(obj):
 @app.route('/engines/nessus/getreport/<scan_id>')
 def getreport(scan_id):
     scan_id = str(scan_id)
-    filepath = BASE_DIR+"/results/nessus_"+scan_id+".json"
-
-    if not os.path.exists(filepath):
+    if this.results.find(scan_id) is None:
         return jsonify({
             "status": "error",
             "reason": "report file for scan_id '{}' not found".format(scan_id)}
         )
 
-    return send_from_directory(BASE_DIR+"/results/", "nessus_"+scan_id+".json")
+    # Compressed reports are sent as is to the clients accepting them
+    return this.results.report_response(scan_id, request.accept_encodings)
 
 
 def allowed_file(filename):
@@ -371,8 +373,7 @@ def start_scan():
         #         "findings": {}
         #     }
         # })
-        with transaction(table) as tr:
-            tr.insert({
+        _insert_scan({
                 "scan_id": scan_id,
                 "scan_name": scan_name,
                 "nessscan_id": this.nessscan.res["info"]["object_id"],
@@ -447,8 +448,7 @@ def start_scan():
         #     }
         # })
 
-        with transaction(table) as tr:
-            tr.insert({
+        _insert_scan({
                     "scan_id": scan_id,
                     "scan_name": nessscan_name,
                     "nessscan_id": nessscan_id,
@@ -465,6 +465,30 @@ def start_scan():
     return jsonify(res)
 
 
+def _insert_scan(item):
+    """
+        Record a scan and checkpoint its Nessus scan ID: the scans are polled
+        from it, so that they are followed again after a restart.
+    """
+    with transaction(table) as tr:
+        tr.insert(item)
+    checkpoint = this.checkpoints.create(item["scan_id"], item)
+    checkpoint.set_job("nessscan_id", item["nessscan_id"])
+
+
+def _resume_scans():
+    """Follow again the scans checkpointed by a previous process of the engine."""
+    for checkpoint in this.checkpoints.claim_orphans():
+        if not resume_enabled():
+            checkpoint.remove()
+            continue
+        if not table.search(Query().scan_id == checkpoint.scan_id):
+            # The scans database was lost with the previous container
+            item = dict(checkpoint.params, nessscan_id=checkpoint.job("nessscan_id"), status="STARTED")
+            with transaction(table) as tr:
+                tr.insert(item)
+
+
 @app.route('/engines/nessus/stop/<scan_id>', methods=['GET'])
 def stop_scan(scan_id):
     res = {"page": "stopscan"}
@@ -487,6 +511,7 @@ def stop_scan(scan_id):
         return jsonify(res)
     with transaction(table) as tr:
             tr.update({"status": "STOPPED", "finished_at": int(time.time() * 1000)}, where('scan_id') == scan_id )
+    this.checkpoints.remove(scan_id)
 
     res.update({"status": "success", "scan": item[0]})
     return jsonify(res)
@@ -508,6 +533,8 @@ def stop():
 @app.route('/engines/nessus/clean', methods=['GET'])
 def clean():
     res = {"page": "clean"}
+    for item in table.all():
+        this.checkpoints.remove(item["scan_id"])
     table.truncate()
     _loadconfig()
     return jsonify(res)
@@ -530,6 +557,7 @@ def clean_scan(scan_id):
     #this.scans.pop(scan_id)
     with transaction(table) as tr:
         tr.remove(where('scan_id') == scan_id)
+    this.checkpoints.remove(scan_id)
     res.update({"status": "removed"})
     return jsonify(res)
 
@@ -792,6 +820,13 @@ def page_not_found(e):
     })
 
 
+@app.errorhandler(PatrowlEngineExceptions)
+def handle_invalid_usage(error):
+    response = jsonify(error.to_dict())
+    response.status_code = 404
+    return response
+
+
 @app.before_first_request
 def main():
     if not os.path.exists(BASE_DIR+"/results"):
@@ -799,6 +834,7 @@ def main():
     if not os.path.exists(BASE_DIR+"/reports"):
         os.makedirs(BASE_DIR+"/reports")
     _loadconfig()
+    _resume_scans()
 
 
 if __name__ == '__main__':
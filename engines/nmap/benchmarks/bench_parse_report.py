@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the parsing of the nmap reports.
+
+Writes a synthetic report of N hosts (open ports with service detection, a
+vulners script output and hostnames), then parses it with _parse_report
+(streaming, one host at a time) and, as a reference, loads it with ET.parse
+(the whole tree, as the parser did before). Each one runs in its own
+process: the time, the findings per second and the peak RSS are printed.
+
+Usage: python3 bench_parse_report.py [-n 100000] [-a 1000] [-f report.xml]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import optparse
+import importlib.util
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+HOST_XML = """<host starttime="{ts}" endtime="{ts}"><status state="up" reason="syn-ack" reason_ttl="0"/>
+<address addr="{ip}" addrtype="ipv4"/>
+<hostnames>
+<hostname name="host-{i}.example.com" type="user"/>
+<hostname name="host-{i}.example.com" type="PTR"/>
+</hostnames>
+<ports><extraports state="closed" count="997">
+<extrareasons reason="reset" count="997" proto="tcp" ports="1-21,23-79,81-442,444-65535"/>
+</extraports>
+<port protocol="tcp" portid="22"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="ssh" product="OpenSSH" version="8.9p1" method="probed" conf="10"><cpe>cpe:/a:openbsd:openssh:8.9p1</cpe></service></port>
+<port protocol="tcp" portid="80"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="http" product="nginx" version="1.18.0" method="probed" conf="10"><cpe>cpe:/a:igor_sysoev:nginx:1.18.0</cpe></service><script id="vulners" output="&#xa;  cpe:/a:igor_sysoev:nginx:1.18.0: &#xa;    &#x9;CVE-2021-23017&#x9;&#x9;7.5&#x9;&#x9;https://vulners.com/cve/CVE-2021-23017&#xa;    &#x9;CVE-2019-20372&#x9;&#x9;4.3&#x9;&#x9;https://vulners.com/cve/CVE-2019-20372"/></port>
+<port protocol="tcp" portid="443"><state state="filtered" reason="no-response" reason_ttl="0"/><service name="https" method="table" conf="3"/></port>
+</ports>
+<os><osmatch name="Linux 5.0 - 5.4" accuracy="95" line="64141"/></os>
+<times srtt="1000" rttvar="1000" to="100000"/>
+</host>
+"""
+
+
+def write_report(filename, nb_hosts):
+    """Write a nmap XML report of nb_hosts hosts, return its size."""
+    ts = int(time.time())
+    with open(filename, "w") as report_file:
+        report_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        report_file.write('<nmaprun scanner="nmap" args="nmap -sV -oX" start="{}" version="7.94" xmloutputversion="1.05">\n'.format(ts))
+        report_file.write('<scaninfo type="syn" protocol="tcp" numservices="1000" services="1-1000"/>\n')
+        report_file.write('<taskbegin task="Ping Scan" time="{}"/>\n'.format(ts))
+        for i in range(nb_hosts):
+            ip = "10.{}.{}.{}".format((i >> 16) & 255, (i >> 8) & 255, i & 255)
+            report_file.write(HOST_XML.format(ts=ts, ip=ip, i=i))
+        report_file.write('<runstats><finished time="{}"/><hosts up="{}" down="0" total="{}"/></runstats>\n'.format(ts, nb_hosts, nb_hosts))
+        report_file.write('</nmaprun>\n')
+    return os.path.getsize(filename)
+
+
+def _load_engine():
+    spec = importlib.util.spec_from_file_location("engine_nmap", os.path.join(BASE_DIR, "engine-nmap.py"))
+    engine = importlib.util.module_from_spec(spec)
+    sys.modules["engine_nmap"] = engine
+    spec.loader.exec_module(engine)
+    return engine
+
+
+def _assets(nb_hosts, nb_assets):
+    """Assets of the scan: hostnames and URLs of the first hosts of the report."""
+    assets = []
+    for i in range(min(nb_assets, nb_hosts)):
+        if i % 2:
+            assets.append({"value": "https://host-{}.example.com/".format(i), "datatype": "url"})
+        else:
+            assets.append({"value": "host-{}.example.com".format(i), "datatype": "domain"})
+    return assets
+
+
+def parse_report(filename, nb_hosts, nb_assets):
+    engine = _load_engine()
+    engine.this.scans["bench"] = engine._new_scan("bench", _assets(nb_hosts, nb_assets), {})
+    nb_findings = 0
+    size = 0
+    for issue in engine._parse_report(filename, "bench"):
+        nb_findings += 1
+        size += len(json.dumps(issue))
+    return {"findings": nb_findings, "bytes": size}
+
+
+def load_tree(filename, nb_hosts, nb_assets):
+    tree = ET.parse(filename)
+    return {"hosts": len(tree.findall("host"))}
+
+
+def _run(func, args, conn):
+    start = time.perf_counter()
+    result = func(*args)
+    result["elapsed"] = time.perf_counter() - start
+    # KB on Linux
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    conn.send(result)
+    conn.close()
+
+
+def bench(func, *args):
+    """Run func in a new process, return its result with its time and peak RSS."""
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=_run, args=(func, args, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--nb-hosts", type="int", default=100000,
+                      help="Number of hosts of the report [default %default]")
+    parser.add_option("-a", "--nb-assets", type="int", default=1000,
+                      help="Number of assets of the scan [default %default]")
+    parser.add_option("-f", "--file", default="/tmp/bench_nmap_report.xml",
+                      help="Report written [default %default]")
+    parser.add_option("-k", "--keep", action="store_true", help="Keep the report written")
+    options, _ = parser.parse_args()
+
+    size = write_report(options.file, options.nb_hosts)
+    print("{} hosts, {} assets: {:.1f} MB report".format(options.nb_hosts, options.nb_assets, size / 1e6))
+    try:
+        args = (options.file, options.nb_hosts, options.nb_assets)
+        result = bench(parse_report, *args)
+        print("{:<24} {:>8.2f} s {:>10.0f} findings/s {:>10.1f} MB peak RSS".format(
+            "_parse_report", result["elapsed"], result["findings"] / result["elapsed"], result["max_rss_mb"]))
+        result = bench(load_tree, *args)
+        print("{:<24} {:>8.2f} s {:>21} {:>10.1f} MB peak RSS".format(
+            "ET.parse (tree only)", result["elapsed"], "", result["max_rss_mb"]))
+    finally:
+        if not options.keep:
+            os.remove(options.file)
+
+
+if __name__ == '__main__':
+    main()
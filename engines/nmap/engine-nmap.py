@@ -3,7 +3,6 @@
 import os
 import subprocess
 import sys
-import psutil
 import json
 import optparse
 import threading
@@ -11,17 +10,36 @@ import urllib
 import time
 import hashlib
 import datetime
+import re
+import heapq
+import ipaddress
 from shlex import split
 from urllib.parse import urlparse
-from copy import deepcopy
-from flask import Flask, request, jsonify, redirect, url_for, send_file
+from flask import Flask, Response, request, jsonify, redirect, url_for
 import xml.etree.ElementTree as ET
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
+from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken
+from PatrowlEnginesUtils.PatrowlEngineProcess import supervisor
+from PatrowlEnginesUtils.PatrowlEngineMetrics import EngineMetrics
+from PatrowlEnginesUtils.PatrowlEngineCheckpoint import get_checkpoint_store, resume_enabled
+from PatrowlEnginesUtils.PatrowlEngineCache import get_lookup_cache, force_refresh
+from PatrowlEnginesUtils.PatrowlEngineCveIndex import get_cve_index
 
 app = Flask(__name__)
 APP_DEBUG = False
 APP_HOST = "0.0.0.0"
 APP_PORT = 5001
 APP_MAXSCANS = int(os.environ.get('APP_MAXSCANS', 25))
+NMAP_STATS_EVERY = os.environ.get('APP_NMAP_STATS_EVERY', "10s")
+# Two-phase scans ('discovery' option): host discovery, then port scans of the live hosts
+NMAP_DISCOVERY_ARGS = "-sn -PE -PP -PS21,22,23,25,80,110,139,443,445,3389,8080 -PA80,443"
+NMAP_DISCOVERY_TTL = int(os.environ.get('APP_NMAP_DISCOVERY_TTL', 3600))
+NMAP_BATCH_DURATION = int(os.environ.get('APP_NMAP_BATCH_DURATION', 300))
+NMAP_BATCH_INITIAL_SIZE = 64
+NMAP_BATCH_MIN_SIZE = 16
+NMAP_BATCH_MAX_SIZE = 4096
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 this = sys.modules[__name__]
@@ -29,9 +47,28 @@ this.proc = None  # to delete
 this.scanner = {}
 this.scan_id = 1
 this.scans = {}
+this.metrics = EngineMetrics("nmap")
+this.results = ResultsStore(BASE_DIR+"/results", "nmap")
+this.metrics.register_scans(this.scans)
+this.checkpoints = get_checkpoint_store(BASE_DIR+"/results", "nmap")
+this.cache = get_lookup_cache(BASE_DIR, "nmap", ttls={"nmap": NMAP_DISCOVERY_TTL}, metrics=this.metrics)  # Live hosts
+this.cve_index = None  # CVEs of the CPEs detected (see loadconfig)
+
+# Lines of the reports salvaged or being written (see _read_report_line)
+_NMAPRUN_RE = re.compile(r'<nmaprun\b[^>]*\bstart="([^"]*)"')
+_TASK_RE = re.compile(r'<(taskbegin|taskprogress|taskend)\b([^>]*)/>')
+_XML_ATTR_RE = re.compile(r'(\w+)="([^"]*)"')
+_HOST_START_RE = re.compile(r"<host\b")
+# Targets in the nmap range syntax (e.g. 192.168.0-1.1-254): their live hosts are not cached
+_NMAP_RANGE_RE = re.compile(r"^[0-9.]*[,*-][0-9.,*-]*$")
 
 
 # Generic functions
+def _nb_active_scans():
+    # Stopped scans no longer hold any resource
+    return len([s for s in this.scans.values() if s["status"] != "STOPPED"])
+
+
 def shellquote(s):
     return "'" + s.replace("'", "'\\''") + "'"
 
@@ -60,6 +97,10 @@ def loadconfig():
         json_data = open(conf_file)
         this.scanner = json.load(json_data)
         this.scanner['status'] = "READY"
+        if "discovery_cache_ttl" in this.scanner:
+            this.cache.set_ttl("nmap", this.scanner["discovery_cache_ttl"])
+        # Offline CVE index, if built (see PatrowlEngineCveIndex)
+        this.cve_index = get_cve_index(this.scanner.get("cve_index", BASE_DIR+"/data/nvd_cves.db"))
     else:
         this.scanner['status'] = "ERROR"
         # print ("Error: config file '{}' not found".format(conf_file))
@@ -83,7 +124,7 @@ def start():
     res = {"page": "startscan"}
 
     # check the scanner is ready to start a new scan
-    if len(this.scans) == APP_MAXSCANS:
+    if _nb_active_scans() >= APP_MAXSCANS:
         res.update({
             "status": "error",
             "reason": "Scan refused: max concurrent active scans reached ({})".format(APP_MAXSCANS)
@@ -91,7 +132,7 @@ def start():
         return jsonify(res)
 
     # update scanner status
-    status()
+    _update_scanner_status()
 
     if this.scanner['status'] != "READY":
         res.update({
@@ -124,28 +165,66 @@ def start():
     if type(data['options']) == str:
         data['options'] = json.loads(data['options'])
 
-    scan = {
-        'assets':       data['assets'],
+    scan = _new_scan(scan_id, data['assets'], data['options'])
+    scan['checkpoint'] = this.checkpoints.create(
+        scan_id, {"assets": data['assets'], "options": data['options'], "scan_id": scan_id})
+
+    this.scans.update({scan_id: scan})
+    this.metrics.scan_started(scan_id)
+    _start_scan_thread(scan_id)
+
+    res.update({
+        "status": "accepted",
+        "details": {"scan_id": scan['scan_id']}
+    })
+
+    return jsonify(res)
+
+
+def _new_scan(scan_id, assets, options):
+    return {
+        'assets':       assets,
         'threads':      [],
         'proc':         None,
-        'options':      data['options'],
+        'options':      options,
         'scan_id':      scan_id,
         'status':       "STARTED",
         'started_at':   int(time.time() * 1000),
-        'nb_findings':  0
+        'nb_findings':  0,
+        'cancel_token': CancelToken(),
+        # Reports tailed while nmap runs, and the issues of their hosts done
+        'tails':        {},
+        'partial':      {"nb_findings": 0},
+        'tail_lock':    threading.Lock()
     }
 
-    this.scans.update({scan_id: scan})
+
+def _start_scan_thread(scan_id):
     th = threading.Thread(target=_scan_thread, args=(scan_id,))
     th.start()
     this.scans[scan_id]['threads'].append(th)
 
-    res.update({
-        "status": "accepted",
-        "details": {"scan_id": scan['scan_id']}
-    })
 
-    return jsonify(res)
+def _resume_scans():
+    """
+        Resume the scans checkpointed by a previous process of the engine:
+        nmap continues from its log ('--resume') instead of starting again.
+    """
+    for checkpoint in this.checkpoints.claim_orphans():
+        if not resume_enabled():
+            checkpoint.remove()
+            continue
+        scan_id = checkpoint.scan_id
+        scan = _new_scan(scan_id, checkpoint.params["assets"], checkpoint.params["options"])
+        scan['checkpoint'] = checkpoint
+        scan['resumed'] = True
+        this.scans.update({scan_id: scan})
+        this.metrics.scan_started(scan_id)
+        if checkpoint.finished:
+            scan['status'] = "FINISHED"
+            this.metrics.scan_finished(scan_id)
+        else:
+            _start_scan_thread(scan_id)
 
 
 def _scan_thread(scan_id):
@@ -153,6 +232,8 @@ def _scan_thread(scan_id):
 
     for asset in this.scans[scan_id]['assets']:
         if asset["datatype"] not in this.scanner["allowed_asset_types"]:
+            # No nmap process to wait for: the scan ends here
+            this.scans[scan_id]["status"] = "ERROR"
             return jsonify({
                 "status": "refused",
                 "details": {
@@ -165,30 +246,337 @@ def _scan_thread(scan_id):
             else:
                 hosts.append(asset["value"].strip())
 
-    # ensure no duplicates
-    hosts = list(set(hosts))
+    # Sanitize args :
+    # options = json.loads(this.scans[scan_id]['options'])
+    options = this.scans[scan_id]['options']
+
+    if "host_file_path" in options:  # /!\ @todo / Security issue: Sanitize parameters here
+        if os.path.isfile(options.get("host_file_path")):
+            with open(options.get("host_file_path"), 'r') as f:
+                hosts.extend(line.strip() for line in f if line.strip())
+
+    # ensure no duplicates (in a stable order: a resumed nmap reads the same hosts file)
+    hosts = list(dict.fromkeys(hosts))
+
+    app.logger.debug('options: %s', options)
+
+    scan = this.scans[scan_id]
+    checkpoint = scan["checkpoint"]
+    if options.get("discovery") and not options.get("no_ping"):
+        return _two_phase_scan(scan_id, hosts)
+
+    nb_shards = checkpoint.job("shards") or _nb_shards(options)
+    shards = _split_hosts(hosts, nb_shards) if nb_shards > 1 else []
+    if len(shards) <= 1:
+        _write_hosts_file(scan_id, None, hosts)
+        return _run_nmap(scan_id, None)
+
+    # Sharded scan: one nmap process per part of the hosts, run in parallel
+    # (up to the max number of nmap processes of the supervisor)
+    checkpoint.set_job("shards", len(shards))
+    checkpoint.add_units(["shard-{}".format(shard) for shard in range(len(shards))])
+    scan["shards"] = {}
+    for shard, (shard_hosts, nb_addresses) in enumerate(shards):
+        _write_hosts_file(scan_id, shard, shard_hosts)
+        scan["shards"][shard] = {
+            "shard": shard, "status": "WAITING", "nb_addresses": nb_addresses, "pid": None}
+
+    threads = []
+    for shard in range(len(shards)):
+        if checkpoint.is_done("shard-{}".format(shard)):
+            scan["shards"][shard]["status"] = "FINISHED"
+            continue
+        th = threading.Thread(target=_run_nmap, args=(scan_id, shard))
+        th.start()
+        threads.append(th)
+    for th in threads:
+        th.join()
+
+    return _finish_shards(scan_id, range(len(shards)))
+
+
+def _finish_shards(scan_id, shards):
+    """Merge the reports of the shards of a scan (unless it was stopped), then remove their files."""
+    scan = this.scans[scan_id]
+    if scan["status"] not in ["STARTED", "SCANNING"] or scan["cancel_token"].is_cancelled():
+        return False
+    # Not tailed anymore once merged
+    with scan["tail_lock"]:
+        _merge_reports(scan_id, shards)
+        scan["checkpoint"].finish()
+        scan["status"] = "FINISHED"
+        this.metrics.scan_finished(scan_id)
+        for shard in list(shards) + ["discovery"]:
+            for path in _nmap_paths(scan_id, shard).values():
+                if os.path.exists(path):
+                    os.remove(path)
+    return True
+
+
+def _two_phase_scan(scan_id, hosts):
+    """
+        Scan the live hosts only: a host discovery pass (see _discover_hosts),
+        then port scans of the live hosts (without discovery, -Pn) in batches
+        sized to last about APP_NMAP_BATCH_DURATION seconds each, run by up
+        to 'shards' parallel nmap processes.
+    """
+    scan = this.scans[scan_id]
+    checkpoint = scan["checkpoint"]
+    scan["shards"] = {}
+    scan["phase"] = "discovery"
+    live_hosts = checkpoint.job("live_hosts")
+    if live_hosts is None:
+        live_hosts = _discover_hosts(scan_id, hosts)
+        if live_hosts is None:
+            return False
+        checkpoint.set_job("live_hosts", live_hosts)
+    scan["nb_live_hosts"] = len(live_hosts)
+    scan["phase"] = "ports"
+
+    cmd = _nmap_cmd(scan["options"])
+    if " -Pn" not in cmd:
+        cmd += " -Pn"
+    # Batches of a previous run of the scan: {batch: [first host, last host + 1]}
+    batches = checkpoint.job("batches") or {}
+    pending = [(batch, bounds) for batch, bounds in batches.items() if not checkpoint.is_done("shard-" + batch)]
+    batching = {
+        "next_host": max([end for _, end in batches.values()] or [0]),
+        "size": NMAP_BATCH_INITIAL_SIZE, "nb_hosts": 0, "elapsed": 0.0,
+        "lock": threading.Lock()}
+
+    def _next_batch():
+        with batching["lock"]:
+            if pending:
+                return pending.pop(0)
+            if batching["next_host"] >= len(live_hosts) or scan["cancel_token"].is_cancelled():
+                return None
+            batching["size"] = _batch_size(batching["size"], batching["nb_hosts"], batching["elapsed"])
+            bounds = [batching["next_host"], min(batching["next_host"] + batching["size"], len(live_hosts))]
+            batching["next_host"] = bounds[1]
+            batch = "b{}".format(len(batches))
+            batches[batch] = bounds
+            checkpoint.set_job("batches", batches)
+            checkpoint.add_unit("shard-" + batch)
+            return batch, bounds
+
+    def _scan_batches():
+        while True:
+            next_batch = _next_batch()
+            if next_batch is None:
+                return
+            batch, (first, end) = next_batch
+            _write_hosts_file(scan_id, batch, live_hosts[first:end])
+            scan["shards"][batch] = {
+                "shard": batch, "status": "WAITING", "nb_addresses": end - first, "pid": None}
+            started_at = time.time()
+            if not _run_nmap(scan_id, batch, cmd=cmd):
+                return
+            with batching["lock"]:
+                batching["nb_hosts"] += end - first
+                batching["elapsed"] += time.time() - started_at
+
+    for batch, (first, end) in batches.items():
+        if checkpoint.is_done("shard-" + batch):
+            scan["shards"][batch] = {
+                "shard": batch, "status": "FINISHED", "nb_addresses": end - first, "pid": None}
+    threads = [threading.Thread(target=_scan_batches) for _ in range(max(1, _nb_shards(scan["options"])))]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    return _finish_shards(scan_id, list(batches))
+
+
+def _batch_size(size, nb_hosts, elapsed):
+    """
+        Return the size of the next batch of hosts: to last about
+        NMAP_BATCH_DURATION, from the time per host of the batches done (at
+        most twice the previous size).
+    """
+    if nb_hosts and elapsed > 0:
+        size = min(int(NMAP_BATCH_DURATION * nb_hosts / elapsed), 2 * size)
+    return max(NMAP_BATCH_MIN_SIZE, min(size, NMAP_BATCH_MAX_SIZE))
+
+
+def _discovery_cmd(options):
+    """Return the nmap command of the host discovery of a scan (ping scan)."""
+    cmd = this.scanner['path'] + " -vvv " + this.scanner.get("discovery_args", NMAP_DISCOVERY_ARGS)
+    for opt_key in ["no_dns", "aggressive_scan", "slow_scan"]:
+        if options.get(opt_key) and opt_key in this.scanner['options']:
+            cmd += " {}".format(this.scanner['options'][opt_key]['value'])
+    return cmd
+
+
+def _discover_hosts(scan_id, targets):
+    """
+        Return the live hosts of the targets of a scan (hostnames or IPs),
+        None if the scan was stopped. The live hosts of each target are
+        cached ('discovery_ttl' option, else the TTL of the engine): only the
+        targets not cached are scanned, by one nmap ping scan.
+    """
+    scan = this.scans[scan_id]
+    options = scan["options"]
+    cmd = _discovery_cmd(options)
+    # The same targets scanned with other probes are discovered again
+    endpoint = "discovery:" + cmd
+    refresh = force_refresh(scan)
+
+    live_hosts = []
+    unknown_targets = []
+    for target in targets:
+        cached = this.cache.get("nmap", endpoint, target, force_refresh=refresh)
+        if cached is None:
+            unknown_targets.append(target)
+        else:
+            live_hosts.extend(cached)
+    if not unknown_targets:
+        return list(dict.fromkeys(live_hosts))
+
+    _write_hosts_file(scan_id, "discovery", unknown_targets)
+    scan["shards"]["discovery"] = {
+        "shard": "discovery", "status": "WAITING", "nb_addresses": _split_hosts(unknown_targets, 1)[0][1], "pid": None}
+    if not _run_nmap(scan_id, "discovery", cmd=cmd):
+        return None
+
+    targets_index = _targets_index(unknown_targets)
+    discovered = {target: [] for target in unknown_targets}
+    with scan["tail_lock"]:
+        for host in _iter_report_hosts(_nmap_paths(scan_id, "discovery")["report"], {}):
+            if host.find("status") is None or host.find("status").get("state") != "up":
+                continue
+            addr = host.find("address").get("addr")
+            names = [h.get("name") for h in host.iter("hostname") if h.get("type") == "user"]
+            # Hostnames are scanned by name, as their asset
+            live_host = names[0] if names else addr
+            target = _host_target(targets_index, names[0] if names else None, addr)
+            if target is not None:
+                discovered[target].append(live_host)
+            live_hosts.append(live_host)
+
+    ttl = options.get("discovery_ttl")
+    for target, target_hosts in discovered.items():
+        if not _NMAP_RANGE_RE.match(target):
+            this.cache.set("nmap", endpoint, target, target_hosts, ttl=ttl)
+    return list(dict.fromkeys(live_hosts))
+
+
+def _targets_index(targets):
+    """Return the targets by name or IP, and the networks (CIDR) by IP version and prefix length."""
+    names = {}
+    networks = {}
+    for target in targets:
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            names[target.lower()] = target
+            continue
+        if network.num_addresses == 1:
+            names[str(network.network_address)] = target
+        else:
+            networks.setdefault((network.version, network.prefixlen), {})[network] = target
+    return names, networks
+
+
+def _host_target(targets_index, hostname, addr):
+    """Return the target of a host found by the discovery (see _targets_index), None if unknown."""
+    names, networks = targets_index
+    if hostname is not None and hostname.lower() in names:
+        return names[hostname.lower()]
+    if addr in names:
+        return names[addr]
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return None
+    for (version, prefixlen), version_networks in networks.items():
+        if version != ip.version:
+            continue
+        target = version_networks.get(ipaddress.ip_network("{}/{}".format(addr, prefixlen), strict=False))
+        if target is not None:
+            return target
+    return None
+
+
+def _nb_shards(options):
+    """
+        Return the number of nmap processes of a scan: its 'shards' option,
+        or the number of cores if it is true (but not a number).
+    """
+    shards = options.get("shards", 1)
+    if shards is True:
+        return os.cpu_count() or 1
+    try:
+        return int(shards)
+    except (TypeError, ValueError):
+        return 1
+
+
+def _split_hosts(hosts, nb_shards):
+    """
+        Split the hosts of a scan into up to nb_shards parts of about the
+        same number of addresses, return [(hosts, nb_addresses)]. The largest
+        networks (CIDR) are split in halves until there are enough targets.
+    """
+    # Heap of the targets, the largest first: (-nb_addresses, position, host, network)
+    targets = []
+    for position, host in enumerate(hosts):
+        try:
+            network = ipaddress.ip_network(host, strict=False) if "/" in host else None
+        except ValueError:
+            network = None
+        targets.append((-network.num_addresses if network is not None else -1, position, host, network))
+    heapq.heapify(targets)
+    position = len(targets)
+    while targets and len(targets) < nb_shards:
+        size, _, _, network = targets[0]
+        if network is None or size > -2:
+            break
+        heapq.heappop(targets)
+        for subnet in network.subnets(prefixlen_diff=1):
+            heapq.heappush(targets, (-subnet.num_addresses, position, str(subnet), subnet))
+            position += 1
+
+    # The largest targets first, each in the shard with the fewest addresses
+    shards = [[[], 0] for _ in range(min(nb_shards, len(targets)))]
+    sizes = [(0, shard) for shard in range(len(shards))]
+    for size, position, host, _ in sorted(targets):
+        nb_addresses, shard = heapq.heappop(sizes)
+        shards[shard][0].append((position, host))
+        shards[shard][1] -= size
+        heapq.heappush(sizes, (nb_addresses - size, shard))
+    return [([host for _, host in sorted(shard_hosts)], nb_addresses) for shard_hosts, nb_addresses in shards]
+
+
+def _nmap_paths(scan_id, shard=None):
+    """Return the files of the nmap process of a scan, or of one of its shards."""
+    name = scan_id if shard is None else "{}_{}".format(scan_id, shard)
+    return {
+        "hosts": BASE_DIR+"/tmp/engine_nmap_hosts_file_scan_id_{}.tmp".format(name),
+        "report": BASE_DIR+"/results/nmap_" + name + ".xml",
+        # Grepable output: log of the hosts done, to resume the scan after a restart
+        "resume": BASE_DIR+"/results/nmap_" + name + ".gnmap",
+        "log": BASE_DIR+"/logs/" + name + ".error",
+    }
+
 
+def _write_hosts_file(scan_id, shard, hosts):
     # write hosts in a file (cleaner and doesn't break with shell arguments limit (for thousands of hosts)
-    hosts_filename = BASE_DIR+"/tmp/engine_nmap_hosts_file_scan_id_{}.tmp".format(scan_id)
+    hosts_filename = _nmap_paths(scan_id, shard)["hosts"]
     with open(hosts_filename, 'w') as hosts_file:
         for item in hosts:
             hosts_file.write("%s\n" % item)
             app.logger.debug('asset: %s', item)
 
-    # Sanitize args :
-    # options = json.loads(this.scans[scan_id]['options'])
-    options = this.scans[scan_id]['options']
 
+def _nmap_cmd(options):
+    """Return the nmap command of the options of a scan, less its outputs and targets."""
     ports = None
     if "ports" in options:
         ports = ",".join(options['ports'])
     # del this.scans[scan_id]['options']['ports']
 
-    app.logger.debug('options: %s', options)
-
-    log_path = BASE_DIR+"/logs/" + scan_id + ".error"
-
-    cmd = this.scanner['path'] + " -vvv" + " -oX " +BASE_DIR+"/results/nmap_" + scan_id + ".xml"
+    cmd = this.scanner['path'] + " -vvv"
 
     # Check options
     for opt_key in options.keys():
@@ -202,29 +590,121 @@ def _scan_thread(scan_id):
             cmd += " --script {}".format(options.get(opt_key))
         if opt_key == "script_args":  # /!\ @todo / Security issue: Sanitize parameters here
             cmd += " --script-args {}".format(options.get(opt_key))
-        if opt_key == "host_file_path":  # /!\ @todo / Security issue: Sanitize parameters here
-            if os.path.isfile(options.get(opt_key)):
-                with open(options.get(opt_key), 'r') as f:
-                    with open(hosts_filename, 'a') as hosts_file:
-                        for line in f:
-                            hosts_file.write(line)
-
-    cmd += " -iL " + hosts_filename
+    return cmd
+
+
+def _run_nmap(scan_id, shard=None, cmd=None):
+    """
+        Run the nmap process of a scan (or of one of its shards) until it
+        exits, return False if the scan was stopped meanwhile. A process
+        interrupted by a restart of the engine continues from its log.
+        cmd: the nmap command (less its outputs and targets), else the one
+        of the options of the scan.
+    """
+    scan = this.scans[scan_id]
+    checkpoint = scan["checkpoint"]
+    paths = _nmap_paths(scan_id, shard)
+    resume_job = "resume_file" if shard is None else "resume_file:{}".format(shard)
+
+    if cmd is None:
+        cmd = _nmap_cmd(scan['options'])
+    # Progress of the tasks written in the XML report (taskprogress)
+    cmd += " --stats-every " + NMAP_STATS_EVERY
+    cmd += " -oX " + paths["report"] + " -oG " + paths["resume"]
+    cmd += " -iL " + paths["hosts"]
     app.logger.debug('cmd: %s', cmd)
 
     cmd_sec = split(cmd)
 
-    this.scans[scan_id]["proc_cmd"] = "not set!!"
-    with open(log_path, "w") as stderr:
-        this.scans[scan_id]["proc"] = subprocess.Popen(cmd_sec, shell=False, stdout=open("/dev/null", "w"), stderr=stderr)
-    this.scans[scan_id]["proc_cmd"] = cmd
+    if checkpoint.job(resume_job) and os.path.exists(paths["resume"]):
+        # Continue after the last host done (same output files and hosts file)
+        cmd = "{} --resume {}".format(this.scanner['path'], paths["resume"])
+        cmd_sec = split(cmd)
+    else:
+        checkpoint.set_job(resume_job, paths["resume"])
+
+    if shard is None:
+        scan["proc_cmd"] = "not set!!"
+    else:
+        checkpoint.unit_started("shard-{}".format(shard))
+    with open(paths["log"], "a" if scan.get("resumed") else "w") as stderr:
+        # nmap runs in its own process group, terminated if the scan is stopped
+        proc = scan["cancel_token"].popen(
+            cmd_sec, shell=False, stdout=subprocess.DEVNULL, stderr=stderr)
+    if proc is None:
+        # Stopped while waiting for a free nmap slot
+        if shard is not None:
+            scan["shards"][shard]["status"] = "STOPPED"
+        return False
+    if shard is None:
+        scan["proc"] = proc
+        scan["proc_cmd"] = cmd
+    else:
+        scan["shards"][shard].update({"status": "SCANNING", "pid": proc.pid, "cmd": cmd})
+    if scan["status"] == "STARTED":
+        scan["status"] = "SCANNING"
+
+    # Wait for nmap (reaped by the process supervisor): the status requests
+    # only read the status set by this thread
+    returncode = scan["cancel_token"].wait_process(proc)
+    if shard is not None:
+        if returncode is None:
+            scan["shards"][shard]["status"] = "STOPPED"
+            return False
+        if returncode == 0:
+            scan["shards"][shard]["status"] = "FINISHED"
+            checkpoint.unit_done("shard-{}".format(shard))
+        else:
+            # Its hosts done are reported anyway
+            scan["shards"][shard]["status"] = "ERROR"
+            checkpoint.unit_failed("shard-{}".format(shard))
+        return True
+
+    if scan["status"] == "SCANNING":
+        checkpoint.finish()
+        scan["status"] = "FINISHED"
+        this.metrics.scan_finished(scan_id)
 
     return True
 
 
+def _merge_reports(scan_id, shards):
+    """Write the report of a sharded scan: the hosts of the reports of its shards, in one nmaprun."""
+    report_filename = _nmap_paths(scan_id)["report"]
+    header_written = False
+    with open(report_filename + ".tmp", "w") as report_file:
+        report_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        for shard in shards:
+            shard_report = _nmap_paths(scan_id, shard)["report"]
+            if not os.path.exists(shard_report):
+                continue
+            run = {}
+            for host in _iter_report_hosts(shard_report, run):
+                if not header_written:
+                    # Start time of the first shard reporting hosts
+                    _write_nmaprun_header(report_file, run)
+                    header_written = True
+                host.tail = "\n"
+                report_file.write(ET.tostring(host, encoding="unicode"))
+        if not header_written:
+            _write_nmaprun_header(report_file, {"start": str(int(time.time()))})
+        report_file.write("</nmaprun>\n")
+    os.replace(report_filename + ".tmp", report_filename)
+
+
+def _write_nmaprun_header(report_file, run):
+    report_file.write('<nmaprun scanner="nmap" start="{}">\n'.format(run.get("start") or ""))
+    if run.get("taskbegin"):
+        report_file.write('<taskbegin task="Shards" time="{}"/>\n'.format(run["taskbegin"]))
+
+
 @app.route('/engines/nmap/clean')
 def clean():
     res = {"page": "clean"}
+    for scan_id, scan in this.scans.items():
+        scan["cancel_token"].cancel()
+        scan["checkpoint"].remove()
+        this.metrics.scan_removed(scan_id)
     this.scans.clear()
     loadconfig()
     res.update({"status": "SUCCESS"})
@@ -240,7 +720,10 @@ def clean_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    this.scans.pop(scan_id)
+    scan = this.scans.pop(scan_id)
+    scan["cancel_token"].cancel()
+    scan["checkpoint"].remove()
+    this.metrics.scan_removed(scan_id)
     res.update({"status": "removed"})
     return jsonify(res)
 
@@ -266,22 +749,36 @@ def stop_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
+    # Terminate and reap the nmap process group
+    if this.scans[scan_id]["status"] in ["STARTED", "SCANNING"]:
+        this.scans[scan_id]["status"] = "STOPPED"
+    this.scans[scan_id]["cancel_token"].cancel()
+    this.scans[scan_id]["checkpoint"].remove()
+
     proc = this.scans[scan_id]["proc"]
     if hasattr(proc, 'pid'):
-        # his.proc.terminate()
-        # proc.kill()
-        # os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-        if psutil.pid_exists(proc.pid):
-            psutil.Process(proc.pid).terminate()
         res.update({"status": "TERMINATED",
             "details": {
                 "pid": proc.pid,
                 "cmd": this.scans[scan_id]["proc_cmd"],
                 "scan_id": scan_id}
         })
+    elif this.scans[scan_id].get("shards"):
+        # Every shard is terminated with the scan
+        res.update({"status": "TERMINATED",
+            "details": {
+                "pids": [s["pid"] for s in this.scans[scan_id]["shards"].values() if s["pid"] is not None],
+                "scan_id": scan_id}
+        })
     return jsonify(res)
 
 
+@app.route('/engines/nmap/metrics')
+def getmetrics():
+    # Not named 'metrics': it would replace this.metrics (module global)
+    return this.metrics.response()
+
+
 @app.route('/engines/nmap/status/<scan_id>')
 def scan_status(scan_id):
     res = {"page": "status", "status": "UNKNOWN"}
@@ -289,55 +786,69 @@ def scan_status(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    proc = this.scans[scan_id]["proc"]
+    scan = this.scans[scan_id]
 
-    if this.scans[scan_id]["status"] == "ERROR":
+    if scan["status"] == "ERROR":
         res.update({"status": "error", "reason": "todo"})
         return jsonify(res)
 
-    if not hasattr(proc, "pid"):
-        res.update({"status": "ERROR", "reason": "No PID found"})
+    if scan["status"] in ["STOPPED", "FINISHED"]:
+        res.update({"status": scan["status"]})
         return jsonify(res)
 
-    if not psutil.pid_exists(proc.pid):
-        res.update({"status": "FINISHED"})
-        this.scans[scan_id]["status"] = "FINISHED"
-
-    elif psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() in ["sleeping", "running"]:
+    # STARTED or SCANNING: nmap is running (or about to)
+    res.update({"status": "SCANNING"})
+    # Progress of nmap (--stats-every) and hosts done, read from its report
+    res.update(_scan_progress(scan_id))
+    if scan["proc"] is not None:
         res.update({
-            "status": "SCANNING",
             "info": {
-                "pid": proc.pid,
-                "cmd": this.scans[scan_id]["proc_cmd"]}
+                "pid": scan["proc"].pid,
+                "cmd": scan["proc_cmd"]}
         })
-    elif psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() == "zombie":
-        res.update({"status": "FINISHED"})
-        this.scans[scan_id]["status"] = "FINISHED"
-        psutil.Process(proc.pid).terminate()
-        # Check for errors
-        # log_path = BASE_DIR+"/logs/" + scan_id +".error"
-        #
-        # if os.path.isfile(log_path) and os.stat(log_path).st_size != 0:
-        #     error = open(log_path, 'r')
-        #     res.update({
-        #         "status" : "error",
-        #         "details": {
-        #             "error_output" : error.read(),
-        #             "scan_id": scan_id,
-        #             "cmd": this.scans[scan_id]["proc_cmd"] }
-        #     })
-        #     stop()
-        #     os.remove(log_path)
-        #     res.update({"status": "READY"})
-
     return jsonify(res)
 
 
-@app.route('/engines/nmap/status')
-def status():
-    res = {"page": "status"}
+def _shards_status(shards, nb_addresses=None):
+    """
+        Return the progress of a sharded scan (its shards weighted by their
+        number of addresses, of nb_addresses if given) and the status of its
+        shards.
+    """
+    if nb_addresses is None:
+        nb_addresses = sum(s["nb_addresses"] for s in shards)
+    nb_done = 0.0
+    counts = {}
+    processes = []
+    for shard in shards:
+        counts[shard["status"]] = counts.get(shard["status"], 0) + 1
+        tail = shard.get("tail") or {}
+        if shard["status"] in ["FINISHED", "ERROR"]:
+            progress = 100.0
+        elif shard["status"] == "SCANNING":
+            progress = tail.get("percent") or 0.0
+        else:
+            progress = 0.0
+        nb_done += shard["nb_addresses"] * progress / 100
+        processes.append({
+            "shard": shard["shard"], "status": shard["status"], "pid": shard["pid"],
+            "nb_addresses": shard["nb_addresses"], "progress": progress,
+            "task": tail.get("task"), "eta": tail.get("etc"), "nb_hosts_done": tail.get("nb_hosts", 0)})
+    etas = [p["eta"] for p in processes if p["status"] == "SCANNING" and p["eta"]]
+    return {
+        "progress": round(100.0 * nb_done / nb_addresses, 1) if nb_addresses else 0.0,
+        # Of the shards running (those waiting for a slot are not known)
+        "eta": max(etas) if etas else None,
+        "nb_hosts_done": sum(p["nb_hosts_done"] for p in processes),
+        "info": {
+            "shards": counts,
+            "processes": processes,
+        }
+    }
 
-    if len(this.scans) == APP_MAXSCANS:
+
+def _update_scanner_status():
+    if _nb_active_scans() >= APP_MAXSCANS:
         this.scanner['status'] = "BUSY"
     else:
         this.scanner['status'] = "READY"
@@ -351,15 +862,20 @@ def status():
             app.logger.error("NMAP engine not found (%s)",this.scanner['path'])
             this.scanner['status'] = "ERROR"
 
+
+@app.route('/engines/nmap/status')
+def status():
+    res = {"page": "status"}
+
+    _update_scanner_status()
     res.update({"status": this.scanner['status']})
 
     # display info on the scanner
     res.update({"scanner": this.scanner})
 
-    # display the status of scans performed
+    # display the status of scans performed (set by their thread)
     scans = {}
-    for scan in this.scans.keys():
-        scan_status(scan)
+    for scan in list(this.scans.keys()):
         scans.update({scan: {
             "status": this.scans[scan]["status"],
             # "proc_cmd": this.scans[scan]["proc_cmd"],
@@ -368,14 +884,14 @@ def status():
             "nb_findings": this.scans[scan]["nb_findings"],
         }})
     res.update({"scans": scans})
+    res.update({"processes": supervisor.stats()})
     return jsonify(res)
 
 
 @app.route('/engines/nmap/info')
 def info():
     scans = {}
-    for scan in this.scans.keys():
-        scan_status(scan)
+    for scan in list(this.scans.keys()):
         scans.update({scan: {
             "status": this.scans[scan]["status"],
             "options": this.scans[scan]["options"],
@@ -390,13 +906,15 @@ def info():
     return jsonify(res)
 
 
-def _add_issue(scan_id, target, ts, title, desc, type, severity="info", confidence="certain", vuln_refs={}, links=[], tags=[], risk={}):
-    this.scans[scan_id]["nb_findings"] = this.scans[scan_id]["nb_findings"] + 1
+def _add_issue(counter, target, ts, title, desc, type, severity="info", confidence="certain", vuln_refs={}, links=[], tags=[], risk={}):
+    # counter: the scan, or the partial findings of a running scan
+    counter["nb_findings"] = counter["nb_findings"] + 1
     issue = {
-        "issue_id": this.scans[scan_id]["nb_findings"],
+        "issue_id": counter["nb_findings"],
         "severity": severity,
         "confidence": confidence,
-        "target": target,
+        # The target of a host is updated for each of its ports
+        "target": dict(target),
         "title": title,
         "description": desc,
         "solution": "n/a",
@@ -413,221 +931,431 @@ def _add_issue(scan_id, target, ts, title, desc, type, severity="info", confiden
     return issue
 
 
-def _parse_report(filename, scan_id):
-    """Parse the nmap report."""
-    res = []
-    target = {}
+def _iter_report_hosts(filename, run):
+    """
+        Yield the <host> elements of a nmap report one at a time, cleared
+        once the next one is read. 'run' (dict) gets the 'start' time of the
+        nmap run and of its first task ('taskbegin'), if found.
+        The report of a resumed scan is the truncated output of the first
+        nmap run followed by the output of '--resume': it is then read again
+        line by line, its complete hosts not yet yielded are yielded.
+    """
+    nb_hosts = 0
     try:
-        tree = ET.parse(filename)
-    except Exception:
-        # No Element found in XML file
-        return {"status": "ERROR", "reason": "no issues found"}
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(filename, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                    run["start"] = elem.get("start")
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if elem.tag == "taskbegin":
+                run.setdefault("taskbegin", elem.get("time"))
+            elif elem.tag == "host":
+                nb_hosts += 1
+                yield elem
+            del root[:]
+        return
+    except ET.ParseError:
+        pass
+
+    with open(filename) as report_file:
+        for line in report_file:
+            host = _read_report_line(line, run)
+            if host is None:
+                continue
+            if nb_hosts > 0:
+                # Already yielded before the end of the first run
+                nb_hosts -= 1
+                continue
+            yield host
+
+
+def _read_report_line(line, run):
+    """
+        Read a line of a nmap XML report, salvaged or being written: update
+        'run' (start time, progress of the current task), return the <host>
+        element completed by this line, if any. A host not complete (end of
+        the first run of a resumed scan) is dropped.
+    """
+    if "start" not in run:
+        nmaprun = _NMAPRUN_RE.search(line)
+        if nmaprun is not None:
+            run["start"] = nmaprun.group(1)
+    task = _TASK_RE.search(line)
+    if task is not None:
+        attrs = dict(_XML_ATTR_RE.findall(task.group(2)))
+        run["task"] = attrs.get("task")
+        if task.group(1) == "taskbegin":
+            run.setdefault("taskbegin", attrs.get("time"))
+            run.update({"percent": 0.0, "remaining": None, "etc": None})
+        elif task.group(1) == "taskprogress":
+            run.update({
+                "percent": float(attrs.get("percent") or 0),
+                "remaining": int(attrs["remaining"]) if attrs.get("remaining") else None,
+                "etc": int(attrs["etc"]) if attrs.get("etc") else None})
+        else:
+            run.update({"percent": 100.0, "remaining": 0, "etc": None})
+
+    host_start = _HOST_START_RE.search(line)
+    if host_start is not None:
+        run["host_lines"] = [line[host_start.start():]]
+    elif run.get("host_lines") is not None:
+        run["host_lines"].append(line)
+    if run.get("host_lines") is None or "</host>" not in line:
+        return None
+    host_xml = "".join(run.pop("host_lines"))
+    try:
+        return ET.fromstring(host_xml[:host_xml.index("</host>") + len("</host>")])
+    except ET.ParseError:
+        return None
+
+
+def _tail_report(scan_id, shard=None, partial=True):
+    """
+        Read what nmap appended to the XML report of a scan (or of one of
+        its shards) since the last call: the progress of its current task
+        (--stats-every) is updated, and the issues of the hosts completed
+        meanwhile are appended to the partial findings of the scan (if
+        'partial'). Return the state of the tail. Called with the
+        'tail_lock' of the scan.
+    """
+    scan = this.scans[scan_id]
+    tail = scan["tails"].setdefault(shard, {"offset": 0, "nb_hosts": 0})
+    report_filename = _nmap_paths(scan_id, shard)["report"]
+    if not os.path.exists(report_filename):
+        return tail
+
+    state = scan["partial"]
+    if "url_assets" not in state:
+        state["url_assets"] = _url_assets_index(scan["assets"])
+    issues = []
+    with open(report_filename, "rb") as report_file:
+        report_file.seek(tail["offset"])
+        for line in report_file:
+            if not line.endswith(b"\n"):
+                # Being written: read again next time
+                break
+            tail["offset"] += len(line)
+            host = _read_report_line(line.decode("utf-8", "replace"), tail)
+            if host is None:
+                continue
+            tail["nb_hosts"] += 1
+            if not partial:
+                continue
+            ts = tail.get("taskbegin") or tail.get("start")
+            issues.extend(_host_issues(scan_id, state, host, ts, state["url_assets"], set()))
+
+    if issues or not state.get("written"):
+        with open(_partial_findings_path(scan_id), "a" if state.get("written") else "w") as partial_file:
+            for issue in issues:
+                partial_file.write(json.dumps(issue, default=_json_serial) + "\n")
+        state["written"] = True
+    return tail
+
+
+def _partial_findings_path(scan_id):
+    return BASE_DIR+"/results/nmap_{}.partial.json".format(scan_id)
+
+
+def _scan_progress(scan_id):
+    """Return the progress of a running scan, from the reports being written by nmap."""
+    scan = this.scans[scan_id]
+    with scan["tail_lock"]:
+        if not scan.get("shards"):
+            tail = _tail_report(scan_id)
+            return {
+                "progress": tail.get("percent") or 0.0,
+                "task": tail.get("task"),
+                "eta": tail.get("etc"),
+                "remaining": tail.get("remaining"),
+                "nb_hosts_done": tail["nb_hosts"],
+                "nb_partial_findings": scan["partial"]["nb_findings"],
+            }
+        for shard in scan["shards"].values():
+            if shard["status"] != "WAITING":
+                # The hosts found by the discovery are scanned next
+                shard["tail"] = _tail_report(scan_id, shard["shard"], partial=shard["shard"] != "discovery")
+        if scan.get("phase") == "ports":
+            # Two-phase scan: the live hosts scanned
+            progress = _shards_status(
+                [s for s in scan["shards"].values() if s["shard"] != "discovery"], scan["nb_live_hosts"])
+        else:
+            progress = _shards_status(list(scan["shards"].values()))
+        if scan.get("phase"):
+            progress["phase"] = scan["phase"]
+        progress["nb_partial_findings"] = scan["partial"]["nb_findings"]
+        return progress
 
-    if tree.find("taskbegin") is not None:
-        ts = tree.find("taskbegin").get("time")
-    else:
-        ts = tree.getroot().get("start")
 
-    unidentified_assets = set([a["value"] for a in this.scans[scan_id]["assets"]])
+def _url_assets_index(assets):
+    """Return {netloc: [(position, value)]} of the url assets of a scan."""
+    index = {}
+    for position, asset in enumerate(assets):
+        if asset["datatype"] == "url":
+            index.setdefault(urlparse(asset["value"]).netloc, []).append((position, asset["value"]))
+    return index
 
-    for host in tree.findall('host'):
+
+def _parse_report(filename, scan_id):
+    """Parse the nmap report, yield its issues (one host at a time)."""
+    run = {}
+    hosts = _iter_report_hosts(filename, run)
+    url_assets = _url_assets_index(this.scans[scan_id]["assets"])
+    asset_values = [a["value"] for a in this.scans[scan_id]["assets"]]
+    unidentified_assets = set(asset_values)
+    ts = None
+
+    for host in hosts:
         #  get startdate of the host scan
         #  ts = host.get('starttime')
-
-        addr_list = []
-        addr_type = host.find('address').get('addrtype')
-
-        has_hostnames = False
-        # Find hostnames
-        for hostnames in host.findall('hostnames'):
-            # for hostname in hostnames.getchildren():
-            for hostname in list(hostnames):
-                if hostname.get("type") in ["user", "PTR"]:
-                    has_hostnames = True
-                    addr = hostname.get("name")
-                    addr_list.append(hostname.get("name"))
-
-        # Get IP address otherwise
-        if not has_hostnames:
-            addr = host.find('address').get('addr')
-            addr_list.append(addr)
-
-        # Check if it was extracted from URLs. If yes: add them
-        for a in this.scans[scan_id]["assets"]:
-            if a["datatype"] == "url" and urlparse(a["value"]).netloc in addr_list:
-                addr_list.append(a["value"])
-
-        # Initialize the 'target' value
-        target = {
-            "addr": addr_list,
-            "addr_type": addr_type,
-        }
-
-        if has_hostnames:
-            for hostnames in host.findall('hostnames'):
-                for hostname in list(hostnames):
-                    res.append(deepcopy(_add_issue(scan_id, target, ts,
-                        "Host '{}' has ip: '{}'".format(hostname.get('name'),host.find('address').get('addr')),
-                        "The scan detected that the host {} has IP '{}'".format(hostname.get('name'), host.find('address').get('addr')),
-                        type="host_availability")))
-
-
-        # Add the addr_list to identified_assets (post exec: spot unresolved assets)
-        unidentified_assets = unidentified_assets.difference(set(addr_list))
-
-        # get host status
-        status = host.find('status').get('state')
-        if status and status == "up":
-            res.append(deepcopy(_add_issue(scan_id, target, ts,
-                "Host '{}' is up".format(addr),
-                "The scan detected that the host {} was up".format(addr),
-                type="host_availability")))
-        else:
-            res.append(deepcopy(_add_issue(scan_id, target, ts,
-                "Host '{}' is down".format(addr),
-                "The scan detected that the host {} was down".format(addr),
-                type="host_availability")))
-
-        # get OS information
-        if host.find('os') is not None:
-            osinfo = host.find('os').find('osmatch')
-            if osinfo is not None:
-                res.append(deepcopy(_add_issue(scan_id, target, ts,
-                    "OS: {}".format(osinfo.get('name')),
-                    "The scan detected that the host run in OS '{}' (accuracy={}%)"
-                        .format(osinfo.get('name'), osinfo.get('accuracy')),
-                    type="host_osinfo",
-                    confidence="undefined")))
-
-        # get ports status - generate issues
-        if host.find('ports') is not None:
-            openports = False
-            for port in host.find('ports'):
-                # for port in host.find('ports'):
-                if port.tag == 'extraports':
-                    continue
-                proto = port.get('protocol')
-                portid = port.get('portid')
-                port_state = port.find('state').get('state')
-
-                target.update({
-                    "protocol": proto,
-                    "port_id": portid,
-                    "port_state": port_state})
-
-                if port_state not in ["filtered", "closed"]:
-                    openports = True
-                    res.append(deepcopy(_add_issue(scan_id, target, ts,
-                    "Port '{}/{}' is {}".format(proto, portid, port_state),
-                    "The scan detected that the port '{}/{}' was {}".format(
-                        proto, portid, port_state),
-                    type="port_status")))
-
-                # get service information if available
-                if port.find('service') is not None and port.find('state').get('state') not in ["filtered", "closed"]:
-                    svc_name = port.find('service').get('name')
-                    target.update({"service": svc_name})
-
-                    # Check if a CPE has been identified
-                    cpe_info = ""
-                    cpe_link = None
-                    cpe_refs = {}
-                    if port.find('service').find("cpe") is not None:
-                        cpe_vector = port.find('service').find("cpe").text
-                        cpe_link = _get_cpe_link(cpe_vector)
-                        cpe_info = "\n The following CPE vector has been identified: {}".format(cpe_vector)
-                        cpe_refs = {"CPE": [cpe_vector]}
-
-                    res.append(deepcopy(_add_issue(scan_id, target, ts,
-                        "Service '{}' is running on port '{}/{}'".format(svc_name, proto, portid),
-                        "The scan detected that the service '{}' is running on port '{}/{}'. {}"
-                            .format(svc_name, proto, portid, cpe_info),
-                        type="port_info",
-                        links=[cpe_link],
-                        vuln_refs=cpe_refs)))
-
-                for port_script in port.findall('script'):
-                    script_id = port_script.get('id')
-                    script_output = port_script.get('output')
-                    # Disable hash for some script_id
-                    if script_id in ["fingerprint-strings"]:
-                        script_hash = "None"
-                    else:
-                        script_hash = hashlib.sha1(str(script_output).encode('utf-8')).hexdigest()[:6]
-
-                    if script_id == "vulners":
-                        port_max_cvss, port_cve_list, port_cve_links, port_cpe = _get_vulners_findings(script_output)
-
-                        port_severity = "info"
-                        if port_max_cvss >= 7.5:
-                            port_severity = "high"
-                        elif port_max_cvss >= 5.0 and port_max_cvss < 7.5:
-                            port_severity = "medium"
-                        elif port_max_cvss >= 3.0 and port_max_cvss < 5.0:
-                            port_severity = "low"
-
-                        res.append(deepcopy(_add_issue(scan_id, target, ts,
-                            "Nmap script '{}' detected findings on port {}/{}"
-                                .format(script_id, proto, portid),
-                            "The script '{}' detected following findings:\n{}"
-                                .format(script_id, script_output),
-                            severity=port_severity,
-                            type="port_script",
-                            tags=[script_id],
-                            risk={"cvss_base_score": port_max_cvss},
-                            vuln_refs={"CVE": port_cve_list, "CPE": port_cpe},
-                            links=port_cve_links
-                            )))
-                    else:
-                        res.append(deepcopy(_add_issue(scan_id, target, ts,
-                            "Nmap script '{}' detected findings on port {}/{}"
-                                .format(script_id, proto, portid),
-                            "The script '{}' detected following findings:\n{}"
-                                .format(script_id, script_output),
-                            type="port_script",
-                            tags=[script_id])))
-            if not openports:
-                res.append(deepcopy(_add_issue(scan_id, target, ts,
-                "All Ports are closed",
-                "The scan detected that all ports are closed or filtered",
-                type="port_status")))
-
-        # get script results - generate issues
-        if host.find('hostscript') is not None:
-            for script in host.find('hostscript'):
-                script_output = script.get('output')
-                res.append(deepcopy(_add_issue(scan_id, target, ts,
-                    "Script '{}' has given results".format(script.get('id')),
-                    "The script '{}' revealed following information: \n{}"
-                        .format(script.get('id'), script_output),
-                    type="host_script")))
-
-                if "script_output_fields" in this.scans[scan_id]["options"].keys():
-                    for elem in script.findall("elem"):
-                        if elem.get("key") in this.scans[scan_id]["options"]["script_output_fields"]:
-                            res.append(deepcopy(_add_issue(scan_id, target, ts,
-                                "Script results '{}/{}' set to '{}'"
-                                    .format(script.get('id'), elem.get("key"), elem.text),
-                                "The script '{}' revealed following information: \n'{}' was identified to '{}'"
-                                    .format(script.get('id'), elem.get("key"), elem.text),
-                                type="host_script_advanced")))
-
-    for unidentified_asset in unidentified_assets:
+        if ts is None:
+            ts = run.get("taskbegin") or run.get("start")
+        yield from _host_issues(scan_id, this.scans[scan_id], host, ts, url_assets, unidentified_assets)
+
+    if "start" not in run:
+        # No nmaprun element: empty or invalid XML report
+        return
+    if ts is None:
+        ts = run.get("taskbegin") or run.get("start")
+    for unidentified_asset in dict.fromkeys(asset_values):
+        if unidentified_asset not in unidentified_assets:
+            continue
         target = {
             "addr": [unidentified_asset],
             "addr_type": "tcp",
         }
-        res.append(deepcopy(_add_issue(scan_id, target, ts,
+        yield _add_issue(this.scans[scan_id], target, ts,
             "Failed to resolve '{}'".format(unidentified_asset),
             "The asset '{}' was not resolved by the engine.".format(unidentified_asset),
-            type="nmap_error_unresolved")))
-    return res
+            type="nmap_error_unresolved")
+
+
+def _host_issues(scan_id, counter, host, ts, url_assets, unidentified_assets):
+    """
+        Yield the issues of a <host> element of a report, numbered by the
+        'nb_findings' of counter (dict); the addresses of the host are
+        removed from unidentified_assets.
+    """
+    addr_list = []
+    addr_type = host.find('address').get('addrtype')
+
+    has_hostnames = False
+    # Find hostnames
+    for hostnames in host.findall('hostnames'):
+        # for hostname in hostnames.getchildren():
+        for hostname in list(hostnames):
+            if hostname.get("type") in ["user", "PTR"]:
+                has_hostnames = True
+                addr = hostname.get("name")
+                addr_list.append(hostname.get("name"))
+
+    # Get IP address otherwise
+    if not has_hostnames:
+        addr = host.find('address').get('addr')
+        addr_list.append(addr)
+
+    # Check if it was extracted from URLs. If yes: add them (in the order of the assets)
+    urls = set()
+    for host_addr in addr_list:
+        urls.update(url_assets.get(host_addr, []))
+    addr_list.extend(value for _, value in sorted(urls))
+
+    # Initialize the 'target' value
+    target = {
+        "addr": addr_list,
+        "addr_type": addr_type,
+    }
+
+    if has_hostnames:
+        for hostnames in host.findall('hostnames'):
+            for hostname in list(hostnames):
+                yield _add_issue(counter, target, ts,
+                    "Host '{}' has ip: '{}'".format(hostname.get('name'),host.find('address').get('addr')),
+                    "The scan detected that the host {} has IP '{}'".format(hostname.get('name'), host.find('address').get('addr')),
+                    type="host_availability")
+
+
+    # Add the addr_list to identified_assets (post exec: spot unresolved assets)
+    unidentified_assets.difference_update(addr_list)
+
+    # get host status
+    status = host.find('status').get('state')
+    if status and status == "up":
+        yield _add_issue(counter, target, ts,
+            "Host '{}' is up".format(addr),
+            "The scan detected that the host {} was up".format(addr),
+            type="host_availability")
+    else:
+        yield _add_issue(counter, target, ts,
+            "Host '{}' is down".format(addr),
+            "The scan detected that the host {} was down".format(addr),
+            type="host_availability")
+
+    # get OS information
+    if host.find('os') is not None:
+        osinfo = host.find('os').find('osmatch')
+        if osinfo is not None:
+            yield _add_issue(counter, target, ts,
+                "OS: {}".format(osinfo.get('name')),
+                "The scan detected that the host run in OS '{}' (accuracy={}%)"
+                    .format(osinfo.get('name'), osinfo.get('accuracy')),
+                type="host_osinfo",
+                confidence="undefined")
+
+    # get ports status - generate issues
+    if host.find('ports') is not None:
+        openports = False
+        for port in host.find('ports'):
+            # for port in host.find('ports'):
+            if port.tag == 'extraports':
+                continue
+            proto = port.get('protocol')
+            portid = port.get('portid')
+            port_state = port.find('state').get('state')
+
+            target.update({
+                "protocol": proto,
+                "port_id": portid,
+                "port_state": port_state})
+
+            if port_state not in ["filtered", "closed"]:
+                openports = True
+                yield _add_issue(counter, target, ts,
+                "Port '{}/{}' is {}".format(proto, portid, port_state),
+                "The scan detected that the port '{}/{}' was {}".format(
+                    proto, portid, port_state),
+                type="port_status")
+
+            # get service information if available
+            if port.find('service') is not None and port.find('state').get('state') not in ["filtered", "closed"]:
+                svc_name = port.find('service').get('name')
+                target.update({"service": svc_name})
+
+                # Check if a CPE has been identified
+                cpe_info = ""
+                cpe_link = None
+                cpe_refs = {}
+                if port.find('service').find("cpe") is not None:
+                    cpe_vector = port.find('service').find("cpe").text
+                    cpe_link = _get_cpe_link(cpe_vector)
+                    cpe_info = "\n The following CPE vector has been identified: {}".format(cpe_vector)
+                    cpe_refs = {"CPE": [cpe_vector]}
+
+                yield _add_issue(counter, target, ts,
+                    "Service '{}' is running on port '{}/{}'".format(svc_name, proto, portid),
+                    "The scan detected that the service '{}' is running on port '{}/{}'. {}"
+                        .format(svc_name, proto, portid, cpe_info),
+                    type="port_info",
+                    links=[cpe_link],
+                    vuln_refs=cpe_refs)
+
+                # Known CVEs of the CPEs identified, from the offline index
+                if this.cve_index is not None:
+                    for cpe in port.find('service').findall("cpe"):
+                        cves = this.cve_index.lookup(cpe.text)
+                        if cves:
+                            yield _get_cve_index_issue(counter, target, ts, cpe.text, cves, proto, portid)
+
+            for port_script in port.findall('script'):
+                script_id = port_script.get('id')
+                script_output = port_script.get('output')
+                # Disable hash for some script_id
+                if script_id in ["fingerprint-strings"]:
+                    script_hash = "None"
+                else:
+                    script_hash = hashlib.sha1(str(script_output).encode('utf-8')).hexdigest()[:6]
+
+                if script_id == "vulners":
+                    port_max_cvss, port_cve_list, port_cve_links, port_cpe = _get_vulners_findings(script_output)
+                    port_severity = _get_cvss_severity(port_max_cvss)
+
+                    yield _add_issue(counter, target, ts,
+                        "Nmap script '{}' detected findings on port {}/{}"
+                            .format(script_id, proto, portid),
+                        "The script '{}' detected following findings:\n{}"
+                            .format(script_id, script_output),
+                        severity=port_severity,
+                        type="port_script",
+                        tags=[script_id],
+                        risk={"cvss_base_score": port_max_cvss},
+                        vuln_refs={"CVE": port_cve_list, "CPE": port_cpe},
+                        links=port_cve_links
+                        )
+                else:
+                    yield _add_issue(counter, target, ts,
+                        "Nmap script '{}' detected findings on port {}/{}"
+                            .format(script_id, proto, portid),
+                        "The script '{}' detected following findings:\n{}"
+                            .format(script_id, script_output),
+                        type="port_script",
+                        tags=[script_id])
+        if not openports:
+            yield _add_issue(counter, target, ts,
+            "All Ports are closed",
+            "The scan detected that all ports are closed or filtered",
+            type="port_status")
+
+    # get script results - generate issues
+    if host.find('hostscript') is not None:
+        for script in host.find('hostscript'):
+            script_output = script.get('output')
+            yield _add_issue(counter, target, ts,
+                "Script '{}' has given results".format(script.get('id')),
+                "The script '{}' revealed following information: \n{}"
+                    .format(script.get('id'), script_output),
+                type="host_script")
+
+            if "script_output_fields" in this.scans[scan_id]["options"].keys():
+                for elem in script.findall("elem"):
+                    if elem.get("key") in this.scans[scan_id]["options"]["script_output_fields"]:
+                        yield _add_issue(counter, target, ts,
+                            "Script results '{}/{}' set to '{}'"
+                                .format(script.get('id'), elem.get("key"), elem.text),
+                            "The script '{}' revealed following information: \n'{}' was identified to '{}'"
+                                .format(script.get('id'), elem.get("key"), elem.text),
+                            type="host_script_advanced")
 
 
 def _get_cpe_link(cpe):
     return "https://nvd.nist.gov/vuln/search/results?adv_search=true&cpe={}".format(cpe)
 
 
+def _get_cvss_severity(cvss):
+    if cvss >= 7.5:
+        return "high"
+    elif cvss >= 5.0:
+        return "medium"
+    elif cvss >= 3.0:
+        return "low"
+    return "info"
+
+
+def _get_cve_index_issue(counter, target, ts, cpe, cves, proto, portid):
+    """Return the issue of the CVEs of a CPE found in the CVE index (see CveIndex.lookup)."""
+    max_cvss = max(cve["cvss"] or 0.0 for cve in cves)
+    cve_info = []
+    for cve in cves:
+        cve_info.append("{}\t{}\t{}".format(
+            cve["cve_id"], cve["cvss"] if cve["cvss"] is not None else "n/a", cve["cvss_vector"] or ""))
+        cve_info.extend("  " + reference for reference in cve["references"])
+    return _add_issue(counter, target, ts,
+        "Known vulnerabilities of '{}' on port {}/{}".format(cpe, proto, portid),
+        "The following CVEs of the CPE '{}' have been found in the CVE index (NVD):\n{}"
+            .format(cpe, "\n".join(cve_info)),
+        severity=_get_cvss_severity(max_cvss),
+        type="port_cves",
+        tags=["cve_index"],
+        risk={"cvss_base_score": max_cvss, "cvss_vector": cves[0]["cvss_vector"]},
+        vuln_refs={"CVE": sorted(cve["cve_id"] for cve in cves), "CPE": [cpe]},
+        links=[cve["link"] for cve in cves])
+
+
 # custom functions for Vulners issues
 def _get_vulners_findings(findings):
     max_cvss = 0.0
@@ -652,15 +1380,20 @@ def _get_vulners_findings(findings):
 def getfindings(scan_id):
     res = {"page": "getfindings", "scan_id": scan_id}
     if scan_id not in this.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        if "cursor" in request.args and this.results.find(scan_id) is not None:
+            return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    proc = this.scans[scan_id]["proc"]
+    if this.scans[scan_id].get("findings_written") and this.results.find(scan_id) is not None:
+        return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
     # check if the scan is finished
-    status()
-    if hasattr(proc, 'pid') and psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() in ["sleeping", "running"]:
-        # print "scan not finished"
+    if this.scans[scan_id]["status"] in ["STARTED", "SCANNING"]:
+        if request.args.get("partial", "").lower() in ["1", "true", "yes"]:
+            # The issues of the hosts done so far
+            return _partial_findings_response(scan_id, res)
         res.update({"status": "error", "reason": "Scan in progress"})
         return jsonify(res)
 
@@ -670,40 +1403,58 @@ def getfindings(scan_id):
         res.update({"status": "error", "reason": "Report file not available"})
         return jsonify(res)
 
+    # Issues are parsed while written (none for an empty or invalid XML report)
     issues = _parse_report(report_filename, scan_id)
     scan = {
         "scan_id": scan_id
     }
-    summary = {
-        "nb_issues": len(issues),
-        "nb_info": len(issues),
-        "nb_low": 0,
-        "nb_medium": 0,
-        "nb_high": 0,
-        "engine_name": "nmap",
-        "engine_version": this.scanner['version']
-    }
 
-    # Store the findings in a file
-    with open(BASE_DIR+"/results/nmap_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    summary = this.results.write_report(
+        scan_id, scan, issues,
+        summary={"engine_name": "nmap", "engine_version": this.scanner['version']},
+        default=_json_serial,
+        assets=this.scans[scan_id]["assets"], delta_only=delta_only(this.scans[scan_id]))
+    this.scans[scan_id]["findings_written"] = True
+    this.metrics.scan_findings(scan_id, summary["nb_issues"])
 
     # Delete the tmp hosts file (used with -iL argument upon launching nmap)
     hosts_filename = BASE_DIR+"/tmp/engine_nmap_hosts_file_scan_id_{}.tmp".format(scan_id)
     if os.path.exists(hosts_filename):
         os.remove(hosts_filename)
-
-    res.update({
-        "scan": scan,
-        "summary": summary,
-        "issues": issues,
-        "status": "success"
-        })
-    return jsonify(res)
+    resume_path = BASE_DIR+"/results/nmap_{}.gnmap".format(scan_id)
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
+    if os.path.exists(_partial_findings_path(scan_id)):
+        os.remove(_partial_findings_path(scan_id))
+
+    return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
+
+
+def _partial_findings_response(scan_id, res):
+    """Stream the issues of the hosts done by the nmap processes of a running scan."""
+    scan = this.scans[scan_id]
+    _scan_progress(scan_id)
+    with scan["tail_lock"]:
+        nb_issues = scan["partial"]["nb_findings"]
+        path = _partial_findings_path(scan_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _generate():
+        body = {"status": "partial", "nb_issues": nb_issues}
+        body.update(res)
+        yield json.dumps(body)[:-1] + ', "issues": ['
+        remaining = size
+        if remaining:
+            # Up to the issues counted (more may be appended meanwhile)
+            with open(path, "rb") as partial_file:
+                for i, line in enumerate(partial_file):
+                    if remaining <= 0:
+                        break
+                    yield (b"," if i else b"") + line.rstrip(b"\n")
+                    remaining -= len(line)
+        yield "]}"
+    return Response(_generate(), mimetype="application/json")
 
 
 @app.route('/engines/nmap/getreport/<scan_id>')
@@ -714,16 +1465,13 @@ def getreport(scan_id):
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    filepath = BASE_DIR+"/results/nmap_"+scan_id+".json"
-    if not os.path.exists(filepath):
+    if this.results.find(scan_id) is None:
         return jsonify({"status": "ERROR", "reason": "report file for scan_id '{}' not found".format(scan_id)})
 
-    return send_file(
-        filepath,
-        mimetype='application/json',
-        attachment_filename='nmap_'+str(scan_id)+".json",
-        as_attachment=True
-    )
+    # Compressed reports are sent as is to the clients accepting them
+    response = this.results.report_response(scan_id, request.accept_encodings)
+    response.headers["Content-Disposition"] = "attachment; filename=nmap_{}.json".format(scan_id)
+    return response
 
 
 @app.route('/engines/nmap/test')
@@ -746,6 +1494,13 @@ def page_not_found(e):
     return jsonify({"page": "not found"})
 
 
+@app.errorhandler(PatrowlEngineExceptions)
+def handle_invalid_usage(error):
+    response = jsonify(error.to_dict())
+    response.status_code = 404
+    return response
+
+
 @app.before_first_request
 def main():
     if os.getuid() != 0:
@@ -756,6 +1511,7 @@ def main():
     if not os.path.exists(BASE_DIR+"/tmp"):
         os.makedirs(BASE_DIR+"/tmp")
     loadconfig()
+    _resume_scans()
 
 
 if __name__ == '__main__':
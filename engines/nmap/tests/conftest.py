@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Unit tests of the nmap engine: the engine module and PatrowlEnginesUtils
+are imported from this checkout.
+"""
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ENGINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(os.path.dirname(ENGINE_DIR), "utils")
+
+if "PatrowlEnginesUtils" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        "PatrowlEnginesUtils", os.path.join(UTILS_DIR, "__init__.py"),
+        submodule_search_locations=[UTILS_DIR])
+    sys.modules["PatrowlEnginesUtils"] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules["PatrowlEnginesUtils"])
+
+
+@pytest.fixture(scope="session")
+def engine(tmp_path_factory):
+    """The engine module, its checkpoints and cache in a temporary directory."""
+    if "engine_nmap" not in sys.modules:
+        tmp_dir = tmp_path_factory.mktemp("nmap")
+        os.environ.setdefault("APP_CHECKPOINTS_DB", str(tmp_dir / "checkpoints.db"))
+        os.environ.setdefault("APP_CACHE_DB", str(tmp_dir / "cache.db"))
+        spec = importlib.util.spec_from_file_location("engine_nmap", os.path.join(ENGINE_DIR, "engine-nmap.py"))
+        sys.modules["engine_nmap"] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules["engine_nmap"])
+    return sys.modules["engine_nmap"]
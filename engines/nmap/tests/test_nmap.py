@@ -45,6 +45,30 @@ def test_nmap_scan_ip():
     )
 
 
+
+def test_nmap_scan_discovery():
+    """Two-phase scan: discovery then port scan of the live hosts."""
+    PET.custom_test(
+        test_name="nmap_scan_discovery",
+        assets=[{
+            "id": "1",
+            "value": "8.8.8.0/29",
+            "criticity": "low",
+            "datatype": "ip-subnet"
+        }],
+        scan_policy={
+            "discovery": 1,
+            "ports": [
+                "53",
+                "443"
+            ],
+            "show_open_ports": 1
+        },
+        is_valid=True,
+        scan_id="3-4"
+    )
+
+
 if __name__ == "__main__":
     # test_generic_features()
     test_nmap_scan_ip()
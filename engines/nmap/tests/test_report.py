@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Unit tests of the nmap reports: split of the targets into shards, reading
+of the reports being written and of the reports of resumed scans.
+"""
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<nmaprun scanner="nmap" args="nmap -oX" start="{}" version="7.94">\n'
+HOST = '<host starttime="1" endtime="1"><status state="up"/>\n<address addr="{}" addrtype="ipv4"/>\n</host>\n'
+FOOTER = '<runstats><finished time="2"/></runstats>\n</nmaprun>\n'
+
+
+def _addresses(hosts):
+    return [host.find("address").get("addr") for host in hosts]
+
+
+def test_split_hosts(engine):
+    """The largest networks are split until there are enough targets."""
+    assert engine._split_hosts(["10.0.0.0/24", "a.com", "10.1.0.1"], 4) == [
+        (["10.0.0.0/25"], 128), (["10.0.0.128/25"], 128), (["a.com"], 1), (["10.1.0.1"], 1)]
+    assert engine._split_hosts(["10.0.0.0/30"], 8) == [
+        (["10.0.0.0/32"], 1), (["10.0.0.1/32"], 1), (["10.0.0.2/32"], 1), (["10.0.0.3/32"], 1)]
+    assert engine._split_hosts(["10.0.0.1/32"], 4) == [(["10.0.0.1/32"], 1)]
+
+
+def test_split_hosts_balanced(engine):
+    """Each target goes to the shard with the fewest addresses, in order."""
+    assert engine._split_hosts(["a", "b", "c"], 2) == [(["a", "c"], 2), (["b"], 1)]
+    assert engine._split_hosts(["10.0.0.0/28", "a", "10.0.1.0/29", "b"], 2) == [
+        (["10.0.0.0/28"], 16), (["a", "10.0.1.0/29", "b"], 10)]
+    assert engine._split_hosts(["a.com", "bad/net"], 1) == [(["a.com", "bad/net"], 2)]
+
+
+def test_read_report_line_progress(engine):
+    """The start time and the progress of the current task are read."""
+    run = {}
+    assert engine._read_report_line('<nmaprun scanner="nmap" start="1700000000" version="7.94">', run) is None
+    engine._read_report_line('<taskbegin task="SYN Stealth Scan" time="1700000001"/>', run)
+    assert run == {"start": "1700000000", "task": "SYN Stealth Scan", "taskbegin": "1700000001",
+                   "percent": 0.0, "remaining": None, "etc": None}
+    engine._read_report_line('<taskprogress task="SYN Stealth Scan" time="1700000011" percent="42.50" remaining="13" etc="1700000024"/>', run)
+    assert (run["percent"], run["remaining"], run["etc"]) == (42.5, 13, 1700000024)
+    engine._read_report_line('<taskprogress task="Service scan" time="1700000012" percent=""/>', run)
+    assert (run["task"], run["percent"], run["remaining"], run["etc"]) == ("Service scan", 0.0, None, None)
+    engine._read_report_line('<taskend task="Service scan" time="1700000020"/>', run)
+    assert (run["percent"], run["remaining"]) == (100.0, 0)
+    # First task only
+    assert run["taskbegin"] == "1700000001"
+
+
+def test_read_report_line_host(engine):
+    """A host is returned by the line which completes it."""
+    run = {}
+    lines = HOST.format("10.0.0.1").splitlines(True)
+    assert [engine._read_report_line(line, run) for line in lines[:-1]] == [None] * (len(lines) - 1)
+    host = engine._read_report_line(lines[-1], run)
+    assert _addresses([host]) == ["10.0.0.1"]
+    assert "host_lines" not in run
+
+
+def test_iter_report_hosts(engine, tmp_path):
+    """A complete report is parsed, with its start time."""
+    report = tmp_path / "nmap.xml"
+    report.write_text(HEADER.format(1) + '<taskbegin task="Ping Scan" time="3"/>\n'
+                      + HOST.format("10.0.0.1") + HOST.format("10.0.0.2") + FOOTER)
+    run = {}
+    assert _addresses(engine._iter_report_hosts(str(report), run)) == ["10.0.0.1", "10.0.0.2"]
+    assert run == {"start": "1", "taskbegin": "3"}
+
+
+def test_iter_report_hosts_resumed(engine, tmp_path):
+    """
+    The report of a resumed scan: the hosts of the first run, then the
+    hosts of the '--resume' run, each one once; the host being written when
+    the first run stopped is dropped.
+    """
+    first_run = HEADER.format(1) + HOST.format("10.0.0.1") + HOST.format("10.0.0.2") + HOST.format("10.0.0.3")[:60]
+    second_run = HEADER.format(2) + HOST.format("10.0.0.3") + HOST.format("10.0.0.4") + FOOTER
+    report = tmp_path / "nmap.xml"
+    report.write_text(first_run + "\n" + second_run)
+    run = {}
+    assert _addresses(engine._iter_report_hosts(str(report), run)) == [
+        "10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]
+    assert run["start"] == "1"
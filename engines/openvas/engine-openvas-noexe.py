@@ -6,7 +6,6 @@ import os
 import sys
 import json
 import time
-import threading
 from urllib.parse import urlparse
 # import random
 # import string
@@ -350,9 +349,7 @@ def start_scan():
     }
 
     engine.scans.update({scan_id: scan})
-    thread = threading.Thread(target=_scan, args=(scan_id,))
-    thread.start()
-    engine.scans[scan_id]['threads'].append(thread)
+    engine.start_thread(scan_id, _scan, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -485,7 +482,7 @@ def _parse_results(scan_id):
             meta_risk={"cvss_base_score": issue_cvss},
             meta_vuln_refs=issue_meta
         )
-        issues.append(issue._PatrowlEngineFinding__to_dict())
+        issues.append(issue.to_dict())
 
         nb_vulns[severity] += 1
         issue_id += 1
@@ -545,6 +542,10 @@ def getfindings(scan_id):
 
     # Check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -566,19 +567,13 @@ def getfindings(scan_id):
     summary = engine.scans[scan_id]['summary']
     issues = engine.scans[scan_id]['issues']
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/openvas_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # Remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
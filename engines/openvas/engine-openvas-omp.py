@@ -5,10 +5,9 @@
 from os import makedirs
 from os.path import dirname, exists, isfile, realpath
 from sys import modules
-from json import dump, load, loads
+from json import load, loads
 from re import search as re_search
 from subprocess import check_output
-from threading import Thread
 from time import time, sleep
 from urllib.parse import urlparse
 from uuid import UUID
@@ -19,7 +18,6 @@ from flask import Flask, request, jsonify
 from dns.resolver import query
 
 # Own library
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
 
@@ -543,9 +541,7 @@ def start_scan():
         return jsonify(res)
 
     engine.scans.update({scan_id: scan})
-    thread = Thread(target=_scan_urls, args=(scan_id,))
-    thread.start()
-    engine.scans[scan_id]["threads"].append(thread)
+    engine.start_thread(scan_id, _scan_urls, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -717,6 +713,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -737,19 +737,13 @@ def getfindings(scan_id):
         "finished_at": engine.scans[scan_id]["finished_at"]
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/openvas_"+scan_id+".json", "w") as report_file:
-        dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
@@ -6,10 +6,9 @@ import os
 from os import makedirs
 from os.path import dirname, exists, isfile, realpath
 from sys import modules
-from json import dump, load, loads
+from json import load, loads
 from netaddr import IPNetwork, IPAddress, glob_to_iprange
 from netaddr.core import AddrFormatError
-from threading import Thread
 import time
 from urllib.parse import urlparse
 from uuid import UUID
@@ -30,6 +29,7 @@ from gvm.protocols.gmpv7.types import AliveTest
 from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
 
 # Debug
 # from pdb import set_trace as st
@@ -104,7 +104,7 @@ def get_target(target_name, scan_portlist_id=None, alive_test=None):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -190,7 +190,7 @@ def get_scan_config(name=None):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -237,7 +237,7 @@ def create_target(
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -276,7 +276,7 @@ def get_task_by_target_name(target_name, scan_config_id=None):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -311,7 +311,7 @@ def get_scanners(name=None):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -346,7 +346,7 @@ def create_task(target_name, target_id, scan_config_id=None, scanner_id=None):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -381,7 +381,7 @@ def start_task(task_id):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -411,7 +411,7 @@ def get_last_report(task_id):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -622,27 +622,24 @@ def status():
         else:
             engine.status = "READY"
 
+    # The scans are polled by their _scan_assets thread, not here
     scans = []
-    for scan_id in engine.scans.keys():
-        assets_map = None
-        if "assets_map" in engine.scans[scan_id].keys():
-            assets_map = engine.scans[scan_id]['assets_map']
-
+    for scan_id, summary in engine.scans.summaries(fields=("assets", "assets_map")):
         scan_data = {
-            "status": engine.scans[scan_id]['status'],
-            "started_at": engine.scans[scan_id]['started_at'],
-            "finished_at": engine.scans[scan_id]['finished_at'],
-            "assets": engine.scans[scan_id]['assets'],
-            "assets_map": assets_map
+            "status": summary.get('status'),
+            "started_at": summary.get('started_at'),
+            "finished_at": summary.get('finished_at'),
+            "assets": summary.get('assets'),
+            "assets_map": summary.get('assets_map')
         }
-        if "info" in engine.scans[scan_id].keys():
+        if "info" in summary.keys():
             scan_data.update({
-                "info": engine.scans[scan_id]['info'],
+                "info": summary['info'],
             })
         scans.append({scan_id: scan_data})
 
     res.update({
-        "nb_scans": len(engine.scans),
+        "nb_scans": len(scans),
         "status": engine.status,
         "scans": scans})
     return jsonify(res)
@@ -659,7 +656,7 @@ def _status_scan(scan_id, gmp_cnx=None):
             port=engine.scanner["options"]["gmp_port"]["value"],
             timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
         )
-        with Gmp(connection) as gmp_cnx:
+        with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
             gmp_cnx.authenticate(
                 engine.scanner["options"]["gmp_username"]["value"],
                 engine.scanner["options"]["gmp_password"]["value"])
@@ -684,29 +681,42 @@ def _status_scan(scan_id, gmp_cnx=None):
     return scan_assets_status
 
 
+@app.route("/engines/openvas/metrics")
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route("/engines/openvas/events")
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route("/engines/openvas/status/<scan_id>")
 def status_scan(scan_id):
     """Get status on scan identified by id."""
     res = {"page": "status", "status": "UNKNOWN"}
-    if scan_id not in engine.scans.keys():
+    # Updated by the _scan_assets thread of the scan: no GMP request here
+    summary = engine.scans.summary(scan_id)
+    if summary is None:
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    if engine.scans[scan_id]["status"] == "ERROR":
-        res.update({"status": "error", "reason": engine.scans[scan_id]["reason"]})
+    if summary["status"] == "ERROR":
+        res.update({"status": "error", "reason": summary.get("reason")})
         return jsonify(res)
 
-    assets_status = _status_scan(scan_id)
-    if engine.scans[scan_id]['status'] in ["SCANNING", "STARTED", "FINISHED"]:
+    if summary['status'] in ["SCANNING", "STARTED", "FINISHED"]:
         res.update({
-            'status': engine.scans[scan_id]['status']
+            'status': summary['status']
         })
-        if 'info' in engine.scans[scan_id].keys():
+        if 'info' in summary.keys():
             res.update({
-                'info': engine.scans[scan_id]['info'],
+                'info': summary['info'],
             })
 
-    if assets_status is None:
+    if summary['status'] == "UNKNOWN":
         res.update({"status": "error", "reason": "Cannot find any report_status"})
 
     return jsonify(res)
@@ -733,7 +743,7 @@ def stop_scan(scan_id):
             port=engine.scanner["options"]["gmp_port"]["value"],
             timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
         )
-        with Gmp(connection) as gmp_cnx:
+        with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
             gmp_cnx.authenticate(
                 engine.scanner["options"]["gmp_username"]["value"],
                 engine.scanner["options"]["gmp_password"]["value"])
@@ -936,37 +946,60 @@ def start_scan():
         assets.append(asset["value"])
 
     scan_id = str(data["scan_id"])
+    scan = _new_scan(scan_id, assets, data["options"], engine.callback_url(data))
+
+    engine.scans.update({scan_id: scan})
+    # The GMP task and report are checkpointed to be polled again after a restart
+    engine.start_checkpoint(scan_id, {
+        "assets": assets, "options": data["options"], "scan_id": scan_id,
+        "callback_url": scan["callback_url"]})
+    engine.metrics.scan_started(scan_id)
+    engine.start_thread(scan_id, _scan_assets, args=(scan_id,))
 
-    scan = {
+    res.update({
+        "status": "accepted",
+        "details": {
+            "scan_id": scan["scan_id"]
+        }
+    })
+
+    return jsonify(res)
+
+
+def _new_scan(scan_id, assets, options, callback_url=None):
+    return {
         "assets":       assets,
         "threads":      [],
-        "options":      data["options"],
+        "options":      options,
         "scan_id":      scan_id,
         "status":       "STARTED",
         "reason":       "",
         "lock":         False,
         "started_at":   int(time.time() * 1000),
         "finished_at":  "",
-        "findings":     {}
+        "findings":     {},
+        "callback_url": callback_url
     }
 
-    engine.scans.update({scan_id: scan})
-    thread = Thread(target=_scan_assets, args=(scan_id,))
-    thread.start()
-    engine.scans[scan_id]["threads"].append(thread)
 
-    res.update({
-        "status": "accepted",
-        "details": {
-            "scan_id": scan["scan_id"]
-        }
-    })
+def _restore_scan(checkpoint):
+    """Return the scan of a checkpoint (see engine.resume_scans)."""
+    params = checkpoint.params
+    scan = _new_scan(checkpoint.scan_id, params["assets"], params["options"], params.get("callback_url"))
+    if checkpoint.finished:
+        # The report was written before the restart
+        scan["report_available"] = True
+    return scan
 
-    return jsonify(res)
+
+def _resume_scan(scan_id):
+    engine.start_thread(scan_id, _scan_assets, args=(scan_id,))
 
 
 def _scan_assets(scan_id):
     scan = engine.scans[scan_id]
+    checkpoint = engine.checkpoint(scan_id)
+    info = checkpoint.jobs() if checkpoint is not None else {}
 
     scan_config_name = None
     if 'profile' in engine.scans[scan_id]["options"].keys():
@@ -993,48 +1026,63 @@ def _scan_assets(scan_id):
     assets_hash = hashlib.sha1(str(''.join(assets)).encode('utf-8')).hexdigest()
     engine.scans[scan_id]["assets_hash"] = assets_hash
 
-    try:
-        target_id = get_target(assets_hash, scan_portlist_id)
-
-        if target_id is None and options["enable_create_target"] is True:
-            target_id = create_target(
-                target_name=assets_hash,
-                target_hosts=engine.scans[scan_id]["assets"],
-                port_list_id=scan_portlist_id,
-                port_list_name=scan_portlist_name)  # Todo: add credentials if needed
-        if target_id is None:
-            engine.scans[scan_id]['status'] = "ERROR"
-            engine.scans[scan_id]['reason'] = "Unable to create a target ({})".format(assets_hash)
-
-        task_id = get_task_by_target_name(assets_hash, scan_config_id)
-        if task_id is None and options["enable_create_task"] is True:
-            task_id = create_task(assets_hash, target_id, scan_config_id=scan_config_id)
-        if task_id is None:
-            engine.scans[scan_id]['status'] = "ERROR"
-            engine.scans[scan_id]['reason'] = "Unable to create a task ({})".format(assets_hash)
-
-        if options["enable_start_task"] is True:
-            report_id = start_task(task_id)
-            if report_id is None:
+    task_id = info.get("task_id")
+    report_id = info.get("report_id")
+    if task_id is not None and report_id is not None:
+        # Resumed: the task started before the restart is polled, not started again
+        engine.scans[scan_id]['info'] = {
+            "task_id": task_id,
+            "report_id": report_id,
+            "status": "accepted"
+        }
+    else:
+        try:
+            target_id = get_target(assets_hash, scan_portlist_id)
+
+            if target_id is None and options["enable_create_target"] is True:
+                target_id = create_target(
+                    target_name=assets_hash,
+                    target_hosts=engine.scans[scan_id]["assets"],
+                    port_list_id=scan_portlist_id,
+                    port_list_name=scan_portlist_name)  # Todo: add credentials if needed
+            if target_id is None:
+                engine.scans[scan_id]['status'] = "ERROR"
+                engine.scans[scan_id]['reason'] = "Unable to create a target ({})".format(assets_hash)
+
+            task_id = get_task_by_target_name(assets_hash, scan_config_id)
+            if task_id is None and options["enable_create_task"] is True:
+                task_id = create_task(assets_hash, target_id, scan_config_id=scan_config_id)
+            if task_id is None:
+                engine.scans[scan_id]['status'] = "ERROR"
+                engine.scans[scan_id]['reason'] = "Unable to create a task ({})".format(assets_hash)
+
+            if options["enable_start_task"] is True:
+                report_id = start_task(task_id)
+                if report_id is None:
+                    report_id = get_last_report(task_id)
+            else:
                 report_id = get_last_report(task_id)
-        else:
-            report_id = get_last_report(task_id)
 
-        if report_id is None:
+            if report_id is None:
+                engine.scans[scan_id]['status'] = "ERROR"
+                engine.scans[scan_id]['reason'] = "Unable to get a report ({})".format(assets_hash)
+
+            # Store the scan info
+            engine.scans[scan_id]['info'] = {
+                    "task_id": task_id,
+                    "report_id": report_id,
+                    "status": "accepted"
+                }
+        except Exception as e:
+            print(e)
             engine.scans[scan_id]['status'] = "ERROR"
-            engine.scans[scan_id]['reason'] = "Unable to get a report ({})".format(assets_hash)
+            engine.scans[scan_id]['reason'] = "Error when trying to start the scan"
+            return False
 
-        # Store the scan info
-        engine.scans[scan_id]['info'] = {
-                "task_id": task_id,
-                "report_id": report_id,
-                "status": "accepted"
-            }
-    except Exception as e:
-        print(e)
-        engine.scans[scan_id]['status'] = "ERROR"
-        engine.scans[scan_id]['reason'] = "Error when trying to start the scan"
-        return False
+        if checkpoint is not None and report_id is not None:
+            checkpoint.set_job("target_id", target_id)
+            checkpoint.set_job("task_id", task_id)
+            checkpoint.set_job("report_id", report_id)
 
     # Scan is now running
     engine.scans[scan_id]['status'] = "SCANNING"
@@ -1066,6 +1114,7 @@ def _scan_assets(scan_id):
                 try:
                     # Get the report from the OpenVAS instance
                     engine.scans[scan_id]["findings"] = get_report(scan_id)
+                    engine.metrics.scan_first_result(scan_id)
                 except Exception as e:
                     print(e)
                     engine.scans[scan_id]['status'] = "ERROR"
@@ -1090,17 +1139,18 @@ def _scan_assets(scan_id):
                     "finished_at": engine.scans[scan_id]["finished_at"]
                 }
 
-                # Store the findings in a file
-                with open(APP_BASE_DIR+"/results/openvas_"+scan_id+".json", "w") as rf:
-                    dump({
-                        "scan": scan,
-                        "summary": summary,
-                        "issues": issues
-                    }, rf, default=_json_serial)
+                # Store the findings in a file, one at a time
+                report_summary = engine.results.write_report(
+                    scan_id, scan, issues, summary=summary, default=_json_serial,
+                    assets=scan["assets"], delta_only=delta_only(scan))
 
                 engine.scans[scan_id]["status"] = "FINISHED"
                 engine.scans[scan_id]["finished_at"] = int(time.time() * 1000)
                 engine.scans[scan_id]["report_available"] = True
+                engine.scans[scan_id]["nb_issues"] = report_summary["nb_issues"]
+                engine.metrics.scan_finished(scan_id)
+                if checkpoint is not None:
+                    checkpoint.finish()
 
     return True
 
@@ -1118,7 +1168,7 @@ def get_report(scan_id):
         port=engine.scanner["options"]["gmp_port"]["value"],
         timeout=int(engine.scanner["options"].get("timeout", DEFAULT_TIMEOUT))
     )
-    with Gmp(connection) as gmp_cnx:
+    with engine.metrics.api_call("gmp"), Gmp(connection) as gmp_cnx:
         gmp_cnx.authenticate(
             engine.scanner["options"]["gmp_username"]["value"],
             engine.scanner["options"]["gmp_password"]["value"])
@@ -1196,8 +1246,6 @@ def get_report(scan_id):
                 }
             })
 
-        engine.scans[scan_id]['assets_map'] = assets_map
-
         report = tree.getroot().find("report")  # Use with get_reports
         # report = tree.getroot()  # Use with get_results
         for result in report.findall('.//result'):
@@ -1210,16 +1258,18 @@ def get_report(scan_id):
                 for a in assets_map.keys():
                     if host_ip in assets_map[a]['siblings']:
                         issues.append(result)
-                        engine.scans[scan_id]['assets_map'][a]['has_issues'] = True
+                        assets_map[a]['has_issues'] = True
                     elif host_name is not None and host_name.text in assets_map[a]['siblings']:
                         issues.append(result)
-                        engine.scans[scan_id]['assets_map'][a]['has_issues'] = True
+                        assets_map[a]['has_issues'] = True
 
             except Exception as e:
                 # probably unknown issue's host, skip it
                 app.logger.error("Warning: failed to process issue: {}".format(ET.tostring(result, encoding='utf8', method='xml')))
                 app.logger.error(e)
 
+    # Published once complete (shown by /status)
+    engine.scans[scan_id]['assets_map'] = assets_map
     connection.disconnect()
     return issues
 
@@ -1452,9 +1502,7 @@ def getfindings(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    # check if the scan is finished
-    # status()
-    _status_scan(scan_id)
+    # check if the scan is finished (updated by its _scan_assets thread)
     if engine.scans[scan_id]["status"] != "FINISHED":
         res.update({
             "status": "error",
@@ -1462,23 +1510,15 @@ def getfindings(scan_id):
         })
         return jsonify(res)
 
-    try:
-        with open(APP_BASE_DIR+"/results/openvas_"+scan_id+".json", "r") as rf:
-            json_report = load(rf)
-    except Exception:
+    if engine.results.find(scan_id) is None:
         res.update({
             "status": "error",
             "reason": "Unable to get report and findings from scan '{}'".format(scan_id)
         })
         return jsonify(res)
 
-    res.update({
-        "scan": json_report['scan'],
-        "summary": json_report['summary'],
-        "issues": json_report['issues'],
-        "status": "success"
-    })
-    return jsonify(res)
+    engine.metrics.scan_findings(scan_id, engine.scans[scan_id].get("nb_issues", 0))
+    return engine.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
 
 @app.before_first_request
@@ -1487,6 +1527,8 @@ def main():
     if not exists(APP_BASE_DIR+"/results"):
         makedirs(APP_BASE_DIR+"/results")
     _loadconfig()
+    # Poll again the GMP tasks of the scans interrupted by a restart
+    engine.resume_scans(_resume_scan, restore=_restore_scan)
     # resetcnx()
 #
 #
@@ -3,7 +3,6 @@
 """Owl_Code PatrOwl engine application."""
 
 import os
-import signal
 import threading
 from flask import Flask, request, jsonify
 import hashlib
@@ -26,6 +25,7 @@ APP_MAXSCANS = int(os.environ.get('APP_MAXSCANS', 25))
 APP_ENGINE_NAME = "owl_code"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 VERSION = "1.4.18"
+SCAN_LOCK = threading.RLock()
 
 app = Flask(__name__)
 engine = PatrowlEngine(
@@ -80,6 +80,14 @@ def clean_scan(scan_id): return engine.clean_scan(scan_id)
 def status(): return engine.getstatus()
 
 
+@app.route('/engines/owl_code/metrics')
+def metrics(): return engine.getmetrics()
+
+
+@app.route('/engines/owl_code/events')
+def events(): return engine.getevents()
+
+
 @app.route('/engines/owl_code/status/<scan_id>')
 def status_scan(scan_id): return engine.getstatus_scan(scan_id)
 
@@ -96,6 +104,10 @@ def stop_scan(scan_id): return engine.stop_scan(scan_id)
 def getfindings(scan_id): return engine.getfindings(scan_id)
 
 
+@app.route('/engines/owl_code/getpartialfindings/<scan_id>')
+def getpartialfindings(scan_id): return engine.getpartialfindings(scan_id)
+
+
 @app.route('/engines/owl_code/getreport/<scan_id>')
 def getreport(scan_id): return engine.getreport(scan_id)
 
@@ -110,21 +122,15 @@ def start_scan():
 
     scan_id = res["details"]["scan_id"]
 
-    if "scan_js" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["scan_js"] is True:
-        for asset in engine.scans[scan_id]["assets"]:
-            th = threading.Thread(target=_scanjs_thread, args=(scan_id, asset["value"],))
-            th.start()
-            engine.scans[scan_id]['threads'].append(th)
+    # SCANNING until all the jobs are queued and done
+    with engine.scheduling(scan_id):
+        if "scan_js" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["scan_js"] is True:
+            for asset in engine.scans[scan_id]["assets"]:
+                engine.schedule(scan_id, _scanjs_thread, args=(scan_id, asset["value"],), asset=asset)
 
-    if "scan_owaspdc" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["scan_owaspdc"] is True:
-        for asset in engine.scans[scan_id]["assets"]:
-            th = threading.Thread(
-                target=_scanowaspdc_thread,
-                args=(scan_id, asset["value"],))
-            th.start()
-            engine.scans[scan_id]['threads'].append(th)
-
-    engine.scans[scan_id]['status'] = "SCANNING"
+        if "scan_owaspdc" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["scan_owaspdc"] is True:
+            for asset in engine.scans[scan_id]["assets"]:
+                engine.schedule(scan_id, _scanowaspdc_thread, args=(scan_id, asset["value"],), asset=asset)
 
     # Finish
     res.update({"status": "accepted"})
@@ -217,6 +223,8 @@ def _scanjs_thread(scan_id, asset_kw):
         os.makedirs(scan_wd)
 
     for asset_value in asset_values:
+        if engine.is_cancelled(scan_id):
+            break
         checked_files = []
         # create the asset scan workdir
         scan_wd_asset = "{}/{}".format(scan_wd, hashlib.sha1(str(asset_value).encode('utf-8')).hexdigest()[:6])
@@ -244,15 +252,15 @@ def _scanjs_thread(scan_id, asset_kw):
         report_filename = "{}/oc_{}.json".format(scan_wd_asset, scan_id)
         cmd = 'retire -j --path="{}" --outputformat json --outputpath="{}" -v'.format(
             scan_wd_asset, report_filename)
-        p = subprocess.Popen(cmd, shell=True, stdout=open("/dev/null", "w"), stderr=None)
+        if engine.run_process(scan_id, cmd, shell=True, stdout=subprocess.DEVNULL, stderr=None) is None:
+            # Scan stopped
+            break
 
-        # Wait a little to ensure the report file is completely writen
-        p.wait()
-        time.sleep(3)
+        # The tool exited (and was reaped): its report is complete
         if not os.path.exists(report_filename):
             print("report file '{}' not found.".format(report_filename))
             engine.scans[scan_id]["status"] = "ERROR"
-            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+            shutil.rmtree(scan_wd, ignore_errors=True)
             return
 
         scan_results = json.load(open(report_filename))
@@ -322,9 +330,9 @@ def _scanjs_thread(scan_id, asset_kw):
         findings.append(summary_asset_finding)
 
     # Write results under mutex
-    scan_lock = threading.RLock()
-    with scan_lock:
-        engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
+    with SCAN_LOCK:
+        if not engine.is_cancelled(scan_id):
+            engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
 
     # Remove the workdir
     shutil.rmtree(scan_wd, ignore_errors=True)
@@ -341,6 +349,8 @@ def _scanowaspdc_thread(scan_id, asset_kw):
         os.makedirs(scan_wd)
 
     for asset_value in asset_values:
+        if engine.is_cancelled(scan_id):
+            break
         checked_files = []
         # create the asset scan workdir
         scan_wd_asset = "{}/{}/src".format(scan_wd, hashlib.sha1(str(asset_value).encode('utf-8')).hexdigest()[:6])
@@ -370,11 +380,11 @@ def _scanowaspdc_thread(scan_id, asset_kw):
         cmd = 'libs/dependency-check/bin/dependency-check.sh --scan "{}" --format JSON --out "{}/oc_{}.json" --project "{}" --enableExperimental'.format(
             scan_wd_asset, scan_wd_asset, scan_id, scan_id)
 
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        if engine.run_process(scan_id, cmd, shell=True, stdout=subprocess.DEVNULL) is None:
+            # Scan stopped
+            break
 
-        # Wait a little to ensure the report file is completely writen
-        p.wait()
-        time.sleep(2)
+        # The tool exited (and was reaped): its report is complete
 
         report_filename = scan_wd_asset + "/oc_{}.json".format(scan_id)
         if not os.path.exists(report_filename):
@@ -455,9 +465,9 @@ def _scanowaspdc_thread(scan_id, asset_kw):
         findings.append(summary_asset_finding)
 
     # Write results under mutex
-    scan_lock = threading.RLock()
-    with scan_lock:
-        engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
+    with SCAN_LOCK:
+        if not engine.is_cancelled(scan_id):
+            engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
 
     # Remove the workdir
     shutil.rmtree(scan_wd, ignore_errors=True)
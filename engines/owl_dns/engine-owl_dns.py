@@ -1,11 +1,16 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import os, sys, json, time, urllib, hashlib, threading, datetime, copy, dns.resolver, socket, optparse
-from flask import Flask, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, request, jsonify, redirect, url_for
 import validators
 import whois
 from modules.dnstwist import dnstwist
 from concurrent.futures import ThreadPoolExecutor
+from PatrowlEnginesUtils.PatrowlEngineScheduler import ScanScheduler
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken
+from PatrowlEnginesUtils.PatrowlEngineMetrics import EngineMetrics
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import delta_only
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
 
 
 app = Flask(__name__)
@@ -26,6 +31,11 @@ this.resolver = dns.resolver.Resolver()
 this.resolver.lifetime = this.resolver.timeout = 5.0
 
 this.pool = ThreadPoolExecutor(4)
+this.scheduler = ScanScheduler(name="owl_dns-worker")
+this.metrics = EngineMetrics("owl_dns")
+this.metrics.register_scheduler(this.scheduler)
+this.metrics.register_scans(this.scans)
+this.results = ResultsStore(BASE_DIR + "/results", "owl_dns")  # Findings reports and their fingerprints
 
 
 @app.route('/')
@@ -104,93 +114,83 @@ def start_scan():
         'scan_id':      scan_id,
         'status':       "STARTED",
         'started_at':   int(time.time() * 1000),
-        'findings':     {}
+        'findings':     {},
+        'cancel_token': CancelToken()
     }
 
     this.scans.update({scan_id: scan})
+    this.metrics.scan_started(scan_id)
 
-    if 'do_whois' in scan['options'].keys() and data['options']['do_whois']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_get_whois, args=(scan_id, asset["value"],))
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_advanced_whois' in scan['options'].keys() and data['options']['do_advanced_whois']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_get_whois, args=(scan_id, asset["value"],))
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    # subdomains enumeration using search engines, VT and public PassiveDNS API
-    if 'do_subdomain_enum' in scan['options'].keys() and data['options']['do_subdomain_enum']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_subdomain_enum, args=(scan_id, asset["value"],))
-                th.daemon = True
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_subdomains_resolve' in scan['options'].keys() and data['options']['do_subdomains_resolve']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_dns_resolve, args=(scan_id, asset["value"], True))
-                th.daemon = True
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_dns_resolve' in scan['options'].keys() and data['options']['do_dns_resolve']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_dns_resolve, args=(scan_id, asset["value"], False))
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_subdomain_bruteforce' in scan['options'].keys() and data['options']['do_subdomain_bruteforce']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = threading.Thread(target=_subdomain_bruteforce, args=(scan_id, asset["value"],))
-                th.daemon = True
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_reverse_dns' in scan['options'].keys() and data['options']['do_reverse_dns']:
-        for asset in data["assets"]:
-            if asset["datatype"] == "ip":
-                th = threading.Thread(target=_reverse_dns, args=(scan_id, asset["value"]))
-                th.start()
-                this.scans[scan_id]['threads'].append(th)
-
-    if 'do_dnstwist_subdomain_search' in scan['options'].keys() and data['options']['do_dnstwist_subdomain_search']:
-        # Check if extra TLD should be tested
-        tld = False
-        if 'dnstwist_check_tld' in scan['options'].keys() and data['options']['dnstwist_check_tld']:
-            tld = this.scanner['dnstwist_common_tlds']
-        check_ssdeep = False
-        if 'dnstwist_check_ssdeep' in scan['options'].keys() and data['options']['dnstwist_check_ssdeep']:
-            check_ssdeep = True
-        check_geoip = False
-        if 'dnstwist_check_geoip' in scan['options'].keys() and data['options']['dnstwist_check_geoip']:
-            check_geoip = True
-        check_mx = False
-        if 'dnstwist_check_mx' in scan['options'].keys() and data['options']['dnstwist_check_mx']:
-            check_mx = True
-        check_whois = False
-        if 'dnstwist_check_whois' in scan['options'].keys() and data['options']['dnstwist_check_whois']:
-            check_whois = True
-        check_banners = False
-        if 'dnstwist_check_banners' in scan['options'].keys() and data['options']['dnstwist_check_banners']:
-            check_banners = True
-        timeout = APP_TIMEOUT
-        if 'max_timeout' in scan['options'].keys() and data['options']['max_timeout']:
-            timeout = data['options']['max_timeout']
-
-        for asset in data["assets"]:
-            if asset["datatype"] == "domain":
-                th = this.pool.submit(dnstwist.search_subdomains, scan_id, asset["value"], tld, check_ssdeep, check_geoip, check_mx, check_whois, check_banners, timeout)
-                this.scans[scan_id]['dnstwist'][asset["value"]] = {}
-                this.scans[scan_id]['futures'].append(th)
+    # Not finished before all its jobs are queued (see ScanScheduler.open_scan)
+    this.scheduler.open_scan(scan_id)
+    try:
+        if 'do_whois' in scan['options'].keys() and data['options']['do_whois']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _get_whois, args=(scan_id, asset["value"],), criticity=asset.get("criticity"))
+
+        if 'do_advanced_whois' in scan['options'].keys() and data['options']['do_advanced_whois']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _get_whois, args=(scan_id, asset["value"],), criticity=asset.get("criticity"))
+
+        # subdomains enumeration using search engines, VT and public PassiveDNS API
+        if 'do_subdomain_enum' in scan['options'].keys() and data['options']['do_subdomain_enum']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _subdomain_enum, args=(scan_id, asset["value"],), criticity=asset.get("criticity"))
+
+        if 'do_subdomains_resolve' in scan['options'].keys() and data['options']['do_subdomains_resolve']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _dns_resolve, args=(scan_id, asset["value"], True), criticity=asset.get("criticity"))
+
+        if 'do_dns_resolve' in scan['options'].keys() and data['options']['do_dns_resolve']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _dns_resolve, args=(scan_id, asset["value"], False), criticity=asset.get("criticity"))
+
+        if 'do_subdomain_bruteforce' in scan['options'].keys() and data['options']['do_subdomain_bruteforce']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    this.scheduler.submit(scan_id, _subdomain_bruteforce, args=(scan_id, asset["value"],), criticity=asset.get("criticity"))
+
+        if 'do_reverse_dns' in scan['options'].keys() and data['options']['do_reverse_dns']:
+            for asset in data["assets"]:
+                if asset["datatype"] == "ip":
+                    this.scheduler.submit(scan_id, _reverse_dns, args=(scan_id, asset["value"]), criticity=asset.get("criticity"))
+
+        if 'do_dnstwist_subdomain_search' in scan['options'].keys() and data['options']['do_dnstwist_subdomain_search']:
+            # Check if extra TLD should be tested
+            tld = False
+            if 'dnstwist_check_tld' in scan['options'].keys() and data['options']['dnstwist_check_tld']:
+                tld = this.scanner['dnstwist_common_tlds']
+            check_ssdeep = False
+            if 'dnstwist_check_ssdeep' in scan['options'].keys() and data['options']['dnstwist_check_ssdeep']:
+                check_ssdeep = True
+            check_geoip = False
+            if 'dnstwist_check_geoip' in scan['options'].keys() and data['options']['dnstwist_check_geoip']:
+                check_geoip = True
+            check_mx = False
+            if 'dnstwist_check_mx' in scan['options'].keys() and data['options']['dnstwist_check_mx']:
+                check_mx = True
+            check_whois = False
+            if 'dnstwist_check_whois' in scan['options'].keys() and data['options']['dnstwist_check_whois']:
+                check_whois = True
+            check_banners = False
+            if 'dnstwist_check_banners' in scan['options'].keys() and data['options']['dnstwist_check_banners']:
+                check_banners = True
+            timeout = APP_TIMEOUT
+            if 'max_timeout' in scan['options'].keys() and data['options']['max_timeout']:
+                timeout = data['options']['max_timeout']
+
+            for asset in data["assets"]:
+                if asset["datatype"] == "domain":
+                    th = this.pool.submit(dnstwist.search_subdomains, scan_id, asset["value"], tld, check_ssdeep, check_geoip, check_mx, check_whois, check_banners, timeout, cancel_token=scan['cancel_token'])
+                    this.scans[scan_id]['dnstwist'][asset["value"]] = {}
+                    this.scans[scan_id]['futures'].append(th)
+    finally:
+        this.scheduler.close_scan(scan_id)
 
     res.update({
         "status": "accepted",
@@ -201,6 +201,18 @@ def start_scan():
     return jsonify(res)
 
 
+def _is_cancelled(scan_id):
+    return scan_id not in this.scans.keys() or this.scans[scan_id]['cancel_token'].is_cancelled()
+
+
+def _cancel_scan(scan_id):
+    """Cancel the jobs of a scan: queued ones are dropped, running ones stop at their next unit."""
+    this.scheduler.forget(scan_id)
+    this.scans[scan_id]['cancel_token'].cancel()
+    for f in this.scans[scan_id]['futures']:
+        f.cancel()
+
+
 def __is_ip_addr(host):
     res = False
     try:
@@ -225,6 +237,8 @@ def _dns_resolve(scan_id, asset, check_subdomains=False):
     res.update({asset: __dns_resolve_asset(asset)})
 
     with this.scan_lock:
+        if _is_cancelled(scan_id):
+            return res
         this.scans[scan_id]["findings"]["dns_resolve"] = res
 
     if check_subdomains:
@@ -232,11 +246,15 @@ def _dns_resolve(scan_id, asset, check_subdomains=False):
         subdomains = _subdomain_enum(scan_id, asset)
         for a in subdomains.keys():
             for s in subdomains[a]:
+                if _is_cancelled(scan_id):
+                    return res
                 data = __dns_resolve_asset(s)
                 if len(data) > 0:
                     res_dom.update({asset: {s: data}})
 
         with this.scan_lock:
+            if _is_cancelled(scan_id):
+                return res
             this.scans[scan_id]["findings"]["subdomains_resolve"] = res_dom
 
     return res
@@ -265,7 +283,7 @@ def _reverse_dns(scan_id, asset):
     res = {}
 
     # check the asset is a valid domain name
-    if not __is_ip_addr(asset):
+    if _is_cancelled(scan_id) or not __is_ip_addr(asset):
         return res
 
     try:
@@ -280,6 +298,8 @@ def _reverse_dns(scan_id, asset):
 
     scan_lock = threading.RLock()
     with scan_lock:
+        if _is_cancelled(scan_id):
+            return res
         this.scans[scan_id]["findings"]["reverse_dns"] = res
 
     return res
@@ -289,10 +309,11 @@ def _get_whois(scan_id, asset):
     res = {}
 
     # check the asset is a valid domain name
-    if not __is_domain(asset):
+    if _is_cancelled(scan_id) or not __is_domain(asset):
         return res
 
-    w = whois.whois(str(asset))
+    with this.metrics.api_call("whois"):
+        w = whois.whois(str(asset))
     if w.domain_name is None:
         res.update({
             asset: {"errors": w}
@@ -304,6 +325,8 @@ def _get_whois(scan_id, asset):
 
     scan_lock = threading.RLock()
     with scan_lock:
+        if _is_cancelled(scan_id):
+            return res
         this.scans[scan_id]["findings"]["whois"] = res
 
     return res
@@ -330,12 +353,17 @@ def _subdomain_bruteforce(scan_id, asset):
 
     valid_sudoms = []
     for sub in SUB_LIST:
+        if _is_cancelled(scan_id):
+            return res
         subdom = ".".join((sub, asset))
         results = __dns_resolve_asset(subdom)
 
         if len(results) > 0:
             valid_sudoms.append(subdom)
 
+    if _is_cancelled(scan_id):
+        return res
+
     # add the subdomain in scan['findings']['subdomains_list'] if not exists
     # @todo: mutex on this.scans[scan_id]['findings']['subdomains_list']
     if 'subdomains_list' in this.scans[scan_id]['findings'].keys():
@@ -359,7 +387,7 @@ def _subdomain_enum(scan_id, asset):
     res = {}
 
     # check the asset is a valid domain name
-    if not __is_domain(asset):
+    if _is_cancelled(scan_id) or not __is_domain(asset):
         return res
 
     sub_res = sublist3r.main(
@@ -371,6 +399,8 @@ def _subdomain_enum(scan_id, asset):
         engines=None)
 
     res.update({asset: sub_res})
+    if _is_cancelled(scan_id):
+        return res
 
     if 'subdomains_list' in this.scans[scan_id]['findings'].keys():
         if asset in this.scans[scan_id]['findings']['subdomains_list']:
@@ -402,14 +432,8 @@ def stop_scan(scan_id):
         res.update({"status": "error", "reason": "scan '{}' is not running (status={})".format(scan_id, this.scans[scan_id]['status'])})
         return jsonify(res)
 
-    for t in this.scans[scan_id]['threads']:
-        # t._Thread__stop()
-        # t.terminate()
-        try:
-            t.join()
-            this.scans[scan_id]['threads'].remove(t)
-        except Exception:
-            pass
+    # Drop the queued jobs of the scan, stop the running ones
+    _cancel_scan(scan_id)
     this.scans[scan_id]['status'] = "STOPPED"
     this.scans[scan_id]['finished_at'] = int(time.time() * 1000)
 
@@ -431,6 +455,9 @@ def stop():
 @app.route('/engines/owl_dns/clean')
 def clean():
     res = {"page": "clean"}
+    for scan_id in this.scans.keys():
+        _cancel_scan(scan_id)
+        this.metrics.scan_removed(scan_id)
     this.scans.clear()
     _loadconfig()
     res.update({"status": "SUCCESS"})
@@ -446,35 +473,22 @@ def clean_scan(scan_id):
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
-    # Terminate thread if any
-    for t in this.scans[scan_id]['threads']:
-        try:
-            # t._Thread__stop()
-            # t.terminate()
-            # print("{}: clean threads '{}'".format(scan_id, t))
-            t.join()
-            this.scans[scan_id]['threads'].remove(t)
-        except Exception as e:
-            print(e)
-            pass
-    #
-    # for t in this.scans[scan_id]['futures']:
-    #     try:
-    #         # t._Thread__stop()
-    #         # t.terminate()
-    #         print("{}: clean futures '{}'".format(scan_id, t))
-    #         print(dir(t))
-    #         # t.join()
-    #     except Exception as e:
-    #         print(e)
-    #         pass
+    # Drop the queued jobs if any, stop the running ones
+    _cancel_scan(scan_id)
 
     # Remove Scan for current scans
     this.scans.pop(scan_id)
+    this.metrics.scan_removed(scan_id)
     res.update({"status": "removed"})
     return jsonify(res)
 
 
+@app.route('/engines/owl_dns/metrics')
+def getmetrics():
+    # Not named 'metrics': it would replace this.metrics (module global)
+    return this.metrics.response()
+
+
 @app.route('/engines/owl_dns/status/<scan_id>')
 def scan_status(scan_id):
     if scan_id not in this.scans.keys():
@@ -482,18 +496,17 @@ def scan_status(scan_id):
             "status": "ERROR",
             "details": "scan_id '{}' not found".format(scan_id)})
 
+    if this.scans[scan_id]['status'] == "STOPPED":
+        return jsonify({"status": this.scans[scan_id]['status']})
+
     all_threads_finished = True
 
-    for t in this.scans[scan_id]['threads']:
-        # print("scan_status-thread:", t.name, t.native_id)
-        if t.is_alive():
+    progress = this.scheduler.progress(scan_id)
+    if progress is not None:
+        this.scans[scan_id]['progress'] = progress
+        if not this.scheduler.is_finished(scan_id):
             this.scans[scan_id]['status'] = "SCANNING"
             all_threads_finished = False
-            break
-        else:
-            # Terminate thread
-            t.join()
-            this.scans[scan_id]['threads'].remove(t)
 
     for f in this.scans[scan_id]['futures']:
         if not f.done():
@@ -505,11 +518,15 @@ def scan_status(scan_id):
             this.scans[scan_id]['dnstwist'][dnstwist_asset] = dnstwist_results
             this.scans[scan_id]['futures'].remove(f)
 
-    if all_threads_finished and len(this.scans[scan_id]['threads']) == 0 and len(this.scans[scan_id]['futures']) == 0:
+    if all_threads_finished and len(this.scans[scan_id]['futures']) == 0:
         this.scans[scan_id]['status'] = "FINISHED"
         this.scans[scan_id]['finished_at'] = int(time.time() * 1000)
+        this.metrics.scan_finished(scan_id)
 
-    return jsonify({"status": this.scans[scan_id]['status']})
+    res = {"status": this.scans[scan_id]['status']}
+    if progress is not None:
+        res.update({"progress": progress})
+    return jsonify(res)
 
 
 @app.route('/engines/owl_dns/status')
@@ -985,6 +1002,9 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in this.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        if "cursor" in request.args and this.results.find(scan_id) is not None:
+            return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -1000,29 +1020,27 @@ def getfindings(scan_id):
         "scan_id": scan_id
     }
 
-    # Store the findings in a file
-    with open(BASE_DIR+"/results/owl_dns_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time. Compared with the
+    # previous scan of the assets, only the changes with 'delta_only'
+    summary = this.results.write_report(
+        scan_id, scan, issues, summary=summary, default=_json_serial,
+        assets=this.scans[scan_id]["assets"], delta_only=delta_only(this.scans[scan_id]))
+    this.metrics.scan_findings(scan_id, summary["nb_issues"])
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan_id, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    res.update({"scan": scan_id})
+    return this.results.findings_response(scan_id, res, request.args, request.headers.get("Accept"))
 
 
 @app.route('/engines/owl_dns/getreport/<scan_id>')
 def getreport(scan_id):
-    filepath = BASE_DIR+"/results/owl_dns_"+scan_id+".json"
-
-    if not os.path.exists(filepath):
+    if this.results.find(scan_id) is None:
         return jsonify({"status": "error", "reason": "report file for scan_id '{}' not found".format(scan_id)})
 
-    return send_from_directory(BASE_DIR+"/results/", "owl_dns_"+scan_id+".json")
+    # Compressed reports are sent as is to the clients accepting them
+    return this.results.report_response(scan_id, request.accept_encodings)
 
 
 def _json_serial(obj):
@@ -5,7 +5,10 @@ import subprocess
 import os
 import json
 import hashlib
+import tempfile
 from .common import json_validator
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken, terminate_process
+from PatrowlEnginesUtils.PatrowlEngineProcess import supervisor
 
 DNSTWIST_TIMEOUT = 600
 DNSTWIST_NB_THREADS = 5
@@ -27,7 +30,10 @@ class dnstwist:
             print("[+] ERROR - Not able to load dnstwist module.")
             return False
 
-    def search_subdomains(scan_id, domain, tld=False, ssdeep=False, geoip=False, mxcheck=False, whois=False, banners=False, timeout=DNSTWIST_TIMEOUT, nb_threads=DNSTWIST_NB_THREADS):
+    def search_subdomains(scan_id, domain, tld=False, ssdeep=False, geoip=False, mxcheck=False, whois=False, banners=False, timeout=DNSTWIST_TIMEOUT, nb_threads=DNSTWIST_NB_THREADS, cancel_token=None):
+        # dnstwist is terminated with the scan (see PatrowlEngineCancel)
+        if cancel_token is None:
+            cancel_token = CancelToken()
         cmd = "{} -r -f json -t {}".format(globals()['dnstwist'].__file__, nb_threads)
         if tld and os.path.exists(tld):
             cmd += " --tld {}".format(tld)
@@ -44,11 +50,20 @@ class dnstwist:
         cmd += " {}".format(domain)
 
         outs = b'[{}]'
-        try:
-            outs = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True, timeout=timeout)
-        except subprocess.TimeoutExpired:
-            print("[+] ERROR - Timeout reached ({}s) for cmd: {}".format(
-                timeout, cmd))
+        with tempfile.TemporaryFile() as outs_file:
+            proc = cancel_token.popen(cmd, stdout=outs_file, stderr=subprocess.STDOUT, shell=True)
+            if proc is None:
+                return domain, {}
+            try:
+                if supervisor.wait(proc, timeout) is None:
+                    print("[+] ERROR - Timeout reached ({}s) for cmd: {}".format(
+                        timeout, cmd))
+                    terminate_process(proc)
+                elif not cancel_token.is_cancelled():
+                    outs_file.seek(0)
+                    outs = outs_file.read()
+            finally:
+                cancel_token.unregister(proc)
         # print(outs)
         if json_validator(outs):
             return domain, json.loads(outs)
@@ -26,6 +26,7 @@ APP_SEARCH_TWITTER_MAX_COUNT_DEFAULT = 100
 APP_ENGINE_NAME = "owl_leaks"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 VERSION = "1.4.18"
+SCAN_LOCK = threading.RLock()
 
 app = Flask(__name__)
 engine = PatrowlEngine(
@@ -111,6 +112,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route('/engines/owl_leaks/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/owl_leaks/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/owl_leaks/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -135,6 +148,12 @@ def getfindings(scan_id):
     return engine.getfindings(scan_id)
 
 
+@app.route('/engines/owl_leaks/getpartialfindings/<scan_id>')
+def getpartialfindings(scan_id):
+    """Get the findings produced since '?since=' on running or finished scans."""
+    return engine.getpartialfindings(scan_id)
+
+
 @app.route('/engines/owl_leaks/getreport/<scan_id>')
 def getreport(scan_id):
     """Get report on finished scans."""
@@ -151,19 +170,15 @@ def start_scan():
 
     scan_id = res["details"]["scan_id"]
 
-    if engine.had_options("github_api_token") and "search_github" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["search_github"] is True:
-        for asset in engine.scans[scan_id]["assets"]:
-            th = threading.Thread(target=_search_github_thread, args=(scan_id, asset["value"],))
-            th.start()
-            engine.scans[scan_id]['threads'].append(th)
-
-    if engine.had_options(["twitter_oauth_token", "twitter_oauth_secret", "twitter_consumer_key", "twitter_consumer_secret"]) and "search_twitter" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["search_twitter"] is True:
-        for asset in engine.scans[scan_id]["assets"]:
-            th = threading.Thread(target=_search_twitter_thread, args=(scan_id, asset["value"],))
-            th.start()
-            engine.scans[scan_id]['threads'].append(th)
+    # SCANNING until all the jobs are queued and done
+    with engine.scheduling(scan_id):
+        if engine.had_options("github_api_token") and "search_github" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["search_github"] is True:
+            for asset in engine.scans[scan_id]["assets"]:
+                engine.schedule(scan_id, _search_github_thread, args=(scan_id, asset["value"],), asset=asset)
 
-    engine.scans[scan_id]['status'] = "SCANNING"
+        if engine.had_options(["twitter_oauth_token", "twitter_oauth_secret", "twitter_consumer_key", "twitter_consumer_secret"]) and "search_twitter" in engine.scans[scan_id]["options"].keys() and engine.scans[scan_id]["options"]["search_twitter"] is True:
+            for asset in engine.scans[scan_id]["assets"]:
+                engine.schedule(scan_id, _search_twitter_thread, args=(scan_id, asset["value"],), asset=asset)
 
     # Finish
     res.update({"status": "accepted"})
@@ -306,8 +321,7 @@ def _search_github_thread(scan_id, asset_kw):
         findings.append(new_finding)
 
     # Write results under mutex
-    scan_lock = threading.RLock()
-    with scan_lock:
+    with SCAN_LOCK:
         engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
 
 
@@ -382,8 +396,7 @@ def _search_twitter_thread(scan_id, asset_kw):
             findings.append(new_finding)
 
     # Write results under mutex
-    scan_lock = threading.RLock()
-    with scan_lock:
+    with SCAN_LOCK:
         engine.scans[scan_id]["findings"] = engine.scans[scan_id]["findings"] + findings
 
 
@@ -7,10 +7,8 @@ import json
 import time
 import copy
 import datetime
-import requests
 from urllib.parse import urlparse
 from flask import Flask, request, jsonify
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
 
@@ -103,6 +101,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route('/engines/owl_request/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/owl_request/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/owl_request/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -226,6 +236,7 @@ def start_scan():
     scan["status"] = "STARTED"
     scan["threads"] = []
     scan["findings"] = []
+    scan["callback_url"] = engine.callback_url(data)
 
     engine.scans.update({scan["scan_id"]: scan})
     # thread = threading.Thread(target=_scan_urls, args=(scan["scan_id"],))
@@ -260,19 +271,19 @@ def _scan_http(scan_id, asset):
 
     try:
         if http_method == "GET":
-            requests.get(url)
+            engine.http.get(url)
         elif http_method == "POST":
-            requests.post(url, data=http_data)
+            engine.http.post(url, data=http_data)
         elif http_method == "PUT":
-            requests.put(url, data=http_data)
+            engine.http.put(url, data=http_data)
         elif http_method == "DELETE":
-            requests.delete(url)
+            engine.http.delete(url)
         elif http_method == "HEAD":
-            requests.head(url)
+            engine.http.head(url)
         elif http_method == "PATCH":
-            requests.patch(url, data=http_data)
+            engine.http.patch(url, data=http_data)
         elif http_method == "OPTIONS":
-            requests.options(url)
+            engine.http.options(url)
     except Exception as e:
         print(e)
         return False
@@ -345,6 +356,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -365,23 +380,13 @@ def getfindings(scan_id):
         "finished_at": engine.scans[scan_id]['finished_at']
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/owl_request_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({
-        "scan": scan,
-        "summary": summary,
-        "issues": issues,
-        "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
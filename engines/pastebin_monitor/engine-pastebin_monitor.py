@@ -11,13 +11,14 @@ Copyright (c) 2020 Yann Faure - Leboncoin
 
 import os
 import sys
-import json
+import copy
 import time
 import datetime
 import logging
 from flask import Flask, request, jsonify, redirect, url_for
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineConfig import ConfigLoader
 
 from classes.database import Database
 
@@ -40,6 +41,13 @@ engine = PatrowlEngine(
     max_scans=APP_MAXSCANS
 )
 
+CONF_FILE = APP_BASE_DIR+'/pastebin_monitor.json'
+if len(sys.argv) > 1 and os.path.exists(APP_BASE_DIR+"/"+sys.argv[1]):
+    CONF_FILE = APP_BASE_DIR + "/" + sys.argv[1]
+CONFIG = ConfigLoader(CONF_FILE)
+this = sys.modules[__name__]
+this.config = None
+
 @app.errorhandler(404)
 def page_not_found(error):
     '''Page not found.'''
@@ -113,6 +121,16 @@ def stop_scan(scan_id):
     '''stop_scan'''
     return engine.stop_scan(scan_id)
 
+@app.route('/engines/pastebin_monitor/metrics')
+def metrics():
+    '''Get the engine metrics (Prometheus text format).'''
+    return engine.getmetrics()
+
+@app.route('/engines/pastebin_monitor/events')
+def events():
+    '''Stream the status transitions and findings of the scans (Server-Sent Events).'''
+    return engine.getevents()
+
 @app.route('/engines/pastebin_monitor/status/<scan_id>')
 def status_scan(scan_id):
     '''Get status on scan identified by id.'''
@@ -129,21 +147,21 @@ def status_scan(scan_id):
 @app.route('/engines/pastebin_monitor/getreport/<scan_id>')
 def getreport(scan_id):
     '''Get report on finished scans.'''
-    res = {'status': 'ERROR', 'reason': 'no issues found'}
-
-    if os.path.isfile('results/pastebin_monitor_report_{}.txt'.format(scan_id)):
-        result_file = open('results/pastebin_monitor_report_{scan_id}.txt'
-                           .format(scan_id=scan_id), 'r')
-        result = result_file.read()
-        result_file.close()
-        return jsonify(result)
-    return jsonify(res)
+    return engine.getreport(scan_id)
 
 @app.route('/engines/pastebin_monitor/getfindings/<scan_id>')
 def getfindings(scan_id):
     '''Get findings on finished scans.'''
     res = {'page': 'getfindings', 'scan_id': scan_id}
 
+    if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
+        res.update({'status': 'error', 'reason': "scan_id '{}' not found".format(scan_id)})
+        return jsonify(res)
+
     data = database.fetchall('SELECT id, asset, link, content, criticity, \
                                 is_new, date_found, date_updated FROM findings')
 
@@ -170,14 +188,6 @@ def getfindings(scan_id):
                 SET is_new = ?, date_updated = ? WHERE id = ?',
                 (0, datetime.datetime.now(), row[0]))
 
-    nb_vulns = {
-        "info": 0,
-        "low": 0,
-        "medium": 0,
-        "high": 0,
-        "critical": 0
-    }
-
     scan = {
         "scan_id": scan_id,
         "assets": engine.scans[scan_id]["assets"],
@@ -186,26 +196,12 @@ def getfindings(scan_id):
         "started_at": engine.scans[scan_id]["started_at"]
     }
 
-    summary = {
-        "nb_issues": len(issues),
-        "nb_info": nb_vulns["info"],
-        "nb_low": nb_vulns["low"],
-        "nb_medium": nb_vulns["medium"],
-        "nb_high": nb_vulns["high"],
-        "nb_critical": nb_vulns["critical"],
-        "engine_name": "pastebin_monitor"
-    }
-
-    if not os.path.isfile('results/pastebin_monitor_report_{}.txt'.format(scan_id)):
-        result_file = open('results/pastebin_monitor_report_{}.txt'.format(scan_id), 'w')
-        result_file.write(json.dumps({'scan': scan, 'summary': summary, 'issues': issues}))
-        result_file.close()
+    # Store the findings in a file, one at a time (with the severity counters)
+    engine.write_findings(scan_id, scan, issues, summary={"engine_name": "pastebin_monitor"})
 
     clean_scan(scan_id)
 
-    res.update({'scan': scan, 'summary': summary, 'issues': issues, 'status': 'success'})
-
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 @app.route('/engines/pastebin_monitor/startscan', methods=['POST'])
 def start_scan():
@@ -230,23 +226,23 @@ def start_scan():
 
     return jsonify(res)
 
-def _loadconfig():
-    '''Load the Engine configuration.'''
-    conf_file = APP_BASE_DIR+'/pastebin_monitor.json'
-    if len(sys.argv) > 1 and os.path.exists(APP_BASE_DIR+"/"+sys.argv[1]):
-        conf_file = APP_BASE_DIR + "/" + sys.argv[1]
-    if os.path.exists(conf_file):
-        json_data = open(conf_file)
-        engine.scanner = json.load(json_data)
-        engine.scanner["status"] = "READY"
-        return {"status": "success"}
-    return {"status": "error", "reason": "config file not found"}
+def _loadconfig(force=False):
+    '''Load the Engine configuration (parsed again only if the file changed).'''
+    try:
+        config = CONFIG.get(force=force)
+    except PatrowlEngineExceptions:
+        return {"status": "error", "reason": "config file not found"}
+    if config is not this.config:
+        # Working copy of the config: the snapshot is left as is
+        engine.scanner = dict(copy.deepcopy(config.config), status="READY")
+        this.config = config
+    return {"status": "success"}
 
 @app.route('/engines/pastebin_monitor/reloadconfig')
 def reloadconfig():
     '''reloadconfig'''
     res = {"page": "reloadconfig"}
-    _loadconfig()
+    _loadconfig(force=True)
     res.update({"config": engine.scanner})
     return jsonify(res)
 
@@ -4,7 +4,6 @@ import os
 import sys
 import requests
 import json
-import threading
 import datetime
 import time
 import hashlib
@@ -14,7 +13,6 @@ from urllib.parse import urlparse
 from flask import Flask, request, jsonify
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
 
@@ -178,9 +176,10 @@ def _loadconfig():
         engine.scanner = json.load(json_data)
         if "api_url" not in engine.scanner.keys() or engine.scanner["api_url"] == "":
             engine.scanner["api_url"] = DEFAULT_API_URL
+        engine.scanner["api_url"] = os.environ.get('SSLLABS_API_URL', engine.scanner["api_url"])
 
         try:
-            r = requests.get(url=engine.scanner['api_url'] + 'info', verify=False)
+            r = engine.http.get(engine.scanner['api_url'] + 'info', verify=False, api="ssllabs")
             if r.status_code == 200:
                 engine.scanner['status'] = 'READY'
             else:
@@ -218,7 +217,7 @@ def _is_scan_finished(scan_id):
     all_scans_done = False
     try:
         for host in engine.scans[scan_id]["assets"]:
-            r = requests.get(url=host["url"], verify=False)
+            r = engine.http.get(host["url"], verify=False, api="ssllabs", coalesce=True)
             if r.status_code == 200 and json.loads(r.text)["status"] in ["READY", "ERROR"]:
                 all_scans_done = True
 
@@ -234,6 +233,18 @@ def _is_scan_finished(scan_id):
     return False
 
 
+@app.route('/engines/ssllabs/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/ssllabs/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/ssllabs/status/<scan_id>', methods=['GET'])
 def scan_status(scan_id):
     res = {"page": "scan_status"}
@@ -331,11 +342,10 @@ def start_scan():
     scan["status"] = "STARTED"
     scan["threads"] = []
     scan["findings"] = []
+    scan["callback_url"] = engine.callback_url(data)
 
     engine.scans.update({scan["scan_id"]: scan})
-    th = threading.Thread(target=_scan_urls, args=(scan["scan_id"],))
-    th.start()
-    engine.scans[scan["scan_id"]]['threads'].append(th)
+    engine.start_thread(scan["scan_id"], _scan_urls, args=(scan["scan_id"],))
 
     # Prepare data returned
     # res.update({"scan": scan})
@@ -352,7 +362,7 @@ def start_scan():
 def _scan_urls(scan_id):
     try:
         for host in engine.scans[scan_id]["assets"]:
-            r = requests.get(url=host["url"], verify=False)
+            r = engine.http.get(host["url"], verify=False, api="ssllabs", coalesce=True)
             if r.status_code == 200:
                 engine.scans[scan_id]["status"] = "SCANNING"
             else:
@@ -368,6 +378,14 @@ def _scan_urls(scan_id):
 def getfindings(scan_id):
     res = {"page": "getfindings", "scan_id": scan_id}
 
+    if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
+    elif engine.scans[scan_id].get("findings_written") and engine.results.find(scan_id) is not None:
+        return engine.findings_response(scan_id, res)
+
     if not _is_scan_finished(scan_id):
         res.update({
             "status": "error",
@@ -385,7 +403,7 @@ def getfindings(scan_id):
         tmp_status = "pending"
         while tmp_status !="READY":
             try:
-                r = requests.get(url=host["url"]+"&all=done", verify=False)
+                r = engine.http.get(host["url"]+"&all=done", verify=False, api="ssllabs", coalesce=True)
                 if r.status_code != 200:
                     res.update({
                         "status": "error",
@@ -424,19 +442,11 @@ def getfindings(scan_id):
         "engine_version": engine.scanner["version"]
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/ssllabs_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            # "scan": engine.scans[scan_id],
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, {"scan_id": scan_id}, issues, summary=summary)
+    engine.scans[scan_id]["findings_written"] = True
 
-    res.update({
-        "issues": issues,
-        "summary": summary,
-        "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 def _parse_report(results, asset_name, asset_port):
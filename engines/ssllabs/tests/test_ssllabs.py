@@ -5,12 +5,25 @@ SSLLabs Tests
 """
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngineTest import PatrowlEngineTest
+from PatrowlEnginesUtils.PatrowlEngineTest import PatrowlEngineTest, start_mocks
 
 BASE_URL = "http://127.0.0.1:5004/engines/ssllabs"
 
 # Define the engine instance
 PET = PatrowlEngineTest(engine_name="ssllabs", base_url=BASE_URL)
+MOCK = None
+
+
+def setup_module():
+    """Serve the recorded API responses if $APP_MOCK_PORT is set."""
+    global MOCK
+    MOCK = start_mocks(["ssllabs"])
+
+
+def teardown_module():
+    if MOCK is not None:
+        MOCK.stop()
+
 
 def test_generic_features():
     """ generic tests """
@@ -7,7 +7,6 @@ import os
 import sys
 import subprocess
 import threading
-import time
 from urllib.parse import urlparse
 import xml.etree.ElementTree as ET
 from flask import Flask, request, jsonify
@@ -24,6 +23,8 @@ APP_ENGINE_NAME = "sslscan"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 VERSION = "1.4.18"
 
+SCAN_LOCK = threading.RLock()
+
 app = Flask(__name__)
 CORS(app)
 engine = PatrowlEngine(
@@ -109,6 +110,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route('/engines/sslscan/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/sslscan/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/sslscan/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -133,6 +146,12 @@ def getfindings(scan_id):
     return engine.getfindings(scan_id)
 
 
+@app.route('/engines/sslscan/getpartialfindings/<scan_id>')
+def getpartialfindings(scan_id):
+    """Get the findings produced since '?since=' on running or finished scans."""
+    return engine.getpartialfindings(scan_id)
+
+
 @app.route('/engines/sslscan/getreport/<scan_id>')
 def getreport(scan_id):
     """Get report on finished scans."""
@@ -148,7 +167,15 @@ def startscan():
         return jsonify(res)
 
     scan_id = res["details"]["scan_id"]
+    _start_scan(scan_id)
 
+    # Finish
+    res.update({"status": "accepted"})
+    return jsonify(res)
+
+
+def _start_scan(scan_id):
+    """Queue the jobs of a new or resumed scan (the jobs done are skipped)."""
     if "ports" in engine.scans[scan_id]["options"].keys():
         asset_ports = engine.scans[scan_id]["options"]["ports"]
         if not isinstance(asset_ports, list):
@@ -160,32 +187,28 @@ def startscan():
     if not os.path.exists(APP_BASE_DIR+"/results/"+scan_id):
         os.makedirs(APP_BASE_DIR+"/results/"+scan_id)
 
-    assets_list = []
+    assets_list = {}
     for asset in engine.scans[scan_id]["assets"]:
         # @todo: Check if datatype is correct
         if asset["datatype"] not in engine.allowed_asset_types:
             continue
         if asset["datatype"] == "url":
             asset["value"] = urlparse(asset["value"]).netloc
-        if asset["value"] not in assets_list:
-            assets_list.append(asset["value"])
-
-    for asset in assets_list:
-        for asset_port in asset_ports:
-            th = threading.Thread(
-                target=_scan_thread,
-                kwargs={
-                    "scan_id": scan_id,
-                    "asset": asset,
-                    "asset_port": asset_port})
-            th.start()
-            engine.scans[scan_id]['threads'].append(th)
-
-    engine.scans[scan_id]['status'] = "SCANNING"
-
-    # Finish
-    res.update({"status": "accepted"})
-    return jsonify(res)
+        if asset["value"] not in assets_list.keys():
+            assets_list[asset["value"]] = asset
+
+    # SCANNING until all the jobs are queued and done
+    with engine.scheduling(scan_id):
+        for asset in assets_list.keys():
+            for asset_port in asset_ports:
+                engine.schedule(
+                    scan_id,
+                    target=_scan_thread,
+                    kwargs={
+                        "scan_id": scan_id,
+                        "asset": asset,
+                        "asset_port": asset_port},
+                    asset=assets_list[asset])
 
 
 def _scan_thread(scan_id, asset, asset_port):
@@ -199,13 +222,11 @@ def _scan_thread(scan_id, asset, asset_port):
         engine.options["bin_path"],
         output_dir, asset+"_"+asset_port, asset, asset_port)
 
-    p = subprocess.Popen(cmd, shell=True, stdout=open("/dev/null", "w"))
-    while p.poll() is None:
-        # print("still running")
-        time.sleep(1)
+    if engine.run_process(scan_id, cmd, shell=True, stdout=subprocess.DEVNULL) is None:
+        # Scan stopped
+        return
 
     _parse_xml_results(scan_id, asset, asset_port)
-    engine.scans[scan_id]['status'] = "FINISHED"
 
 
 def _parse_xml_results(scan_id, asset, asset_port):
@@ -279,8 +300,9 @@ def _parse_xml_results(scan_id, asset, asset_port):
             findings.append(hb_vuln)
 
     # Write results under mutex
-    scan_lock = threading.RLock()
-    with scan_lock:
+    with SCAN_LOCK:
+        if engine.is_cancelled(scan_id):
+            return False
         engine.scans[scan_id]["findings"] += findings
 
     return True
@@ -446,6 +468,9 @@ def main():
     if not os.path.isfile(engine.options["bin_path"]):
         sys.exit(-1)
 
+    # Resume the scans interrupted by a restart
+    engine.resume_scans(_start_scan)
+
 
 if __name__ == '__main__':
     engine.run_app(app_debug=APP_DEBUG, app_host=APP_HOST, app_port=APP_PORT)
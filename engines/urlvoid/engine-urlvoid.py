@@ -6,18 +6,16 @@ import os
 import sys
 import json
 import time
-import threading
-import random
-import requests
 import re
 from urllib.parse import urlparse
 import xml.etree.ElementTree as ElementTree
 from flask import Flask, request, jsonify
 
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 # from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngineFinding
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineKeyPool import KeyPool
+from PatrowlEnginesUtils.PatrowlEngineCache import force_refresh
 
 app = Flask(__name__)
 APP_DEBUG = False
@@ -26,6 +24,7 @@ APP_PORT = 5008
 APP_MAXSCANS = int(os.environ.get('APP_MAXSCANS', 25))
 APP_ENGINE_NAME = "urlvoid"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_API_URL = "http://api.urlvoid.com/api1000/"
 VERSION = "1.4.18"
 
 engine = PatrowlEngine(
@@ -37,7 +36,7 @@ engine = PatrowlEngine(
 )
 
 this = sys.modules[__name__]
-this.keys = []
+this.keypool = KeyPool([])
 
 
 @app.errorhandler(404)
@@ -108,6 +107,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route('/engines/urlvoid/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/urlvoid/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/urlvoid/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -137,12 +148,17 @@ def _loadconfig():
     if os.path.exists(conf_file):
         json_data = open(conf_file)
         engine.scanner = json.load(json_data)
+        engine.scanner["api_url"] = os.environ.get(
+            'URLVOID_API_URL', engine.scanner.get("api_url", DEFAULT_API_URL))
 
-        this.keys = []
-        for apikey in engine.scanner["apikeys"]:
-            this.keys.append(apikey)
+        # Rate and quota of the apikeys of the plan, if any (see PatrowlEngineKeyPool)
+        this.keypool = KeyPool(
+            engine.scanner["apikeys"], name=APP_ENGINE_NAME,
+            **engine.scanner.get("apikeys_rate", {}))
 
         del engine.scanner["apikeys"]
+        if "cache_ttl" in engine.scanner:
+            engine.cache.set_ttl(APP_ENGINE_NAME, engine.scanner["cache_ttl"])
         engine.scanner['status'] = "READY"
 
     else:
@@ -232,13 +248,12 @@ def start_scan():
         'scan_id':      scan_id,
         'status':       "STARTED",
         'started_at':   int(time.time() * 1000),
-        'findings':     {}
+        'findings':     {},
+        'callback_url': engine.callback_url(data)
     }
 
     engine.scans.update({scan_id: scan})
-    th = threading.Thread(target=_scan_urls, args=(scan_id,))
-    th.start()
-    engine.scans[scan_id]['threads'].append(th)
+    engine.start_thread(scan_id, _scan_urls, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -255,32 +270,55 @@ def _scan_urls(scan_id):
     for asset in engine.scans[scan_id]['assets']:
         assets.append(asset)
 
+    refresh = force_refresh(engine.scans[scan_id])
     for asset in assets:
-        apikey = this.keys[random.randint(0, len(this.keys)-1)]
         if asset not in engine.scans[scan_id]["findings"]:
             engine.scans[scan_id]["findings"][asset] = {}
-        try:
-            engine.scans[scan_id]["findings"][asset]['issues'] = get_report(asset, apikey)
-        except Exception as ex:
-            app.logger.error("_scan_urls failed {}".format(re.sub(r'/'+apikey+'/',r'/***/',ex.__str__())))
+        # Reports of the previous and concurrent scans, see PatrowlEngineCache
+        # Error responses (bad key, quota, ...) are not cached
+        report = engine.cache.lookup(
+            APP_ENGINE_NAME, "host", asset, lambda: _fetch_report(scan_id, asset),
+            force_refresh=refresh,
+            cacheable=lambda report: report is not None and report["status_code"] == 200 and report["error"] is None)
+        if report is None:
             return False
+        if report["error"] is not None:
+            app.logger.error("get_report failed for '{}': {}".format(asset, report["error"]))
+        engine.scans[scan_id]["findings"][asset]['issues'] = report["issues"]
 
     return True
 
 
+def _fetch_report(scan_id, asset):
+    """Get the report of an asset with the next available apikey, None if failed."""
+    apikey = this.keypool.acquire(cancel=lambda: engine.is_cancelled(scan_id))
+    if apikey is None:
+        return None
+    try:
+        return get_report(asset, apikey)
+    except Exception as ex:
+        app.logger.error("_scan_urls failed {}".format(re.sub(r'/'+apikey+'/',r'/***/',ex.__str__())))
+        return None
+
+
 def get_report(asset, apikey):
-    """Get URLVoid XML report."""
+    """Get URLVoid XML report: its status code, error (None if none) and detections."""
     scan_url = "{}{}/host/{}/".format(
-        "http://api.urlvoid.com/api1000/", apikey, asset
+        engine.scanner["api_url"], apikey, asset
     )
-    xml = requests.get(scan_url)
-    issues = []
+    xml = engine.http.get(scan_url, api="urlvoid")
+    report = {"status_code": xml.status_code, "error": None, "issues": []}
+    if xml.status_code != 200:
+        report["error"] = "HTTP {}".format(xml.status_code)
+        return report
     tree = ElementTree.fromstring(xml.text)
+    if tree.find("error") is not None:
+        report["error"] = tree.findtext("error")
     if tree.find("detections/engines") is not None:
         for child in tree.find("detections/engines"):
-            issues.append(child.text)
+            report["issues"].append(child.text)
 
-    return issues
+    return report
 
 
 def _parse_results(scan_id):
@@ -348,6 +386,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -368,19 +410,13 @@ def getfindings(scan_id):
         "finished_at": engine.scans[scan_id]['finished_at']
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/urlvoid_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
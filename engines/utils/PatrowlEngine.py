@@ -1,27 +1,43 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import os, urllib, time, datetime, optparse, json
-from flask import jsonify, url_for, redirect, send_from_directory
-from PatrowlEngineExceptions import PatrowlEngineExceptions
+import os, urllib, time, optparse, json, threading, logging
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from flask import jsonify, url_for, redirect, request, has_request_context, Response
+from .PatrowlEngineExceptions import PatrowlEngineExceptions
+from .PatrowlEngineResults import ResultsStore
+from .PatrowlEngineStore import get_scans_store
+from .PatrowlEngineScheduler import ScanScheduler, DEFAULT_MAX_WORKERS, DEFAULT_MAX_SCAN_WORKERS
+from .PatrowlEngineCancel import CancelToken
+from .PatrowlEngineProcess import supervisor
+from .PatrowlEngineJson import dumps_bytes, json_serial as _json_serial
+from .PatrowlEngineConfig import ConfigLoader
+from .PatrowlEngineMetrics import EngineMetrics
+from .PatrowlEngineHttp import HttpClient
+from .PatrowlEngineCache import get_lookup_cache
+from .PatrowlEngineFingerprint import delta_only, fingerprint, content_digest
+from .PatrowlEngineCheckpoint import get_checkpoint_store, resume_enabled, UNIT_DONE, UNIT_ERROR
+from .PatrowlEngineEvents import ScanEvents
 
 DEFAULT_APP_HOST = "127.0.0.1"
 DEFAULT_APP_PORT = 5000
 DEFAULT_APP_DEBUG = False
 DEFAULT_APP_MAXSCANS = 25
+DEFAULT_SCANS_WATCH_INTERVAL = 1
+DEFAULT_FINDINGS_FLUSH_INTERVAL = 10
+# Min seconds between two writes of the progress of a running scan
+DEFAULT_PROGRESS_WRITE_INTERVAL = 1
 
-def _json_serial(obj):
-    """
-        JSON serializer for objects not serializable by default json code
-        Used for datetime serialization when the results are written in file
-    """
-    if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
-        serial = obj.isoformat()
-        return serial
-    raise TypeError ("Type not serializable")
+logger = logging.getLogger(__name__)
+
+def _progress_key(progress):
+    # Job events may be handled out of order: the jobs ended, then the end of the scheduling
+    return (progress["done"] + progress["errors"], not progress.get("scheduling", False))
 
 
 class PatrowlEngine:
-    def __init__(self, app, base_dir, name, max_scans=DEFAULT_APP_MAXSCANS):
+    def __init__(self, app, base_dir, name, max_scans=DEFAULT_APP_MAXSCANS, scans_store=None,
+                 max_workers=DEFAULT_MAX_WORKERS, max_scan_workers=DEFAULT_MAX_SCAN_WORKERS):
         self.app = app
         self.base_dir = str(base_dir)
         self.name = name
@@ -29,10 +45,65 @@ class PatrowlEngine:
         self.description = ""
         self.allowed_asset_types = []
         self.options = {}
-        self.scans = {}
+        self.config = None
+        self.config_loader = ConfigLoader(self.base_dir+'/'+self.name+'.json')
+        if scans_store is None:
+            scans_store = get_scans_store(self.base_dir, self.name)
+        self.scans = scans_store
+        self.results = ResultsStore(self.base_dir+"/results", self.name)
         self.max_scans = max_scans
+        self.scheduler = ScanScheduler(
+            max_workers=max_workers,
+            max_scan_workers=max_scan_workers,
+            name="{}-worker".format(self.name),
+            listener=self._scan_progressed)
+        self.metrics = EngineMetrics(self.name)
+        self.metrics.register_scheduler(self.scheduler)
+        self.metrics.register_scans(self.scans)
+        self.http = HttpClient(metrics=self.metrics)
+        # Status transitions and findings of the scans, pushed to their callback URL
+        self.events = ScanEvents(self.name, self.http)
+        self.scans.listener = self.events.scan_changed
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._checkpoints = None
+        self._scan_checkpoints = {}
         self.status = "INIT"
-
+        self._scans_watcher = None
+        self._scans_watcher_lock = threading.Lock()
+        self._flushed_findings = {}
+        # Progress of the local scans not written yet, and time of their last write
+        self._pending_progress = {}
+        self._progress_written = {}
+        self._status_lock = threading.RLock()
+
+
+    @property
+    def cache(self):
+        """Lookup cache of the engine (see PatrowlEngineCache), opened on first use."""
+        if self._cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    self._cache = get_lookup_cache(self.base_dir, self.name, metrics=self.metrics)
+        return self._cache
+
+    @property
+    def checkpoints(self):
+        """Scan checkpoints of the engine (see PatrowlEngineCheckpoint), opened on first use."""
+        if self._checkpoints is None:
+            with self._cache_lock:
+                if self._checkpoints is None:
+                    self._checkpoints = get_checkpoint_store(self.results.results_dir, self.name)
+        return self._checkpoints
+
+    def checkpoint(self, scan_id):
+        """Return the checkpoint of a scan run by this process, or None."""
+        return self._scan_checkpoints.get(scan_id)
+
+    def _remove_checkpoint(self, scan_id):
+        # Stopped or cleaned scans are not resumed
+        self._scan_checkpoints.pop(scan_id, None)
+        self.checkpoints.remove(scan_id)
 
     def __str__(self):
         return "%s - %s" % (self.name, self.version)
@@ -75,26 +146,33 @@ class PatrowlEngine:
         return res
 
     def info(self):
-        self.getstatus()
+        self._refresh_status()
         return jsonify({"page": "info", "engine_config": self.__to_dict()})
 
 
-    def _loadconfig(self):
-        conf_file = self.base_dir+'/'+self.name+'.json'
-        if os.path.exists(conf_file):
-            engine_config = json.load(open(conf_file))
+    def _loadconfig(self, force=False):
+        """
+            Load the engine config. The file is parsed again only if it
+            changed since the last call (see PatrowlEngineConfig).
+        """
+        try:
+            config = self.config_loader.get(force=force)
+        except PatrowlEngineExceptions:
+            self.status = "ERROR"
+            return { "status": "ERROR", "reason": "config file not found" }
+
+        if config is not self.config:
+            engine_config = config.config
             self.version = engine_config["version"]
             self.description = engine_config["description"]
             self.options = engine_config["options"]
             self.allowed_asset_types = engine_config["allowed_asset_types"]
-            self.status = "READY"
-        else:
-            self.status = "ERROR"
-            return { "status": "ERROR", "reason": "config file not found" }
+            self.config = config
+        self.status = "READY"
 
     def reloadconfig(self):
         res = { "page": "reloadconfig" }
-        self._loadconfig()
+        self._loadconfig(force=True)
         res.update({"config": {
             "status": self.status
         }})
@@ -114,7 +192,15 @@ class PatrowlEngine:
 
     def clean(self):
         res = {"page": "clean"}
+        for scan_id in self.scans.local_scans():
+            self._cancel_scan(scan_id)
+            self.metrics.scan_removed(scan_id)
+        for scan_id in self.scans.keys():
+            self._remove_checkpoint(scan_id)
+            self.events.forget(scan_id)
         self.scans.clear()
+        self._pending_progress.clear()
+        self._progress_written.clear()
         self._loadconfig()
         res.update({"status": "SUCCESS"})
         return jsonify(res)
@@ -129,58 +215,272 @@ class PatrowlEngine:
             res.update({ "status": "ERROR", "reason": "scan_id '{}' not found".format(scan_id)})
             return jsonify(res)
 
+        self._cancel_scan(scan_id)
+        self._remove_checkpoint(scan_id)
         self.scans.pop(scan_id)
-        #Todo: force terminating all threads
+        self.events.forget(scan_id)
+        self._flushed_findings.pop(scan_id, None)
+        self._pending_progress.pop(scan_id, None)
+        self._progress_written.pop(scan_id, None)
+        self.metrics.scan_removed(scan_id)
         res.update({"status": "removed"})
         return jsonify(res)
 
 
-    def getstatus_scan(self, scan_id):
-        if not scan_id in self.scans.keys():
-            raise PatrowlEngineExceptions(1002)
-            return jsonify({
-                "status": "ERROR",
-                "details": "scan_id '{}' not found".format(scan_id)})
-
-        all_threads_finished = False
-        for t in self.scans[scan_id]['threads']:
-            if t.isAlive():
-                self.scans[scan_id]['status'] = "SCANNING"
-                all_threads_finished = False
-                break
+    def _scan_progressed(self, scan_id, progress=None):
+        """
+            Push the progress of a local scan to its status. Called by the
+            scheduler and by the scan threads when a job starts or ends.
+        """
+        with self._status_lock:
+            try:
+                scan = self.scans[scan_id]
+            except KeyError:
+                # Cleaned in the meantime
+                return
+            if scan['status'] in ["STOPPED", "ERROR"]:
+                return
+
+            if progress is not None:
+                last = self._pending_progress.get(scan_id) or scan.get('progress')
+                if last is not None and _progress_key(last) > _progress_key(progress):
+                    # Late event of an earlier job
+                    return
+                # Not finished until all its jobs are queued (see scheduling)
+                running = progress.get("scheduling", False) or progress["done"] + progress["errors"] < progress["total"]
+                if running and scan['status'] == "SCANNING" and \
+                        time.time() - self._progress_written.get(scan_id, 0) < DEFAULT_PROGRESS_WRITE_INTERVAL:
+                    # Each job starts and ends: written later (see _write_progress)
+                    self._pending_progress[scan_id] = progress
+                    return
+                self._pending_progress.pop(scan_id, None)
+                self._progress_written[scan_id] = time.time()
+                scan['progress'] = progress
             else:
-                all_threads_finished = True
-
-        if all_threads_finished and len(self.scans[scan_id]['threads']) >=1:
-            self.scans[scan_id]['status'] = "FINISHED"
-            self.scans[scan_id]['finished_at'] = int(time.time() * 1000)
-
-        return jsonify({"status": self.scans[scan_id]['status']})
+                # Threads not started yet are running
+                current = threading.current_thread()
+                running = any(t.is_alive() or t.ident is None
+                              for t in scan.get('threads', []) if t is not current)
+
+            if len(scan.get('findings', [])) > 0:
+                self.metrics.scan_first_result(scan_id)
+            if running:
+                if scan['status'] != "SCANNING":
+                    scan['status'] = "SCANNING"
+            elif scan['status'] != "FINISHED" or 'finished_at' not in scan:
+                # Persist the in-place changes (findings, ...) before publishing
+                self.scans.flush(scan_id)
+                checkpoint = self.checkpoint(scan_id)
+                if checkpoint is not None:
+                    findings = scan.get('findings')
+                    checkpoint.finish(findings if isinstance(findings, list) else None)
+                scan['finished_at'] = int(time.time() * 1000)
+                scan['status'] = "FINISHED"
+                self.metrics.scan_finished(scan_id)
+
+    def _write_progress(self, scan_id):
+        # Write the last progress of a running scan, if not written yet
+        with self._status_lock:
+            progress = self._pending_progress.pop(scan_id, None)
+            if progress is None:
+                return
+            try:
+                scan = self.scans[scan_id]
+            except KeyError:
+                return
+            if scan['status'] == "SCANNING":
+                self._progress_written[scan_id] = time.time()
+                scan['progress'] = progress
+
+    def _flush_findings(self, scan_id):
+        # Publish the findings of a running scan for the partial findings
+        # requests served by other workers
+        nb_findings = len(self.scans[scan_id].get('findings', []))
+        if self._flushed_findings.get(scan_id) != nb_findings:
+            self.scans.flush(scan_id)
+            self._flushed_findings[scan_id] = nb_findings
+
+    def _watch_scans(self):
+        # Push the number of findings of the running scans (see
+        # PatrowlEngineEvents). Shared stores: cancel the local scans stopped
+        # by other workers and publish the findings of the running ones.
+        last_flush = time.time()
+        while True:
+            time.sleep(DEFAULT_SCANS_WATCH_INTERVAL)
+            flush_findings = time.time() - last_flush >= DEFAULT_FINDINGS_FLUSH_INTERVAL
+            for scan_id in self.scans.local_scans():
+                summary = self.scans.summary(scan_id)
+                if summary is None:
+                    continue
+                try:
+                    if summary['status'] == "STOPPED":
+                        if self.scans[scan_id]['status'] != "STOPPED":
+                            self.scans[scan_id]['status'] = "STOPPED"
+                        self._cancel_scan(scan_id)
+                    elif summary['status'] in ["STARTED", "SCANNING"]:
+                        self._write_progress(scan_id)
+                        self.events.scan_changed(scan_id, self.scans[scan_id])
+                        if summary['status'] == "SCANNING" and flush_findings and self.scans.shared:
+                            self._flush_findings(scan_id)
+                except KeyError:
+                    continue
+            if flush_findings:
+                last_flush = time.time()
+
+    def _start_scans_watcher(self):
+        with self._scans_watcher_lock:
+            if self._scans_watcher is None or not self._scans_watcher.is_alive():
+                self._scans_watcher = threading.Thread(target=self._watch_scans, daemon=True)
+                self._scans_watcher.start()
+
+    def _scan_summary(self, scan_id):
+        """Return the status summary of a scan (see PatrowlEngineStatus)."""
+        summary = self.scans.summary(scan_id)
+        if summary is None:
+            raise PatrowlEngineExceptions(1002)
+        return summary
 
+    def getstatus_scan(self, scan_id):
+        self._write_progress(scan_id)
+        summary = self._scan_summary(scan_id)
+        res = {"status": summary.get('status')}
+        progress = summary.get('progress')
+        if progress is not None:
+            res.update({"progress": progress})
+        return jsonify(res)
 
-    def getstatus(self):
-        res = {"page": "status"}
+    @contextmanager
+    def scheduling(self, scan_id):
+        """
+            Queue the jobs of a scan (see schedule) in a 'with' block. The
+            scan is SCANNING from the start of the block, and FINISHED once
+            the block ended and all its jobs too, not as soon as the jobs
+            queued so far ended.
+        """
+        if self.scans[scan_id]['status'] == "STARTED":
+            self.scans[scan_id]['status'] = "SCANNING"
+        self.scheduler.open_scan(scan_id)
+        try:
+            yield
+        finally:
+            self.scheduler.close_scan(scan_id)
+
+    def schedule(self, scan_id, target, args=(), kwargs=None, asset=None, unit=None):
+        """
+            Queue a unit of work of a scan in the shared worker pool.
+            Jobs of the most critical assets are run first. The state of
+            the unit (named after the target and its arguments by default)
+            is checkpointed: the units done are skipped when the scan is
+            resumed. Return False if skipped.
+        """
+        criticity = None
+        if isinstance(asset, dict):
+            criticity = asset.get("criticity")
+
+        checkpoint = self.checkpoint(scan_id)
+        if checkpoint is not None:
+            if unit is None:
+                unit = "{}{}".format(
+                    getattr(target, "__name__", "job"),
+                    json.dumps([list(args), kwargs or {}], sort_keys=True, default=str))
+            if checkpoint.add_unit(unit) in (UNIT_DONE, UNIT_ERROR):
+                return False
+            target = self._checkpointed(scan_id, checkpoint, unit, target)
+
+        self.scheduler.submit(scan_id, target, args=args, kwargs=kwargs, criticity=criticity)
+        return True
 
-        if len(self.scans) == self.max_scans:
+    def _checkpointed(self, scan_id, checkpoint, unit, target):
+        def _run(*args, **kwargs):
+            checkpoint.unit_started(unit)
+            try:
+                target(*args, **kwargs)
+            except Exception:
+                checkpoint.unit_failed(unit)
+                raise
+            if not self.is_cancelled(scan_id):
+                checkpoint.unit_done(unit, self.scans[scan_id].get('findings'))
+        _run.__name__ = getattr(target, "__name__", "job")
+        return _run
+
+    def start_thread(self, scan_id, target, args=(), kwargs=None):
+        """
+            Run 'target(*args, **kwargs)' in a dedicated thread of the scan.
+            The scan is SCANNING until its threads end, then FINISHED.
+        """
+        def _run():
+            try:
+                target(*args, **(kwargs or {}))
+            finally:
+                self._scan_progressed(scan_id)
+
+        thread = threading.Thread(target=_run)
+        self.scans[scan_id]['threads'].append(thread)
+        thread.start()
+        self._scan_progressed(scan_id)
+        return thread
+
+
+    def _refresh_status(self):
+        # Stopped and failed scans no longer hold any resource
+        nb_active_scans = sum(n for status, n in self.scans.count_by_status().items() if status not in ["STOPPED", "ERROR"])
+        if nb_active_scans >= self.max_scans:
             self.status = "BUSY"
         else:
             self.status = "READY"
 
+    def getstatus(self):
+        res = {"page": "status"}
+
+        self._start_scans_watcher()
+        self._refresh_status()
         scans = []
-        for scan_id in self.scans.keys():
-            self.getstatus_scan(scan_id)
+        for scan_id, summary in self.scans.summaries(fields=("assets",)):
             scans.append({scan_id: {
-                "status": self.scans[scan_id]['status'],
-                "started_at": self.scans[scan_id]['started_at'],
-                "assets": self.scans[scan_id]['assets']
+                "status": summary.get('status'),
+                "started_at": summary.get('started_at'),
+                "assets": summary.get('assets')
             }})
 
         res.update({
-            "nb_scans": len(self.scans),
+            "nb_scans": len(scans),
             "status": self.status,
+            "scheduler": self.scheduler.stats(),
+            "processes": supervisor.stats(),
+            "events": self.events.stats(),
             "scans": scans})
         return jsonify(res)
 
+    def callback_url(self, params):
+        """
+            Return the 'callback_url' of startscan parameters (or of their
+            options), to which the events of the scan are POSTed, or None.
+        """
+        options = params.get('options') if isinstance(params.get('options'), dict) else {}
+        url = params.get('callback_url') or options.get('callback_url')
+        if not url:
+            return None
+        if not isinstance(url, str) or urlparse(url).scheme not in ["http", "https"]:
+            raise PatrowlEngineExceptions(1006)
+        self._start_scans_watcher()
+        return url
+
+    def getevents(self, scan_id=None):
+        """
+            Stream the events of the scans (or of '?scan_id='), as
+            Server-Sent Events. The current status of the scans is sent first.
+        """
+        if scan_id is None and has_request_context():
+            scan_id = request.args.get("scan_id")
+        stream = self.events.subscribe(scan_id)
+        for sid, summary in self.scans.summaries():
+            if scan_id is None or sid == scan_id:
+                stream.put(self.events.event(sid, "status", status=summary.get('status'), snapshot=True))
+        self._start_scans_watcher()
+        return Response(
+            self.events.sse(stream), mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
     def stop_scan(self, scan_id):
         res = {"page": "stop"}
@@ -190,19 +490,54 @@ class PatrowlEngine:
             res.update({ "status": "ERROR", "reason": "scan_id '{}' not found".format(scan_id)})
             return jsonify(res)
 
-        self.getstatus_scan(scan_id)
-        if self.scans[scan_id]['status'] not in ["STARTED", "SCANNING"]:
-            res.update({ "status": "ERROR", "reason": "scan '{}' is not running (status={})".format(scan_id, self.scans[scan_id]['status'])})
+        status = self._scan_summary(scan_id).get('status')
+        if status not in ["STARTED", "SCANNING"]:
+            res.update({ "status": "ERROR", "reason": "scan '{}' is not running (status={})".format(scan_id, status)})
             return jsonify(res)
 
-        for t in self.scans[scan_id]['threads']:
-            t._Thread__stop()
         self.scans[scan_id]['status'] = "STOPPED"
         self.scans[scan_id]['finished_at'] = int(time.time() * 1000)
+        # Scans driven by another worker are cancelled by its scans watcher
+        self._cancel_scan(scan_id)
+        self._remove_checkpoint(scan_id)
 
         res.update({"status": "SUCCESS"})
         return jsonify(res)
 
+    def _cancel_scan(self, scan_id):
+        """Drop the queued jobs of a scan and cancel its running ones."""
+        self.scheduler.forget(scan_id)
+        if not self.scans.is_local(scan_id):
+            return
+        cancel_token = self.scans[scan_id].get('cancel_token')
+        if cancel_token is not None:
+            cancel_token.cancel()
+
+    def is_cancelled(self, scan_id):
+        """
+            Return True if the scan was stopped or removed. Jobs check it
+            between their units of work.
+        """
+        try:
+            scan = self.scans[scan_id]
+        except KeyError:
+            return True
+        cancel_token = scan.get('cancel_token')
+        if cancel_token is not None and cancel_token.is_cancelled():
+            return True
+        return scan['status'] == "STOPPED"
+
+    def run_process(self, scan_id, cmd, **kwargs):
+        """
+            Run an external command in its own process group. It is terminated
+            and reaped if the scan is stopped. Return its exit code, or None
+            if the scan was stopped.
+        """
+        cancel_token = self.scans[scan_id].get('cancel_token')
+        if cancel_token is None or cancel_token.is_cancelled():
+            return None
+        return cancel_token.run(cmd, **kwargs)
+
     # Stop all scans
     def stop(self):
         res = {"page": "stopscans"}
@@ -216,14 +551,14 @@ class PatrowlEngine:
         res = {"page": "startscan", "status": "INIT"}
 
         # check the scanner is ready to start a new scan
-        if len(self.scans) == self.max_scans:
+        self._refresh_status()
+        if self.status == "BUSY":
             res.update({
                 "status": "ERROR",
                 "reason": "Scan refused: max concurrent active scans reached ({})".format(self.max_scans)
             })
             return res
 
-        self.getstatus()
         if self.status != "READY":
             res.update({
                 "status": "ERROR",
@@ -248,12 +583,97 @@ class PatrowlEngine:
         new_scan = PatrowlEngineScan(
             assets=data['assets'],
             options=data['options'],
-            scan_id=scan_id
+            scan_id=scan_id,
+            callback_url=self.callback_url(data)
         )
 
         self.scans.update({scan_id: new_scan.__dict__})
+        self.start_checkpoint(scan_id, new_scan.to_params())
+        self.metrics.scan_started(scan_id)
+        self._start_scans_watcher()
         return res
 
+    def start_checkpoint(self, scan_id, params, units=()):
+        """Checkpoint a new scan, from the parameters needed to start it again."""
+        checkpoint = self.checkpoints.create(scan_id, params, units=units)
+        self._scan_checkpoints[scan_id] = checkpoint
+        return checkpoint
+
+    def _restore_scan(self, checkpoint):
+        params = checkpoint.params
+        scan = PatrowlEngineScan(
+            assets=params.get('assets', []),
+            options=params.get('options', {}),
+            scan_id=checkpoint.scan_id,
+            callback_url=params.get('callback_url'))
+        scan.findings = checkpoint.findings()
+        return scan.__dict__
+
+    def resume_scans(self, start, restore=None):
+        """
+            Resume the scans left unfinished by a previous process of the
+            engine (see PatrowlEngineCheckpoint), on startup.
+            'restore(checkpoint)' returns the scan dict (by default, a
+            PatrowlEngineScan of the startscan parameters and the findings
+            saved), then 'start(scan_id)' runs again its units not done and
+            polls its remote jobs. Return the IDs of the scans resumed.
+        """
+        orphans = self.checkpoints.claim_orphans()
+        if not resume_enabled():
+            for checkpoint in orphans:
+                checkpoint.remove()
+            return []
+
+        resumed = []
+        for checkpoint in orphans:
+            scan_id = checkpoint.scan_id
+            try:
+                scan = restore(checkpoint) if restore is not None else self._restore_scan(checkpoint)
+            except Exception:
+                logger.exception("scan '%s' not resumed", scan_id)
+                checkpoint.remove()
+                continue
+            scan['resumed'] = True
+            self.scans.update({scan_id: scan})
+            self._scan_checkpoints[scan_id] = checkpoint
+            self.metrics.scan_started(scan_id)
+            resumed.append(scan_id)
+
+            if checkpoint.finished:
+                # Only its findings were not retrieved
+                self.scans[scan_id]['finished_at'] = int(time.time() * 1000)
+                self.scans[scan_id]['status'] = "FINISHED"
+                self.metrics.scan_finished(scan_id)
+                continue
+            try:
+                start(scan_id)
+            except Exception:
+                logger.exception("scan '%s' not resumed", scan_id)
+                self.scans[scan_id]['status'] = "ERROR"
+                continue
+            if not self.scans[scan_id].get('threads') and not self.scheduler.has_scan(scan_id):
+                # All its units were done
+                self._scan_progressed(scan_id)
+
+        if resumed:
+            self._start_scans_watcher()
+        return resumed
+
+
+    def _iter_findings(self, scan_id):
+        """Yield the findings of a scan as dicts, one at a time."""
+        # The units interrupted by a restart may find again the findings saved
+        seen = set() if self.scans[scan_id].get("resumed") else None
+        for issue in self.scans[scan_id]["findings"]:
+            # Findings of scans driven by another worker are already dicts
+            if isinstance(issue, PatrowlEngineFinding):
+                issue = issue.to_dict()
+            if seen is not None:
+                key = (fingerprint(issue), content_digest(issue))
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield issue
 
     def _parse_results(self, scan_id):
         if not scan_id in self.scans.keys():
@@ -265,7 +685,6 @@ class PatrowlEngine:
         issues = []
         summary = {}
 
-        scan = self.scans[scan_id]
         nb_vulns = {
             "info": 0,
             "low": 0,
@@ -273,9 +692,9 @@ class PatrowlEngine:
             "high": 0,
         }
 
-        for issue in self.scans[scan_id]["findings"]:
-            issues.append(issue._PatrowlEngineFinding__to_dict())
-            nb_vulns[issue.severity]+=1
+        for issue in self._iter_findings(scan_id):
+            issues.append(issue)
+            nb_vulns[issue["severity"]]+=1
 
         summary = {
             "nb_issues": len(issues),
@@ -290,49 +709,132 @@ class PatrowlEngine:
         return issues, summary
 
 
-    def getfindings(self, scan_id):
-
-        try:
+    def getfindings(self, scan_id, args=None):
+        """
+            Return the findings of a finished scan. They are streamed as one
+            JSON document, or as NDJSON pages with '?format=ndjson&cursor=&limit='.
+            Once the report is written, the scan is removed from the active
+            scan list and the next pages are served from the report file.
+        """
+        res = { "page": "getfindings", "scan_id": scan_id, "scan": scan_id }
+        accept = None
+        if has_request_context():
+            accept = request.headers.get("Accept")
+            if args is None:
+                args = request.args
+
+        if scan_id in self.scans:
+            # check if the scan is finished
+            status = self._scan_summary(scan_id).get('status')
+            if status != "FINISHED":
+                raise PatrowlEngineExceptions(1003)
+                res.update({ "status": "ERROR", "reason": "scan_id '{}' not finished (status={})".format(scan_id, status)})
+                return jsonify(res)
+
+            # Store the findings in a file, one at a time
             scan = self.scans[scan_id]
-        except:
+            self.write_findings(
+                scan_id,
+                scan={"scan_id": scan_id},
+                issues=self._iter_findings(scan_id) if scan.get("resumed") else scan["findings"],
+                summary={"engine_name": self.name, "engine_version": self.version})
+
+            # remove the scan from the active scan list
+            self.clean_scan(scan_id)
+        elif self.results.find(scan_id) is None:
             raise PatrowlEngineExceptions(1002)
 
-        res = { "page": "getfindings", "scan_id": scan_id }
-
-        # check if the scan is finished
-        self.getstatus_scan(scan_id)
-        if scan['status'] != "FINISHED":
-            raise PatrowlEngineExceptions(1003)
-            res.update({ "status": "ERROR", "reason": "scan_id '{}' not finished (status={})".format(scan_id, scan['status'])})
-            return jsonify(res)
-
-        issues, summary =  self._parse_results(scan_id)
+        return self.results.findings_response(scan_id, res, args, accept=accept)
+
+    def write_findings(self, scan_id, scan, issues, summary=None, default=_json_serial):
+        """
+            Write the findings report of a finished scan, one issue at a
+            time (see ResultsStore.write_report), compared with the previous
+            scan of its assets. Return the summary of the report.
+        """
+        record = self.scans[scan_id]
+        report_summary = self.results.write_report(
+            scan_id, scan, issues, summary=summary, default=default,
+            assets=record.get("assets"), delta_only=delta_only(record))
+        self.metrics.scan_findings(scan_id, report_summary["nb_issues"])
+        return report_summary
+
+    def findings_response(self, scan_id, res):
+        """
+            Stream the findings report of a scan (see write_findings), as one
+            JSON document or as the NDJSON page requested (see getfindings).
+        """
+        args, accept = None, None
+        if has_request_context():
+            args, accept = request.args, request.headers.get("Accept")
+        return self.results.findings_response(scan_id, res, args, accept=accept)
+
+    def findings_page(self, scan_id, res):
+        """
+            Return the next findings page of a scan already cleaned (a
+            request with a 'cursor'), or None.
+        """
+        if not has_request_context() or "cursor" not in request.args:
+            return None
+        if self.results.find(scan_id) is None:
+            return None
+        return self.findings_response(scan_id, res)
+
+    def getpartialfindings(self, scan_id, since=None, limit=None):
+        """
+            Return the findings produced since the position 'since' (the
+            'next_since' of the previous call, 0 first) while the scan is
+            running or once finished. The scan is not cleaned.
+        """
+        if has_request_context():
+            if since is None:
+                since = request.args.get("since", None)
+            if limit is None:
+                limit = request.args.get("limit", None)
+        try:
+            since = int(since or 0)
+            limit = int(limit) if limit not in [None, ""] else None
+        except ValueError:
+            raise PatrowlEngineExceptions(1004)
+        if since < 0:
+            raise PatrowlEngineExceptions(1004)
 
-        #Store the findings in a file
-        with open(self.base_dir+"/results/"+self.name+"_"+scan_id+".json", 'w') as report_file:
-            json.dump({
-                "scan": {
-                    "scan_id": scan_id
-                },
-                "summary": summary,
-                "issues": issues
-            }, report_file, default=_json_serial)
+        if not scan_id in self.scans.keys():
+            raise PatrowlEngineExceptions(1002)
 
-        # remove the scan from the active scan list
-        self.clean_scan(scan_id)
+        status = self._scan_summary(scan_id).get('status')
+        findings = self.scans[scan_id]["findings"]
+        end = len(findings) if limit is None else min(len(findings), since + max(limit, 1))
+        issues = []
+        for issue in findings[since:end]:
+            if isinstance(issue, PatrowlEngineFinding):
+                issue = issue.to_dict()
+            issues.append(issue)
+
+        res = {
+            "page": "getpartialfindings",
+            "scan_id": scan_id,
+            "status": "success",
+            "scan_status": status,
+            "since": since,
+            "next_since": since + len(issues),
+            "nb_issues": len(issues),
+            "issues": issues
+        }
+        return Response(dumps_bytes(res, default=_json_serial), mimetype="application/json")
 
-        res.update({ "scan": scan_id, "summary": summary, "issues": issues, "status": "success"})
-        return jsonify(res)
+    def getmetrics(self):
+        """Return the engine metrics in the Prometheus text format."""
+        return self.metrics.response()
 
     def getreport(self, scan_id):
-        filepath = "{}/results/{}_{}.json".format(self.base_dir, self.name, scan_id)
-        if not os.path.exists(filepath):
+        if self.results.find(scan_id) is None:
             raise PatrowlEngineExceptions(1001)
             return jsonify({ "status": "ERROR", "reason": "report file for scan_id '{}' not found".format(scan_id)})
 
-        return send_from_directory(
-            self.base_dir+"/results/",
-            "{}_{}.json".format(self.name, scan_id))
+        # Compressed reports are sent as is to the clients accepting them
+        accept_encodings = request.accept_encodings if has_request_context() else None
+        return self.results.report_response(scan_id, accept_encodings)
 
     def page_not_found(self):
         return jsonify({"page": "not found"})
@@ -345,9 +847,14 @@ class PatrowlEngine:
 
 
 class PatrowlEngineFinding:
+    # No per-instance __dict__: scans may hold millions of findings
+    __slots__ = ("issue_id", "type", "title", "description", "solution", "severity",
+                 "confidence", "raw", "target_addrs", "target_proto", "meta_links",
+                 "meta_tags", "meta_vuln_refs", "meta_risk", "timestamp")
+
     def __init__(self, issue_id, type, title, description, solution, severity,
-                 confidence, raw, target_addrs, target_proto="", meta_links=[], meta_tags=[],
-                 meta_vuln_refs=[], meta_risk=[], timestamp = None):
+                 confidence, raw, target_addrs, target_proto="", meta_links=None, meta_tags=None,
+                 meta_vuln_refs=None, meta_risk=None, timestamp = None):
         self.issue_id = issue_id
         self.type = type
         self.title = title
@@ -358,16 +865,16 @@ class PatrowlEngineFinding:
         self.raw = raw
         self.target_addrs = target_addrs
         self.target_proto = target_proto
-        self.meta_links = meta_links
-        self.meta_tags = meta_tags
-        self.meta_vuln_refs = meta_vuln_refs
-        self.meta_risk = meta_risk
+        self.meta_links = meta_links if meta_links is not None else []
+        self.meta_tags = meta_tags if meta_tags is not None else []
+        self.meta_vuln_refs = meta_vuln_refs if meta_vuln_refs is not None else []
+        self.meta_risk = meta_risk if meta_risk is not None else []
         if timestamp:
             self.timestamp = timestamp
         else:
             self.timestamp = int(time.time() * 1000)
 
-    def __to_dict(self):
+    def to_dict(self):
         return {
             "issue_id": self.issue_id,
             "type": self.type,
@@ -390,12 +897,21 @@ class PatrowlEngineFinding:
             "timestamp": self.timestamp
         }
 
+    # Name used by the engines written before to_dict()
+    __to_dict = to_dict
+
+    def to_json_bytes(self, default=_json_serial):
+        """Encode the finding to JSON bytes (same document as to_dict)."""
+        return dumps_bytes(self.to_dict(), default=default)
+
 class PatrowlEngineScan:
-    def __init__(self, assets, options, scan_id):
+    def __init__(self, assets, options, scan_id, callback_url=None):
         self.assets = assets
         self.options = options
         self.scan_id = scan_id
+        self.callback_url = callback_url
         self.threads = []
+        self.cancel_token = CancelToken()
         self.status = "STARTED"
         self.started_at = int(time.time() * 1000)
         self.findings = []
@@ -411,6 +927,15 @@ class PatrowlEngineScan:
     def add_issue(self, issue):
         self.findings.append(issue)
 
+    def to_params(self):
+        """Return the parameters to start the scan again (see PatrowlEngineCheckpoint)."""
+        return {
+            "assets": self.assets,
+            "options": self.options,
+            "scan_id": self.scan_id,
+            "callback_url": self.callback_url
+        }
+
     def had_options(self, options):
         opts = []
         if isinstance(options, str): # is a string
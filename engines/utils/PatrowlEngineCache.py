@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the lookups of an engine to external (threat-intel) APIs.
+
+Results are kept in a SQLite database (WAL mode, shared by the worker
+processes and kept across restarts), keyed by (provider, endpoint,
+normalized asset), for a TTL set per provider. The assets scanned again
+every day are then looked up once per TTL, sparing the API quotas. A scan
+bypasses the cached results with the "force_refresh" option; the results
+it gets are cached for the next scans. Concurrent lookups of the same
+key share one fetch (see PatrowlEngineSingleFlight).
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import collections
+from urllib.parse import urlsplit, urlunsplit
+
+from .PatrowlEngineSingleFlight import SingleFlight
+
+DEFAULT_CACHE_TTL = int(os.environ.get("APP_CACHE_TTL", 86400))
+DEFAULT_SQLITE_TIMEOUT = 30
+# Scan option bypassing the cached results
+FORCE_REFRESH_OPTION = "force_refresh"
+
+_MISSING = object()
+
+
+def normalize_asset(asset):
+    """Return the cache key of an asset: hostnames and IPs, URL scheme and host are case-insensitive."""
+    asset = str(asset).strip()
+    if "://" in asset:
+        parts = urlsplit(asset)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+    return asset.lower().rstrip(".")
+
+
+def force_refresh(scan):
+    """Return True if the options of a scan dict ask to bypass the cache."""
+    options = scan.get("options") or {}
+    return bool(isinstance(options, dict) and options.get(FORCE_REFRESH_OPTION, False))
+
+
+class LookupCache:
+    """
+    TTL cache of API lookups backed by a SQLite database.
+    - ttls: TTL in seconds by provider, others get 'default_ttl'
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, db_path, ttls=None, default_ttl=DEFAULT_CACHE_TTL,
+                 timeout=DEFAULT_SQLITE_TIMEOUT, metrics=None):
+        self.db_path = str(db_path)
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self.metrics = metrics
+        self._tls = threading.local()
+        self._lock = threading.Lock()
+        self._hits = collections.Counter()
+        self._misses = collections.Counter()
+        self._flights = SingleFlight()
+        self._init_db()
+
+    def _conn(self):
+        # SQLite connections must not be shared across threads nor fork()
+        conn = getattr(self._tls, "conn", None)
+        if conn is None or self._tls.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._tls.conn = conn
+            self._tls.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "provider TEXT, endpoint TEXT, asset TEXT, value TEXT, expires_at REAL, "
+            "PRIMARY KEY (provider, endpoint, asset))")
+
+    def ttl(self, provider):
+        return self.ttls.get(provider, self.default_ttl)
+
+    def set_ttl(self, provider, ttl):
+        self.ttls[provider] = ttl
+
+    def _count(self, provider, hit):
+        with self._lock:
+            (self._hits if hit else self._misses)[provider] += 1
+        if self.metrics is not None:
+            self.metrics.cache_lookup(provider, hit)
+
+    def get(self, provider, endpoint, asset, default=None, force_refresh=False):
+        """
+        Return the cached value of a lookup, or 'default' if missing or
+        expired. With 'force_refresh', the cached value is ignored (and
+        counted as a miss).
+        """
+        row = None
+        if not force_refresh:
+            row = self._conn().execute(
+                "SELECT value, expires_at FROM lookups WHERE provider = ? AND endpoint = ? AND asset = ?",
+                (provider, endpoint, normalize_asset(asset))).fetchone()
+        if row is None or row[1] <= time.time():
+            self._count(provider, False)
+            return default
+        self._count(provider, True)
+        return json.loads(row[0])
+
+    def set(self, provider, endpoint, asset, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl(provider)
+        if ttl <= 0:
+            return
+        self._conn().execute(
+            "INSERT OR REPLACE INTO lookups (provider, endpoint, asset, value, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (provider, endpoint, normalize_asset(asset), json.dumps(value), time.time() + ttl))
+
+    def delete(self, provider, endpoint, asset):
+        self._conn().execute(
+            "DELETE FROM lookups WHERE provider = ? AND endpoint = ? AND asset = ?",
+            (provider, endpoint, normalize_asset(asset)))
+
+    def lookup(self, provider, endpoint, asset, fetch, force_refresh=False,
+               cacheable=bool, ttl=None):
+        """
+        Return the cached value of a lookup (see get), or 'fetch()' and
+        cache it if 'cacheable(value)' (default: not empty; None: always).
+        The concurrent misses of a lookup wait for the same fetch.
+        """
+        value = self.get(provider, endpoint, asset, _MISSING, force_refresh)
+        if value is not _MISSING:
+            return value
+        return self._flights.do(
+            (provider, endpoint, normalize_asset(asset)),
+            self._fetch, provider, endpoint, asset, fetch, cacheable, ttl)
+
+    def _fetch(self, provider, endpoint, asset, fetch, cacheable, ttl):
+        value = fetch()
+        if cacheable is None or cacheable(value):
+            self.set(provider, endpoint, asset, value, ttl)
+        return value
+
+    def purge(self):
+        """Remove the expired entries, return their number."""
+        return self._conn().execute(
+            "DELETE FROM lookups WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def clear(self):
+        self._conn().execute("DELETE FROM lookups")
+
+    def stats(self):
+        """Return the hits and misses of this process, by provider."""
+        with self._lock:
+            providers = set(self._hits) | set(self._misses)
+            return {p: {"hits": self._hits[p], "misses": self._misses[p]} for p in sorted(providers)}
+
+
+def get_lookup_cache(base_dir, name, ttls=None, metrics=None):
+    """Return the lookup cache of an engine, in $APP_CACHE_DB if set."""
+    db_path = os.environ.get("APP_CACHE_DB", "{}/{}_cache.db".format(base_dir, name))
+    cache = LookupCache(db_path, ttls=ttls)
+    # Entries of the previous runs
+    cache.purge()
+    if metrics is not None:
+        metrics.register_cache(cache)
+    return cache
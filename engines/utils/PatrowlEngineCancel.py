@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Cooperative cancellation of scans.
+
+Each scan holds a CancelToken. Workers check it between units of work and
+the external processes they spawn are registered on it, so that stopping a
+scan terminates (then kills) their whole process group and reaps it. The
+processes are started by the supervisor of the engine (see
+PatrowlEngineProcess).
+"""
+import os
+import time
+import signal
+import threading
+import subprocess
+
+from .PatrowlEngineProcess import supervisor
+
+DEFAULT_TERMINATE_TIMEOUT = 5
+
+
+def start_process(cmd, **kwargs):
+    """
+    Start 'cmd' as the leader of a new process group (and its children),
+    once a slot of its tool is free (see ProcessSupervisor.start).
+    """
+    return supervisor.start(cmd, **kwargs)
+
+
+def process_stats():
+    """Return the number of processes started, and of those not reaped yet."""
+    return supervisor.counts()
+
+
+def _signal_group(proc, sig):
+    # A reaped leader may have its pid reused: only signal unreaped ones
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def terminate_processes(procs, timeout=DEFAULT_TERMINATE_TIMEOUT):
+    """
+    Send SIGTERM to the process groups, SIGKILL the ones still alive after
+    'timeout' seconds, then reap them.
+    """
+    for proc in procs:
+        _signal_group(proc, signal.SIGTERM)
+    deadline = time.time() + timeout
+    for proc in procs:
+        try:
+            proc.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            _signal_group(proc, signal.SIGKILL)
+            proc.wait()
+
+
+def terminate_process(proc, timeout=DEFAULT_TERMINATE_TIMEOUT):
+    terminate_processes([proc], timeout=timeout)
+
+
+class CancelToken:
+    """Cancellation flag of a scan, with the processes to terminate."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = []
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Sleep up to 'timeout' seconds; return True if cancelled meanwhile."""
+        return self._event.wait(timeout)
+
+    def cancel(self, timeout=DEFAULT_TERMINATE_TIMEOUT):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            procs = self._procs
+            self._procs = []
+        terminate_processes(procs, timeout=timeout)
+
+    def register(self, proc):
+        """Terminate 'proc' with the scan. It is terminated at once if the scan is already cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._procs.append(proc)
+                return proc
+        terminate_process(proc)
+        return proc
+
+    def unregister(self, proc):
+        with self._lock:
+            if proc in self._procs:
+                self._procs.remove(proc)
+
+    def popen(self, cmd, **kwargs):
+        """
+        Start 'cmd' in its own process group, terminated with the scan.
+        Return None if the scan was cancelled while waiting for a slot.
+        """
+        proc = start_process(cmd, cancel=self.is_cancelled, **kwargs)
+        if proc is None:
+            return None
+        return self.register(proc)
+
+    def wait_process(self, proc):
+        """
+        Wait for a process started by popen() to exit (or to be terminated
+        by cancel()). Return its exit code, or None if it was cancelled.
+        """
+        try:
+            supervisor.wait(proc)
+            return None if self.is_cancelled() else proc.returncode
+        finally:
+            self.unregister(proc)
+
+    def run(self, cmd, **kwargs):
+        """
+        Run 'cmd' until it exits or the scan is cancelled. Return its exit
+        code, or None if it was cancelled.
+        """
+        proc = self.popen(cmd, **kwargs)
+        if proc is None:
+            return None
+        return self.wait_process(proc)
@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the scans of an engine, to resume them after a restart.
+
+A checkpoint holds the parameters of a scan (the startscan request), the
+state of its units of work (typically one per asset: pending, running, done
+or error), the findings of the units done and the IDs of the jobs started
+on remote scanners (GMP task and report, Nessus scan, Cortex jobs) or the
+files to resume a local tool (nmap --resume). It is kept in a SQLite
+database until the scan is cleaned or stopped.
+
+Each checkpoint is owned by the process running the scan. On startup, an
+engine claims the checkpoints whose owner process is gone and resumes them:
+the units done are not run again and the remote jobs are polled instead of
+being started again.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_SQLITE_TIMEOUT = 30
+
+CHECKPOINT_RUNNING = "running"
+CHECKPOINT_FINISHED = "finished"
+
+UNIT_PENDING = "pending"
+UNIT_RUNNING = "running"
+UNIT_DONE = "done"
+UNIT_ERROR = "error"
+
+
+def _checkpoint_serial(obj):
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def _dumps(value):
+    return json.dumps(value, default=_checkpoint_serial)
+
+
+def process_token(pid=None):
+    """
+        Return the owner token of a process: its PID and start time, so that
+        a PID reused after a restart is not taken for the previous owner.
+    """
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_file:
+            # The command name may contain spaces: fields are counted after it
+            start_time = stat_file.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        start_time = ""
+    return "{}:{}".format(pid, start_time)
+
+
+def is_alive(owner):
+    """Return True if the process of an owner token is still running."""
+    pid, _, start_time = str(owner).partition(":")
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if start_time:
+        return process_token(pid) == owner
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScanCheckpoint:
+    """The checkpoint of one scan (see CheckpointStore)."""
+
+    def __init__(self, store, scan_id, params=None, status=CHECKPOINT_RUNNING, resumed=False):
+        self.store = store
+        self.scan_id = scan_id
+        self.params = params or {}
+        self.status = status
+        self.resumed = resumed
+        self._lock = threading.Lock()
+        self._nb_findings = None
+
+    def __repr__(self):
+        return "<ScanCheckpoint {} ({})>".format(self.scan_id, self.status)
+
+    @property
+    def finished(self):
+        return self.status == CHECKPOINT_FINISHED
+
+    # Units of work
+    def add_units(self, units):
+        """Register units of work as pending (the units known are kept as is)."""
+        now = time.time()
+        conn = self.store._conn()
+        # One transaction (and one fsync) for all of them
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO checkpoint_units (scan_id, unit, state, updated_at) "
+                "VALUES (?, ?, ?, ?)", ((self.scan_id, str(u), UNIT_PENDING, now) for u in units))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add_unit(self, unit):
+        """Register a unit of work as pending if unknown; return its state."""
+        state = self.unit_state(unit)
+        if state is None:
+            self.store._conn().execute(
+                "INSERT OR IGNORE INTO checkpoint_units (scan_id, unit, state, updated_at) "
+                "VALUES (?, ?, ?, ?)", (self.scan_id, str(unit), UNIT_PENDING, time.time()))
+            state = UNIT_PENDING
+        return state
+
+    def set_unit(self, unit, state):
+        conn = self.store._conn()
+        now = time.time()
+        # Updated in place: a replaced row would lose its registration order
+        cursor = conn.execute(
+            "UPDATE checkpoint_units SET state=?, updated_at=? WHERE scan_id=? AND unit=?",
+            (state, now, self.scan_id, str(unit)))
+        if cursor.rowcount == 0:
+            conn.execute(
+                "INSERT OR IGNORE INTO checkpoint_units (scan_id, unit, state, updated_at) "
+                "VALUES (?, ?, ?, ?)", (self.scan_id, str(unit), state, now))
+
+    def unit_started(self, unit):
+        self.set_unit(unit, UNIT_RUNNING)
+
+    def unit_done(self, unit, findings=None):
+        """Mark a unit done, after saving the findings of the scan (see save_findings)."""
+        if findings is not None:
+            self.save_findings(findings)
+        self.set_unit(unit, UNIT_DONE)
+
+    def unit_failed(self, unit):
+        self.set_unit(unit, UNIT_ERROR)
+
+    def units(self):
+        """Return {unit: state}."""
+        return dict(self.store._conn().execute(
+            "SELECT unit, state FROM checkpoint_units WHERE scan_id=?", (self.scan_id,)))
+
+    def unit_state(self, unit):
+        """Return the state of a unit, None if unknown."""
+        row = self.store._conn().execute(
+            "SELECT state FROM checkpoint_units WHERE scan_id=? AND unit=?",
+            (self.scan_id, str(unit))).fetchone()
+        return row[0] if row is not None else None
+
+    def is_done(self, unit):
+        return self.unit_state(unit) in (UNIT_DONE, UNIT_ERROR)
+
+    def pending_units(self):
+        """Return the units not run yet or interrupted, in registration order."""
+        return [unit for (unit,) in self.store._conn().execute(
+            "SELECT unit FROM checkpoint_units WHERE scan_id=? AND state IN (?, ?) "
+            "ORDER BY rowid", (self.scan_id, UNIT_PENDING, UNIT_RUNNING))]
+
+    def progress(self):
+        """Return the number of units by state."""
+        counts = {UNIT_PENDING: 0, UNIT_RUNNING: 0, UNIT_DONE: 0, UNIT_ERROR: 0}
+        for state, count in self.store._conn().execute(
+                "SELECT state, COUNT(*) FROM checkpoint_units WHERE scan_id=? GROUP BY state",
+                (self.scan_id,)):
+            counts[state] = count
+        return counts
+
+    # Partial findings
+    def save_findings(self, findings):
+        """
+            Save the findings of the scan not saved yet. The list of the
+            findings of a scan only grows: the new ones are at its end.
+        """
+        with self._lock:
+            if self._nb_findings is None:
+                self._nb_findings = self.store._conn().execute(
+                    "SELECT COUNT(*) FROM checkpoint_findings WHERE scan_id=?",
+                    (self.scan_id,)).fetchone()[0]
+            start = self._nb_findings
+            new_findings = list(findings[start:])
+            if not new_findings:
+                return 0
+            self.store._conn().executemany(
+                "INSERT OR REPLACE INTO checkpoint_findings (scan_id, seq, finding) VALUES (?, ?, ?)",
+                ((self.scan_id, start + i, _dumps(f)) for i, f in enumerate(new_findings)))
+            self._nb_findings = start + len(new_findings)
+            return len(new_findings)
+
+    def findings(self):
+        """Return the findings saved (dicts), in order."""
+        return [json.loads(finding) for (finding,) in self.store._conn().execute(
+            "SELECT finding FROM checkpoint_findings WHERE scan_id=? ORDER BY seq", (self.scan_id,))]
+
+    # Remote jobs and resume files
+    def set_job(self, name, value):
+        """Keep the ID of a remote job (or any JSON value needed to resume)."""
+        self.store._conn().execute(
+            "INSERT OR REPLACE INTO checkpoint_jobs (scan_id, name, value) VALUES (?, ?, ?)",
+            (self.scan_id, name, _dumps(value)))
+
+    def job(self, name, default=None):
+        row = self.store._conn().execute(
+            "SELECT value FROM checkpoint_jobs WHERE scan_id=? AND name=?",
+            (self.scan_id, name)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def jobs(self):
+        return {name: json.loads(value) for name, value in self.store._conn().execute(
+            "SELECT name, value FROM checkpoint_jobs WHERE scan_id=?", (self.scan_id,))}
+
+    def del_job(self, name):
+        self.store._conn().execute(
+            "DELETE FROM checkpoint_jobs WHERE scan_id=? AND name=?", (self.scan_id, name))
+
+    # Scan
+    def finish(self, findings=None):
+        """Mark the scan finished: resumed as is, not run again."""
+        if findings is not None:
+            self.save_findings(findings)
+        self.status = CHECKPOINT_FINISHED
+        self.store._conn().execute(
+            "UPDATE checkpoints SET status=?, updated_at=? WHERE scan_id=?",
+            (self.status, time.time(), self.scan_id))
+
+    def remove(self):
+        self.store.remove(self.scan_id)
+
+
+class CheckpointStore:
+    """Checkpoints of the scans of an engine, in a SQLite database."""
+
+    def __init__(self, db_path, timeout=DEFAULT_SQLITE_TIMEOUT):
+        self.db_path = str(db_path)
+        self.timeout = timeout
+        self._tls = threading.local()
+        self._init_db()
+
+    def _conn(self):
+        # SQLite connections must not be shared across threads nor fork()
+        conn = getattr(self._tls, "conn", None)
+        if conn is None or self._tls.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._tls.conn = conn
+            self._tls.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "scan_id TEXT PRIMARY KEY, owner TEXT, status TEXT, params TEXT, "
+            "created_at REAL, updated_at REAL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_units ("
+            "scan_id TEXT, unit TEXT, state TEXT, updated_at REAL, PRIMARY KEY (scan_id, unit))")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_findings ("
+            "scan_id TEXT, seq INTEGER, finding TEXT, PRIMARY KEY (scan_id, seq))")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_jobs ("
+            "scan_id TEXT, name TEXT, value TEXT, PRIMARY KEY (scan_id, name))")
+
+    def create(self, scan_id, params, units=()):
+        """Start the checkpoint of a new scan (a previous one is replaced)."""
+        scan_id = str(scan_id)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete(conn, scan_id)
+            conn.execute(
+                "INSERT INTO checkpoints (scan_id, owner, status, params, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (scan_id, process_token(), CHECKPOINT_RUNNING, _dumps(params), now, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        checkpoint = ScanCheckpoint(self, scan_id, json.loads(_dumps(params)))
+        checkpoint._nb_findings = 0
+        if units:
+            checkpoint.add_units(units)
+        return checkpoint
+
+    def get(self, scan_id):
+        """Return the checkpoint of a scan, or None."""
+        row = self._conn().execute(
+            "SELECT params, status FROM checkpoints WHERE scan_id=?", (str(scan_id),)).fetchone()
+        if row is None:
+            return None
+        return ScanCheckpoint(self, str(scan_id), json.loads(row[0]), row[1])
+
+    def claim_orphans(self):
+        """
+            Take over the checkpoints whose owner process is gone and return
+            them, oldest first. Each one is claimed by a single process.
+        """
+        owner = process_token()
+        conn = self._conn()
+        claimed = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT scan_id, owner, status, params FROM checkpoints ORDER BY created_at").fetchall()
+            for scan_id, previous_owner, status, params in rows:
+                if previous_owner == owner or is_alive(previous_owner):
+                    continue
+                conn.execute(
+                    "UPDATE checkpoints SET owner=?, updated_at=? WHERE scan_id=?",
+                    (owner, time.time(), scan_id))
+                claimed.append(ScanCheckpoint(self, scan_id, json.loads(params), status, resumed=True))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def _delete(self, conn, scan_id):
+        for table in ("checkpoints", "checkpoint_units", "checkpoint_findings", "checkpoint_jobs"):
+            conn.execute("DELETE FROM {} WHERE scan_id=?".format(table), (scan_id,))
+
+    def remove(self, scan_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete(conn, str(scan_id))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def scan_ids(self):
+        return [scan_id for (scan_id,) in self._conn().execute(
+            "SELECT scan_id FROM checkpoints ORDER BY created_at")]
+
+
+def resume_enabled():
+    """Return False if $APP_RESUME_SCANS disables the resume of the scans on startup."""
+    return os.environ.get("APP_RESUME_SCANS", "1").lower() not in ("0", "false", "no")
+
+
+def get_checkpoint_store(results_dir, name):
+    """Return the checkpoint store of an engine, in $APP_CHECKPOINTS_DB if set."""
+    db_path = os.environ.get("APP_CHECKPOINTS_DB", "{}/{}_checkpoints.db".format(results_dir, name))
+    return CheckpointStore(db_path)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Cached engine configuration.
+
+The JSON config file is parsed, and its derived structures (whitelist
+sets, API key pools, ...) are built, only when the file (or one of the
+files it refers to) changes: its inode, mtime or size. Each load builds a
+new ConfigSnapshot which is then published with a single assignment, so
+readers (and in-flight scans holding a snapshot) never see a half-loaded
+config. Snapshots must not be modified once published.
+"""
+import os
+import json
+import threading
+
+from .PatrowlEngineExceptions import PatrowlEngineExceptions
+
+
+class ConfigSnapshot:
+    """A loaded config: parsed file, derived structures and file signature."""
+
+    __slots__ = ("config", "derived", "signature")
+
+    def __init__(self, config, derived, signature):
+        self.config = config
+        self.derived = derived
+        self.signature = signature
+
+
+def _stat_files(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None, None))
+    return tuple(signature)
+
+
+class ConfigLoader:
+    """
+    Loader of a JSON config file.
+    - build(config): return the derived structures (a dict). It may also
+      complete 'config', which is not published yet.
+    - files(config): return the other files the config depends on.
+    """
+
+    def __init__(self, filepath, build=None, files=None):
+        self.filepath = filepath
+        self._build = build
+        self._files = files
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, snapshot):
+        if snapshot is None:
+            return False
+        return _stat_files([s[0] for s in snapshot.signature]) == snapshot.signature
+
+    def get(self, force=False):
+        """Return the current snapshot, (re)loaded if the files changed."""
+        snapshot = self._snapshot
+        if not force and self._is_fresh(snapshot):
+            return snapshot
+
+        with self._lock:
+            # Loaded by another thread in the meantime
+            snapshot = self._snapshot
+            if not force and self._is_fresh(snapshot):
+                return snapshot
+
+            if not os.path.exists(self.filepath):
+                raise PatrowlEngineExceptions(1000)
+
+            # Files are stat'ed before being read: a change during the load
+            # triggers a new load on the next call
+            signature = _stat_files([self.filepath])
+            with open(self.filepath) as conf_file:
+                config = json.load(conf_file)
+            if self._files is not None:
+                signature += _stat_files([f for f in self._files(config) if f])
+            derived = self._build(config) if self._build is not None else {}
+
+            snapshot = ConfigSnapshot(config, derived, signature)
+            self._snapshot = snapshot
+            return snapshot
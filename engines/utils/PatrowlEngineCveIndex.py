@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Offline index of the CVEs of the NVD, by CPE.
+
+The index is a SQLite database built from the NVD JSON feeds: the 1.1
+feeds (nvdcve-1.1-*.json[.gz], "CVE_Items") or the pages of the 2.0 API
+saved as files ("vulnerabilities"). Each CVE keeps its CVSS score and
+vector (v3.x, else v2), its description and references; its vulnerable CPE
+matches (with their version ranges) are indexed by (part, vendor, product),
+so the lookup of a CPE is one B-tree search (O(log n)) plus the filtering
+of the versions of this product. Engines open it read-only and memory-mapped
+once at startup, then look up the CPEs they detect without network access.
+
+The build is incremental: the feeds not changed since they were imported
+(size and mtime) are skipped, and a CVE is replaced only by a more recent
+version (lastModified), e.g. from the "modified" feed. The CPE matches of
+the configurations are flattened: the platform conditions of the AND nodes
+(e.g. "running on Windows") are not checked.
+
+Usage: python3 PatrowlEngineCveIndex.py -d nvd_cves.db nvdcve-1.1-*.json.gz
+"""
+import os
+import re
+import gzip
+import json
+import time
+import sqlite3
+import optparse
+import threading
+
+DEFAULT_SQLITE_TIMEOUT = 30
+# Memory mapped by the readers
+DEFAULT_MMAP_SIZE = int(os.environ.get("APP_CVE_INDEX_MMAP_SIZE", 1 << 30))
+NVD_CVE_URL = "https://nvd.nist.gov/vuln/detail/{}"
+
+_VERSION_TOKEN_RE = re.compile(r"\d+|[a-z]+")
+_CPE23_SPLIT_RE = re.compile(r"(?<!\\):")
+_SQLITE_MAX_PARAMS = 500
+
+
+def parse_cpe(cpe):
+    """
+    Return the (part, vendor, product, version) of a CPE, as a 2.2 URI
+    (cpe:/a:vendor:product:version, as reported by nmap) or a 2.3 formatted
+    string; None if it is not a CPE. The version (with its update, if any)
+    is None if not set.
+    """
+    cpe = str(cpe).strip().lower()
+    if cpe.startswith("cpe:2.3:"):
+        fields = [f.replace("\\", "") for f in _CPE23_SPLIT_RE.split(cpe[8:])]
+    elif cpe.startswith("cpe:/"):
+        fields = cpe[5:].split(":")
+    else:
+        return None
+    fields += [""] * (5 - len(fields))
+    part, vendor, product, version, update = fields[:5]
+    if not part or not vendor or not product:
+        return None
+    if version in ("", "*", "-"):
+        return part, vendor, product, None
+    # The NVD splits the versions as nmap reports them: 8.9p1 is 8.9:p1
+    if update not in ("", "*", "-"):
+        version += update
+    return part, vendor, product, version
+
+
+def version_key(version):
+    """Return a key ordering the versions: '1.10' > '1.9', '8.9p1' > '8.9'."""
+    return [(1, int(t), "") if t.isdigit() else (0, 0, t) for t in _VERSION_TOKEN_RE.findall(version.lower())]
+
+
+def version_matches(version, match):
+    """Return True if a version is in the versions of a CPE match (dict, see CveIndex.lookup)."""
+    if match["version"] is not None:
+        return version_key(version) == version_key(match["version"])
+    key = version_key(version)
+    if match["start"] is not None:
+        start = version_key(match["start"])
+        if key < start or (key == start and not match["start_incl"]):
+            return False
+    if match["end"] is not None:
+        end = version_key(match["end"])
+        if key > end or (key == end and not match["end_incl"]):
+            return False
+    # A product without a version nor a range: all its versions
+    return True
+
+
+def _cvss(metrics):
+    """Return (score, vector, severity) of the most recent CVSS version of the metrics."""
+    for score, vector, severity in metrics:
+        if score is not None:
+            return float(score), vector, severity
+    return None, None, None
+
+
+def _english(descriptions):
+    for description in descriptions:
+        if description.get("lang", "en") == "en":
+            return description.get("value", "")
+    return ""
+
+
+def _cpe_matches_11(nodes):
+    for node in nodes:
+        for match in node.get("cpe_match", []):
+            if match.get("vulnerable", True):
+                yield (match.get("cpe23Uri", ""),
+                       match.get("versionStartIncluding"), match.get("versionStartExcluding"),
+                       match.get("versionEndIncluding"), match.get("versionEndExcluding"))
+        for match in _cpe_matches_11(node.get("children", [])):
+            yield match
+
+
+def _parse_item_11(item):
+    """Return the CVE of an item of a 1.1 feed (see _store_cve)."""
+    cve = item.get("cve", {})
+    impact = item.get("impact", {})
+    v3 = impact.get("baseMetricV3", {}).get("cvssV3", {})
+    v2 = impact.get("baseMetricV2", {})
+    return {
+        "cve_id": cve.get("CVE_data_meta", {}).get("ID"),
+        "last_modified": item.get("lastModifiedDate", ""),
+        "cvss": _cvss([
+            (v3.get("baseScore"), v3.get("vectorString"), v3.get("baseSeverity")),
+            (v2.get("cvssV2", {}).get("baseScore"), v2.get("cvssV2", {}).get("vectorString"), v2.get("severity")),
+        ]),
+        "description": _english(cve.get("description", {}).get("description_data", [])),
+        "references": [r.get("url") for r in cve.get("references", {}).get("reference_data", []) if r.get("url")],
+        "matches": list(_cpe_matches_11(item.get("configurations", {}).get("nodes", []))),
+    }
+
+
+def _parse_item_20(item):
+    """Return the CVE of an item of a 2.0 API page (see _store_cve)."""
+    cve = item.get("cve", item)
+    metrics = cve.get("metrics", {})
+    cvss = []
+    for name in ("cvssMetricV40", "cvssMetricV31", "cvssMetricV30", "cvssMetricV2"):
+        # The primary (NVD) score first
+        for metric in sorted(metrics.get(name, []), key=lambda m: m.get("type") != "Primary"):
+            data = metric.get("cvssData", {})
+            cvss.append((data.get("baseScore"), data.get("vectorString"),
+                         data.get("baseSeverity") or metric.get("baseSeverity")))
+    matches = []
+    for configuration in cve.get("configurations", []):
+        for node in configuration.get("nodes", []):
+            for match in node.get("cpeMatch", []):
+                if match.get("vulnerable", True):
+                    matches.append((match.get("criteria", ""),
+                                    match.get("versionStartIncluding"), match.get("versionStartExcluding"),
+                                    match.get("versionEndIncluding"), match.get("versionEndExcluding")))
+    return {
+        "cve_id": cve.get("id"),
+        "last_modified": cve.get("lastModified", ""),
+        "cvss": _cvss(cvss),
+        "description": _english(cve.get("descriptions", [])),
+        "references": [r.get("url") for r in cve.get("references", []) if r.get("url")],
+        "matches": matches,
+    }
+
+
+def read_feed(filename):
+    """Yield the CVEs of a NVD JSON feed file (gzipped or not)."""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as feed_file:
+        feed = json.load(feed_file)
+    if "CVE_Items" in feed:
+        items, parse = feed["CVE_Items"], _parse_item_11
+    else:
+        items, parse = feed.get("vulnerabilities", []), _parse_item_20
+    for item in items:
+        cve = parse(item)
+        if cve["cve_id"]:
+            yield cve
+
+
+class CveIndex:
+    """The CVEs of the NVD by CPE, in a SQLite database (see the module)."""
+
+    def __init__(self, db_path, readonly=True, timeout=DEFAULT_SQLITE_TIMEOUT, mmap_size=DEFAULT_MMAP_SIZE):
+        self.db_path = str(db_path)
+        self.readonly = readonly
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self._tls = threading.local()
+        if not readonly:
+            self._init_db()
+
+    def _conn(self):
+        # SQLite connections must not be shared across threads nor fork()
+        conn = getattr(self._tls, "conn", None)
+        if conn is None or self._tls.pid != os.getpid():
+            if self.readonly:
+                conn = sqlite3.connect("file:{}?mode=ro".format(self.db_path), uri=True,
+                                       timeout=self.timeout, isolation_level=None)
+                conn.execute("PRAGMA mmap_size={}".format(int(self.mmap_size)))
+            else:
+                conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            self._tls.conn = conn
+            self._tls.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS feeds ("
+            "name TEXT PRIMARY KEY, size INTEGER, mtime REAL, nb_cves INTEGER, imported_at REAL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cves ("
+            "cve_id TEXT PRIMARY KEY, last_modified TEXT, cvss REAL, cvss_vector TEXT, "
+            "severity TEXT, description TEXT, refs TEXT)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cpe_matches ("
+            "part TEXT, vendor TEXT, product TEXT, cve_id TEXT, version TEXT, "
+            "version_start TEXT, start_incl INTEGER, version_end TEXT, end_incl INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cpe_matches_product ON cpe_matches (part, vendor, product)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cpe_matches_cve ON cpe_matches (cve_id)")
+
+    # Build
+    def import_feed(self, filename, force=False):
+        """Import the CVEs of a feed file, unless imported since its last change; return their number (None if skipped)."""
+        name = os.path.basename(filename)
+        stat = os.stat(filename)
+        conn = self._conn()
+        row = conn.execute("SELECT size, mtime FROM feeds WHERE name=?", (name,)).fetchone()
+        if not force and row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return None
+        nb_cves = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for cve in read_feed(filename):
+                nb_cves += self._store_cve(conn, cve)
+            conn.execute(
+                "INSERT OR REPLACE INTO feeds (name, size, mtime, nb_cves, imported_at) VALUES (?, ?, ?, ?, ?)",
+                (name, stat.st_size, stat.st_mtime, nb_cves, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return nb_cves
+
+    def _store_cve(self, conn, cve):
+        """Insert or replace a CVE (dict, see read_feed) unless the index has a more recent one; return 1 if stored."""
+        row = conn.execute("SELECT last_modified FROM cves WHERE cve_id=?", (cve["cve_id"],)).fetchone()
+        if row is not None and row[0] > cve["last_modified"]:
+            return 0
+        score, vector, severity = cve["cvss"]
+        conn.execute(
+            "INSERT OR REPLACE INTO cves (cve_id, last_modified, cvss, cvss_vector, severity, description, refs) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (cve["cve_id"], cve["last_modified"], score, vector, severity, cve["description"],
+             json.dumps(cve["references"])))
+        conn.execute("DELETE FROM cpe_matches WHERE cve_id=?", (cve["cve_id"],))
+        matches = []
+        for cpe, start_incl, start_excl, end_incl, end_excl in cve["matches"]:
+            parsed = parse_cpe(cpe)
+            if parsed is None:
+                continue
+            matches.append(parsed + (
+                cve["cve_id"], start_incl or start_excl, start_incl is not None,
+                end_incl or end_excl, end_incl is not None))
+        # The same product may be listed in several nodes
+        conn.executemany(
+            "INSERT INTO cpe_matches (part, vendor, product, version, cve_id, "
+            "version_start, start_incl, version_end, end_incl) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            dict.fromkeys(matches))
+        return 1
+
+    # Lookups
+    def lookup(self, cpe):
+        """
+        Return the CVEs of a CPE (dicts: cve_id, cvss, cvss_vector,
+        severity, description, references, link), the highest CVSS first.
+        A CPE without a version matches nothing: all the CVEs of a product
+        are not those of the version detected.
+        """
+        parsed = parse_cpe(cpe)
+        if parsed is None or parsed[3] is None:
+            return []
+        part, vendor, product, version = parsed
+        conn = self._conn()
+        cve_ids = []
+        for row in conn.execute(
+                "SELECT cve_id, version, version_start, start_incl, version_end, end_incl FROM cpe_matches "
+                "WHERE part=? AND vendor=? AND product=?", (part, vendor, product)):
+            match = dict(zip(("cve_id", "version", "start", "start_incl", "end", "end_incl"), row))
+            if version_matches(version, match):
+                cve_ids.append(match["cve_id"])
+        cve_ids = list(dict.fromkeys(cve_ids))
+
+        cves = []
+        for i in range(0, len(cve_ids), _SQLITE_MAX_PARAMS):
+            chunk = cve_ids[i:i + _SQLITE_MAX_PARAMS]
+            for cve_id, score, vector, severity, description, refs in conn.execute(
+                    "SELECT cve_id, cvss, cvss_vector, severity, description, refs FROM cves "
+                    "WHERE cve_id IN ({})".format(",".join("?" * len(chunk))), chunk):
+                cves.append({
+                    "cve_id": cve_id, "cvss": score, "cvss_vector": vector, "severity": severity,
+                    "description": description, "references": json.loads(refs),
+                    "link": NVD_CVE_URL.format(cve_id),
+                })
+        return sorted(cves, key=lambda c: (-(c["cvss"] or 0.0), c["cve_id"]))
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            "feeds": conn.execute("SELECT COUNT(*) FROM feeds").fetchone()[0],
+            "cves": conn.execute("SELECT COUNT(*) FROM cves").fetchone()[0],
+            "cpe_matches": conn.execute("SELECT COUNT(*) FROM cpe_matches").fetchone()[0],
+        }
+
+
+def get_cve_index(db_path):
+    """Return the CVE index (read-only) of $APP_CVE_INDEX_DB if set, else of db_path; None if not built."""
+    db_path = os.environ.get("APP_CVE_INDEX_DB", db_path)
+    if not db_path or not os.path.isfile(db_path):
+        return None
+    return CveIndex(db_path)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog -d INDEX [options] FEED...")
+    parser.add_option("-d", "--db", help="CVE index built or updated")
+    parser.add_option("-f", "--force", action="store_true", help="Import the feeds not changed too")
+    options, feeds = parser.parse_args()
+    if not options.db or not feeds:
+        parser.error("an index and feeds are required")
+
+    index = CveIndex(options.db, readonly=False)
+    for feed in feeds:
+        start = time.time()
+        nb_cves = index.import_feed(feed, force=options.force)
+        if nb_cves is None:
+            print("{}: not changed".format(feed))
+        else:
+            print("{}: {} CVEs imported in {:.1f} s".format(feed, nb_cves, time.time() - start))
+    print(json.dumps(index.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Events of the scans of an engine, pushed instead of polled.
+
+An event is published on each status transition of a scan ("status") and
+when its number of findings changes ("findings"). Events are streamed to
+the clients of /engines/<name>/events (Server-Sent Events, optionally for
+one scan with '?scan_id=') and POSTed as JSON to the 'callback_url' given
+in the startscan request, if any.
+
+The callbacks are delivered by a few background workers from a bounded
+queue: when the queue is full, the oldest event is dropped. A failed
+delivery (connection error or non-2xx response) is retried with a jittered
+exponential backoff. Events carry an increasing 'id' (per engine process)
+so that receivers can drop the duplicates and reorder the retried ones.
+"""
+import os
+import json
+import time
+import heapq
+import logging
+import itertools
+import threading
+import collections
+
+from .PatrowlEngineHttp import backoff_delay
+
+EVENTS_QUEUE_SIZE = int(os.environ.get("APP_EVENTS_QUEUE_SIZE", 1000))
+CALLBACK_RETRIES = int(os.environ.get("APP_CALLBACK_RETRIES", 5))
+CALLBACK_WORKERS = int(os.environ.get("APP_CALLBACK_WORKERS", 2))
+CALLBACK_TIMEOUT = (5, 10)
+CALLBACK_BACKOFF = 1
+CALLBACK_MAX_BACKOFF = 60
+SSE_KEEPALIVE_INTERVAL = 15
+
+EVENT_STATUS = "status"
+EVENT_FINDINGS = "findings"
+
+logger = logging.getLogger(__name__)
+
+
+class EventStream:
+    """Bounded queue of the events sent to one SSE client (the oldest are dropped)."""
+
+    def __init__(self, scan_id=None, maxsize=EVENTS_QUEUE_SIZE):
+        self.scan_id = scan_id
+        self.dropped = 0
+        self._events = collections.deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        if self.scan_id is not None and event["scan_id"] != self.scan_id:
+            return
+        with self._cond:
+            if len(self._events) >= self._maxsize:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next event, or None after 'timeout' seconds."""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            if not self._events:
+                return None
+            return self._events.popleft()
+
+
+class CallbackDispatcher:
+    """
+    POST the events to their callback URL from a bounded queue, with
+    retries. Deliveries waiting for a retry stay in the queue (and count in
+    its size) without blocking the other ones.
+    """
+
+    def __init__(self, http, maxsize=EVENTS_QUEUE_SIZE, retries=CALLBACK_RETRIES,
+                 workers=CALLBACK_WORKERS, backoff=CALLBACK_BACKOFF):
+        self.http = http
+        self.maxsize = maxsize
+        self.retries = retries
+        self.workers = workers
+        self.backoff = backoff
+        self._queue = []    # heap of (due time, seq, url, event, attempt)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._stats = collections.Counter()
+
+    def _start_workers(self):
+        # Workers are started lazily so that forked processes get their own
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = []
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name="callback-{}".format(i), daemon=True).start()
+
+    def submit(self, url, event):
+        with self._cond:
+            self._start_workers()
+            if len(self._queue) >= self.maxsize:
+                # Drop the oldest event (the first one due)
+                heapq.heappop(self._queue)
+                self._stats["dropped"] += 1
+            heapq.heappush(self._queue, (time.monotonic(), next(self._seq), url, event, 0))
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    delay = self._queue[0][0] - time.monotonic()
+                    if delay <= 0:
+                        return heapq.heappop(self._queue)
+                    self._cond.wait(delay)
+                else:
+                    self._cond.wait()
+
+    def _work(self):
+        while True:
+            _, _, url, event, attempt = self._next()
+            try:
+                response = self.http.post(url, json=event, timeout=CALLBACK_TIMEOUT, retries=0)
+                delivered = 200 <= response.status_code < 300
+                response.close()
+                reason = "HTTP {}".format(response.status_code)
+            except Exception as e:
+                delivered = False
+                reason = str(e)
+
+            with self._cond:
+                if delivered:
+                    self._stats["delivered"] += 1
+                elif attempt < self.retries and len(self._queue) < self.maxsize:
+                    self._stats["retried"] += 1
+                    due = time.monotonic() + backoff_delay(attempt, self.backoff, CALLBACK_MAX_BACKOFF)
+                    heapq.heappush(self._queue, (due, next(self._seq), url, event, attempt + 1))
+                    self._cond.notify()
+                else:
+                    self._stats["failed"] += 1
+                    logger.warning("scan '%s': event %s not delivered to %s (%s)",
+                                   event.get("scan_id"), event.get("id"), url, reason)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, queued=len(self._queue))
+
+
+class ScanEvents:
+    """
+    Publisher of the events of the scans of an engine. The engine reports
+    the status and the number of findings of its scans as they are written;
+    only the changes are published.
+    """
+
+    def __init__(self, name, http):
+        self.name = name
+        self.dispatcher = CallbackDispatcher(http)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._streams = set()
+        self._last = {}     # scan_id: (status, nb_findings)
+
+    def subscribe(self, scan_id=None):
+        stream = EventStream(scan_id)
+        with self._lock:
+            self._streams.add(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def event(self, scan_id, event_type, **fields):
+        """Return a new event of a scan."""
+        event = {
+            "id": next(self._ids),
+            "type": event_type,
+            "engine": self.name,
+            "scan_id": scan_id,
+            "timestamp": int(time.time() * 1000),
+        }
+        event.update(fields)
+        return event
+
+    def publish(self, scan_id, event_type, callback_url=None, **fields):
+        event = self.event(scan_id, event_type, **fields)
+        with self._lock:
+            streams = list(self._streams)
+        for stream in streams:
+            stream.put(event)
+        if callback_url:
+            self.dispatcher.submit(callback_url, event)
+        return event
+
+    def scan_changed(self, scan_id, scan):
+        """
+            Publish the status transition and the new findings of a scan dict,
+            if any. The findings are counted from its 'nb_findings', else from
+            its list of 'findings'; the findings of the engines keeping them
+            in another shape (e.g. raw results by asset) are not counted.
+        """
+        status = scan.get("status")
+        nb_findings = scan.get("nb_findings")
+        if nb_findings is None:
+            findings = scan.get("findings")
+            if isinstance(findings, list):
+                nb_findings = len(findings)
+        callback_url = scan.get("callback_url")
+        if not callback_url and not self._streams:
+            return
+        with self._lock:
+            last_status, last_nb_findings = self._last.get(scan_id, (None, None))
+            if status == last_status and nb_findings == last_nb_findings:
+                return
+            self._last[scan_id] = (status, nb_findings)
+        if status != last_status:
+            fields = {"status": status, "previous_status": last_status}
+            if nb_findings is not None:
+                fields["nb_findings"] = nb_findings
+            if scan.get("progress") is not None:
+                fields["progress"] = scan["progress"]
+            if scan.get("reason"):
+                fields["reason"] = scan["reason"]
+            self.publish(scan_id, EVENT_STATUS, callback_url, **fields)
+        elif nb_findings != last_nb_findings:
+            self.publish(scan_id, EVENT_FINDINGS, callback_url, status=status, nb_findings=nb_findings)
+
+    def forget(self, scan_id):
+        with self._lock:
+            self._last.pop(scan_id, None)
+
+    def sse(self, stream, keepalive=SSE_KEEPALIVE_INTERVAL):
+        """Yield the events of a stream in the Server-Sent Events format, until the client leaves."""
+        try:
+            # Sent at once, so that the client knows it is subscribed
+            yield ": subscribed\n\n"
+            while True:
+                event = stream.get(timeout=keepalive)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "id: {}\nevent: {}\ndata: {}\n\n".format(event["id"], event["type"], json.dumps(event))
+        finally:
+            self.unsubscribe(stream)
+
+    def stats(self):
+        with self._lock:
+            streams = list(self._streams)
+        return {
+            "subscribers": len(streams),
+            "dropped": sum(s.dropped for s in streams),
+            "callbacks": self.dispatcher.stats(),
+        }
@@ -14,6 +14,9 @@ class PatrowlEngineExceptions(Exception):
         1001: 'Report file not found.',
         1002: 'Scan_id not found in current scans.',
         1003: 'Scan not finished.',
+        1004: 'Invalid findings cursor.',
+        1005: 'Report file not streamable.',
+        1006: 'Invalid callback URL.',
     }
 
     def __init__(self, code, msg=None):
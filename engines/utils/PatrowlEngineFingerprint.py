@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Fingerprints of the findings of an engine, across its scans.
+
+A finding is identified by a stable hash of its type, target, title (less
+the content hashes and counters some engines append to it, e.g. "(#: 3,
+HASH: 1a2b3c)") and key metadata (vulnerability references), and its
+content by a hash of its severity, description and solution. The
+fingerprints of the last scan of each asset are kept in a SQLite database.
+
+Every report written with the assets of its scan updates the index. With
+the "delta_only" scan option, the report holds only the findings new or
+changed since the previous scan of the same assets, then one "resolved"
+finding for each finding of this previous scan no longer found. They are
+marked with "delta": "new", "changed" or "resolved", and the summary
+counts them.
+
+Cost of a report: each finding is hashed once while it is written, and
+the memory held is the key and digest of each finding of the previous
+scan and the key of each finding of this one (not the findings). Only the new and changed findings
+are written to the index (their type, title, severity and target, staged
+in a temporary table until the report is complete), the resolved ones are
+removed from it. $APP_FINGERPRINTS=0 turns the index off (no delta).
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import itertools
+import threading
+from contextlib import contextmanager
+
+DEFAULT_SQLITE_TIMEOUT = 30
+# Scan option of the reports holding only the changes
+DELTA_ONLY_OPTION = "delta_only"
+# Metadata identifying a finding, besides its type, target and title
+KEY_METADATA = ("vuln_refs", "cve", "cwe", "cpe")
+
+FINGERPRINTS_ENABLED = os.environ.get("APP_FINGERPRINTS", "1").lower() not in ("0", "false", "no")
+
+_TITLE_HASH_RE = re.compile(r"\s*\([^()]*HASH:[^()]*\)")
+_SQLITE_MAX_PARAMS = 500
+_STAGING_BATCH = 1000
+
+
+def delta_only(scan):
+    """Return True if the options of a scan dict ask for the changes only."""
+    options = scan.get("options") or {}
+    return bool(isinstance(options, dict) and options.get(DELTA_ONLY_OPTION, False))
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _target(issue):
+    target = issue.get("target") or {}
+    addrs = target.get("addr") or []
+    if not isinstance(addrs, list):
+        addrs = [addrs]
+    return target, sorted(str(a).strip().lower() for a in addrs)
+
+
+def fingerprint(issue):
+    """Return the identity hash of a finding (dict)."""
+    target, addrs = _target(issue)
+    metadata = issue.get("metadata") or {}
+    return _hash([
+        issue.get("type", ""),
+        addrs,
+        str(target.get("port_id", "")),
+        target.get("port_type", "") or target.get("protocol", ""),
+        _TITLE_HASH_RE.sub("", issue.get("title", "")).strip(),
+        {k: metadata[k] for k in KEY_METADATA if metadata.get(k)},
+    ])
+
+
+def content_digest(issue):
+    """Return the hash of the content of a finding (dict)."""
+    return _hash([
+        issue.get("severity", ""),
+        issue.get("description", ""),
+        issue.get("solution", ""),
+    ])
+
+
+def asset_values(assets):
+    """Return the values of the assets of a scan (dicts or strings), normalized."""
+    values = []
+    for asset in assets or []:
+        value = asset.get("value") if isinstance(asset, dict) else asset
+        if value:
+            values.append(str(value).strip().lower())
+    return sorted(set(values))
+
+
+class Delta:
+    """
+    Iterable of the findings of a report compared with the index; 'counts'
+    is complete once iterated. The index is updated at the end.
+    """
+
+    def __init__(self, index, issues, assets, delta_only=True):
+        self.index = index
+        self.issues = issues
+        self.assets = asset_values(assets)
+        self.delta_only = delta_only
+        # Findings not targeting one of the assets (e.g. the IPs of a scanned range)
+        self.scan_scope = "scan:" + _hash(self.assets)[:16]
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0, "resolved": 0}
+
+    def _scope(self, addrs):
+        for addr in addrs:
+            if addr in self.assets:
+                return addr
+        return self.scan_scope
+
+    def __iter__(self):
+        scopes = self.assets + [self.scan_scope]
+        # {scope: {key: digest}} of the previous scan, {scope: {key}} of this one
+        previous = self.index.digests(scopes)
+        seen = {scope: set() for scope in scopes}
+        last_issue_id = 0
+        with self.index.staging() as stage:
+            for issue in self.issues:
+                item = issue if isinstance(issue, dict) else issue.to_dict()
+                _, addrs = _target(item)
+                scope = self._scope(addrs)
+                key = fingerprint(item)
+                digest = content_digest(item)
+                seen[scope].add(key)
+                last_issue_id = max(last_issue_id, item.get("issue_id") or 0)
+                previous_digest = previous[scope].get(key)
+                if previous_digest is None:
+                    status = "new"
+                elif previous_digest != digest:
+                    status = "changed"
+                else:
+                    status = "unchanged"
+                self.counts[status] += 1
+                if status != "unchanged":
+                    stage.add(scope, key, digest, {
+                        "type": item.get("type", ""), "title": item.get("title", ""),
+                        "severity": item.get("severity", "info"), "target": item.get("target", {}),
+                    })
+                if not self.delta_only:
+                    yield issue
+                elif status != "unchanged":
+                    yield dict(item, delta=status)
+
+            resolved = [
+                (scope, key) for scope in scopes
+                for key in previous[scope] if key not in seen[scope]]
+            del previous, seen
+            self.counts["resolved"] = len(resolved)
+            if self.delta_only:
+                ts = int(time.time() * 1000)
+                for finding in self.index.findings(resolved):
+                    last_issue_id += 1
+                    yield {
+                        "issue_id": last_issue_id,
+                        "type": finding["type"],
+                        "title": finding["title"],
+                        "description": "Not found anymore since the previous scan: {}".format(finding["title"]),
+                        "solution": "n/a",
+                        "severity": "info",
+                        "confidence": "certain",
+                        "target": finding["target"],
+                        "metadata": {"tags": ["resolved"]},
+                        "raw": {"previous_severity": finding["severity"]},
+                        "delta": "resolved",
+                        "timestamp": ts,
+                    }
+
+            # Only once the report is complete
+            stage.commit(resolved)
+
+
+class _Staging:
+    """New and changed fingerprints of a report, kept aside until it is complete."""
+
+    def __init__(self, index, run):
+        self.index = index
+        self.run = run
+        self._rows = []
+
+    def add(self, scope, key, digest, finding):
+        self._rows.append((self.run, scope, key, digest, json.dumps(finding, default=str)))
+        if len(self._rows) >= _STAGING_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self.index._conn().executemany(
+                "INSERT OR REPLACE INTO temp.fingerprints_staging (run, scope, key, digest, finding) "
+                "VALUES (?, ?, ?, ?, ?)", self._rows)
+            self._rows = []
+
+    def commit(self, resolved):
+        """
+            Write the staged fingerprints and remove the 'resolved' ones, in
+            one transaction. The unchanged ones are left as is.
+        """
+        self.flush()
+        now = time.time()
+        conn = self.index._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "DELETE FROM fingerprints WHERE scope=? AND key=?", resolved)
+            conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (scope, key, digest, finding, seen_at) "
+                "SELECT scope, key, digest, finding, ? FROM temp.fingerprints_staging WHERE run=?",
+                (now, self.run))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class FingerprintIndex:
+    """Fingerprints of the findings of the last scan of each asset, in a SQLite database."""
+
+    def __init__(self, db_path, timeout=DEFAULT_SQLITE_TIMEOUT):
+        self.db_path = str(db_path)
+        self.timeout = timeout
+        self._tls = threading.local()
+        self._runs = itertools.count()
+        self._init_db()
+
+    def _conn(self):
+        # SQLite connections must not be shared across threads nor fork()
+        conn = getattr(self._tls, "conn", None)
+        if conn is None or self._tls.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Per connection, not written to the database file
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS fingerprints_staging ("
+                "run INTEGER, scope TEXT, key TEXT, digest TEXT, finding TEXT, "
+                "PRIMARY KEY (run, scope, key))")
+            self._tls.conn = conn
+            self._tls.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "scope TEXT, key TEXT, digest TEXT, finding TEXT, seen_at REAL, "
+            "PRIMARY KEY (scope, key))")
+
+    def digests(self, scopes):
+        """Return {scope: {key: digest}} of the scopes (asset values)."""
+        previous = {scope: {} for scope in scopes}
+        conn = self._conn()
+        for i in range(0, len(scopes), _SQLITE_MAX_PARAMS):
+            chunk = scopes[i:i + _SQLITE_MAX_PARAMS]
+            rows = conn.execute(
+                "SELECT scope, key, digest FROM fingerprints WHERE scope IN ({})".format(
+                    ",".join("?" * len(chunk))), chunk)
+            for scope, key, digest in rows:
+                previous[scope][key] = digest
+        return previous
+
+    def findings(self, keys):
+        """Yield the finding (type, title, severity, target) of each (scope, key) indexed."""
+        conn = self._conn()
+        for scope, key in keys:
+            row = conn.execute(
+                "SELECT finding FROM fingerprints WHERE scope=? AND key=?", (scope, key)).fetchone()
+            if row is not None:
+                yield json.loads(row[0])
+
+    @contextmanager
+    def staging(self):
+        """Stage the fingerprints of a report (see Delta); dropped if not committed."""
+        stage = _Staging(self, next(self._runs))
+        try:
+            yield stage
+        finally:
+            self._conn().execute(
+                "DELETE FROM temp.fingerprints_staging WHERE run=?", (stage.run,))
+
+    def delta(self, issues, assets, delta_only=True):
+        """Return the Delta of the findings of a scan of 'assets' (see Delta)."""
+        return Delta(self, issues, assets, delta_only=delta_only)
+
+
+def get_fingerprint_index(results_dir, name):
+    """Return the fingerprint index of an engine, in $APP_FINGERPRINTS_DB if set."""
+    db_path = os.environ.get("APP_FINGERPRINTS_DB", "{}/{}_fingerprints.db".format(results_dir, name))
+    return FingerprintIndex(db_path)
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+HTTP client shared by the requests of an engine to external APIs and targets.
+
+Connections are kept alive in a pool per host, so that an API polled
+hundreds of times per scan costs one TLS handshake, not one per poll. The
+number of concurrent requests to a host is capped by the size of its pool
+(a request waits for a free connection). Requests have connect and read
+timeouts, and are retried with a jittered exponential backoff on
+connection errors, 429 and 5xx responses (Retry-After is honoured).
+Identical concurrent GET requests may share one response ('coalesce').
+"""
+import os
+import time
+import random
+import logging
+import threading
+import contextlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .PatrowlEngineSingleFlight import SingleFlight
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("APP_HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("APP_HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("APP_HTTP_RETRIES", 3))
+HTTP_MAX_HOST_CONNECTIONS = int(os.environ.get("APP_HTTP_MAX_HOST_CONNECTIONS", 8))
+HTTP_BACKOFF = 0.5
+HTTP_MAX_BACKOFF = 60
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Retried on any error; the others only if the request was not processed
+# (connect timeout, 429)
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, backoff=HTTP_BACKOFF, max_backoff=HTTP_MAX_BACKOFF):
+    """Return the delay before the retry 'attempt' (from 0): full jitter."""
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def _retry_after(response, max_backoff=HTTP_MAX_BACKOFF):
+    """Return the delay asked by the Retry-After header (in seconds), or None."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return min(max_backoff, max(0.0, float(value)))
+    except ValueError:
+        # HTTP-date: not worth parsing, fall back to the backoff
+        return None
+
+
+class HttpClient:
+    """
+    Pooled HTTP client of an engine.
+    - timeout: (connect, read) in seconds, for the requests without one
+    - retries: max number of retries of a request
+    - max_host_connections: connections kept alive, and concurrent
+      requests, per host
+    - metrics: EngineMetrics, the requests made with an 'api' name are
+      timed and their errors counted
+    """
+
+    def __init__(self, timeout=None, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF,
+                 max_host_connections=HTTP_MAX_HOST_CONNECTIONS, headers=None,
+                 metrics=None):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_host_connections = max_host_connections
+        self.headers = headers or {}
+        self.metrics = metrics
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def _new_session(self):
+        session = requests.Session()
+        # Blocking pools: a request waits for a free connection to its host
+        adapter = HTTPAdapter(
+            pool_connections=16, pool_maxsize=self.max_host_connections,
+            pool_block=True, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self.headers)
+        return session
+
+    @property
+    def session(self):
+        # The connections are not shared with forked processes
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._new_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _api_call(self, api):
+        if api is None or self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.api_call(api)
+
+    def request(self, method, url, api=None, retries=None, coalesce=False, **kwargs):
+        """
+        Send a request (see requests.Session.request), retried on connection
+        errors, 429 and 5xx. The last response is returned, whatever its
+        status; the last connection error is raised.
+        With 'coalesce', a GET sent while the same one is in flight waits for
+        it and returns its response (to be read only, not streamed).
+        """
+        method = method.upper()
+        if coalesce and method == "GET" and not kwargs.get("stream"):
+            key = (url, repr(kwargs.get("params")), repr(kwargs.get("headers")))
+            return self._flights.do(key, self._send, method, url, api, retries, kwargs)
+        return self._send(method, url, api, retries, kwargs)
+
+    def _send(self, method, url, api, retries, kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if retries is None:
+            retries = self.retries
+        idempotent = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            try:
+                with self._api_call(api):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Other errors may hide a processed request
+                retryable = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt >= retries or not retryable:
+                    raise
+                delay = backoff_delay(attempt, self.backoff)
+                logger.debug("%s %s failed (%s), retry in %.1fs", method, url, e, delay)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= retries \
+                        or (not idempotent and response.status_code != 429):
+                    if api is not None and self.metrics is not None and response.status_code >= 400:
+                        self.metrics.api_error(api)
+                    return response
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = backoff_delay(attempt, self.backoff)
+                logger.debug("%s %s: HTTP %s, retry in %.1fs", method, url, response.status_code, delay)
+                # Give the connection back to the pool
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.request("OPTIONS", url, **kwargs)
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+JSON encoding of findings and reports.
+
+orjson is used when it is installed, the standard json module otherwise.
+Both encode to bytes with the same semantics: values not serializable by
+default go through the 'default' function (datetimes by default).
+"""
+import json
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def json_serial(obj):
+    """
+        JSON serializer for objects not serializable by default json code
+        Used for datetime serialization when the results are written in file
+    """
+    if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
+        serial = obj.isoformat()
+        return serial
+    raise TypeError("Type not serializable")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps_bytes(obj, default=json_serial):
+        """Encode 'obj' to compact JSON bytes."""
+        try:
+            return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # Values orjson rejects but json accepts (ints over 64 bits, ...)
+            return json.dumps(obj, default=default, separators=(",", ":")).encode("utf-8")
+else:
+    def dumps_bytes(obj, default=json_serial):
+        """Encode 'obj' to compact JSON bytes."""
+        return json.dumps(obj, default=default, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Pool of API keys of a rate-limited provider.
+
+Each key has a token bucket refilled at the published rate of the provider
+(e.g. 4 requests per minute) and, optionally, a quota (e.g. 500 requests
+per day, or the credits reported by the provider). Callers acquire the key
+which can serve soonest and, when all the keys are empty, wait on the
+buckets instead of sleeping a fixed time: N keys serve N times the rate of
+one. A key rejected by the provider (rate limited, quota exceeded) is put
+aside until it can serve again, the others keep serving.
+"""
+import time
+import threading
+
+# Max time between two checks of the 'cancel' callback of a waiting caller
+CANCEL_CHECK_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """
+    'rate' requests per 'period' seconds, at most 'burst' (default: 'rate')
+    in a row. Not thread-safe: used under the lock of its KeyPool.
+    """
+
+    def __init__(self, rate, period=60.0, burst=None, now=None):
+        self.rate = float(rate) / float(period)
+        self.capacity = float(burst if burst is not None else rate)
+        self.tokens = self.capacity
+        self._updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def delay(self, now):
+        """Return the seconds to wait for a token."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self, now):
+        """Empty the bucket (the provider rate limited the key anyway)."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class _PoolKey:
+    """A key of the pool, its bucket, quota and counters."""
+
+    def __init__(self, key, bucket, quota, quota_period, now):
+        self.key = key
+        self.bucket = bucket
+        self.quota = quota
+        self.quota_period = quota_period
+        self.remaining = quota
+        self.reset_at = now + quota_period if quota is not None and quota_period else None
+        self.blocked_until = 0.0
+        self.dropped = False
+        self.requests = 0
+        self.rejections = 0
+
+    def ready_at(self, now):
+        """Return when the key can serve (None: never again)."""
+        if self.dropped:
+            return None
+        if self.remaining is not None and self.remaining <= 0:
+            if self.reset_at is None:
+                return None
+            if now >= self.reset_at:
+                self.remaining = self.quota
+                self.reset_at = now + self.quota_period if self.quota_period else None
+        if self.remaining is not None and self.remaining <= 0:
+            ready_at = self.reset_at
+        else:
+            ready_at = now
+        if self.bucket is not None:
+            ready_at = max(ready_at, now + self.bucket.delay(now))
+        return max(ready_at, self.blocked_until)
+
+
+class KeyPool:
+    """
+    API keys sharing the rate of a provider.
+    - rate, period, burst: token bucket of each key (rate None: no limit)
+    - quota, quota_period: requests allowed per key and period in seconds
+      (quota None: unknown, quota_period None: not renewed)
+    """
+
+    def __init__(self, keys, rate=None, period=60.0, burst=None,
+                 quota=None, quota_period=None, name="api"):
+        now = time.monotonic()
+        self.name = name
+        self.period = float(period)
+        self._cond = threading.Condition()
+        self._keys = []
+        self._index = {}
+        for key in keys:
+            if key in self._index:
+                continue
+            bucket = TokenBucket(rate, period, burst, now=now) if rate else None
+            self._index[key] = len(self._keys)
+            self._keys.append(_PoolKey(key, bucket, quota, quota_period, now))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return [k.key for k in self._keys]
+
+    def _select(self, now):
+        """Return (wait, key) of the key which can serve soonest, or (None, None)."""
+        best = None
+        for pool_key in self._keys:
+            ready_at = pool_key.ready_at(now)
+            if ready_at is None:
+                continue
+            # Same availability: the key with the most remaining quota first
+            rank = (ready_at, -(pool_key.remaining if pool_key.remaining is not None else float("inf")))
+            if best is None or rank < best[0]:
+                best = (rank, pool_key)
+        if best is None:
+            return None, None
+        return max(0.0, best[0][0] - now), best[1]
+
+    def acquire(self, timeout=None, cancel=None):
+        """
+        Return the key which can serve soonest, waiting for it if needed.
+        Return None if the wait exceeds 'timeout' (seconds), if 'cancel()'
+        returns True while waiting, or if no key can serve anymore.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait, pool_key = self._select(now)
+                if pool_key is None:
+                    return None
+                if wait <= 0:
+                    if pool_key.bucket is not None:
+                        pool_key.bucket.take(now)
+                    if pool_key.remaining is not None:
+                        pool_key.remaining -= 1
+                    pool_key.requests += 1
+                    return pool_key.key
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now)
+                if cancel is not None:
+                    if cancel():
+                        return None
+                    wait = min(wait, CANCEL_CHECK_INTERVAL)
+                # Woken up earlier if a key is given back some quota
+                self._cond.wait(wait)
+
+    def remaining(self, key):
+        """Return the remaining quota of 'key' (None: unknown)."""
+        with self._cond:
+            pool_key = self._keys[self._index[key]]
+            pool_key.ready_at(time.monotonic())
+            return pool_key.remaining
+
+    def reject(self, key, retry_after=None):
+        """
+        The provider rejected a request of 'key' (rate limit, quota): put it
+        aside for 'retry_after' seconds (default: the bucket period).
+        """
+        with self._cond:
+            pool_key = self._keys[self._index[key]]
+            now = time.monotonic()
+            pool_key.rejections += 1
+            if pool_key.bucket is not None:
+                pool_key.bucket.drain(now)
+            if retry_after is None:
+                retry_after = self.period
+            pool_key.blocked_until = max(pool_key.blocked_until, now + retry_after)
+
+    def drop(self, key):
+        """The provider refused 'key' (invalid, revoked): never use it again."""
+        with self._cond:
+            pool_key = self._keys[self._index[key]]
+            pool_key.rejections += 1
+            pool_key.dropped = True
+            # Waiting callers select another key
+            self._cond.notify_all()
+
+    def set_quota(self, key, remaining, reset_after=None):
+        """Set the remaining quota of 'key', as reported by the provider."""
+        with self._cond:
+            pool_key = self._keys[self._index[key]]
+            pool_key.remaining = remaining
+            if reset_after is not None:
+                pool_key.reset_at = time.monotonic() + reset_after
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return the counters of the keys (the keys themselves are not shown)."""
+        with self._cond:
+            now = time.monotonic()
+            stats = []
+            for i, pool_key in enumerate(self._keys):
+                ready_at = pool_key.ready_at(now)
+                stats.append({
+                    "key": i,
+                    "requests": pool_key.requests,
+                    "rejections": pool_key.rejections,
+                    "remaining": pool_key.remaining,
+                    "available_in": None if ready_at is None else round(max(0.0, ready_at - now), 3),
+                })
+            return {"name": self.name, "keys": stats}
@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Engine metrics in the Prometheus text exposition format.
+
+EngineMetrics holds the collectors shared by all the engines (scan phases,
+scheduler, external API calls, subprocesses, findings). Engines built on
+PatrowlEngine get them through engine.metrics; standalone engines create
+their own EngineMetrics and call the same hooks. Metrics are per process.
+"""
+import time
+import threading
+import collections
+from contextlib import contextmanager
+from flask import Response
+
+from .PatrowlEngineCancel import process_stats
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PHASE_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FINDINGS_RATE_WINDOW = 60
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, _labels_str(labels), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self._callback = callback
+
+    def samples(self):
+        if self._callback is None:
+            return super().samples()
+        # Read at scrape time from a monotonic total kept elsewhere
+        return [(self.name, (), self._callback())]
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self._callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self._callback is None:
+            return super().samples()
+        # Computed at scrape time: callback() returns a value or {label_value: value}
+        values = self._callback()
+        if not isinstance(values, dict):
+            return [(self.name, (), values)]
+        return [(self.name, ((self.labelnames[0], k),), v) for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=API_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    samples.append((self.name + "_bucket", key + (("le", _format_value(float(bound))),), bucket_count))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, count))
+        return samples
+
+
+class EngineMetrics:
+    """Collectors of an engine and their hooks."""
+
+    def __init__(self, name):
+        self.name = name
+        self.metrics = []
+        self._scans = {}
+        self._scans_lock = threading.Lock()
+        self._findings = collections.deque()
+
+        self.scan_phase = self.histogram(
+            "patrowl_engine_scan_phase_seconds",
+            "Duration from startscan to the first result, to the end of the scan, and from its end to getfindings.",
+            ["phase"], buckets=PHASE_BUCKETS)
+        self.api_latency = self.histogram(
+            "patrowl_engine_api_request_seconds",
+            "Latency of the requests to the external APIs.",
+            ["api"], buckets=API_BUCKETS)
+        self.api_errors = self.counter(
+            "patrowl_engine_api_errors_total",
+            "Failed requests to the external APIs.",
+            ["api"])
+        self.findings = self.counter(
+            "patrowl_engine_findings_total",
+            "Findings delivered by getfindings.")
+        self.gauge(
+            "patrowl_engine_findings_per_second",
+            "Findings delivered per second over the last {} seconds.".format(FINDINGS_RATE_WINDOW),
+            callback=self._findings_rate)
+        self.counter(
+            "patrowl_engine_subprocesses_started_total",
+            "External processes started since the engine started.",
+            callback=lambda: process_stats()["started"])
+        self.gauge(
+            "patrowl_engine_subprocesses_running",
+            "External processes running (not reaped yet).",
+            callback=lambda: process_stats()["running"])
+
+    def counter(self, name, help, labelnames=(), callback=None):
+        return self._register(Counter(name, help, labelnames, callback=callback))
+
+    def gauge(self, name, help, labelnames=(), callback=None):
+        return self._register(Gauge(name, help, labelnames, callback=callback))
+
+    def histogram(self, name, help, labelnames=(), buckets=API_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets=buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_scheduler(self, scheduler):
+        """Expose the queue depth and the active workers of a ScanScheduler."""
+        self.gauge(
+            "patrowl_engine_scan_queue_depth",
+            "Units of work waiting for a worker.",
+            callback=lambda: scheduler.stats()["queue_depth"])
+        self.gauge(
+            "patrowl_engine_active_workers",
+            "Workers running a unit of work.",
+            callback=lambda: scheduler.stats()["active_workers"])
+
+    def register_scans(self, scans):
+        """
+        Expose the number of scans by status. scans is a scan store (counted
+        by count_by_status(), without loading the records) or a plain dict
+        of scan dicts.
+        """
+        if hasattr(scans, "count_by_status"):
+            self.gauge("patrowl_engine_scans", "Scans by status.", ["status"], callback=scans.count_by_status)
+            return
+
+        def _scans_by_status():
+            statuses = {}
+            for scan in list(scans.values()):
+                status = scan.get("status")
+                if status is not None:
+                    statuses[status] = statuses.get(status, 0) + 1
+            return statuses
+        self.gauge("patrowl_engine_scans", "Scans by status.", ["status"], callback=_scans_by_status)
+
+    def register_cache(self, cache):
+        """Count the hits and misses of a LookupCache."""
+        self.cache_hits = self.counter(
+            "patrowl_engine_cache_hits_total",
+            "Lookups served by the cache.",
+            ["provider"])
+        self.cache_misses = self.counter(
+            "patrowl_engine_cache_misses_total",
+            "Lookups not found in the cache (or refreshed).",
+            ["provider"])
+        cache.metrics = self
+
+    def cache_lookup(self, provider, hit):
+        (self.cache_hits if hit else self.cache_misses).inc(provider=provider)
+
+    # Scan phases
+    def scan_started(self, scan_id):
+        with self._scans_lock:
+            self._scans[scan_id] = {"started": time.time()}
+
+    def _phase(self, scan_id, phase, since):
+        with self._scans_lock:
+            times = self._scans.get(scan_id)
+            if times is None or phase in times or since not in times:
+                return
+            times[phase] = time.time()
+            duration = times[phase] - times[since]
+        self.scan_phase.observe(duration, phase=phase)
+
+    def scan_first_result(self, scan_id):
+        self._phase(scan_id, "first_result", "started")
+
+    def scan_finished(self, scan_id):
+        self._phase(scan_id, "finished", "started")
+
+    def scan_findings(self, scan_id, nb_findings=0):
+        """
+        First getfindings of a scan: record the last phase and count the
+        findings (the next pages of the same scan are not counted again).
+        """
+        with self._scans_lock:
+            times = self._scans.pop(scan_id, None)
+        if times is None:
+            return
+        if "finished" in times:
+            self.scan_phase.observe(time.time() - times["finished"], phase="getfindings")
+        self.findings_emitted(nb_findings)
+
+    def scan_removed(self, scan_id):
+        with self._scans_lock:
+            self._scans.pop(scan_id, None)
+
+    # Findings
+    def findings_emitted(self, nb_findings):
+        if nb_findings <= 0:
+            return
+        self.findings.inc(nb_findings)
+        with self._scans_lock:
+            self._findings.append((time.time(), nb_findings))
+
+    def _findings_rate(self):
+        limit = time.time() - FINDINGS_RATE_WINDOW
+        with self._scans_lock:
+            while self._findings and self._findings[0][0] < limit:
+                self._findings.popleft()
+            nb_findings = sum(n for _, n in self._findings)
+        return nb_findings / FINDINGS_RATE_WINDOW
+
+    # External APIs
+    @contextmanager
+    def api_call(self, api):
+        """Time a call to an external API; exceptions are counted as errors."""
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.api_errors.inc(api=api)
+            raise
+        finally:
+            self.api_latency.observe(time.time() - start, api=api)
+
+    def api_error(self, api):
+        """Count a failed API call that did not raise (error status, ...)."""
+        self.api_errors.inc(api=api)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def response(self):
+        return Response(self.render(), content_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Supervisor of the external processes (tools) started by an engine.
+
+All the tools of an engine process are started by one ProcessSupervisor:
+- at most N processes of a tool run at once ($APP_MAX_PROCESSES_<TOOL>,
+  default $APP_MAX_PROCESSES or the number of CPUs), the next ones wait
+  for a slot instead of oversubscribing the CPUs of the scan box,
+- they get the nice level, CPU affinity and rlimits set by $APP_PROCESS_*,
+- a reaper thread, woken by a pidfd of each process (Linux >= 5.3) or
+  else by SIGCHLD (through the wakeup fd of the signal module, installed
+  with the first process), reaps them as soon as they exit (no zombies,
+  no polling loops in the engines), releases their slot and fires their
+  completion callbacks,
+- stats() returns their CPU and RSS (of their whole process group), shown
+  in the /status of the engines.
+"""
+import os
+import time
+import shlex
+import select
+import signal
+import threading
+import subprocess
+
+DEFAULT_MAX_PROCESSES = int(os.environ.get("APP_MAX_PROCESSES", os.cpu_count() or 1))
+# Seconds between two reaps when no SIGCHLD handler could be installed
+DEFAULT_REAP_INTERVAL = 1.0
+# Max time between two checks of the 'cancel' callback of a process waiting for a slot
+CANCEL_CHECK_INTERVAL = 1.0
+
+RLIMITS_ENV = {
+    "APP_PROCESS_MAX_MEMORY": "RLIMIT_AS",
+    "APP_PROCESS_MAX_CPU_TIME": "RLIMIT_CPU",
+    "APP_PROCESS_MAX_FILES": "RLIMIT_NOFILE",
+}
+
+try:
+    import resource
+except ImportError:  # Not on Linux
+    resource = None
+
+
+def parse_cpus(value):
+    """Parse a CPU list, e.g. '0-3,6', into a set of CPUs."""
+    cpus = set()
+    for part in str(value).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def tool_name(cmd):
+    """Return the tool of a command: the basename of its program."""
+    if isinstance(cmd, (list, tuple)):
+        program = cmd[0] if cmd else ""
+    else:
+        try:
+            program = shlex.split(cmd)[0]
+        except (ValueError, IndexError):
+            program = str(cmd).split(" ", 1)[0]
+    return os.path.basename(str(program)) or "unknown"
+
+
+def _read_proc_stat(pid):
+    """Return (pgid, cpu seconds, rss bytes) of a process (Linux /proc)."""
+    with open("/proc/{}/stat".format(pid)) as stat_file:
+        # The command name may contain spaces: fields are counted after it
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (
+        int(fields[2]),
+        (int(fields[11]) + int(fields[12])) / ticks,
+        int(fields[21]) * os.sysconf("SC_PAGE_SIZE"),
+    )
+
+
+def group_usage(pgids):
+    """Return {pgid: (cpu seconds, rss bytes)} of the processes of the groups."""
+    usage = {pgid: (0.0, 0) for pgid in pgids}
+    if not usage:
+        return usage
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return usage
+    for pid in pids:
+        try:
+            pgid, cpu, rss = _read_proc_stat(pid)
+        except (OSError, IndexError, ValueError):
+            continue
+        if pgid in usage:
+            usage[pgid] = (usage[pgid][0] + cpu, usage[pgid][1] + rss)
+    return usage
+
+
+def _pidfd_open(pid):
+    """Return a pidfd of a process, readable once it exits, or None if not supported."""
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        # Kernel < 5.3, or already reaped
+        return None
+
+
+class _Supervised:
+    """A supervised process, its tool and its completion."""
+
+    __slots__ = ("proc", "pidfd", "tool", "cmd", "started", "callbacks", "done", "cpu_sample")
+
+    def __init__(self, proc, tool, cmd, callbacks):
+        self.proc = proc
+        self.pidfd = _pidfd_open(proc.pid)
+        self.tool = tool
+        self.cmd = cmd
+        self.started = time.time()
+        self.callbacks = callbacks
+        self.done = threading.Event()
+        self.cpu_sample = None
+
+
+class ProcessSupervisor:
+    """
+    Start, limit and reap the external processes.
+    - max_processes: default max running processes of a tool
+    - limits: max running processes by tool
+    - nice, cpus, rlimits: applied to the processes ({resource.RLIMIT_*: (soft, hard)})
+    """
+
+    def __init__(self, max_processes=DEFAULT_MAX_PROCESSES, limits=None, nice=None, cpus=None,
+                 rlimits=None, reap_interval=DEFAULT_REAP_INTERVAL):
+        self.max_processes = max_processes
+        self.limits = dict(limits or {})
+        self.nice = nice
+        self.cpus = set(cpus) if cpus else None
+        self.rlimits = dict(rlimits or {})
+        self.reap_interval = reap_interval
+        self._lock = threading.Condition()
+        self._procs = {}
+        self._running = {}
+        self._waiting = {}
+        self._started = 0
+        # Self-pipe waking the reaper, also written by the C handler of SIGCHLD
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._reaper = None
+        self._reaper_pid = None
+        self._sigchld = False
+
+    @classmethod
+    def from_env(cls):
+        """Return a supervisor set by the $APP_MAX_PROCESSES* and $APP_PROCESS_* variables."""
+        limits = {}
+        for name, value in os.environ.items():
+            if name.startswith("APP_MAX_PROCESSES_"):
+                limits[name[len("APP_MAX_PROCESSES_"):].lower()] = int(value)
+        rlimits = {}
+        if resource is not None:
+            for name, rlimit in RLIMITS_ENV.items():
+                if os.environ.get(name):
+                    rlimits[getattr(resource, rlimit)] = (int(os.environ[name]), int(os.environ[name]))
+        nice = os.environ.get("APP_PROCESS_NICE")
+        cpus = os.environ.get("APP_PROCESS_CPUS")
+        return cls(
+            limits=limits, rlimits=rlimits,
+            nice=int(nice) if nice else None, cpus=parse_cpus(cpus) if cpus else None)
+
+    def limit(self, tool):
+        return self.limits.get(tool.lower(), self.max_processes)
+
+    def set_limit(self, tool, max_processes):
+        with self._lock:
+            self.limits[tool.lower()] = max_processes
+            self._lock.notify_all()
+
+    # Start
+    def _preexec(self):
+        # In the child, before exec: inherited by the processes of the tool
+        if self.nice:
+            os.nice(self.nice)
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        for rlimit, value in self.rlimits.items():
+            resource.setrlimit(rlimit, value)
+
+    def _acquire(self, tool, cancel):
+        with self._lock:
+            self._waiting[tool] = self._waiting.get(tool, 0) + 1
+            try:
+                while self._running.get(tool, 0) >= self.limit(tool):
+                    if cancel is not None and cancel():
+                        return False
+                    self._lock.wait(CANCEL_CHECK_INTERVAL if cancel is not None else None)
+                self._running[tool] = self._running.get(tool, 0) + 1
+                return True
+            finally:
+                self._waiting[tool] -= 1
+
+    def _release(self, tool):
+        with self._lock:
+            self._running[tool] -= 1
+            self._lock.notify_all()
+
+    def start(self, cmd, tool=None, on_exit=None, cancel=None, **kwargs):
+        """
+        Start 'cmd' (subprocess.Popen arguments) as the leader of a new
+        process group once a slot of its tool is free. 'on_exit(proc)' is
+        called by the reaper when it exits. Return the Popen, or None if
+        'cancel()' became true while waiting for a slot.
+        """
+        if tool is None:
+            tool = tool_name(cmd)
+        self._ensure_reaper()
+        if not self._acquire(tool, cancel):
+            return None
+        kwargs.setdefault("start_new_session", True)
+        if (self.nice or self.cpus or self.rlimits) and "preexec_fn" not in kwargs:
+            kwargs["preexec_fn"] = self._preexec
+        try:
+            proc = subprocess.Popen(cmd, **kwargs)
+        except BaseException:
+            self._release(tool)
+            raise
+        item = _Supervised(proc, tool, cmd, [on_exit] if on_exit is not None else [])
+        with self._lock:
+            self._procs[proc.pid] = item
+            self._started += 1
+        # It may have exited already
+        self.wakeup()
+        return proc
+
+    def add_callback(self, proc, callback):
+        """Call 'callback(proc)' when 'proc' exits (at once if it did)."""
+        with self._lock:
+            item = self._procs.get(proc.pid)
+            if item is not None and item.proc is proc:
+                item.callbacks.append(callback)
+                return
+        callback(proc)
+
+    def wait(self, proc, timeout=None):
+        """Wait for a supervised process to exit; return its exit code, None on timeout."""
+        with self._lock:
+            item = self._procs.get(proc.pid)
+        if item is None or item.proc is not proc:
+            return proc.wait(timeout)
+        if not item.done.wait(timeout):
+            return None
+        return proc.returncode
+
+    # Reaper
+    def _ensure_reaper(self):
+        # Threads do not survive fork(): one reaper per process
+        if self._reaper is not None and self._reaper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._reaper is not None and self._reaper_pid == os.getpid():
+                return
+            for item in self._procs.values():
+                if item.pidfd is not None:
+                    os.close(item.pidfd)
+            self._procs.clear()
+            self._running.clear()
+            if self._reaper is not None:
+                # Forked (e.g. gunicorn --preload): the pipe of the parent is
+                # not shared
+                self._wakeup_r, self._wakeup_w = os.pipe()
+                os.set_blocking(self._wakeup_r, False)
+                os.set_blocking(self._wakeup_w, False)
+                self._sigchld = False
+            self._reaper_pid = os.getpid()
+            self._reaper = threading.Thread(target=self._reap_loop, name="process-reaper", daemon=True)
+            self._reaper.start()
+        if not hasattr(os, "pidfd_open"):
+            self.install_sigchld_handler()
+
+    def install_sigchld_handler(self):
+        """
+        Wake the reaper on SIGCHLD, for the systems without pidfds. Only
+        possible from the main thread, and if no other wakeup fd is set
+        (e.g. by asyncio): the first process is usually started by a scan
+        thread, so the engines may call it at startup. The C handler
+        writes to the wakeup fd at once, the Python one only runs when
+        the main thread does. Without it, the processes are reaped every
+        'reap_interval' seconds.
+        """
+        if self._sigchld:
+            return True
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        previous_fd = signal.set_wakeup_fd(self._wakeup_w, warn_on_full_buffer=False)
+        if previous_fd not in (-1, self._wakeup_w):
+            signal.set_wakeup_fd(previous_fd)
+            return False
+        previous = signal.getsignal(signal.SIGCHLD)
+
+        def _handler(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signal.SIGCHLD, _handler)
+        # Interrupted system calls are restarted
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self._sigchld = True
+        return True
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except (BlockingIOError, OSError):
+            # Already woken up
+            pass
+
+    def _reap_loop(self):
+        while True:
+            # poll(), not select(): the fds may be above FD_SETSIZE
+            poller = select.poll()
+            poller.register(self._wakeup_r, select.POLLIN)
+            with self._lock:
+                for item in self._procs.values():
+                    if item.pidfd is not None:
+                        poller.register(item.pidfd, select.POLLIN)
+            poller.poll(self.reap_interval * 1000)
+            try:
+                while os.read(self._wakeup_r, 512):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+            self.reap()
+
+    def reap(self):
+        """waitpid() the supervised processes, complete the exited ones."""
+        with self._lock:
+            items = list(self._procs.values())
+        for item in items:
+            # poll() only waits for its own pid: the other children of the
+            # engine are left to their owners
+            if item.proc.poll() is None:
+                continue
+            with self._lock:
+                if self._procs.get(item.proc.pid) is not item:
+                    continue
+                del self._procs[item.proc.pid]
+            if item.pidfd is not None:
+                os.close(item.pidfd)
+            self._release(item.tool)
+            for callback in item.callbacks:
+                try:
+                    callback(item.proc)
+                except Exception:
+                    pass
+            item.done.set()
+
+    # Stats
+    def counts(self):
+        """Return the number of processes started, and of those not reaped yet."""
+        with self._lock:
+            return {"started": self._started, "running": len(self._procs)}
+
+    def stats(self):
+        """Return the running processes (pid, tool, CPU, RSS) and the slots by tool."""
+        with self._lock:
+            items = list(self._procs.values())
+            tools = {
+                tool: {"running": self._running.get(tool, 0), "waiting": self._waiting.get(tool, 0),
+                       "max": self.limit(tool)}
+                for tool in set(self._running) | set(self._waiting)
+            }
+        now = time.time()
+        usage = group_usage([item.proc.pid for item in items])
+        processes = []
+        for item in items:
+            cpu, rss = usage.get(item.proc.pid, (0.0, 0))
+            # CPU usage since the previous stats, else since the start
+            since, cpu_before = item.cpu_sample or (item.started, 0.0)
+            item.cpu_sample = (now, cpu)
+            processes.append({
+                "pid": item.proc.pid,
+                "tool": item.tool,
+                "cmd": item.cmd if isinstance(item.cmd, str) else " ".join(item.cmd),
+                "elapsed": round(now - item.started, 1),
+                "cpu_time": round(cpu, 2),
+                "cpu_percent": round(100 * (cpu - cpu_before) / (now - since), 1) if now > since else 0.0,
+                "rss": rss,
+            })
+        return {"tools": tools, "processes": processes}
+
+
+supervisor = ProcessSupervisor.from_env()
+
+
+def install_sigchld_handler():
+    """Install the SIGCHLD handler of the supervisor of the engine (see ProcessSupervisor.install_sigchld_handler)."""
+    return supervisor.install_sigchld_handler()
@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Streamed findings reports.
+
+Reports are written one finding at a time as a valid JSON document laid out
+with one issue per line:
+
+    {"scan": {...}, "issues": [
+    {...}
+    ,{...}
+    ], "summary": {...}}
+
+so that getreport keeps serving a regular JSON file while getfindings can
+stream it (full JSON or NDJSON pages) without loading it in memory. The
+NDJSON cursor is the byte offset of the next issue line.
+
+Reports named '*.gz' (or '*.zst' with zstandard) are compressed in
+independent blocks (gzip members, zstd frames) of whole lines: the file
+remains a regular compressed JSON document, and its '.idx' sidecar maps
+the uncompressed offset of each block to its compressed offset so that a
+cursor is reached without decompressing the previous blocks.
+"""
+import io
+import os
+import gzip
+import json
+import bisect
+from contextlib import contextmanager
+from flask import Response, send_file
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .PatrowlEngineExceptions import PatrowlEngineExceptions
+from .PatrowlEngineJson import dumps_bytes, json_serial
+
+DEFAULT_NDJSON_LIMIT = 1000
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+_REPORT_ISSUES_START = ', "issues": [\n'
+_REPORT_ISSUES_END = '], "summary": '
+_TAIL_CHUNK = 65536
+_READ_CHUNK = 65536
+
+REPORT_BLOCK_SIZE = 1024 * 1024
+REPORT_INDEX_SUFFIX = ".idx"
+
+# Report file extension: codec (also its HTTP Content-Encoding)
+CODECS = {".gz": "gzip"}
+if zstandard is not None:
+    CODECS[".zst"] = "zstd"
+
+
+def report_codec(filepath):
+    """Return the compression codec of a report file, None if not compressed."""
+    return CODECS.get(os.path.splitext(filepath)[1])
+
+
+def _compress_block(codec, data):
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _decompress_stream(codec, fileobj):
+    """Return a buffered reader of the blocks read from 'fileobj'."""
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+        fileobj, read_across_frames=True))
+
+
+class _PlainWriter:
+    def __init__(self, fileobj):
+        self._file = fileobj
+
+    def write_line(self, *parts):
+        for part in parts:
+            self._file.write(part)
+
+    def close(self):
+        return None
+
+
+class _BlockWriter:
+    """Compress the lines written in independent blocks of ~REPORT_BLOCK_SIZE bytes."""
+
+    def __init__(self, fileobj, codec, block_size=None):
+        self._file = fileobj
+        self._codec = codec
+        self._block_size = block_size or REPORT_BLOCK_SIZE
+        self._parts = []
+        self._buffered = 0
+        self._offset = 0
+        self.blocks = []
+
+    def write_line(self, *parts):
+        self._parts.extend(parts)
+        self._buffered += sum(len(part) for part in parts)
+        if self._buffered >= self._block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._buffered:
+            return
+        self.blocks.append((self._offset, self._file.tell()))
+        self._file.write(_compress_block(self._codec, b"".join(self._parts)))
+        self._offset += self._buffered
+        self._parts = []
+        self._buffered = 0
+
+    def close(self):
+        """Flush the last block and return the index of the blocks."""
+        self._flush_block()
+        return {"codec": self._codec, "size": self._offset, "blocks": self.blocks}
+
+
+def write_report(filepath, scan, issues, summary=None, default=json_serial):
+    """
+    Write the issues (any iterable of dicts or PatrowlEngineFinding,
+    possibly lazy) in the report file and return the summary completed with
+    the severity counters. Each issue is serialized once and written as
+    soon as it is produced. The report is compressed if its extension is
+    one of CODECS.
+    """
+    nb_vulns = {"info": 0, "low": 0, "medium": 0, "high": 0, "critical": 0}
+    nb_issues = 0
+    codec = report_codec(filepath)
+
+    tmp_filepath = "{}.{}.tmp".format(filepath, os.getpid())
+    with open(tmp_filepath, 'wb') as report_file:
+        out = _PlainWriter(report_file) if codec is None else _BlockWriter(report_file, codec)
+        header = json.dumps({"scan": scan}, default=default)
+        out.write_line((header[:-1] + _REPORT_ISSUES_START).encode("utf-8"))
+        for issue in issues:
+            if isinstance(issue, dict):
+                line = dumps_bytes(issue, default=default)
+                severity = issue.get("severity", "info")
+            else:
+                line = issue.to_json_bytes(default=default)
+                severity = issue.severity
+            if nb_issues > 0:
+                out.write_line(b",", line, b"\n")
+            else:
+                out.write_line(line, b"\n")
+            nb_issues += 1
+            nb_vulns[severity] = nb_vulns.get(severity, 0) + 1
+
+        report_summary = {
+            "nb_issues": nb_issues,
+            "nb_info": nb_vulns["info"],
+            "nb_low": nb_vulns["low"],
+            "nb_medium": nb_vulns["medium"],
+            "nb_high": nb_vulns["high"],
+        }
+        if nb_vulns["critical"]:
+            report_summary["nb_critical"] = nb_vulns["critical"]
+        if summary:
+            report_summary.update(summary)
+        out.write_line(
+            _REPORT_ISSUES_END.encode("utf-8"),
+            json.dumps(report_summary, default=default).encode("utf-8"),
+            b"}\n")
+        index = out.close()
+
+    # Readers never see a partially written report (nor a stale index)
+    if index is not None:
+        tmp_index = tmp_filepath + REPORT_INDEX_SUFFIX
+        with open(tmp_index, 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(tmp_index, filepath + REPORT_INDEX_SUFFIX)
+    os.replace(tmp_filepath, filepath)
+    return report_summary
+
+
+class ReportReader:
+    """Random access to the scan, the summary and the issue lines of a report."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.codec = report_codec(filepath)
+        self.blocks = self._read_index()
+        self._block_offsets = [b[0] for b in self.blocks] if self.blocks else None
+        with self._open_at(0) as report_file:
+            header = report_file.readline().decode("utf-8")
+        self.issues_offset = len(header.encode("utf-8"))
+        if not header.endswith(_REPORT_ISSUES_START):
+            # Report written by a previous version: not streamable
+            raise PatrowlEngineExceptions(1005)
+        self.scan = json.loads(header[:-len(_REPORT_ISSUES_START)] + "}")["scan"]
+        self.summary = self._read_summary()
+
+    def _read_index(self):
+        if self.codec is None:
+            return None
+        try:
+            with open(self.filepath + REPORT_INDEX_SUFFIX) as index_file:
+                return [tuple(block) for block in json.load(index_file)["blocks"]] or [(0, 0)]
+        except (OSError, ValueError, KeyError):
+            # No index: the blocks are decompressed from the start
+            return [(0, 0)]
+
+    @contextmanager
+    def _open_at(self, offset):
+        """Open the report positioned at the uncompressed 'offset'."""
+        with open(self.filepath, 'rb') as report_file:
+            if self.codec is None:
+                report_file.seek(offset)
+                yield report_file
+                return
+            i = bisect.bisect_right(self._block_offsets, offset) - 1
+            block_offset, compressed_offset = self.blocks[max(i, 0)]
+            report_file.seek(compressed_offset)
+            with _decompress_stream(self.codec, report_file) as stream:
+                to_skip = offset - block_offset
+                while to_skip > 0:
+                    skipped = len(stream.read(min(to_skip, _READ_CHUNK)))
+                    if not skipped:
+                        break
+                    to_skip -= skipped
+                yield stream
+
+    def _read_summary(self):
+        if self.codec is not None:
+            # The summary line is in the last block
+            with self._open_at(self.blocks[-1][0]) as stream:
+                last_line = b""
+                for line in stream:
+                    last_line = line
+            last_line = last_line.rstrip(b"\n").decode("utf-8")
+            return json.loads(last_line[len(_REPORT_ISSUES_END):-1])
+
+        with open(self.filepath, 'rb') as report_file:
+            report_file.seek(0, os.SEEK_END)
+            size = report_file.tell()
+            tail = b""
+            # Read backward until the whole last line is loaded
+            while size > 0 and tail.count(b"\n") < 2:
+                step = min(_TAIL_CHUNK, size)
+                size -= step
+                report_file.seek(size)
+                tail = report_file.read(step) + tail
+        last_line = tail.rstrip(b"\n").rsplit(b"\n", 1)[-1].decode("utf-8")
+        return json.loads(last_line[len(_REPORT_ISSUES_END):-1])
+
+    def check_cursor(self, cursor):
+        """Raise if 'cursor' is not the offset of an issue line."""
+        if cursor < self.issues_offset:
+            raise PatrowlEngineExceptions(1004)
+        with self._open_at(cursor - 1) as report_file:
+            if report_file.read(1) != b"\n":
+                raise PatrowlEngineExceptions(1004)
+
+    def iter_issues(self, cursor=None, limit=None):
+        """Yield (issue_line, next_cursor) from the byte offset 'cursor'."""
+        if cursor is None:
+            cursor = self.issues_offset
+        nb_lines = 0
+        with self._open_at(cursor) as report_file:
+            while limit is None or nb_lines < limit:
+                line = report_file.readline()
+                if not line or line.startswith(_REPORT_ISSUES_END.encode("utf-8")):
+                    return
+                nb_lines += 1
+                cursor += len(line)
+                yield line.lstrip(b",").rstrip(b"\n"), cursor
+
+
+def _get_cursor(args):
+    cursor = args.get("cursor", None)
+    if cursor in [None, ""]:
+        return None
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        raise PatrowlEngineExceptions(1004)
+    if cursor < 0:
+        raise PatrowlEngineExceptions(1004)
+    return cursor
+
+
+def _get_limit(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_NDJSON_LIMIT))
+    except ValueError:
+        limit = DEFAULT_NDJSON_LIMIT
+    return max(limit, 1)
+
+
+def is_ndjson_request(args, accept=None):
+    """Return True if the client asked for the streamed NDJSON mode."""
+    if args.get("format", "") == "ndjson" or "cursor" in args or "limit" in args:
+        return True
+    return accept is not None and NDJSON_MIMETYPE in accept
+
+
+def findings_response(filepath, res, args=None, accept=None):
+    """
+    Stream the findings of a report file:
+    - as one JSON document (previous getfindings format) by default,
+    - as NDJSON pages with '?format=ndjson&cursor=&limit=': a header line
+      (scan, summary), one line per issue, then a trailer line holding the
+      'next_cursor' (null on the last page).
+    """
+    args = args or {}
+    reader = ReportReader(filepath)
+
+    if is_ndjson_request(args, accept):
+        cursor = _get_cursor(args)
+        if cursor is not None:
+            reader.check_cursor(cursor)
+        limit = _get_limit(args)
+        issues = reader.iter_issues(cursor=cursor, limit=limit)
+
+        def _generate():
+            header = {"scan": reader.scan, "summary": reader.summary, "status": "success"}
+            header.update(res)
+            yield json.dumps(header) + "\n"
+            nb_lines = 0
+            next_cursor = cursor
+            for line, next_cursor in issues:
+                nb_lines += 1
+                yield line + b"\n"
+            if nb_lines < limit:
+                next_cursor = None
+            yield json.dumps({
+                "page": res.get("page", "getfindings"),
+                "cursor": cursor,
+                "next_cursor": next_cursor,
+                "nb_issues": nb_lines}) + "\n"
+        return Response(_generate(), mimetype=NDJSON_MIMETYPE)
+
+    issues = reader.iter_issues()
+
+    def _generate():
+        body = {"scan": reader.scan, "summary": reader.summary, "status": "success"}
+        body.update(res)
+        yield json.dumps(body)[:-1] + ', "issues": ['
+        first = True
+        for line, _ in issues:
+            if not first:
+                yield b","
+            first = False
+            yield line
+        yield "]}"
+    return Response(_generate(), mimetype="application/json")
+
+
+def report_response(filepath, accept_encodings=None):
+    """
+    Serve a report file as JSON. A compressed report is sent as is, with
+    its Content-Encoding, to the clients accepting it ('accept_encodings':
+    the request Accept-Encoding values), and decompressed on the fly for
+    the others.
+    """
+    codec = report_codec(filepath)
+    if codec is None:
+        return send_file(filepath, mimetype="application/json")
+
+    if accept_encodings is not None and accept_encodings[codec] > 0:
+        response = send_file(filepath, mimetype="application/json")
+        response.headers["Content-Encoding"] = codec
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def _generate():
+        with open(filepath, 'rb') as report_file:
+            with _decompress_stream(codec, report_file) as stream:
+                while True:
+                    chunk = stream.read(_READ_CHUNK)
+                    if not chunk:
+                        return
+                    yield chunk
+    response = Response(_generate(), mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Results store of an engine: where its findings reports are written.
+
+Reports are compressed (gzip, or zstd if zstandard is installed) and
+sharded in 256 subdirectories by a hash of the scan id, so that a report
+is found from its scan id alone and no directory grows with the number of
+scans. Reports written by previous versions directly in the results
+directory, uncompressed, are still served.
+
+The retention policy (max age, max total size, both disabled by default)
+removes the oldest sharded reports; it is applied at most every
+RETENTION_INTERVAL seconds, after a report is written.
+
+The findings of the reports written with their scan assets update the
+fingerprint index of the engine, and are reduced to the changes since the
+previous scan with 'delta_only' (see PatrowlEngineFingerprint).
+"""
+import os
+import glob
+import time
+import hashlib
+import threading
+
+from .PatrowlEngineJson import json_serial
+from .PatrowlEngineFingerprint import FINGERPRINTS_ENABLED, get_fingerprint_index
+from .PatrowlEngineReport import (
+    write_report, findings_response, report_response, CODECS, REPORT_INDEX_SUFFIX)
+
+RESULTS_COMPRESSION = os.environ.get("APP_RESULTS_COMPRESSION", "gzip")
+RESULTS_MAX_AGE_DAYS = os.environ.get("APP_RESULTS_MAX_AGE_DAYS", None)
+RESULTS_MAX_SIZE_MB = os.environ.get("APP_RESULTS_MAX_SIZE_MB", None)
+RETENTION_INTERVAL = 3600
+
+_CODEC_EXTENSIONS = {codec: ext for ext, codec in CODECS.items()}
+
+
+class ResultsStore:
+    """
+    Sharded, compressed findings reports of an engine.
+    - compression: "gzip", "zstd" or "none"
+    - max_age: in seconds, max_size: in bytes (None: no limit)
+    """
+
+    def __init__(self, results_dir, name, compression=None, max_age=None, max_size=None):
+        self.results_dir = str(results_dir)
+        self.name = name
+        if compression is None:
+            compression = RESULTS_COMPRESSION
+        if compression == "zstd" and compression not in _CODEC_EXTENSIONS:
+            # zstandard is not installed
+            compression = "gzip"
+        if compression != "none" and compression not in _CODEC_EXTENSIONS:
+            raise ValueError("Unknown results compression '{}'".format(compression))
+        self.extension = ".json" + _CODEC_EXTENSIONS.get(compression, "")
+        if max_age is None and RESULTS_MAX_AGE_DAYS:
+            max_age = float(RESULTS_MAX_AGE_DAYS) * 86400
+        if max_size is None and RESULTS_MAX_SIZE_MB:
+            max_size = float(RESULTS_MAX_SIZE_MB) * 1024 * 1024
+        self.max_age = max_age
+        self.max_size = max_size
+        self._last_retention = 0
+        self._retention_lock = threading.Lock()
+        self._fingerprints = None
+
+    @property
+    def fingerprints(self):
+        """Fingerprint index of the findings, opened on first use."""
+        if self._fingerprints is None:
+            self._fingerprints = get_fingerprint_index(self.results_dir, self.name)
+        return self._fingerprints
+
+    def _shard(self, scan_id):
+        return hashlib.sha1(str(scan_id).encode("utf-8")).hexdigest()[:2]
+
+    def path(self, scan_id):
+        """Return the path of the report written for a scan."""
+        return "{}/{}/{}_{}{}".format(
+            self.results_dir, self._shard(scan_id), self.name, scan_id, self.extension)
+
+    def find(self, scan_id):
+        """Return the path of the report of a scan, or None if not found."""
+        shard_dir = "{}/{}".format(self.results_dir, self._shard(scan_id))
+        for ext in [self.extension] + [".json" + e for e in CODECS] + [".json"]:
+            filepath = "{}/{}_{}{}".format(shard_dir, self.name, scan_id, ext)
+            if os.path.exists(filepath):
+                return filepath
+        # Reports of the previous versions
+        filepath = "{}/{}_{}.json".format(self.results_dir, self.name, scan_id)
+        if os.path.exists(filepath):
+            return filepath
+        return None
+
+    def write_report(self, scan_id, scan, issues, summary=None, default=json_serial,
+                     assets=None, delta_only=False):
+        """
+        Write the report of a scan (see PatrowlEngineReport.write_report).
+        With the 'assets' of the scan, its findings are compared with the
+        previous scan of these assets: the report holds only the changes
+        if 'delta_only', and its summary counts them (unless the index is
+        off, see PatrowlEngineFingerprint).
+        """
+        if assets is not None and FINGERPRINTS_ENABLED:
+            delta = self.fingerprints.delta(issues, assets, delta_only=delta_only)
+            issues = delta
+            summary = dict(summary or {}, delta=delta.counts, delta_only=bool(delta_only))
+            if delta_only:
+                # Severity counters of the engine, of all the findings: counted again
+                summary = {k: v for k, v in summary.items() if not k.startswith("nb_")}
+        filepath = self.path(scan_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        report_summary = write_report(filepath, scan, issues, summary=summary, default=default)
+        self.maybe_apply_retention()
+        return report_summary
+
+    def findings_response(self, scan_id, res, args=None, accept=None):
+        return findings_response(self.find(scan_id), res, args, accept=accept)
+
+    def report_response(self, scan_id, accept_encodings=None):
+        return report_response(self.find(scan_id), accept_encodings)
+
+    def _reports(self):
+        """
+            Yield (mtime, size, files) of each report (with its index). Only
+            the sharded reports: the other files of the results directory
+            (tool outputs, partial findings, reports of the previous
+            versions) are left to their engine.
+        """
+        pattern = "{}/[0-9a-f][0-9a-f]/{}_*.json".format(self.results_dir, self.name)
+        extensions = [""] + [ext for ext in CODECS]
+        for ext in extensions:
+            for filepath in glob.glob(pattern + ext):
+                files = [filepath]
+                if os.path.exists(filepath + REPORT_INDEX_SUFFIX):
+                    files.append(filepath + REPORT_INDEX_SUFFIX)
+                try:
+                    stats = [os.stat(f) for f in files]
+                except OSError:
+                    # Removed in the meantime
+                    continue
+                yield stats[0].st_mtime, sum(st.st_size for st in stats), files
+
+    def apply_retention(self, now=None):
+        """Remove the reports older than max_age, then the oldest ones over max_size."""
+        if self.max_age is None and self.max_size is None:
+            return 0
+        if now is None:
+            now = time.time()
+        reports = sorted(self._reports(), key=lambda r: r[0])
+        total_size = sum(r[1] for r in reports)
+        nb_removed = 0
+        for mtime, size, files in reports:
+            too_old = self.max_age is not None and now - mtime > self.max_age
+            too_big = self.max_size is not None and total_size > self.max_size
+            if not too_old and not too_big:
+                break
+            for filepath in files:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            total_size -= size
+            nb_removed += 1
+        return nb_removed
+
+    def maybe_apply_retention(self):
+        if self.max_age is None and self.max_size is None:
+            return
+        with self._retention_lock:
+            if time.time() - self._last_retention < RETENTION_INTERVAL:
+                return
+            self._last_retention = time.time()
+        self.apply_retention()
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Bounded work-queue scheduler shared by the scans of an engine.
+
+Units of work (typically one asset) are queued by priority (asset
+criticity first, then submission order) and executed by a fixed pool of
+worker threads. Each scan is capped to a number of concurrent units so
+that one large scan cannot starve the others.
+
+A scan may queue its jobs between open_scan() and close_scan(): until
+then, its progress is 'scheduling' and it is not finished, even if all
+the jobs queued so far ended.
+"""
+import os
+import heapq
+import logging
+import itertools
+import threading
+
+DEFAULT_MAX_WORKERS = int(os.environ.get('APP_MAXWORKERS', 16))
+DEFAULT_MAX_SCAN_WORKERS = int(os.environ.get('APP_MAXSCANWORKERS', 4))
+
+CRITICITY_PRIORITIES = {
+    "critical": 0,
+    "high": 1,
+    "medium": 2,
+    "low": 3,
+}
+DEFAULT_PRIORITY = len(CRITICITY_PRIORITIES)
+
+logger = logging.getLogger(__name__)
+
+
+def get_priority(criticity):
+    """Return the queue priority of an asset criticity (lower runs first)."""
+    if criticity is None:
+        return DEFAULT_PRIORITY
+    return CRITICITY_PRIORITIES.get(str(criticity).lower(), DEFAULT_PRIORITY)
+
+
+class _ScanJobs:
+    """Queue and counters of one scan."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.pending = []   # heap of jobs waiting for a scan slot
+        self.dispatched = 0  # jobs in the ready queue or running
+        self.total = 0
+        self.running = 0
+        self.done = 0
+        self.errors = 0
+        self.scheduling = False
+
+    def progress(self):
+        return {
+            "total": self.total,
+            "pending": self.total - self.running - self.done - self.errors,
+            "running": self.running,
+            "done": self.done,
+            "errors": self.errors,
+            "scheduling": self.scheduling,
+        }
+
+
+class ScanScheduler:
+    """
+    Fixed pool of workers fed by a priority queue of scan jobs.
+    'listener(scan_id, progress)' is called when a job of a scan starts and
+    when it ends, so that the status of the scans is pushed, not polled.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 max_scan_workers=DEFAULT_MAX_SCAN_WORKERS, name="scheduler",
+                 listener=None):
+        self.max_workers = max_workers
+        self.max_scan_workers = max_scan_workers
+        self.name = name
+        self.listener = listener
+        self._ready = []
+        self._scans = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._active_workers = 0
+        self._pid = None
+
+    def _start_workers(self):
+        # Workers are started lazily so that forked processes get their own
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._ready = []
+        self._scans = {}
+        self._active_workers = 0
+        self._workers = []
+        for i in range(self.max_workers):
+            worker = threading.Thread(
+                target=self._work, name="{}-{}".format(self.name, i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _jobs(self, scan_id, max_scan_workers=None):
+        jobs = self._scans.get(scan_id)
+        if jobs is None:
+            jobs = _ScanJobs(max_scan_workers or self.max_scan_workers)
+            self._scans[scan_id] = jobs
+        return jobs
+
+    def open_scan(self, scan_id, max_scan_workers=None):
+        """Start queuing the jobs of a scan: it is not finished before close_scan()."""
+        with self._cond:
+            self._start_workers()
+            self._jobs(scan_id, max_scan_workers).scheduling = True
+
+    def close_scan(self, scan_id):
+        """All the jobs of a scan are queued: notify its progress (finished if they all ended)."""
+        with self._cond:
+            jobs = self._scans.get(scan_id)
+            if jobs is None:
+                # Forgotten (stopped) meanwhile
+                return
+            jobs.scheduling = False
+            progress = jobs.progress()
+        self._notify(scan_id, progress)
+
+    def submit(self, scan_id, target, args=(), kwargs=None, criticity=None,
+               max_scan_workers=None):
+        """Queue 'target(*args, **kwargs)' as a unit of work of 'scan_id'."""
+        job = (get_priority(criticity), next(self._seq), scan_id, target, args, kwargs or {})
+        with self._cond:
+            self._start_workers()
+            jobs = self._jobs(scan_id, max_scan_workers)
+            jobs.total += 1
+            if jobs.dispatched < jobs.max_workers:
+                jobs.dispatched += 1
+                heapq.heappush(self._ready, job)
+                self._cond.notify()
+            else:
+                heapq.heappush(jobs.pending, job)
+
+    def _release(self, jobs):
+        # A scan slot is free: dispatch its next pending job, if any
+        jobs.dispatched -= 1
+        if jobs.pending and jobs.dispatched < jobs.max_workers:
+            jobs.dispatched += 1
+            heapq.heappush(self._ready, heapq.heappop(jobs.pending))
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                _, _, scan_id, target, args, kwargs = heapq.heappop(self._ready)
+                jobs = self._scans.get(scan_id)
+                if jobs is None:
+                    # Scan forgotten while its job was queued
+                    continue
+                jobs.running += 1
+                self._active_workers += 1
+                progress = jobs.progress()
+
+            self._notify(scan_id, progress)
+            failed = False
+            try:
+                target(*args, **kwargs)
+            except Exception:
+                failed = True
+                logger.exception("scan '%s': job %s failed", scan_id, getattr(target, "__name__", target))
+
+            with self._cond:
+                self._active_workers -= 1
+                jobs.running -= 1
+                if failed:
+                    jobs.errors += 1
+                else:
+                    jobs.done += 1
+                forgotten = self._scans.get(scan_id) is not jobs
+                if not forgotten:
+                    self._release(jobs)
+                progress = jobs.progress()
+
+            if not forgotten:
+                self._notify(scan_id, progress)
+
+    def _notify(self, scan_id, progress):
+        if self.listener is None:
+            return
+        try:
+            self.listener(scan_id, progress)
+        except Exception:
+            logger.exception("scan '%s': progress listener failed", scan_id)
+
+    def has_scan(self, scan_id):
+        with self._cond:
+            return scan_id in self._scans
+
+    def progress(self, scan_id):
+        """Return the job counters of a scan, or None if it has no job."""
+        with self._cond:
+            jobs = self._scans.get(scan_id)
+            return jobs.progress() if jobs is not None else None
+
+    def is_finished(self, scan_id):
+        with self._cond:
+            jobs = self._scans.get(scan_id)
+            return jobs is not None and not jobs.scheduling and jobs.done + jobs.errors == jobs.total
+
+    def forget(self, scan_id):
+        """Drop the queued jobs and the counters of a scan."""
+        with self._cond:
+            jobs = self._scans.pop(scan_id, None)
+            if jobs is None:
+                return
+            self._ready = [j for j in self._ready if j[2] != scan_id]
+            heapq.heapify(self._ready)
+
+    def stats(self):
+        with self._cond:
+            # Jobs of forgotten (stopped) scans are only finishing their unit
+            active_workers = sum(j.running for j in self._scans.values())
+            return {
+                "workers": self.max_workers,
+                "active_workers": active_workers,
+                "stopping_workers": self._active_workers - active_workers,
+                "queue_depth": len(self._ready) + sum(len(j.pending) for j in self._scans.values()),
+            }
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Summary of the scans of an engine, maintained by their state transitions.
+
+Workers (scheduler jobs, scan threads, pollers) write the status of their
+scans as it changes; the board keeps the few fields shown by /status and
+the number of scans by status, so that the status requests only read it
+and never walk the threads, processes or remote scanners of the scans.
+"""
+import threading
+import collections
+
+# Fields of the scans shown by the status requests of the engines, written
+# again on each change of one of them: the large ones written once (assets,
+# ...) are read from the scans by the listings instead (see summaries())
+SUMMARY_FIELDS = ("status", "started_at", "finished_at", "progress", "reason", "info")
+
+
+def summary_fields(scan):
+    """Return the summary fields of a scan dict."""
+    return {k: scan[k] for k in SUMMARY_FIELDS if k in scan}
+
+
+class ScanStatusBoard:
+    """Summary fields of each scan and number of scans by status."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scans = {}
+        self._counts = collections.Counter()
+        self._listing = None
+
+    def set(self, scan_id, fields):
+        """Set the summary fields of a scan (a new scan is listed last)."""
+        fields = dict(fields)
+        with self._lock:
+            old = self._scans.get(scan_id)
+            if old is not None:
+                self._counts[old.get("status")] -= 1
+            # Entries are replaced, never modified: listings already returned stay valid
+            self._scans[scan_id] = fields
+            self._counts[fields.get("status")] += 1
+            self._listing = None
+
+    def remove(self, scan_id):
+        with self._lock:
+            entry = self._scans.pop(scan_id, None)
+            if entry is not None:
+                self._counts[entry.get("status")] -= 1
+                self._listing = None
+
+    def clear(self):
+        with self._lock:
+            self._scans = {}
+            self._counts = collections.Counter()
+            self._listing = None
+
+    def get(self, scan_id):
+        """Return the summary fields of a scan (not to be modified), or None."""
+        return self._scans.get(scan_id)
+
+    def listing(self):
+        """Return the (scan_id, fields) of the scans, in creation order."""
+        listing = self._listing
+        if listing is None:
+            with self._lock:
+                listing = self._listing = tuple(self._scans.items())
+        return listing
+
+    def counts(self):
+        """Return the number of scans by status."""
+        with self._lock:
+            return {k: v for k, v in self._counts.items() if v > 0 and k is not None}
+
+    def __len__(self):
+        return len(self._scans)
@@ -0,0 +1,513 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Scan state backends for PatrowlEngine.
+
+The in-memory store keeps the historical behaviour (one plain dict per
+process). The SQLite store persists every scan in a WAL database so that
+several worker processes behind the same port share the scans and so that
+a restart does not drop them. The scans still running when their process
+died are marked ERROR when the store is opened again (those resumed from
+their checkpoint are then replaced, see PatrowlEngine.resume_scans).
+
+Both stores maintain the summary of the scans (see PatrowlEngineStatus)
+from the writes of their summary fields, read by the status requests, and
+call their 'listener(scan_id, scan)' on each of these writes (see
+PatrowlEngineEvents). The SQLite store keeps the findings of the scans in
+their own table, where a flush only appends the new ones.
+"""
+import os
+import json
+import time
+import logging
+import sqlite3
+import datetime
+import threading
+from collections.abc import MutableMapping
+
+from .PatrowlEngineStatus import ScanStatusBoard, summary_fields, SUMMARY_FIELDS
+from .PatrowlEngineCheckpoint import process_token, is_alive
+
+SCANS_STORE_MEMORY = "memory"
+SCANS_STORE_SQLITE = "sqlite"
+DEFAULT_SCANS_STORE = SCANS_STORE_SQLITE
+DEFAULT_SQLITE_TIMEOUT = 30
+SUMMARY_FIELDS_SET = frozenset(SUMMARY_FIELDS)
+# Field of the scans kept in the scan_findings table
+FINDINGS_FIELD = "findings"
+# Status of the scans not running anymore
+FINAL_STATUSES = ("FINISHED", "STOPPED", "ERROR")
+
+logger = logging.getLogger(__name__)
+
+
+def _store_serial(obj):
+    """
+        JSON serializer for the values persisted in the scan store.
+        Objects that cannot be serialized (threads, processes, ...) raise a
+        TypeError and are kept in the owner process only.
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError("Type not serializable")
+
+
+def _owner_alive(owner, owner_pid):
+    """Return True if the process owning a scan is running."""
+    if owner:
+        # Its pid and start time: not mistaken for a later process with the same pid
+        return is_alive(owner)
+    # Scans stored before the owner tokens
+    if not owner_pid or owner_pid == os.getpid():
+        # A previous process of the engine, with the same pid (e.g. 1 in a container)
+        return False
+    try:
+        os.kill(owner_pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _notify(store, scan_id, scan):
+    if store.listener is None:
+        return
+    try:
+        store.listener(scan_id, scan)
+    except Exception:
+        logger.exception("scan '%s': store listener failed", scan_id)
+
+
+class ScanRecord(dict):
+    """
+    A scan as returned by a store. Top-level assignments are written through
+    to the store (and to the summary of the scans); nested in-place mutations
+    are persisted on the next flush() of the scan.
+    """
+
+    def __init__(self, store, scan_id, data):
+        dict.__init__(self, data)
+        self._store = store
+        self._scan_id = scan_id
+
+    def _summary_changed(self, keys):
+        if not SUMMARY_FIELDS_SET.isdisjoint(keys):
+            self._store._save_summary(self._scan_id, self)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._store._save_fields(self._scan_id, {key: value})
+        self._summary_changed((key,))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._store._delete_field(self._scan_id, key)
+        self._summary_changed((key,))
+
+    def update(self, *args, **kwargs):
+        values = dict(*args, **kwargs)
+        dict.update(self, values)
+        self._store._save_fields(self._scan_id, values)
+        self._summary_changed(values)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = dict.pop(self, key, *default)
+        if had_key:
+            self._store._delete_field(self._scan_id, key)
+            self._summary_changed((key,))
+        return value
+
+
+class MemoryScanStore(dict):
+    """Process-local scan store (previous behaviour, used for tests)."""
+
+    shared = False
+
+    def __init__(self):
+        dict.__init__(self)
+        self.board = ScanStatusBoard()
+        self.listener = None
+
+    def __setitem__(self, scan_id, scan):
+        record = ScanRecord(self, scan_id, scan)
+        dict.__setitem__(self, scan_id, record)
+        self.board.set(scan_id, summary_fields(record))
+        _notify(self, scan_id, record)
+
+    def __delitem__(self, scan_id):
+        dict.__delitem__(self, scan_id)
+        self.board.remove(scan_id)
+
+    def update(self, *args, **kwargs):
+        for scan_id, scan in dict(*args, **kwargs).items():
+            self[scan_id] = scan
+
+    def setdefault(self, scan_id, default=None):
+        if scan_id not in self:
+            self[scan_id] = default
+        return dict.__getitem__(self, scan_id)
+
+    def pop(self, scan_id, *default):
+        had_key = scan_id in self
+        scan = dict.pop(self, scan_id, *default)
+        if had_key:
+            self.board.remove(scan_id)
+        return scan
+
+    def popitem(self):
+        scan_id, scan = dict.popitem(self)
+        self.board.remove(scan_id)
+        return scan_id, scan
+
+    def clear(self):
+        dict.clear(self)
+        self.board.clear()
+
+    def _save_fields(self, scan_id, values):
+        pass
+
+    def _delete_field(self, scan_id, key):
+        pass
+
+    def _save_summary(self, scan_id, record):
+        if dict.__contains__(self, scan_id):
+            self.board.set(scan_id, summary_fields(record))
+            _notify(self, scan_id, record)
+
+    def summary(self, scan_id):
+        """Return the summary fields of a scan, or None if not found."""
+        return self.board.get(scan_id)
+
+    def summaries(self, fields=()):
+        """
+            Return the (scan_id, summary fields) of the scans, oldest first,
+            with their 'fields' not in the summary (e.g. 'assets').
+        """
+        listing = self.board.listing()
+        if not fields:
+            return listing
+        scans = [(scan_id, dict.get(self, scan_id)) for scan_id, _ in listing]
+        return [
+            (scan_id, dict(summary, **{k: scan[k] for k in fields if scan is not None and k in scan}))
+            for (scan_id, summary), (_, scan) in zip(listing, scans)]
+
+    def count_by_status(self):
+        return self.board.counts()
+
+    def is_local(self, scan_id):
+        return scan_id in self
+
+    def local_scans(self):
+        return list(self.keys())
+
+    def flush(self, scan_id):
+        pass
+
+
+class SQLiteScanStore(MutableMapping):
+    """
+    Scan store backed by a SQLite database in WAL mode.
+
+    Scans created by this process are kept in a local cache holding the
+    objects that only make sense here (threads, subprocesses). Scans created
+    by other workers are read from the database on each access.
+    """
+
+    shared = True
+
+    def __init__(self, db_path, timeout=DEFAULT_SQLITE_TIMEOUT):
+        self.db_path = str(db_path)
+        self.timeout = timeout
+        self._tls = threading.local()
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._local = {}
+        # {scan_id: (findings list, number saved)} of the local scans
+        self._saved_findings = {}
+        self.listener = None
+        self._init_db()
+
+    def _conn(self):
+        # SQLite connections must not be shared across threads nor fork()
+        conn = getattr(self._tls, "conn", None)
+        if conn is None or self._tls.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._tls.conn = conn
+            self._tls.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS scans ("
+            "scan_id TEXT PRIMARY KEY, owner_pid INTEGER, created_at REAL, owner TEXT)")
+        if "owner" not in [row[1] for row in conn.execute("PRAGMA table_info(scans)")]:
+            conn.execute("ALTER TABLE scans ADD COLUMN owner TEXT")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan_fields ("
+            "scan_id TEXT, key TEXT, value TEXT, PRIMARY KEY (scan_id, key))")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan_summary ("
+            "scan_id TEXT PRIMARY KEY, status TEXT, fields TEXT)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan_findings ("
+            "scan_id TEXT, seq INTEGER, finding TEXT, PRIMARY KEY (scan_id, seq))")
+        # Scans stored before the summary table existed
+        for (scan_id,) in conn.execute(
+                "SELECT scan_id FROM scans WHERE scan_id NOT IN "
+                "(SELECT scan_id FROM scan_summary)").fetchall():
+            self._save_summary(scan_id, self._load(scan_id) or {})
+        self._recover_scans()
+
+    def _recover_scans(self):
+        """
+            Mark ERROR the scans left running by a dead process (killed or
+            restarted engine): they would never end, and would count in the
+            max number of scans of the engine.
+        """
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT c.scan_id, c.owner, c.owner_pid FROM scans c JOIN scan_summary s ON s.scan_id = c.scan_id "
+            "WHERE s.status IS NULL OR s.status NOT IN ({})".format(",".join("?" * len(FINAL_STATUSES))),
+            FINAL_STATUSES).fetchall()
+        for scan_id, owner, owner_pid in rows:
+            if _owner_alive(owner, owner_pid):
+                continue
+            data = self._load(scan_id)
+            if data is None:
+                continue
+            logger.warning("scan '%s': interrupted (process %s not running)", scan_id, owner_pid)
+            ScanRecord(self, scan_id, data).update({
+                "status": "ERROR",
+                "reason": "interrupted by a restart of the engine",
+                "finished_at": int(time.time() * 1000),
+            })
+
+    def _owned(self):
+        # Local records inherited from a parent process are not ours
+        if self._pid != os.getpid():
+            with self._lock:
+                self._local = {}
+                self._saved_findings = {}
+                self._pid = os.getpid()
+        return self._local
+
+    def _save_findings(self, scan_id, findings):
+        """
+            Save the findings of a scan not saved yet: the list of the
+            findings of a scan only grows, unless replaced by another one.
+        """
+        conn = self._conn()
+        saved_list, nb_saved = self._saved_findings.get(scan_id, (None, 0))
+        if findings is not saved_list or len(findings) < nb_saved:
+            conn.execute("DELETE FROM scan_findings WHERE scan_id=?", (scan_id,))
+            nb_saved = 0
+        new_findings = findings[nb_saved:]
+        if new_findings:
+            conn.executemany(
+                "INSERT OR REPLACE INTO scan_findings (scan_id, seq, finding) VALUES (?, ?, ?)",
+                ((scan_id, nb_saved + i, json.dumps(f, default=_store_serial)) for i, f in enumerate(new_findings)))
+        self._saved_findings[scan_id] = (findings, nb_saved + len(new_findings))
+
+    def _save_fields(self, scan_id, values):
+        rows = []
+        for key, value in values.items():
+            if key == FINDINGS_FIELD and isinstance(value, list):
+                self._save_findings(scan_id, value)
+                # Only marks the field as set, see _load()
+                value = []
+            try:
+                rows.append((scan_id, key, json.dumps(value, default=_store_serial)))
+            except (TypeError, ValueError):
+                # Process-local value (thread, Popen, ...)
+                continue
+        if rows:
+            self._conn().executemany(
+                "INSERT OR REPLACE INTO scan_fields (scan_id, key, value) "
+                "VALUES (?, ?, ?)", rows)
+
+    def _delete_field(self, scan_id, key):
+        self._conn().execute(
+            "DELETE FROM scan_fields WHERE scan_id=? AND key=?", (scan_id, key))
+        if key == FINDINGS_FIELD:
+            self._delete_findings(self._conn(), scan_id)
+
+    def _delete_findings(self, conn, scan_id):
+        conn.execute("DELETE FROM scan_findings WHERE scan_id=?", (scan_id,))
+        self._saved_findings.pop(scan_id, None)
+
+    def _save_summary(self, scan_id, record):
+        fields = summary_fields(record)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO scan_summary (scan_id, status, fields) "
+            "VALUES (?, ?, ?)",
+            (scan_id, fields.get("status"), json.dumps(fields, default=_store_serial)))
+        _notify(self, scan_id, record)
+
+    def summary(self, scan_id):
+        """Return the summary fields of a scan, or None if not found."""
+        row = self._conn().execute(
+            "SELECT fields FROM scan_summary WHERE scan_id=?", (scan_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def summaries(self, fields=()):
+        """
+            Return the (scan_id, summary fields) of the scans, oldest first,
+            with their 'fields' not in the summary (e.g. 'assets').
+        """
+        summaries = [(scan_id, json.loads(summary)) for scan_id, summary in self._conn().execute(
+            "SELECT s.scan_id, s.fields FROM scan_summary s "
+            "JOIN scans c ON c.scan_id = s.scan_id ORDER BY c.created_at")]
+        if fields:
+            values = {}
+            for scan_id, key, value in self._conn().execute(
+                    "SELECT scan_id, key, value FROM scan_fields WHERE key IN ({})".format(
+                        ",".join("?" * len(fields))), tuple(fields)):
+                values.setdefault(scan_id, {})[key] = json.loads(value)
+            for scan_id, summary in summaries:
+                summary.update(values.get(scan_id, {}))
+        return summaries
+
+    def count_by_status(self):
+        return dict(self._conn().execute(
+            "SELECT status, COUNT(*) FROM scan_summary "
+            "WHERE status IS NOT NULL GROUP BY status").fetchall())
+
+    def _load(self, scan_id):
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM scans WHERE scan_id=?", (scan_id,)).fetchone() is None:
+            return None
+        data = {}
+        for key, value in conn.execute(
+                "SELECT key, value FROM scan_fields WHERE scan_id=?", (scan_id,)):
+            data[key] = json.loads(value)
+        if data.get(FINDINGS_FIELD) == []:
+            data[FINDINGS_FIELD] = [json.loads(finding) for (finding,) in conn.execute(
+                "SELECT finding FROM scan_findings WHERE scan_id=? ORDER BY seq", (scan_id,))]
+        return data
+
+    def __getitem__(self, scan_id):
+        local = self._owned()
+        if scan_id in local:
+            return local[scan_id]
+        data = self._load(scan_id)
+        if data is None:
+            raise KeyError(scan_id)
+        return ScanRecord(self, scan_id, data)
+
+    def __setitem__(self, scan_id, scan):
+        record = ScanRecord(self, scan_id, scan)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM scan_fields WHERE scan_id=?", (scan_id,))
+            self._delete_findings(conn, scan_id)
+            conn.execute(
+                "INSERT OR REPLACE INTO scans (scan_id, owner_pid, created_at, owner) "
+                "VALUES (?, ?, ?, ?)", (scan_id, os.getpid(), time.time(), process_token()))
+            self._save_fields(scan_id, scan)
+            self._save_summary(scan_id, scan)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._owned()[scan_id] = record
+
+    def __delitem__(self, scan_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute("DELETE FROM scans WHERE scan_id=?", (scan_id,))
+            conn.execute("DELETE FROM scan_fields WHERE scan_id=?", (scan_id,))
+            conn.execute("DELETE FROM scan_summary WHERE scan_id=?", (scan_id,))
+            self._delete_findings(conn, scan_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            found = self._owned().pop(scan_id, None) is not None
+        if cur.rowcount == 0 and not found:
+            raise KeyError(scan_id)
+
+    def __contains__(self, scan_id):
+        return self._conn().execute(
+            "SELECT 1 FROM scans WHERE scan_id=?", (scan_id,)).fetchone() is not None
+
+    def _scan_ids(self):
+        scan_ids = [row[0] for row in self._conn().execute(
+            "SELECT scan_id FROM scans ORDER BY created_at")]
+        # Forget the local records cleaned by another worker
+        with self._lock:
+            local = self._owned()
+            for scan_id in set(local.keys()).difference(scan_ids):
+                local.pop(scan_id)
+        return scan_ids
+
+    def __iter__(self):
+        return iter(self._scan_ids())
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM scans").fetchone()[0]
+
+    def keys(self):
+        return self._scan_ids()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM scans")
+            conn.execute("DELETE FROM scan_fields")
+            conn.execute("DELETE FROM scan_summary")
+            conn.execute("DELETE FROM scan_findings")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._owned().clear()
+            self._saved_findings.clear()
+
+    def is_local(self, scan_id):
+        return scan_id in self._owned()
+
+    def local_scans(self):
+        return list(self._owned().keys())
+
+    def flush(self, scan_id):
+        """Persist the nested in-place changes of a scan owned by this process."""
+        record = self._owned().get(scan_id)
+        if record is not None:
+            self._save_fields(scan_id, record)
+
+
+def get_scans_store(base_dir, name, backend=None):
+    """Return the scan store selected by 'backend' or by $APP_SCANS_STORE."""
+    if backend is None:
+        backend = os.environ.get("APP_SCANS_STORE", DEFAULT_SCANS_STORE)
+    if backend == SCANS_STORE_MEMORY:
+        return MemoryScanStore()
+    if backend == SCANS_STORE_SQLITE:
+        db_path = os.environ.get(
+            "APP_SCANS_DB", "{}/{}_scans.db".format(base_dir, name))
+        return SQLiteScanStore(db_path)
+    raise ValueError("Unknown scan store backend '{}'".format(backend))
@@ -1,8 +1,106 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import json, requests, time, random
+import os, sys, json, requests, time, random, threading
 import pytest
 
+# Interval of the status polls and of the engine process samples (seconds)
+BENCHMARK_POLL_INTERVAL = 0.5
+BENCHMARK_SAMPLE_INTERVAL = 1
+
+
+def percentiles(values):
+    """Return the count, min, max, mean and p50/p90/p95/p99 (nearest rank) of values."""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    res = {
+        "count": len(values),
+        "min": round(values[0], 6),
+        "max": round(values[-1], 6),
+        "mean": round(sum(values) / len(values), 6),
+    }
+    for p in (50, 90, 95, 99):
+        rank = max(0, -(-p * len(values) // 100) - 1)
+        res["p{}".format(p)] = round(values[rank], 6)
+    return res
+
+
+def process_sample(pid):
+    """Return the RSS (bytes), CPU time (seconds), threads and FDs of a process (Linux /proc)."""
+    with open("/proc/{}/stat".format(pid)) as stat_file:
+        # The command name may contain spaces: fields are counted after it
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "rss": int(fields[21]) * os.sysconf("SC_PAGE_SIZE"),
+        "cpu": (int(fields[11]) + int(fields[12])) / ticks,
+        "threads": int(fields[17]),
+        "fds": len(os.listdir("/proc/{}/fd".format(pid))),
+    }
+
+
+class _ProcessSampler(threading.Thread):
+    """Samples the engine process until stopped."""
+
+    def __init__(self, pid, interval=BENCHMARK_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.samples.append((time.time(), process_sample(self.pid)))
+            except (OSError, IndexError, ValueError):
+                pass
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        try:
+            self.samples.append((time.time(), process_sample(self.pid)))
+        except (OSError, IndexError, ValueError):
+            pass
+
+    def report(self):
+        if not self.samples:
+            return None
+        (t0, first), (t1, last) = self.samples[0], self.samples[-1]
+        cpu = last["cpu"] - first["cpu"]
+        return {
+            "samples": len(self.samples),
+            "rss_max": max(s["rss"] for _, s in self.samples),
+            "rss_start": first["rss"],
+            "rss_end": last["rss"],
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / (t1 - t0), 1) if t1 > t0 else None,
+            "threads_max": max(s["threads"] for _, s in self.samples),
+            "threads_end": last["threads"],
+            "fds_max": max(s["fds"] for _, s in self.samples),
+            "fds_end": last["fds"],
+        }
+
+
+def start_mocks(services):
+    """
+    Serve the recorded responses of the external APIs of the engine (see
+    mocks/README.md) on $APP_MOCK_PORT, if set: the engine calls them
+    through its *_API_URL. Return the MockServer, None if not set.
+    """
+    port = os.environ.get("APP_MOCK_PORT")
+    if not port:
+        return None
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    from mocks.mock_server import MockServer
+    mock = MockServer(services)
+    mock.start(port=int(port))
+    return mock
+
+
 class PatrowlEngineTest:
     def __init__(self, engine_name, base_url):
         self.engine_name = engine_name
@@ -122,6 +220,107 @@ class PatrowlEngineTest:
         else:
             assert False
 
+    def _benchmark_scan(self, scan_id, assets, scan_policy, max_timeout, poll_interval, latencies, results):
+        """Run one scan of the benchmark and record its latencies."""
+        session = requests.Session()
+        post_data = {"assets": assets, "options": scan_policy, "scan_id": scan_id}
+        result = {"status": "REFUSED"}
+        results[scan_id] = result
+
+        start = time.time()
+        r = session.post(url="{}/startscan".format(self.base_url),
+                         data=json.dumps(post_data),
+                         headers={'Content-type': 'application/json', 'Accept': 'application/json'})
+        latencies["startscan"].append(time.time() - start)
+        if r.status_code != 200 or r.json().get('status') != "accepted":
+            result["reason"] = r.text[:200]
+            return
+
+        result["status"] = "TIMEOUT"
+        while time.time() < start + max_timeout:
+            time.sleep(poll_interval)
+            poll_start = time.time()
+            r = session.get(url="{}/status/{}".format(self.base_url, scan_id))
+            latencies["status"].append(time.time() - poll_start)
+            status = r.json().get("status") if r.status_code == 200 else None
+            if status in ["FINISHED", "ERROR"]:
+                result["status"] = status
+                result["time_to_finish"] = time.time() - start
+                break
+
+        if result["status"] != "FINISHED":
+            return
+        findings_start = time.time()
+        r = session.get(url="{}/getfindings/{}".format(self.base_url, scan_id))
+        latencies["getfindings"].append(time.time() - findings_start)
+        if r.status_code == 200 and r.json().get("status") == "success":
+            result["issues"] = len(r.json().get("issues", []))
+        else:
+            result["status"] = "ERROR"
+        session.get(url="{}/clean/{}".format(self.base_url, scan_id))
+
+    def benchmark(self, assets, scan_policy={}, nb_scans=1, nb_assets=None, engine_pid=None,
+                  max_timeout=1200, poll_interval=BENCHMARK_POLL_INTERVAL):
+        """
+        Run 'nb_scans' concurrent scans of 'nb_assets' assets (the 'assets'
+        repeated with new ids) and return a report of the latencies of
+        startscan, status and getfindings, the time to finish of the scans
+        and, if 'engine_pid' is set, the resources of the engine process.
+        The report is JSON serializable and diffable between versions.
+        """
+        print("benchmark-{}: {} scans".format(self.engine_name, nb_scans))
+        if nb_assets is None:
+            nb_assets = len(assets)
+        scan_assets = []
+        for i in range(nb_assets):
+            asset = dict(assets[i % len(assets)])
+            asset["id"] = str(i + 1)
+            scan_assets.append(asset)
+
+        latencies = {"startscan": [], "status": [], "getfindings": []}
+        results = {}
+        sampler = None
+        if engine_pid is not None:
+            sampler = _ProcessSampler(engine_pid)
+            sampler.start()
+
+        run_id = random.randint(1000000, 1999999)
+        start = time.time()
+        threads = []
+        for i in range(nb_scans):
+            thread = threading.Thread(
+                target=self._benchmark_scan,
+                args=("{}-{}".format(run_id, i), scan_assets, scan_policy, max_timeout,
+                      poll_interval, latencies, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        wall_time = time.time() - start
+        if sampler is not None:
+            sampler.stop()
+
+        scans = {}
+        for result in results.values():
+            scans[result["status"]] = scans.get(result["status"], 0) + 1
+        finished = [r for r in results.values() if r["status"] == "FINISHED"]
+        return {
+            "engine": self.engine_name,
+            "params": {
+                "scans": nb_scans,
+                "assets": nb_assets,
+                "options": scan_policy,
+                "poll_interval": poll_interval,
+            },
+            "wall_time": round(wall_time, 3),
+            "scans": scans,
+            "issues": sum(r.get("issues", 0) for r in finished),
+            "assets_per_second": round(len(finished) * nb_assets / wall_time, 3) if wall_time else None,
+            "latency": {k: percentiles(v) for k, v in latencies.items()},
+            "time_to_finish": percentiles([r["time_to_finish"] for r in finished]),
+            "process": sampler.report() if sampler is not None else None,
+        }
+
     def do_generic_tests(self):
         self.test_connectivity()
         self.test_status()
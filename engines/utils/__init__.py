@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 __title__ = "patrowl_engine_utils"
-__version__ = "1.1.0"
+__version__ = "1.5.0"
 __author__ = "Nicolas MATTIOCCO"
 __license__ = "AGPLv3"
 __copyright__ = "Copyright (C) 2018 Nicolas Mattiocco - @MaKyOtOx"
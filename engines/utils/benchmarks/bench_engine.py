@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Load test of a running engine (see PatrowlEngineTest.benchmark).
+
+Runs M concurrent scans of N assets and writes a JSON report: latency
+percentiles of startscan, status and getfindings, time to finish of the
+scans and, with --pid, RSS, CPU, threads and FDs of the engine process.
+With --compare, the changes from a previous report are printed. With
+--mock, the mock servers of the external APIs (see utils/mocks) are served
+during the benchmark and their stats are added to the report.
+
+Usage: python3 bench_engine.py -u http://127.0.0.1:5001/engines/nmap \
+    -a assets.json [-p policy.json] [-m 10] [-n 100] [--pid PID] [-o report.json]
+    [--mock virustotal --mock-latency 0.3 --mock-rate-limit 4/60]
+"""
+import os
+import sys
+import json
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from PatrowlEngineTest import PatrowlEngineTest
+from mocks.mock_server import MockServer, parse_rate_limit
+
+
+def _flatten(report, prefix=""):
+    values = {}
+    for key, value in (report or {}).items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old, new):
+    """Print the numeric values of two reports and their change."""
+    old_values, new_values = _flatten(old), _flatten(new)
+    for key in sorted(set(old_values) | set(new_values)):
+        before, after = old_values.get(key), new_values.get(key)
+        change = ""
+        if before and after is not None:
+            change = "{:+.1f}%".format(100.0 * (after - before) / before)
+        print("{:<40} {:>14} {:>14} {:>9}".format(key, str(before), str(after), change))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-u", "--base-url", help="Engine URL, e.g. http://127.0.0.1:5001/engines/nmap")
+    parser.add_option("-a", "--assets", help="JSON file of the assets to scan (repeated up to -n)")
+    parser.add_option("-p", "--policy", help="JSON file of the scan options")
+    parser.add_option("-m", "--nb-scans", type="int", default=1,
+                      help="Concurrent scans [default %default]")
+    parser.add_option("-n", "--nb-assets", type="int", default=None,
+                      help="Assets per scan [default: the assets of -a]")
+    parser.add_option("--pid", type="int", default=None, help="PID of the engine process")
+    parser.add_option("-t", "--timeout", type="int", default=1200,
+                      help="Max duration of a scan in seconds [default %default]")
+    parser.add_option("-o", "--output", help="Report file [default: stdout]")
+    parser.add_option("-c", "--compare", help="Previous report to compare with")
+    parser.add_option("--mock", action="append", dest="mocks", help="Mock service to serve, repeatable")
+    parser.add_option("--mock-port", type="int", default=5900, help="[default %default]")
+    parser.add_option("--mock-latency", type="float", help="Seconds added to each mock response")
+    parser.add_option("--mock-rate-limit", help="Mock requests allowed per API key, e.g. 4/60")
+    parser.add_option("--mock-failure-rate", type="float", help="Ratio of the mock requests failing")
+    options, _ = parser.parse_args()
+    if not options.base_url or not options.assets:
+        parser.error("--base-url and --assets are required")
+
+    with open(options.assets) as assets_file:
+        assets = json.load(assets_file)
+    scan_policy = {}
+    if options.policy:
+        with open(options.policy) as policy_file:
+            scan_policy = json.load(policy_file)
+
+    mock = None
+    if options.mocks:
+        mock = MockServer(
+            options.mocks, latency=options.mock_latency, failure_rate=options.mock_failure_rate,
+            rate_limit=parse_rate_limit(options.mock_rate_limit) if options.mock_rate_limit else None)
+        mock.start(port=options.mock_port)
+
+    engine_name = options.base_url.rstrip("/").rsplit("/", 1)[-1]
+    pet = PatrowlEngineTest(engine_name=engine_name, base_url=options.base_url.rstrip("/"))
+    try:
+        report = pet.benchmark(
+            assets, scan_policy=scan_policy, nb_scans=options.nb_scans, nb_assets=options.nb_assets,
+            engine_pid=options.pid, max_timeout=options.timeout)
+    finally:
+        if mock is not None:
+            mock.stop()
+    if mock is not None:
+        report["mocks"] = mock.stats()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as previous_file:
+            compare(json.load(previous_file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the findings serialization.
+
+Compares, per finding, the previous path (to_dict then json.dumps with
+_json_serial) with PatrowlEngineFinding.to_json_bytes, and the memory held
+by the findings of a scan.
+
+Usage: python3 bench_findings.py [-n 1000000]
+"""
+import os
+import sys
+import json
+import time
+import optparse
+import tracemalloc
+import importlib.util
+
+# The utils of this checkout, loaded as the PatrowlEnginesUtils package
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+_spec = importlib.util.spec_from_file_location(
+    "PatrowlEnginesUtils", os.path.join(UTILS_DIR, "__init__.py"), submodule_search_locations=[UTILS_DIR])
+sys.modules["PatrowlEnginesUtils"] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sys.modules["PatrowlEnginesUtils"])
+from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngineFinding, _json_serial  # noqa: E402
+from PatrowlEnginesUtils.PatrowlEngineJson import JSON_BACKEND  # noqa: E402
+
+
+def _new_finding(i):
+    return PatrowlEngineFinding(
+        issue_id=i, type="port_status",
+        title="Port '443/tcp' is open on host 192.0.2.{}".format(i % 254),
+        description="The scan detected that the port '443/tcp' was open.",
+        solution="Restrict access to the service if not needed.",
+        severity="info", confidence="certain",
+        raw={"port": 443, "protocol": "tcp", "state": "open"},
+        target_addrs=["192.0.2.{}".format(i % 254)], target_proto="tcp",
+        meta_tags=["port", "tcp"])
+
+
+def _bench(label, nb_findings, func):
+    start = time.perf_counter()
+    size = func()
+    elapsed = time.perf_counter() - start
+    print("{:<32} {:>8.2f} s {:>8.0f} ns/finding {:>10.1f} MB".format(
+        label, elapsed, elapsed * 1e9 / nb_findings, size / 1e6))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--nb-findings", type="int", default=1000000,
+                      help="Number of findings [default %default]")
+    options, _ = parser.parse_args()
+    nb_findings = options.nb_findings
+
+    tracemalloc.start()
+    findings = [_new_finding(i) for i in range(nb_findings)]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{} findings: {:.0f} bytes/finding held in memory".format(nb_findings, memory / nb_findings))
+    print("JSON backend: {}".format(JSON_BACKEND))
+
+    def legacy():
+        return sum(len(json.dumps(f.to_dict(), default=_json_serial)) for f in findings)
+
+    def to_json_bytes():
+        return sum(len(f.to_json_bytes()) for f in findings)
+
+    _bench("to_dict + json.dumps", nb_findings, legacy)
+    _bench("to_json_bytes", nb_findings, to_json_bytes)
+
+
+if __name__ == '__main__':
+    main()
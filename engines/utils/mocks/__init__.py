@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Mock servers of the external APIs, for the offline tests and benchmarks."""
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Local mock of the external APIs called by the engines.
+
+A MockServer replays the responses recorded in recordings/<service>.json
+(see README.md) with a configurable latency, rate limiting (204 or 429,
+per API key) and failure injection, so that the tests and the benchmarks
+run the real engine code paths offline and at scale. Several services are
+served on the same port (their routes do not overlap).
+
+Usage: python3 mock_server.py -s ssllabs -s virustotal [-P 5900]
+    [--latency 0.2] [--rate-limit 4/60] [--failure-rate 0.05]
+"""
+import os
+import sys
+import json
+import time
+import random
+import threading
+import optparse
+import collections
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from PatrowlEngineKeyPool import TokenBucket
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "recordings")
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5900
+
+
+def load_recording(service):
+    """Return the recording of a service (name in recordings/ or path of a JSON file)."""
+    path = service if service.endswith(".json") else os.path.join(RECORDINGS_DIR, service + ".json")
+    with open(path) as recording_file:
+        return json.load(recording_file)
+
+
+def _flatten(values, prefix=""):
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def render(template, context):
+    """
+    Replace the {{name}} of the strings of a recorded response by the
+    values of the context. A string which is a single {{name}} takes the
+    value as is (numbers, lists, ...).
+    """
+    if isinstance(template, dict):
+        return {k: render(v, context) for k, v in template.items()}
+    if isinstance(template, list):
+        return [render(v, context) for v in template]
+    if not isinstance(template, str) or "{{" not in template:
+        return template
+    stripped = template.strip()
+    if stripped.startswith("{{") and stripped.endswith("}}") and stripped.count("{{") == 1:
+        return context.get(stripped[2:-2].strip(), "")
+    for name, value in context.items():
+        template = template.replace("{{" + name + "}}", str(value))
+    return template
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    """No access log for the mocks served in the background of the tests and benchmarks."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class MockServer:
+    """
+    Flask app replaying the recordings of one or more services.
+    - latency, jitter: seconds added to each response (latency +/- jitter)
+    - rate_limit: (requests, period) allowed per API key, then the
+      'rate_limit_status' of the service (204 for VirusTotal, else 429)
+    - failure_rate: ratio of the requests answered 'failure_status'
+    Settings given here override those of the recordings; they are
+    changed at runtime through /_mock/config.
+    """
+
+    def __init__(self, services, latency=None, jitter=None, rate_limit=None,
+                 rate_limit_status=None, failure_rate=None, failure_status=None, seed=None):
+        self.app = Flask(__name__)
+        self.random = random.Random(seed)
+        self.recordings = {}
+        self.config = {}
+        overrides = {
+            "latency": latency, "jitter": jitter, "rate_limit": rate_limit,
+            "rate_limit_status": rate_limit_status,
+            "failure_rate": failure_rate, "failure_status": failure_status,
+        }
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._sequences = collections.Counter()
+        self._state = {}
+        self._stats = collections.Counter()
+        self._server = None
+        self._thread = None
+
+        for service in services:
+            recording = load_recording(service)
+            name = recording["service"]
+            self.recordings[name] = recording
+            config = {
+                "latency": 0.0, "jitter": 0.0, "rate_limit": None, "rate_limit_status": 429,
+                "failure_rate": 0.0, "failure_status": 500,
+            }
+            config.update(recording.get("config", {}))
+            config.update({k: v for k, v in overrides.items() if v is not None})
+            self.config[name] = config
+            for i, route in enumerate(recording["routes"]):
+                self.app.add_url_rule(
+                    route["rule"], "{}_{}".format(name, i),
+                    self._view(name, route), methods=route.get("methods", ["GET"]))
+
+        self.app.add_url_rule("/_mock/config", "mock_config", self._config_view, methods=["GET", "POST"])
+        self.app.add_url_rule("/_mock/stats", "mock_stats", self._stats_view)
+
+    # Views
+    def _view(self, service, route):
+        def view(**view_args):
+            return self.respond(service, route, view_args)
+        return view
+
+    def _config_view(self):
+        if request.method == "POST":
+            settings = request.get_json(force=True) or {}
+            with self._lock:
+                for service in settings.get("services", list(self.config)):
+                    if service in self.config:
+                        self.config[service].update(
+                            {k: v for k, v in settings.items() if k != "services"})
+                self._buckets.clear()
+        return jsonify(self.config)
+
+    def _stats_view(self):
+        return jsonify(self.stats())
+
+    # Responses
+    def _context(self, view_args):
+        context = {}
+        context.update(request.args.to_dict())
+        context.update(request.form.to_dict())
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            context.update(_flatten(body))
+        context.update(view_args)
+        return context
+
+    def _client_key(self, recording, context):
+        name = recording.get("client_key")
+        if name:
+            value = context.get(name) or request.headers.get(name)
+            if value:
+                return value
+        return request.remote_addr
+
+    def _rate_limited(self, service, config, client_key):
+        """Return the seconds before the next request allowed, 0 if allowed."""
+        if not config["rate_limit"]:
+            return 0
+        rate, period = config["rate_limit"]
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((service, client_key))
+            if bucket is None:
+                bucket = self._buckets[(service, client_key)] = TokenBucket(rate, period, now=now)
+            delay = bucket.delay(now)
+            if delay == 0:
+                bucket.take(now)
+            return delay
+
+    def respond(self, service, route, view_args):
+        recording = self.recordings[service]
+        with self._lock:
+            config = dict(self.config[service])
+        context = self._context(view_args)
+
+        delay = config["latency"]
+        if config["jitter"]:
+            delay += self.random.uniform(-config["jitter"], config["jitter"])
+        if delay > 0:
+            time.sleep(delay)
+
+        retry_after = self._rate_limited(service, config, self._client_key(recording, context))
+        if retry_after:
+            self._count(service, "rate_limited")
+            status = config["rate_limit_status"]
+            headers = {"Retry-After": str(max(1, int(round(retry_after))))}
+            if status == 204:
+                return Response(status=204, headers=headers)
+            return Response(
+                json.dumps({"error": "rate limit exceeded"}), status=status,
+                content_type="application/json", headers=headers)
+
+        if config["failure_rate"] and self.random.random() < config["failure_rate"]:
+            self._count(service, "failures")
+            return Response(
+                json.dumps({"error": "injected failure"}), status=config["failure_status"],
+                content_type="application/json")
+
+        # Responses are played in sequence for each value of the key, the last one repeats
+        key = context.get(route["key"], "") if route.get("key") else ""
+        with self._lock:
+            seq = self._sequences[(route["rule"], key)]
+            self._sequences[(route["rule"], key)] += 1
+            if route.get("load"):
+                context.update(self._state.get((route["load"], context.get(route["load_key"])), {}))
+        context["seq"] = seq
+        responses = route["responses"]
+        response = responses[min(seq, len(responses) - 1)]
+
+        body = render(response.get("json", response.get("body", "")), context)
+        if route.get("save_as") and isinstance(body, dict):
+            # e.g. a job: the variables of its creation are loaded by the routes of the job
+            with self._lock:
+                self._state[(route["save_as"], body.get(route.get("save_key", "id")))] = dict(context)
+        self._count(service, "responses")
+
+        if "json" in response:
+            body = json.dumps(body)
+        return Response(
+            body, status=response.get("status", 200),
+            content_type=response.get("content_type", "application/json"),
+            headers=response.get("headers", {}))
+
+    def _count(self, service, what):
+        with self._lock:
+            self._stats[(service, what)] += 1
+
+    def stats(self):
+        """Return the responses, rate limited and failed requests by service."""
+        with self._lock:
+            stats = {name: {"responses": 0, "rate_limited": 0, "failures": 0} for name in self.recordings}
+            for (service, what), count in self._stats.items():
+                stats[service][what] = count
+        return stats
+
+    # Server
+    def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Serve in a background thread, return the base URL (port 0: any free port)."""
+        self._server = make_server(
+            host, port, self.app, threaded=True, request_handler=_QuietRequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return "http://{}:{}".format(host, self._server.server_port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._server = None
+
+
+def parse_rate_limit(value):
+    """Parse 'N/period' (e.g. '4/60') into (N, period)."""
+    rate, _, period = value.partition("/")
+    return (float(rate), float(period or 60))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--service", action="append", dest="services",
+                      help="Recording to serve (name or JSON file), repeatable")
+    parser.add_option("-H", "--host", default=DEFAULT_HOST, help="[default %default]")
+    parser.add_option("-P", "--port", type="int", default=DEFAULT_PORT, help="[default %default]")
+    parser.add_option("--latency", type="float", help="Seconds added to each response")
+    parser.add_option("--jitter", type="float", help="Random +/- seconds added to the latency")
+    parser.add_option("--rate-limit", help="Requests allowed per API key, e.g. 4/60")
+    parser.add_option("--rate-limit-status", type="int", help="204 or 429 [default: of the recording]")
+    parser.add_option("--failure-rate", type="float", help="Ratio of the requests failing, e.g. 0.05")
+    parser.add_option("--failure-status", type="int", help="[default: 500]")
+    parser.add_option("--seed", type="int", help="Seed of the random latency and failures")
+    options, _ = parser.parse_args()
+    if not options.services:
+        parser.error("at least one --service is required ({})".format(
+            ", ".join(sorted(f[:-5] for f in os.listdir(RECORDINGS_DIR) if f.endswith(".json")))))
+
+    server = MockServer(
+        options.services, latency=options.latency, jitter=options.jitter,
+        rate_limit=parse_rate_limit(options.rate_limit) if options.rate_limit else None,
+        rate_limit_status=options.rate_limit_status, failure_rate=options.failure_rate,
+        failure_status=options.failure_status, seed=options.seed)
+    server.app.run(host=options.host, port=options.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
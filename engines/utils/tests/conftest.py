@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Unit tests of PatrowlEnginesUtils: the modules are imported from this
+checkout (the engines import the installed package).
+"""
+import os
+import sys
+import importlib.util
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "PatrowlEnginesUtils" not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(
+        "PatrowlEnginesUtils", os.path.join(UTILS_DIR, "__init__.py"),
+        submodule_search_locations=[UTILS_DIR])
+    sys.modules["PatrowlEnginesUtils"] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules["PatrowlEnginesUtils"])
+
+
+def run_in_child(func, *args):
+    """Run func(*args) in a forked process, as a previous engine process."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func(*args)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
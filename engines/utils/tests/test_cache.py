@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Lookup cache tests: TTL, force_refresh and cacheable results.
+"""
+import time
+
+from PatrowlEnginesUtils.PatrowlEngineCache import LookupCache, normalize_asset, force_refresh
+
+
+class _Fetch:
+    """Return the given values, one per call."""
+
+    def __init__(self, *values):
+        self.values = list(values)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.values.pop(0)
+
+
+def test_lookup_cached(tmp_path):
+    """A lookup is fetched once per TTL, for the normalized asset."""
+    cache = LookupCache(tmp_path / "cache.db")
+    fetch = _Fetch({"score": 1}, {"score": 2})
+    assert cache.lookup("vt", "domain", "A.com.", fetch) == {"score": 1}
+    assert cache.lookup("vt", "domain", "a.com", fetch) == {"score": 1}
+    assert fetch.calls == 1
+    # Other endpoint, other key
+    assert cache.lookup("vt", "ip", "a.com", _Fetch(3)) == 3
+    assert cache.stats() == {"vt": {"hits": 1, "misses": 2}}
+
+
+def test_lookup_expired(tmp_path):
+    """Expired entries are fetched again, and purged."""
+    cache = LookupCache(tmp_path / "cache.db", ttls={"vt": 0.05})
+    fetch = _Fetch(1, 2)
+    assert cache.lookup("vt", "domain", "a.com", fetch) == 1
+    time.sleep(0.1)
+    assert cache.purge() == 1
+    assert cache.lookup("vt", "domain", "a.com", fetch) == 2
+    assert fetch.calls == 2
+
+
+def test_lookup_force_refresh(tmp_path):
+    """force_refresh bypasses the cached value, and caches the new one."""
+    cache = LookupCache(tmp_path / "cache.db")
+    fetch = _Fetch(1, 2)
+    cache.lookup("vt", "domain", "a.com", fetch)
+    assert cache.lookup("vt", "domain", "a.com", fetch, force_refresh=True) == 2
+    assert cache.get("vt", "domain", "a.com") == 2
+    assert force_refresh({"options": {"force_refresh": True}})
+    assert not force_refresh({"options": None})
+
+
+def test_lookup_not_cacheable(tmp_path):
+    """Values rejected by 'cacheable' (errors, empty results) are fetched again."""
+    cache = LookupCache(tmp_path / "cache.db")
+    fetch = _Fetch({"status_code": 403}, {"status_code": 200})
+    def cacheable(report):
+        return report["status_code"] == 200
+
+    assert cache.lookup("vt", "domain", "a.com", fetch, cacheable=cacheable) == {"status_code": 403}
+    assert cache.lookup("vt", "domain", "a.com", fetch, cacheable=cacheable) == {"status_code": 200}
+    assert cache.lookup("vt", "domain", "a.com", fetch, cacheable=cacheable) == {"status_code": 200}
+    assert fetch.calls == 2
+
+    # Default: empty values are not cached, cacheable=None caches them
+    fetch = _Fetch([], [], [])
+    cache.lookup("vt", "ip", "a.com", fetch)
+    cache.lookup("vt", "ip", "a.com", fetch, cacheable=None)
+    cache.lookup("vt", "ip", "a.com", fetch)
+    assert fetch.calls == 2
+
+
+def test_normalize_asset():
+    assert normalize_asset(" Example.COM. ") == "example.com"
+    assert normalize_asset("HTTPS://Example.com") == "https://example.com/"
+    assert normalize_asset("https://example.com/Path?q=A#frag") == "https://example.com/Path?q=A"
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoint tests: resume of the scans of a dead engine process.
+"""
+from PatrowlEnginesUtils.PatrowlEngineCheckpoint import (
+    CheckpointStore, CHECKPOINT_FINISHED, UNIT_PENDING, UNIT_DONE, UNIT_ERROR)
+
+from conftest import run_in_child
+
+
+def _interrupted_scan(db_path):
+    checkpoint = CheckpointStore(db_path).create("1", {"assets": ["a", "b", "c", "d"]}, units=["a", "b", "c"])
+    checkpoint.add_unit("d")
+    checkpoint.unit_started("a")
+    checkpoint.unit_done("a", findings=[{"issue_id": 1}])
+    checkpoint.unit_started("b")
+    checkpoint.unit_failed("b")
+    checkpoint.unit_started("c")
+    checkpoint.set_job("task_id", "42")
+
+
+def _finished_scan(db_path):
+    checkpoint = CheckpointStore(db_path).create("2", {"assets": ["a"]}, units=["a"])
+    checkpoint.unit_done("a")
+    checkpoint.finish(findings=[{"issue_id": 1}, {"issue_id": 2}])
+
+
+def test_claim_orphans_resumes_units(tmp_path):
+    """The checkpoint of a dead process is claimed with its units left to run."""
+    db_path = tmp_path / "checkpoints.db"
+    run_in_child(_interrupted_scan, db_path)
+
+    store = CheckpointStore(db_path)
+    (checkpoint,) = store.claim_orphans()
+    assert checkpoint.scan_id == "1"
+    assert checkpoint.resumed
+    assert checkpoint.params == {"assets": ["a", "b", "c", "d"]}
+    # The interrupted unit runs again
+    assert checkpoint.pending_units() == ["c", "d"]
+    assert checkpoint.is_done("a") and checkpoint.is_done("b")
+    assert checkpoint.add_unit("a") == UNIT_DONE
+    assert checkpoint.add_unit("b") == UNIT_ERROR
+    assert checkpoint.add_unit("d") == UNIT_PENDING
+    assert checkpoint.findings() == [{"issue_id": 1}]
+    assert checkpoint.job("task_id") == "42"
+
+    # Claimed once
+    assert store.claim_orphans() == []
+
+
+def test_claim_orphans_finished_scan(tmp_path):
+    """A finished checkpoint is claimed with its findings, to be served as is."""
+    db_path = tmp_path / "checkpoints.db"
+    run_in_child(_finished_scan, db_path)
+
+    (checkpoint,) = CheckpointStore(db_path).claim_orphans()
+    assert checkpoint.status == CHECKPOINT_FINISHED
+    assert checkpoint.pending_units() == []
+    assert checkpoint.findings() == [{"issue_id": 1}, {"issue_id": 2}]
+
+
+def test_live_owner_not_claimed(tmp_path):
+    """The checkpoints of a running process are not taken over."""
+    db_path = tmp_path / "checkpoints.db"
+    CheckpointStore(db_path).create("1", {}, units=["a"])
+    assert CheckpointStore(db_path).claim_orphans() == []
+
+
+def test_save_findings_appends(tmp_path):
+    """Only the findings not saved yet are written."""
+    checkpoint = CheckpointStore(tmp_path / "checkpoints.db").create("1", {})
+    findings = [{"issue_id": 1}]
+    assert checkpoint.save_findings(findings) == 1
+    findings.append({"issue_id": 2})
+    assert checkpoint.save_findings(findings) == 1
+    assert checkpoint.save_findings(findings) == 0
+    assert checkpoint.findings() == findings
+
+
+def test_remove(tmp_path):
+    store = CheckpointStore(tmp_path / "checkpoints.db")
+    store.create("1", {}, units=["a"]).remove()
+    assert store.get("1") is None
+    assert store.scan_ids() == []
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+CVE index tests: CPE and version matching, lookups and incremental build.
+"""
+import os
+import gzip
+import json
+
+from PatrowlEnginesUtils.PatrowlEngineCveIndex import CveIndex, get_cve_index, parse_cpe, version_key
+
+
+def _item_11(cve_id, last_modified, score, matches):
+    return {
+        "cve": {
+            "CVE_data_meta": {"ID": cve_id},
+            "description": {"description_data": [{"lang": "en", "value": cve_id + " description"}]},
+            "references": {"reference_data": [{"url": "https://example.com/" + cve_id}]},
+        },
+        "impact": {"baseMetricV3": {"cvssV3": {"baseScore": score, "vectorString": "CVSS:3.1/AV:N", "baseSeverity": "HIGH"}}},
+        "lastModifiedDate": last_modified,
+        "configurations": {"nodes": [{"cpe_match": matches}]},
+    }
+
+
+def _item_20(cve_id, last_modified, score, matches):
+    return {"cve": {
+        "id": cve_id,
+        "lastModified": last_modified,
+        "descriptions": [{"lang": "en", "value": cve_id + " description"}],
+        "references": [],
+        "metrics": {
+            "cvssMetricV31": [{"type": "Primary", "cvssData": {"baseScore": score, "vectorString": "CVSS:3.1/AV:N"}}],
+            "cvssMetricV2": [{"type": "Primary", "cvssData": {"baseScore": 1.0, "vectorString": "AV:N"}}],
+        },
+        "configurations": [{"nodes": [{"cpeMatch": matches}]}],
+    }}
+
+
+def _write_feed(path, feed):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(str(path), "wt", encoding="utf-8") as feed_file:
+        json.dump(feed, feed_file)
+    return str(path)
+
+
+def _ids(cves):
+    return [cve["cve_id"] for cve in cves]
+
+
+def _build(tmp_path):
+    feed = _write_feed(tmp_path / "nvdcve-1.1-2021.json.gz", {"CVE_Items": [
+        _item_11("CVE-2021-23017", "2021-06-01T00:00Z", 7.5, [
+            {"vulnerable": True, "cpe23Uri": "cpe:2.3:a:f5:nginx:*:*:*:*:*:*:*:*",
+             "versionStartIncluding": "0.6.18", "versionEndExcluding": "1.20.1"}]),
+        _item_11("CVE-2019-20372", "2020-01-01T00:00Z", 5.3, [
+            {"vulnerable": True, "cpe23Uri": "cpe:2.3:a:f5:nginx:*:*:*:*:*:*:*:*",
+             "versionEndIncluding": "1.17.6"},
+            {"vulnerable": False, "cpe23Uri": "cpe:2.3:o:linux:linux_kernel:-:*:*:*:*:*:*:*"}]),
+        _item_11("CVE-2021-41617", "2021-09-01T00:00Z", 7.0, [
+            {"vulnerable": True, "cpe23Uri": "cpe:2.3:a:openbsd:openssh:8.9:p1:*:*:*:*:*:*"}]),
+    ]})
+    index = CveIndex(tmp_path / "cves.db", readonly=False)
+    assert index.import_feed(feed) == 3
+    return index, feed
+
+
+def test_parse_cpe():
+    """CPE 2.2 URIs (nmap) and 2.3 strings, the update joined to the version."""
+    assert parse_cpe("cpe:/a:openbsd:openssh:8.9p1") == ("a", "openbsd", "openssh", "8.9p1")
+    assert parse_cpe("cpe:2.3:a:openbsd:openssh:8.9:p1:*:*:*:*:*:*") == ("a", "openbsd", "openssh", "8.9p1")
+    assert parse_cpe("cpe:/a:f5:nginx") == ("a", "f5", "nginx", None)
+    assert parse_cpe("nginx 1.18") is None
+    assert version_key("1.10") > version_key("1.9")
+    assert version_key("8.9p1") > version_key("8.9")
+
+
+def test_lookup(tmp_path):
+    """The CVEs of the version ranges matching a CPE, the highest CVSS first."""
+    _build(tmp_path)
+    index = get_cve_index(str(tmp_path / "cves.db"))
+    assert index.lookup("cpe:/a:igor_sysoev:nginx:1.16.1") == []
+    assert _ids(index.lookup("cpe:/a:f5:nginx:1.16.1")) == ["CVE-2021-23017", "CVE-2019-20372"]
+    assert _ids(index.lookup("cpe:/a:f5:nginx:1.18.0")) == ["CVE-2021-23017"]
+    assert _ids(index.lookup("cpe:/a:f5:nginx:1.20.1")) == []
+    # No version, no CVE
+    assert index.lookup("cpe:/a:f5:nginx") == []
+    assert index.lookup("cpe:/o:linux:linux_kernel:5.4") == []
+
+    cve = index.lookup("cpe:/a:openbsd:openssh:8.9p1")[0]
+    assert cve == {
+        "cve_id": "CVE-2021-41617", "cvss": 7.0, "cvss_vector": "CVSS:3.1/AV:N", "severity": "HIGH",
+        "description": "CVE-2021-41617 description", "references": ["https://example.com/CVE-2021-41617"],
+        "link": "https://nvd.nist.gov/vuln/detail/CVE-2021-41617"}
+    assert index.lookup("cpe:/a:openbsd:openssh:8.9") == []
+
+
+def test_incremental_build(tmp_path):
+    """The feeds not changed are skipped, a CVE is only replaced by a more recent one."""
+    index, feed = _build(tmp_path)
+    assert index.import_feed(feed) is None
+    assert index.import_feed(feed, force=True) == 3
+
+    # The "modified" feed (2.0 API): a new range for one CVE, an older version of another
+    modified = _write_feed(tmp_path / "nvdcve-2.0-modified.json", {"vulnerabilities": [
+        _item_20("CVE-2021-23017", "2021-07-01T00:00Z", 9.8, [
+            {"vulnerable": True, "criteria": "cpe:2.3:a:f5:nginx:*:*:*:*:*:*:*:*",
+             "versionStartIncluding": "0.6.18", "versionEndIncluding": "1.20.1"}]),
+        _item_20("CVE-2019-20372", "2019-12-01T00:00Z", 1.0, []),
+    ]})
+    assert index.import_feed(modified) == 1
+    assert index.stats() == {"feeds": 2, "cves": 3, "cpe_matches": 3}
+    cves = index.lookup("cpe:/a:f5:nginx:1.16.1")
+    assert [(cve["cve_id"], cve["cvss"]) for cve in cves] == [("CVE-2021-23017", 9.8), ("CVE-2019-20372", 5.3)]
+    assert _ids(index.lookup("cpe:/a:f5:nginx:1.20.1")) == ["CVE-2021-23017"]
+
+    # The original feed imported again does not replace the modified CVE
+    os.utime(feed, (0, 0))
+    assert index.import_feed(feed) == 2
+    assert index.lookup("cpe:/a:f5:nginx:1.16.1")[0]["cvss"] == 9.8
+
+
+def test_get_cve_index(tmp_path, monkeypatch):
+    """No index if not built; $APP_CVE_INDEX_DB first."""
+    assert get_cve_index(str(tmp_path / "missing.db")) is None
+    _build(tmp_path)
+    monkeypatch.setenv("APP_CVE_INDEX_DB", str(tmp_path / "cves.db"))
+    assert get_cve_index(str(tmp_path / "missing.db")).stats()["cves"] == 3
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Scan events tests: published changes and delivery of the callbacks.
+"""
+import time
+import threading
+
+from PatrowlEnginesUtils.PatrowlEngineEvents import CallbackDispatcher, ScanEvents
+
+TIMEOUT = 5
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class _Http:
+    """Answer the callbacks with the given status codes (then 200)."""
+
+    def __init__(self, status_codes=()):
+        self.status_codes = list(status_codes)
+        self.posted = []
+        self.delivered = threading.Event()
+
+    def post(self, url, json=None, **kwargs):
+        self.posted.append((url, json["id"]))
+        status_code = self.status_codes.pop(0) if self.status_codes else 200
+        if isinstance(status_code, Exception):
+            raise status_code
+        if status_code == 200:
+            self.delivered.set()
+        return _Response(status_code)
+
+
+def _wait(predicate):
+    deadline = time.time() + TIMEOUT
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_callback_retried():
+    """Failed deliveries are retried until one succeeds."""
+    http = _Http([500, ConnectionError("refused"), 200])
+    dispatcher = CallbackDispatcher(http, backoff=0.01)
+    dispatcher.submit("http://callback/1", {"id": 1, "scan_id": "1"})
+    assert http.delivered.wait(TIMEOUT)
+    assert http.posted == [("http://callback/1", 1)] * 3
+    assert _wait(lambda: dispatcher.stats().get("delivered") == 1)
+    assert dispatcher.stats()["retried"] == 2
+
+
+def test_callback_given_up():
+    """A delivery is given up after its retries."""
+    http = _Http([500] * 10)
+    dispatcher = CallbackDispatcher(http, retries=2, backoff=0.01)
+    dispatcher.submit("http://callback/1", {"id": 1, "scan_id": "1"})
+    assert _wait(lambda: dispatcher.stats().get("failed") == 1)
+    assert len(http.posted) == 3
+
+
+def test_callback_queue_bounded():
+    """When the queue is full, the oldest events are dropped."""
+    dispatcher = CallbackDispatcher(_Http(), maxsize=2, workers=0)
+    for i in range(5):
+        dispatcher.submit("http://callback/1", {"id": i, "scan_id": "1"})
+    assert dispatcher.stats() == {"dropped": 3, "queued": 2}
+    assert [entry[3]["id"] for entry in sorted(dispatcher._queue)] == [3, 4]
+
+
+def _published(events, scan_id, scans):
+    stream = events.subscribe(scan_id)
+    for scan in scans:
+        events.scan_changed(scan_id, scan)
+    published = []
+    event = stream.get(0)
+    while event is not None:
+        published.append(event)
+        event = stream.get(0)
+    return published
+
+
+def test_scan_changed_list_findings():
+    """Only the changes of status and of number of findings are published."""
+    events = ScanEvents("test", _Http())
+    published = _published(events, "1", [
+        {"status": "STARTED", "findings": []},
+        {"status": "SCANNING", "findings": []},
+        {"status": "SCANNING", "findings": []},
+        {"status": "SCANNING", "findings": [{}, {}]},
+        {"status": "FINISHED", "findings": [{}, {}]},
+    ])
+    assert [(e["type"], e["status"], e["nb_findings"]) for e in published] == [
+        ("status", "STARTED", 0), ("status", "SCANNING", 0),
+        ("findings", "SCANNING", 2), ("status", "FINISHED", 2)]
+    assert published[1]["previous_status"] == "STARTED"
+    assert [e["id"] for e in published] == sorted(e["id"] for e in published)
+
+
+def test_scan_changed_findings_by_asset():
+    """Findings kept by asset are not counted, unless the scan counts them."""
+    events = ScanEvents("test", _Http())
+    published = _published(events, "1", [
+        {"status": "SCANNING", "findings": {"a.com": {"positives": 3}}},
+        {"status": "SCANNING", "findings": {"a.com": {}, "b.com": {}}},
+        {"status": "FINISHED", "findings": {"a.com": {}, "b.com": {}}},
+    ])
+    assert [(e["type"], e["status"]) for e in published] == [("status", "SCANNING"), ("status", "FINISHED")]
+    assert all("nb_findings" not in e for e in published)
+
+    published = _published(events, "2", [
+        {"status": "SCANNING", "findings": {"a.com": {}}, "nb_findings": 3},
+        {"status": "SCANNING", "findings": {"a.com": {}}, "nb_findings": 5},
+    ])
+    assert [(e["type"], e["nb_findings"]) for e in published] == [("status", 3), ("findings", 5)]
+
+
+def test_scan_changed_callback():
+    """The events of a scan are POSTed to its callback URL."""
+    http = _Http()
+    events = ScanEvents("test", http)
+    events.scan_changed("1", {"status": "FINISHED", "findings": [], "callback_url": "http://callback/1"})
+    assert http.delivered.wait(TIMEOUT)
+    assert http.posted == [("http://callback/1", 1)]
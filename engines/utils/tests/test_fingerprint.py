@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Fingerprint index tests: new, changed and resolved findings across scans.
+"""
+from PatrowlEnginesUtils.PatrowlEngineFingerprint import FingerprintIndex, fingerprint, content_digest
+
+ASSETS = [{"value": "a.com", "datatype": "domain"}]
+
+
+def _issue(issue_id, title, severity="info", addr="a.com"):
+    return {
+        "issue_id": issue_id, "type": "test", "title": title, "severity": severity,
+        "description": "", "solution": "", "target": {"addr": [addr]}}
+
+
+def _delta(index, issues, delta_only=True):
+    delta = index.delta(iter(issues), ASSETS, delta_only=delta_only)
+    return list(delta), delta.counts
+
+
+def test_fingerprint_ignores_title_hashes():
+    """Hashes and counters appended to the titles do not change the identity."""
+    issue = _issue(1, "Open ports (#: 3, HASH: 1a2b3c)")
+    assert fingerprint(issue) == fingerprint(_issue(2, "Open ports (#: 4, HASH: 4d5e6f)"))
+    assert fingerprint(issue) != fingerprint(_issue(1, "Open ports", addr="b.com"))
+    assert content_digest(issue) != content_digest(_issue(1, "Open ports", severity="high"))
+
+
+def test_delta_new_changed_resolved(tmp_path):
+    index = FingerprintIndex(tmp_path / "fingerprints.db")
+    issues, counts = _delta(index, [_issue(1, "a"), _issue(2, "b"), _issue(3, "c")])
+    assert counts == {"new": 3, "changed": 0, "unchanged": 0, "resolved": 0}
+    assert [i["delta"] for i in issues] == ["new"] * 3
+
+    issues, counts = _delta(index, [_issue(1, "a"), _issue(2, "b", severity="high"), _issue(3, "d")])
+    assert counts == {"new": 1, "changed": 1, "unchanged": 1, "resolved": 1}
+    assert [(i["title"], i["delta"]) for i in issues] == [("b", "changed"), ("d", "new"), ("c", "resolved")]
+    resolved = issues[-1]
+    assert resolved["issue_id"] == 4
+    assert resolved["target"] == {"addr": ["a.com"]}
+    assert resolved["raw"] == {"previous_severity": "info"}
+
+    # The index holds the last scan
+    _, counts = _delta(index, [_issue(1, "a"), _issue(2, "b", severity="high"), _issue(3, "d")])
+    assert counts == {"new": 0, "changed": 0, "unchanged": 3, "resolved": 0}
+
+
+def test_delta_all_findings(tmp_path):
+    """Without delta_only, all the findings are yielded as is and counted."""
+    index = FingerprintIndex(tmp_path / "fingerprints.db")
+    _delta(index, [_issue(1, "a"), _issue(2, "b")])
+    issues, counts = _delta(index, [_issue(1, "a")], delta_only=False)
+    assert issues == [_issue(1, "a")]
+    assert counts == {"new": 0, "changed": 0, "unchanged": 1, "resolved": 1}
+
+
+def test_delta_not_saved_if_interrupted(tmp_path):
+    """A report not written completely does not update the index."""
+    index = FingerprintIndex(tmp_path / "fingerprints.db")
+    delta = iter(index.delta(iter([_issue(1, "a"), _issue(2, "b")]), ASSETS))
+    next(delta)
+    delta.close()
+    _, counts = _delta(index, [_issue(1, "a")])
+    assert counts == {"new": 1, "changed": 0, "unchanged": 0, "resolved": 0}
+    assert index._conn().execute("SELECT COUNT(*) FROM temp.fingerprints_staging").fetchone() == (0,)
+
+
+def test_delta_scan_scope(tmp_path):
+    """The findings of other targets (e.g. IPs of a range) are compared by scan."""
+    index = FingerprintIndex(tmp_path / "fingerprints.db")
+    _delta(index, [_issue(1, "a", addr="10.0.0.1")])
+    _, counts = _delta(index, [_issue(1, "a", addr="10.0.0.1")])
+    assert counts["unchanged"] == 1
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+HTTP client tests: retries, backoff and Retry-After.
+"""
+import os
+
+import pytest
+import requests
+
+from PatrowlEnginesUtils import PatrowlEngineHttp
+from PatrowlEnginesUtils.PatrowlEngineHttp import HttpClient, backoff_delay
+
+
+class _Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _Session:
+    """Return (or raise) the given outcomes, one per request."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def _client(monkeypatch, *outcomes, **kwargs):
+    """Return a client over a fake session, and the list of its sleeps."""
+    sleeps = []
+    monkeypatch.setattr(PatrowlEngineHttp.time, "sleep", sleeps.append)
+    client = HttpClient(**kwargs)
+    client._session = _Session(*outcomes)
+    client._pid = os.getpid()
+    return client, sleeps
+
+
+def test_backoff_delay():
+    """Full jitter, capped by max_backoff."""
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, 0.5, 4) <= min(4, 0.5 * 2 ** attempt)
+
+
+def test_retry_status(monkeypatch):
+    """5xx and 429 are retried, the connection given back to the pool."""
+    failed = _Response(503)
+    client, sleeps = _client(monkeypatch, failed, _Response(429), _Response(200), retries=3)
+    assert client.get("http://api").status_code == 200
+    assert client.session.calls == 3
+    assert len(sleeps) == 2
+    assert failed.closed
+
+
+def test_retry_after(monkeypatch):
+    """Retry-After is honoured, capped by the max backoff."""
+    client, sleeps = _client(
+        monkeypatch, _Response(429, {"Retry-After": "7"}), _Response(429, {"Retry-After": "3600"}),
+        _Response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}), _Response(200),
+        retries=3, backoff=0.5)
+    assert client.get("http://api").status_code == 200
+    assert sleeps[:2] == [7.0, PatrowlEngineHttp.HTTP_MAX_BACKOFF]
+    # HTTP-date: backoff
+    assert 0 <= sleeps[2] <= 2.0
+
+
+def test_retries_exhausted(monkeypatch):
+    """The last response is returned, the last connection error raised."""
+    client, sleeps = _client(monkeypatch, _Response(500), _Response(502), retries=1)
+    assert client.get("http://api").status_code == 502
+    assert len(sleeps) == 1
+
+    client, sleeps = _client(monkeypatch, requests.exceptions.ConnectionError(),
+                             requests.exceptions.ReadTimeout(), retries=1)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.get("http://api")
+    assert client.session.calls == 2
+
+
+def test_not_idempotent(monkeypatch):
+    """A POST is only retried if it was not processed (429, connect timeout)."""
+    client, sleeps = _client(monkeypatch, _Response(503), retries=3)
+    assert client.post("http://api").status_code == 503
+    assert sleeps == []
+
+    client, sleeps = _client(monkeypatch, _Response(429), requests.exceptions.ConnectTimeout(),
+                             _Response(200), retries=3)
+    assert client.post("http://api").status_code == 200
+
+    client, sleeps = _client(monkeypatch, requests.exceptions.ReadTimeout(), retries=3)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post("http://api")
+    assert sleeps == []
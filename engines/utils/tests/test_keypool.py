@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+API key pool tests: token buckets, quotas, rejected and dropped keys.
+"""
+import threading
+import time
+
+from PatrowlEnginesUtils.PatrowlEngineKeyPool import KeyPool, TokenBucket
+
+
+def test_token_bucket():
+    """A bucket serves 'burst' requests in a row, then one per 1/rate."""
+    bucket = TokenBucket(4, period=60.0, now=0.0)
+    for _ in range(4):
+        assert bucket.delay(0.0) == 0.0
+        bucket.take(0.0)
+    assert bucket.delay(0.0) == 15.0
+    assert round(bucket.delay(5.0), 6) == 10.0
+    assert bucket.delay(15.0) == 0.0
+    bucket.drain(15.0)
+    assert bucket.delay(15.0) == 15.0
+
+
+def test_acquire_rate():
+    """N keys serve N times the rate of one, then the caller waits."""
+    pool = KeyPool(["a", "b", "a"], rate=1, period=60.0)
+    assert len(pool) == 2
+    assert sorted([pool.acquire(), pool.acquire()]) == ["a", "b"]
+    assert pool.acquire(timeout=0.05) is None
+
+
+def test_acquire_cancelled():
+    """A waiting caller stops when cancelled."""
+    pool = KeyPool(["a"], rate=1, period=60.0)
+    assert pool.acquire() == "a"
+    start = time.monotonic()
+    assert pool.acquire(cancel=lambda: True) is None
+    assert time.monotonic() - start < 1
+
+
+def test_quota():
+    """The key with the most remaining quota serves first, none once all spent."""
+    pool = KeyPool(["a", "b"], quota=2)
+    pool.set_quota("b", 3)
+    assert [pool.acquire() for _ in range(5)] == ["b", "a", "b", "a", "b"]
+    assert pool.remaining("a") == 0
+    assert pool.acquire() is None
+
+
+def test_reject():
+    """A rejected key is put aside, the others keep serving."""
+    pool = KeyPool(["a", "b"])
+    pool.reject("a", retry_after=0.2)
+    assert [pool.acquire() for _ in range(3)] == ["b", "b", "b"]
+    time.sleep(0.25)
+    assert "a" in [pool.acquire(), pool.acquire()]
+    assert pool.stats()["keys"][0]["rejections"] == 1
+
+
+def test_drop():
+    """A dropped key never serves again, a waiting caller is woken up."""
+    pool = KeyPool(["a"], quota=0)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(pool.acquire(timeout=5)))
+    pool.set_quota("a", 0, reset_after=60)
+    waiter.start()
+    time.sleep(0.1)
+    pool.drop("a")
+    waiter.join(5)
+    assert result == [None]
+    assert pool.stats()["keys"][0]["available_in"] is None
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Results store tests: paginated findings and retention of the reports.
+"""
+import os
+import json
+import time
+
+import pytest
+
+from PatrowlEnginesUtils.PatrowlEngineResults import ResultsStore
+from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+
+NB_ISSUES = 25
+
+
+def _issues():
+    return [{"issue_id": i, "severity": "info", "title": "issue {}".format(i)} for i in range(NB_ISSUES)]
+
+
+def _get_page(results, args):
+    response = results.findings_response("1", {"page": "getfindings", "scan_id": "1"}, args)
+    lines = response.get_data().decode("utf-8").splitlines()
+    return json.loads(lines[0]), [json.loads(line) for line in lines[1:-1]], json.loads(lines[-1])
+
+
+def _files(results_dir):
+    return sorted(
+        os.path.relpath(os.path.join(root, filename), results_dir)
+        for root, _, filenames in os.walk(results_dir) for filename in filenames)
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_cursor_pagination(tmp_path, compression):
+    """The pages of a report hold all its issues, once, in order."""
+    results = ResultsStore(tmp_path, "test", compression=compression)
+    results.write_report("1", {"scan_id": "1"}, _issues(), summary={"nb_info": NB_ISSUES})
+
+    issues = []
+    cursor = None
+    pages = 0
+    while True:
+        args = {"format": "ndjson", "limit": "10"}
+        if cursor is not None:
+            args["cursor"] = str(cursor)
+        header, page, trailer = _get_page(results, args)
+        assert header["scan"] == {"scan_id": "1"}
+        assert header["summary"]["nb_info"] == NB_ISSUES
+        assert trailer["cursor"] == cursor
+        assert trailer["nb_issues"] == len(page)
+        issues.extend(page)
+        pages += 1
+        cursor = trailer["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == 3
+    assert issues == _issues()
+
+
+def test_whole_report(tmp_path):
+    """Without NDJSON arguments, the report is sent as one document."""
+    results = ResultsStore(tmp_path, "test", compression="gzip")
+    results.write_report("1", {"scan_id": "1"}, _issues())
+    body = json.loads(results.findings_response("1", {"scan_id": "1"}).get_data())
+    assert body["status"] == "success"
+    assert body["issues"] == _issues()
+
+
+def test_invalid_cursor(tmp_path):
+    """A cursor not at the start of an issue line is rejected."""
+    results = ResultsStore(tmp_path, "test", compression="none")
+    results.write_report("1", {"scan_id": "1"}, _issues())
+    _, _, trailer = _get_page(results, {"limit": "1"})
+    with pytest.raises(PatrowlEngineExceptions):
+        _get_page(results, {"cursor": str(trailer["next_cursor"] + 1)})
+
+
+def test_retention_max_age(tmp_path):
+    """Only the sharded reports older than max_age are removed, with their index."""
+    results = ResultsStore(tmp_path, "test", compression="gzip", max_age=60)
+    for scan_id in ("1", "2", "3"):
+        results.write_report(scan_id, {"scan_id": scan_id}, _issues())
+    # Files of the engine and report of a previous version
+    for filename in ("test_4.partial.json", "test_4.xml", "test_5.json"):
+        (tmp_path / filename).write_text("{}")
+    old = time.time() - 3600
+    for filename in _files(tmp_path):
+        os.utime(os.path.join(tmp_path, filename), (old, old))
+    os.utime(results.path("3"), None)
+    os.utime(results.path("3") + ".idx", None)
+
+    assert results.apply_retention() == 2
+    assert results.find("1") is None and results.find("2") is None
+    assert _files(tmp_path) == sorted([
+        os.path.relpath(results.path("3"), tmp_path),
+        os.path.relpath(results.path("3") + ".idx", tmp_path),
+        "test_4.partial.json", "test_4.xml", "test_5.json"])
+
+
+def test_retention_max_size(tmp_path):
+    """The oldest reports are removed until the reports fit in max_size."""
+    results = ResultsStore(tmp_path, "test", compression="none")
+    now = time.time()
+    for i, scan_id in enumerate(("1", "2", "3")):
+        results.write_report(scan_id, {"scan_id": scan_id}, _issues())
+        os.utime(results.path(scan_id), (now - 300 + i, now - 300 + i))
+    report_size = os.path.getsize(results.path("3"))
+
+    results.max_size = 2 * report_size
+    assert results.apply_retention() == 1
+    assert results.find("1") is None
+    assert results.find("2") is not None and results.find("3") is not None
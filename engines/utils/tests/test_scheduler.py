@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Scan scheduler tests: order of the jobs and completion of the scans.
+"""
+import threading
+
+from PatrowlEnginesUtils.PatrowlEngineScheduler import ScanScheduler
+
+TIMEOUT = 5
+
+
+def test_jobs_run_by_criticity():
+    """Queued jobs run by asset criticity, then in submission order."""
+    scheduler = ScanScheduler(max_workers=1, max_scan_workers=10)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def _block():
+        started.set()
+        release.wait(TIMEOUT)
+
+    scheduler.submit("1", _block)
+    assert started.wait(TIMEOUT)
+    for name, criticity in [("low-1", "low"), ("none", None), ("high", "high"),
+                            ("low-2", "LOW"), ("critical", "critical")]:
+        scheduler.submit("1", order.append, args=(name,), criticity=criticity)
+    release.set()
+
+    done = threading.Event()
+    scheduler.submit("1", done.set)
+    assert done.wait(TIMEOUT)
+    assert order == ["critical", "high", "low-1", "low-2", "none"]
+
+
+def test_scan_finished_after_close():
+    """A scan is finished once it is closed and all its jobs ended, not before."""
+    notifications = []
+    finished = threading.Event()
+
+    def _listener(scan_id, progress):
+        notifications.append(dict(progress))
+        if not progress["scheduling"] and progress["done"] + progress["errors"] == progress["total"]:
+            finished.set()
+
+    def _fail():
+        raise ValueError("job failed")
+
+    scheduler = ScanScheduler(max_workers=2, max_scan_workers=2, listener=_listener)
+    scheduler.open_scan("1")
+    jobs_done = threading.Semaphore(0)
+    for _ in range(3):
+        scheduler.submit("1", jobs_done.release)
+    for _ in range(3):
+        assert jobs_done.acquire(timeout=TIMEOUT)
+    scheduler.submit("1", _fail)
+
+    # All the jobs queued so far may have ended: still scheduling
+    assert not finished.wait(0.2)
+    assert not scheduler.is_finished("1")
+
+    scheduler.close_scan("1")
+    assert finished.wait(TIMEOUT)
+    assert scheduler.is_finished("1")
+    last = notifications[-1]
+    assert (last["total"], last["done"], last["errors"], last["scheduling"]) == (4, 3, 1, False)
+    # Finished once, on the last notification
+    assert [n for n in notifications if not n["scheduling"] and n["pending"] == n["running"] == 0] == [last]
+
+
+def test_scan_cap():
+    """A scan never runs more jobs than its max_scan_workers at once."""
+    lock = threading.Lock()
+    running = [0, 0]
+    scheduler = ScanScheduler(max_workers=4, max_scan_workers=2)
+    scheduler.open_scan("1")
+
+    def _job():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        threading.Event().wait(0.02)
+        with lock:
+            running[0] -= 1
+
+    for _ in range(10):
+        scheduler.submit("1", _job)
+    scheduler.close_scan("1")
+    for _ in range(TIMEOUT * 20):
+        if scheduler.is_finished("1"):
+            break
+        threading.Event().wait(0.05)
+    assert scheduler.is_finished("1")
+    assert running[1] == 2
+
+
+def test_forget_drops_queued_jobs():
+    """The jobs of a forgotten scan are not run."""
+    scheduler = ScanScheduler(max_workers=1, max_scan_workers=10)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def _block():
+        started.set()
+        release.wait(TIMEOUT)
+
+    scheduler.submit("1", _block)
+    assert started.wait(TIMEOUT)
+    scheduler.submit("2", order.append, args=("2",))
+    scheduler.submit("3", order.append, args=("3",))
+    scheduler.forget("2")
+    release.set()
+
+    done = threading.Event()
+    scheduler.submit("3", done.set)
+    assert done.wait(TIMEOUT)
+    assert order == ["3"]
+    assert not scheduler.has_scan("2")
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+SingleFlight tests: coalescing of identical concurrent calls.
+"""
+import time
+import threading
+
+import pytest
+
+from PatrowlEnginesUtils.PatrowlEngineSingleFlight import SingleFlight
+
+TIMEOUT = 5
+CALLERS = 4
+
+
+class _Blocking:
+    """Count the calls, each one blocked until released."""
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+
+    def __call__(self, value):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(TIMEOUT)
+        if self.error is not None:
+            raise self.error
+        return value
+
+
+def _run(flight, key, fn, n):
+    """Call flight.do(key, fn) from n threads, return their outcomes."""
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(flight.do(key, fn, key))
+        except Exception as e:
+            outcomes.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(n)]
+    threads[0].start()
+    assert fn.started.wait(TIMEOUT)
+    for thread in threads[1:]:
+        thread.start()
+    # All the followers wait for the leader
+    deadline = time.monotonic() + TIMEOUT
+    while flight.coalesced < n - 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    fn.release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    return outcomes
+
+
+def test_coalesced():
+    """Concurrent calls of a key run once and share the result."""
+    flight = SingleFlight()
+    fn = _Blocking()
+    assert _run(flight, "a", fn, CALLERS) == ["a"] * CALLERS
+    assert fn.calls == 1
+    assert flight.coalesced == CALLERS - 1
+    assert flight.in_flight() == 0
+
+
+def test_error_shared():
+    """The exception of the call is raised to all its callers."""
+    flight = SingleFlight()
+    error = ValueError("down")
+    fn = _Blocking(error)
+    assert _run(flight, "a", fn, CALLERS) == [error] * CALLERS
+    assert fn.calls == 1
+
+
+def test_later_calls_run():
+    """A call made once the previous one is done runs again."""
+    flight = SingleFlight()
+    fn = _Blocking(ValueError("down"))
+    fn.release.set()
+    with pytest.raises(ValueError):
+        flight.do("a", fn, "a")
+    fn.error = None
+    assert flight.do("a", fn, "a") == "a"
+    assert flight.do("b", fn, "b") == "b"
+    assert fn.calls == 3
+    assert flight.coalesced == 0
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Scan store tests: records kept across a restart of the engine.
+"""
+from PatrowlEnginesUtils.PatrowlEngineStore import SQLiteScanStore
+
+from conftest import run_in_child
+
+
+def _start_scan(db_path, scan_id, status):
+    store = SQLiteScanStore(db_path)
+    store[scan_id] = {"status": status, "assets": ["8.8.8.8"], "findings": [{"issue_id": 1}]}
+
+
+def test_reopen_keeps_scans(tmp_path):
+    """The scans and their findings are loaded again by a new store."""
+    db_path = tmp_path / "scans.db"
+    store = SQLiteScanStore(db_path)
+    store["1"] = {"status": "FINISHED", "assets": ["8.8.8.8"], "findings": []}
+    store["1"]["findings"].append({"issue_id": 1})
+    store["1"]["findings"].append({"issue_id": 2})
+    store.flush("1")
+
+    store = SQLiteScanStore(db_path)
+    assert list(store.keys()) == ["1"]
+    assert store["1"]["findings"] == [{"issue_id": 1}, {"issue_id": 2}]
+    assert store.summary("1")["status"] == "FINISHED"
+    assert store.count_by_status() == {"FINISHED": 1}
+
+
+def test_restart_interrupts_running_scans(tmp_path):
+    """The scans left running by a dead process are marked ERROR."""
+    db_path = tmp_path / "scans.db"
+    run_in_child(_start_scan, db_path, "1", "SCANNING")
+    run_in_child(_start_scan, db_path, "2", "FINISHED")
+
+    store = SQLiteScanStore(db_path)
+    assert store.summary("1")["status"] == "ERROR"
+    assert store.summary("1")["reason"] == "interrupted by a restart of the engine"
+    assert store["1"]["findings"] == [{"issue_id": 1}]
+    assert store.summary("2")["status"] == "FINISHED"
+
+
+def test_reopen_keeps_running_scans_of_live_process(tmp_path):
+    """A second store of the same process does not interrupt its scans."""
+    db_path = tmp_path / "scans.db"
+    store = SQLiteScanStore(db_path)
+    store["1"] = {"status": "SCANNING"}
+
+    assert SQLiteScanStore(db_path).summary("1")["status"] == "SCANNING"
+    assert store.summary("1")["status"] == "SCANNING"
+
+
+def test_remove_scan(tmp_path):
+    """Removed scans and their findings are not loaded again."""
+    db_path = tmp_path / "scans.db"
+    store = SQLiteScanStore(db_path)
+    store["1"] = {"status": "FINISHED", "findings": [{"issue_id": 1}]}
+    del store["1"]
+
+    store = SQLiteScanStore(db_path)
+    assert "1" not in store
+    assert store.count_by_status() == {}
@@ -7,17 +7,16 @@ import sys
 import json
 import time
 import hashlib
-import threading
 import socket
 import operator
-import random
 import logging
 from flask import Flask, request, jsonify
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineKeyPool import KeyPool
+from PatrowlEnginesUtils.PatrowlEngineCache import force_refresh
 
 # Debug
 # from pdb import set_trace as st
@@ -31,9 +30,12 @@ APP_ENGINE_NAME = "virustotal"
 APP_BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 LOG = logging.getLogger("werkzeug")
 VERSION = "1.4.18"
+# Rate and quota of each apikey of the public API (see "apikeys_rate" in the config)
+VT_APIKEYS_RATE = {"rate": 4, "period": 60, "quota": 500, "quota_period": 86400}
 
 this = sys.modules[__name__]
-this.vts = []
+this.vts = {}
+this.keypool = KeyPool([])
 
 engine = PatrowlEngine(
     app=app,
@@ -43,57 +45,57 @@ engine = PatrowlEngine(
     version=VERSION
 )
 
-def get_result_ratelimit(asset_name, asset_type):
+def get_result_ratelimit(asset_name, asset_type, scan_id=None):
     """
-    This function get the virustotal result and try randomly each apikeys
-    In case of error, generally a 204, it retries.
+    Get the virustotal result of an asset from the lookup cache, or from
+    virustotal if missing, expired or if the scan forces a refresh.
     """
-    # Shuffle the virustotal apikeys
-    random.shuffle(this.vts)
+    refresh = scan_id is not None and force_refresh(engine.scans[scan_id])
+    return engine.cache.lookup(
+        APP_ENGINE_NAME, asset_type, asset_name,
+        lambda: _get_result_ratelimit(asset_name, asset_type, scan_id),
+        force_refresh=refresh)
 
-    count = 0
-    vts_engine = this.vts[count]
 
+def _get_result_ratelimit(asset_name, asset_type, scan_id=None):
+    """
+    This function get the virustotal result with the apikey which can serve
+    soonest, waiting for it if all of them reached their rate limit.
+    In case of error (204 rate limited, 5xx, connection error...), the apikey
+    is put aside and it retries with another one. A rejected apikey (403) is
+    dropped from the pool.
+    """
     if asset_type == "domain":
-        result = vts_engine.get_domain_report(this_domain=asset_name)
-        while result["response_code"] != 200 and vts_engine != this.vts[-1]:
-            count += 1
-            vts_engine = this.vts[count]
-            result = vts_engine.get_domain_report(this_domain=asset_name)
-        if result["response_code"] == 204:
-            # Last try, try to wait a minute to reset the time limit
-            time.sleep(60)
-            result = vts_engine.get_domain_report(this_domain=asset_name)
-        if result["response_code"] == 200:
-            return result
-
+        def get_report(vt):
+            return vt.get_domain_report(this_domain=asset_name)
     elif asset_type == "ip":
-        result = vts_engine.get_ip_report(this_ip=asset_name)
-        while result["response_code"] != 200 and vts_engine != this.vts[-1]:
-            count += 1
-            vts_engine = this.vts[count]
-            result = vts_engine.get_ip_report(this_ip=asset_name)
-        if result["response_code"] == 204:
-            # Last try, try to wait a minute to reset the time limit
-            time.sleep(60)
-            result = vts_engine.get_ip_report(this_ip=asset_name)
-        if result["response_code"] == 200:
-            return result
+        def get_report(vt):
+            return vt.get_ip_report(this_ip=asset_name)
     elif asset_type == "url":
-        result = vts_engine.get_url_report(this_url=asset_name, scan='1', allinfo='1')
-        while result["response_code"] != 200 and vts_engine != this.vts[-1]:
-            count += 1
-            vts_engine = this.vts[count]
-            result = vts_engine.get_url_report(this_url=asset_name, scan='1', allinfo='1')
-        if result["response_code"] == 204:
-            # Last try, try to wait a minute to reset the time limit
-            time.sleep(60)
-            result = vts_engine.get_url_report(this_url=asset_name, scan='1', allinfo='1')
-        if result["response_code"] == 200:
-            return result
+        def get_report(vt):
+            return vt.get_url_report(this_url=asset_name, scan='1', allinfo='1')
     else:
         LOG.error("Wrong asset_type for {}: {}".format(asset_name, asset_type))
-        result = dict()
+        return dict()
+
+    cancel = None
+    if scan_id is not None:
+        cancel = lambda: engine.is_cancelled(scan_id)
+
+    result = dict()
+    # Each apikey, then a last try once a rate limited one is available again
+    for _ in range(len(this.keypool) + 1):
+        apikey = this.keypool.acquire(cancel=cancel)
+        if apikey is None:
+            break
+        result = get_report(this.vts[apikey])
+        response_code = result.get("response_code")
+        if response_code == 200:
+            return result
+        if response_code == 403:
+            this.keypool.drop(apikey)
+        else:
+            this.keypool.reject(apikey)
 
     LOG.error("Wrong response for {}: {}".format(asset_name, result))
     return dict()
@@ -178,6 +180,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route('/engines/virustotal/metrics')
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route('/engines/virustotal/events')
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route('/engines/virustotal/status/<scan_id>')
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -216,10 +230,18 @@ def _loadconfig():
         # sys.path.append(engine.scanner['virustotalapi_bin_path'])
         globals()['virus_total_apis'] = __import__('virus_total_apis')
 
-        this.vts = []
+        # Alternate API, e.g. the mock server of the tests (see utils/mocks)
+        api_url = os.environ.get('VIRUSTOTAL_API_URL', engine.scanner.get("api_url"))
+        this.vts = {}
         for apikey in engine.scanner["apikeys"]:
-            this.vts.append(virus_total_apis.PrivateApi(apikey))
+            this.vts[apikey] = virus_total_apis.PrivateApi(apikey)
+            if api_url:
+                this.vts[apikey].base = api_url
+        apikeys_rate = dict(VT_APIKEYS_RATE, **engine.scanner.get("apikeys_rate", {}))
+        this.keypool = KeyPool(list(this.vts), name=APP_ENGINE_NAME, **apikeys_rate)
         del engine.scanner["apikeys"]
+        if "cache_ttl" in engine.scanner:
+            engine.cache.set_ttl(APP_ENGINE_NAME, engine.scanner["cache_ttl"])
         engine.scanner['status'] = "READY"
     else:
         LOG.error("Error: config file '{}' not found".format(conf_file))
@@ -276,24 +298,19 @@ def start_scan():
         'scan_id':      scan_id,
         'status':       "STARTED",
         'started_at':   int(time.time() * 1000),
-        'findings':     {}
+        'findings':     {},
+        'callback_url': engine.callback_url(data)
     }
 
     engine.scans.update({scan_id: scan})
     if 'do_scan_ip' in scan['options'] and scan['options']['do_scan_ip']:
-        th = threading.Thread(target=_scan_ip, args=(scan_id,))
-        th.start()
-        engine.scans[scan_id]['threads'].append(th)
+        engine.start_thread(scan_id, _scan_ip, args=(scan_id,))
 
     if 'do_scan_domain' in scan['options'] and scan['options']['do_scan_domain']:
-        th = threading.Thread(target=_scan_domain, args=(scan_id,))
-        th.start()
-        engine.scans[scan_id]['threads'].append(th)
+        engine.start_thread(scan_id, _scan_domain, args=(scan_id,))
 
     if 'do_scan_url' in scan['options'] and scan['options']['do_scan_url']:
-        th = threading.Thread(target=_scan_url, args=(scan_id,))
-        th.start()
-        engine.scans[scan_id]['threads'].append(th)
+        engine.start_thread(scan_id, _scan_url, args=(scan_id,))
 
     res.update({
         "status": "accepted",
@@ -323,7 +340,7 @@ def _scan_ip(scan_id):
         if asset not in engine.scans[scan_id]["findings"]:
             engine.scans[scan_id]["findings"][asset] = {}
         try:
-            engine.scans[scan_id]["findings"][asset]['scan_ip'] = get_result_ratelimit(asset, "ip")
+            engine.scans[scan_id]["findings"][asset]['scan_ip'] = get_result_ratelimit(asset, "ip", scan_id)
         except Exception as e:
             LOG.error("API Connexion error (quota?) : {}".format(e))
             return False
@@ -341,11 +358,11 @@ def _scan_domain(scan_id):
         if not asset in engine.scans[scan_id]["findings"]:
             engine.scans[scan_id]["findings"][asset] = {}
         try:
-            domain_result = get_result_ratelimit(asset, "domain")
+            domain_result = get_result_ratelimit(asset, "domain", scan_id)
             if "detected_urls" in domain_result["results"]:
                 count = 0
                 for asset_url_dict in domain_result["results"]["detected_urls"]:
-                    domain_result["results"]["detected_urls"][count]["report"] = get_result_ratelimit(asset_url_dict['url'], "url")
+                    domain_result["results"]["detected_urls"][count]["report"] = get_result_ratelimit(asset_url_dict['url'], "url", scan_id)
                     count += 1
             engine.scans[scan_id]["findings"][asset]["scan_domain"] = domain_result
         except Exception as e:
@@ -365,9 +382,12 @@ def _scan_url(scan_id):
         if asset not in engine.scans[scan_id]["findings"].keys():
             engine.scans[scan_id]["findings"][asset] = {}
         try:
-            this.vts[random.randint(0,len(this.vts)-1)].scan_url(this_url=asset)
+            apikey = this.keypool.acquire(cancel=lambda: engine.is_cancelled(scan_id))
+            if apikey is None:
+                return False
+            this.vts[apikey].scan_url(this_url=asset)
             time.sleep(5)
-            engine.scans[scan_id]["findings"][asset]['scan_url'] = get_result_ratelimit(asset, "url")
+            engine.scans[scan_id]["findings"][asset]['scan_url'] = get_result_ratelimit(asset, "url", scan_id)
         except Exception as e:
             LOG.error("API Connexion error (quota?) : {}".format(e))
             return False
@@ -1074,6 +1094,10 @@ def getfindings(scan_id):
 
     # check if the scan_id exists
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -1094,24 +1118,13 @@ def getfindings(scan_id):
         "finished_at": engine.scans[scan_id]['finished_at']
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/virustotal_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({
-        "scan": scan,
-        "summary": summary,
-        "issues": issues,
-        "status": "success"
-    })
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request
@@ -5,13 +5,25 @@ VIRUSTOTAL Tests
 """
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngineTest import PatrowlEngineTest
+from PatrowlEnginesUtils.PatrowlEngineTest import PatrowlEngineTest, start_mocks
 
 BASE_URL = "http://127.0.0.1:5007/engines/virustotal"
 
 # Define the engine instance
 PET = PatrowlEngineTest(engine_name="virustotal", base_url=BASE_URL)
 MAX_TIMEOUT = 600
+MOCK = None
+
+
+def setup_module():
+    """Serve the recorded API responses if $APP_MOCK_PORT is set."""
+    global MOCK
+    MOCK = start_mocks(["virustotal"])
+
+
+def teardown_module():
+    if MOCK is not None:
+        MOCK.stop()
 
 
 def test_generic_features():
@@ -11,19 +11,18 @@ from hashlib import sha256
 from logging import getLogger
 from os.path import dirname, exists, realpath
 from sys import argv, modules
-from threading import Thread
 from time import time
 import json
 import os
 import re
 import subprocess
-import psutil
 from flask import Flask, request, jsonify
 
 # Own library imports
-from PatrowlEnginesUtils.PatrowlEngine import _json_serial
 from PatrowlEnginesUtils.PatrowlEngine import PatrowlEngine
 from PatrowlEnginesUtils.PatrowlEngineExceptions import PatrowlEngineExceptions
+from PatrowlEnginesUtils.PatrowlEngineCancel import CancelToken
+from PatrowlEnginesUtils.PatrowlEngineKeyPool import KeyPool
 from requests import Session
 
 # Debug
@@ -48,8 +47,12 @@ engine = PatrowlEngine(
     version=VERSION
 )
 
+# Seconds before checking again a token which could not be checked
+API_TOKEN_RETRY_AFTER = 60
+API_TOKEN_QUOTA_PERIOD = 86400
+
 this = modules[__name__]
-this.keys = []
+this.keypool = KeyPool([])
 
 
 def get_options(payload):
@@ -81,32 +84,43 @@ def get_criticity(score):
         criticity = "medium"
     return criticity
 
-def get_api_token(api_token_list):
+def _probe_api_token(api_token):
     """
-    Returns the API key with the most credits
+    Set the remaining credits of an API token in the pool, as reported by
+    wpscan.com. A token which cannot be checked is put aside for a while.
     """
-    SESSION = Session()
-    top_api_token = None
-    top_api_token_credits = 0
-    for api_token in api_token_list:
-        if not re.fullmatch("[a-zA-Z0-9]+", api_token):
-            continue
-        try:
-           token_status_req = SESSION.get(
-               "https://wpscan.com/api/v3/status",
-               headers={"Authorization": f"Token token={api_token}"})
-        except:
-            continue
-        if token_status_req.status_code != 200:
-            continue
-        try:
-            requests_remaining = json.loads(token_status_req.text)["requests_remaining"]
-        except:
-            requests_remaining = 0
-        if requests_remaining > top_api_token_credits:
-            top_api_token = api_token
-            top_api_token_credits = requests_remaining
-    return top_api_token
+    try:
+        token_status_req = Session().get(
+            "https://wpscan.com/api/v3/status",
+            headers={"Authorization": f"Token token={api_token}"})
+    except Exception:
+        this.keypool.set_quota(api_token, 0, reset_after=API_TOKEN_RETRY_AFTER)
+        return
+    if token_status_req.status_code != 200:
+        this.keypool.set_quota(api_token, 0, reset_after=API_TOKEN_RETRY_AFTER)
+        return
+    try:
+        token_status = json.loads(token_status_req.text)
+        requests_remaining = int(token_status["requests_remaining"])
+    except Exception:
+        token_status = {}
+        requests_remaining = 0
+    # Credits are renewed daily, at 'requests_reset' (timestamp) if known
+    reset_after = API_TOKEN_QUOTA_PERIOD
+    if isinstance(token_status.get("requests_reset"), (int, float)):
+        reset_after = max(0, token_status["requests_reset"] - time())
+    this.keypool.set_quota(api_token, requests_remaining, reset_after=reset_after)
+
+
+def get_api_token():
+    """
+    Returns the API key with the most credits, None if all of them are
+    exhausted. Only the tokens with unknown credits are checked.
+    """
+    for api_token in this.keypool.keys():
+        if this.keypool.remaining(api_token) is None:
+            _probe_api_token(api_token)
+    return this.keypool.acquire(timeout=0)
 
 
 @app.errorhandler(404)
@@ -177,6 +191,18 @@ def status():
     return engine.getstatus()
 
 
+@app.route("/engines/wpscan/metrics")
+def metrics():
+    """Get the engine metrics (Prometheus text format)."""
+    return engine.getmetrics()
+
+
+@app.route("/engines/wpscan/events")
+def events():
+    """Stream the status transitions and findings of the scans (Server-Sent Events)."""
+    return engine.getevents()
+
+
 @app.route("/engines/wpscan/status/<scan_id>")
 def status_scan(scan_id):
     """Get status on scan identified by id."""
@@ -189,37 +215,7 @@ def status_scan(scan_id):
         res.update({"status": "error", "reason": "todo"})
         return jsonify(res)
 
-    has_running_thread = False
-    for asset in engine.scans[scan_id]["reports"].keys():
-        proc = None
-        # Handle missing proc during first status
-        if "proc" in engine.scans[scan_id]["reports"][asset]:
-            proc = engine.scans[scan_id]["reports"][asset]["proc"]
-
-        if proc and not hasattr(proc, "pid"):
-            res.update({"status": "ERROR", "reason": "No PID found"})
-            engine.scans[scan_id]["status"] = "ERROR"
-            return jsonify(res)
-
-        if not proc or (psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() in ["sleeping", "running"]):
-            has_running_thread = True
-            res.update({
-                "status": "SCANNING",
-                "info": {
-                    asset: {
-                        "pid": proc.pid,
-                        "cmd": engine.scans[scan_id]["reports"][asset]["proc_cmd"]}
-                    }
-            })
-
-        elif psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() == "zombie":
-            psutil.Process(proc.pid).terminate()
-
-    if has_running_thread is False:
-        res.update({"status": "FINISHED"})
-        engine.scans[scan_id]["status"] = "FINISHED"
-
-    return jsonify(res)
+    return engine.getstatus_scan(scan_id)
 
 
 @app.route("/engines/wpscan/stopscans")
@@ -264,6 +260,11 @@ def _loadconfig():
         LOG.error("Error: You have to specify APIToken in options")
         return {"status": "error", "reason": "You have to specify APIToken in options"}
 
+    api_tokens = [t for t in engine.scanner["options"]["APIToken"]["value"] if re.fullmatch("[a-zA-Z0-9]+", t)]
+    if api_tokens != this.keypool.keys():
+        # Credits of the tokens are checked on first use
+        this.keypool = KeyPool(api_tokens, name=APP_ENGINE_NAME)
+
     LOG.info("[OK] APIToken")
 
 
@@ -279,8 +280,9 @@ def reloadconfig():
 def start_scan():
     res = {"page": "startscan"}
 
-    # Check the scanner is ready to start a new scan
-    if len(engine.scans) == APP_MAXSCANS:
+    # Check the scanner is ready to start a new scan (stopped scans excluded)
+    engine.getstatus()
+    if engine.status == "BUSY":
         res.update({
             "status": "error",
             "reason": "Scan refused: max concurrent active scans reached ({})".format(APP_MAXSCANS)
@@ -344,7 +346,9 @@ def start_scan():
         "scan_id":      scan_id,
         "status":       "STARTED",
         "started_at":   int(time() * 1000),
-        "findings":     {}
+        "findings":     {},
+        "cancel_token": CancelToken(),
+        "callback_url": engine.callback_url(data)
     }
 
     options = get_options(data)
@@ -352,10 +356,10 @@ def start_scan():
     engine.scanner["options"]["extra_args"] = options["extra_args"]
 
     engine.scans.update({scan_id: scan})
-    for a in engine.scans[scan_id]["assets"]:
-        thread = Thread(target=_scan_urls, args=(scan_id, a,))
-        thread.start()
-        engine.scans[scan_id]["threads"].append(thread)
+    # SCANNING until all the jobs are queued and done
+    with engine.scheduling(scan_id):
+        for a in data["assets"]:
+            engine.schedule(scan_id, _scan_urls, args=(scan_id, a["value"],), asset=a)
 
     res.update({
         "status": "accepted",
@@ -368,6 +372,8 @@ def start_scan():
 
 
 def _scan_urls(scan_id, asset):
+    if engine.is_cancelled(scan_id):
+        return False
 
     wpscan_cmd = "wpscan"
 
@@ -390,7 +396,7 @@ def _scan_urls(scan_id, asset):
     wpscan_cmd += " --format json"
 
     # Add API Token if credits remaining
-    api_token = get_api_token(engine.scanner["options"]["APIToken"]["value"])
+    api_token = get_api_token()
     LOG.warning(f"Token used is {api_token}")
     if api_token is not None:
         wpscan_cmd += " --api-token '{}'".format(api_token)
@@ -400,9 +406,22 @@ def _scan_urls(scan_id, asset):
     if re.fullmatch("[a-zA-Z0-9\-_\ :/\.]+", extra_args):
         wpscan_cmd += " " + extra_args
 
-    engine.scans[scan_id]["reports"][asset]["proc"] = subprocess.Popen(wpscan_cmd, shell=True, stdout=open("/dev/null", "w"), stderr=open("/dev/null", "w"))
+    # wpscan runs in its own process group, terminated if the scan is stopped
+    cancel_token = engine.scans[scan_id]["cancel_token"]
+    proc = cancel_token.popen(wpscan_cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if proc is None:
+        # Stopped while waiting for a free wpscan slot
+        return False
+    engine.scans[scan_id]["reports"][asset]["proc"] = proc
     engine.scans[scan_id]["reports"][asset]["proc_cmd"] = wpscan_cmd
 
+    # Hold the worker until wpscan exits: the scan concurrency cap applies
+    cancel_token.wait_process(proc)
+
+    if api_token is not None:
+        # Credits used by the scan
+        _probe_api_token(api_token)
+
     return True
 
 
@@ -703,6 +722,10 @@ def _parse_results(scan_id):
 def getfindings(scan_id):
     res = {"page": "getfindings", "scan_id": scan_id}
     if scan_id not in engine.scans.keys():
+        # Next pages of a cleaned scan are served from the findings file
+        page = engine.findings_page(scan_id, res)
+        if page is not None:
+            return page
         res.update({"status": "error", "reason": "scan_id '{}' not found".format(scan_id)})
         return jsonify(res)
 
@@ -716,7 +739,7 @@ def getfindings(scan_id):
     has_error_reason = ""
     for asset in engine.scans[scan_id]["reports"].keys():
         proc = engine.scans[scan_id]["reports"][asset]["proc"]
-        if hasattr(proc, "pid") and psutil.pid_exists(proc.pid) and psutil.Process(proc.pid).status() in ["sleeping", "running"]:
+        if hasattr(proc, "pid") and proc.poll() is None:
             has_error = True
             has_error_reason = "Scan in progress"
             break
@@ -750,19 +773,13 @@ def getfindings(scan_id):
         "scan_id": scan_id
     }
 
-    # Store the findings in a file
-    with open(APP_BASE_DIR+"/results/wpscan_"+scan_id+".json", 'w') as report_file:
-        json.dump({
-            "scan": scan,
-            "summary": summary,
-            "issues": issues
-        }, report_file, default=_json_serial)
+    # Store the findings in a file, one at a time
+    engine.write_findings(scan_id, scan, issues, summary=summary)
 
     # remove the scan from the active scan list
     clean_scan(scan_id)
 
-    res.update({"scan": scan, "summary": summary, "issues": issues, "status": "success"})
-    return jsonify(res)
+    return engine.findings_response(scan_id, res)
 
 
 @app.before_first_request